@@ -0,0 +1,59 @@
+import asyncio
+import json
+from db_helpers.db_aggregates import aggregate_dataset
+from db_helpers.db_constants import AggregationRequest, AggregationResult
+from db_helpers.db_metadata import get_dataset_by_id
+
+'''
+aggregation_agent.py is a module for the agent that takes the aggregations and the queries about a dataset (see notes/implementation_details.md).
+
+The aggregations are computed by db_aggregates.py, which materializes every result, so the questions the agent asks again
+(or asks over fewer dimensions) are answered from the small pre-aggregated tables instead of scanning the dataset.
+The results are given to the next model as compact JSON tables, the user gets them formatted by that model.
+'''
+
+# Number of groups of each result given to the model, the full result stays in the AggregationResult.
+AGGREGATION_PROMPT_ROWS = 50
+
+class AggregationAgent:
+    def __init__(self, dataset_id: str):
+        self.dataset_id = dataset_id
+        # Raises ValueError if the dataset does not exist.
+        self.dataset = get_dataset_by_id(dataset_id)
+        self.results: list[AggregationResult] = []
+
+    def aggregate(self, request: AggregationRequest) -> AggregationResult:
+        '''
+        aggregate is a function that runs one aggregation over the dataset (see db_aggregates.aggregate_dataset).
+        '''
+        return aggregate_dataset(self.dataset, request)
+
+    async def run_aggregations(self, requests: list[AggregationRequest]) -> list[AggregationResult]:
+        '''
+        run_aggregations is a function that runs the aggregations concurrently, each on a thread of its own (with its own DuckDB cursor).
+        Returns:
+            list[AggregationResult] - The results, in the order of requests.
+        Raises:
+            ValueError - If one of the requests is not valid.
+        '''
+        self.results = list(await asyncio.gather(*(asyncio.to_thread(self.aggregate, request) for request in requests)))
+        return self.results
+
+    def format_aggregations(self, max_rows: int = AGGREGATION_PROMPT_ROWS) -> str:
+        '''
+        format_aggregations is a function that formats the results as JSON tables for the next model, rows as lists under their columns.
+        eg) [{"table": "rides", "columns": ["city", "count"], "rows": [["austin", 25], ["boston", 25]], "groups": 2}]
+        '''
+        tables = [
+            {
+                "table": result.table_name,
+                "columns": result.columns,
+                "rows": [[row[column] for column in result.columns] for row in result.rows[:max_rows]],
+                "groups": len(result.rows),
+            }
+            for result in self.results
+        ]
+        # default=str for the dates and timestamps of time dimensions.
+        return json.dumps(tables, default=str)
+
+# python3 -m ai_helpers.aggregation_agent
@@ -1,5 +1,14 @@
-from fastapi import APIRouter
+import asyncio
+import json
+import logging
+import time
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Optional
 from ai_helpers.insight_agent import InsightAgent
+from ai_helpers.insight_cache import InsightCacheStats, invalidate_insights, get_insight_cache_stats
+from ai_helpers.llm_client import insight_ttfb
+from db_helpers.db_constants import SAMPLE_DEFAULT_STRATEGY, SampleStrategy
 
 router = APIRouter(prefix="/ai", tags=["ai"])
 
@@ -10,16 +19,89 @@ def read_root():
     '''
     return {"message": "Welcome to the AI API"}
 
-# get_insight is a synchronous function as the insight is needed before being able to chain next steps.
+# get_insight is async: the LLM call waits on the event loop (llm_client.py), so slow completions do not use up the threadpool.
+# The insight is still returned in the response, as it is needed before being able to chain next steps.
 @router.post("/dataset/{dataset_id}/insight")
-def get_insight(dataset_id: str, table_name: str) -> dict[str, str]:
+async def get_insight(dataset_id: str, table_name: Optional[str] = None, sample_strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0, use_cache: bool = True) -> dict:
     '''
     Get insight is a service that allows for the frontend to get an immediate insight of the data.
     Note: table_name is a query parameter that is used to see what table the user wants to get an insight of.
+    Without table_name the insight covers the whole dataset: every table is sampled (concurrently) and summarized in one LLM call, with the foreign keys between them.
+    sample_strategy and seed pick the sample rows given to the agent (head, reservoir, system, stratified or outlier).
+    The insight is cached per dataset content, table, sampling and prompt, use_cache=false asks the LLM again (and refreshes the cache).
     '''
 
-    insight_agent = InsightAgent(dataset_id)
-    insight_response = insight_agent.run_full_agent(table_name)
+    try:
+        insight_agent = await asyncio.to_thread(InsightAgent, dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        insight_response = await insight_agent.run_full_agent(table_name, sample_strategy, seed, use_cache)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     # Note: When this is returned, python returns it as a dictionary, but over the rest framework it is converted and sent as a JSON object.
-    return {"message": "Insight retrieved successfully", "insight_response": insight_response}
\ No newline at end of file
+    return {"message": "Insight retrieved successfully", "insight_response": insight_response, "cached": insight_agent.cache_hit}
+
+def sse_event(event: str, data: dict) -> str:
+    '''
+    sse_event is a function that formats one Server-Sent Event, the data is JSON so newlines in the text can not break the event.
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/dataset/{dataset_id}/insight/stream")
+async def stream_insight(dataset_id: str, table_name: Optional[str] = None, sample_strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0, use_cache: bool = True) -> StreamingResponse:
+    '''
+    Stream insight is the streaming variant of get_insight, it sends the insight as Server-Sent Events while the model writes it:
+        event: token  data: {"text": "..."}  - the next piece of the insight.
+        event: done   data: {"cached": bool, "ttfb_ms": float}
+        event: error  data: {"detail": "..."} - the stream stopped early.
+    '''
+    started = time.perf_counter()
+    try:
+        insight_agent = await asyncio.to_thread(InsightAgent, dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if table_name is not None and table_name not in insight_agent.dataset.tables:
+        raise HTTPException(status_code=400, detail=f"Table {table_name} not found in the dataset.")
+
+    async def events():
+        ttfb = None
+        try:
+            async for text in insight_agent.stream_full_agent(table_name, sample_strategy, seed, use_cache):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                    insight_ttfb.record(ttfb)
+                yield sse_event("token", {"text": text})
+            yield sse_event("done", {"cached": insight_agent.cache_hit, "ttfb_ms": round(ttfb * 1000, 3) if ttfb is not None else None})
+        except Exception as e:
+            # The response already started (200), so the error can only be sent as an event.
+            logging.exception("Streaming insight of %s failed", dataset_id)
+            yield sse_event("error", {"detail": str(e)})
+
+    # X-Accel-Buffering: no keeps proxies (eg) nginx) from holding the events back.
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/stream_stats")
+def stream_stats() -> dict:
+    '''
+    Stream stats is a service that returns the time to first token of the streamed insights (count, p50, p95, max in ms).
+    '''
+    return {"insight_ttfb": insight_ttfb.summary()}
+
+@router.delete("/dataset/{dataset_id}/insight")
+def invalidate_insight(dataset_id: str, table_name: Optional[str] = None) -> dict:
+    '''
+    Invalidate insight is a service that drops the cached insights of a dataset (or only of table_name), the next request asks the LLM again.
+    '''
+    removed = invalidate_insights(dataset_id, table_name)
+    return {"message": "Insight cache invalidated", "removed": removed}
+
+@router.get("/insight_cache/stats")
+def insight_cache_stats() -> InsightCacheStats:
+    '''
+    Insight cache stats is a service that returns the hit/miss counts (of this server process) and the number of cached insights.
+    '''
+    return get_insight_cache_stats()
\ No newline at end of file
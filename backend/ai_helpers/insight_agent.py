@@ -1,14 +1,85 @@
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator, Optional
 import duckdb
 import os
-from db_helpers.db_services import get_sample_rows
-from db_helpers.db_metadata import get_dataset_by_id
-from openai import OpenAI
+from db_helpers.db_engine import PARQUET_UPLOAD_TYPES, SQLITE_UPLOAD_TYPES
+from db_helpers.db_sampling import sample_rows, sample_tables
+from db_helpers.db_metadata import get_dataset_by_id, get_profile
+from db_helpers.db_services import get_sqlite_foreign_keys
+from db_helpers.db_metrics import Stage
+from db_helpers.db_constants import SAMPLE_DEFAULT_STRATEGY, SampleStrategy, TableProfile
+from ai_helpers.insight_cache import insight_cache_key, get_insight, save_insight
+from ai_helpers.llm_client import get_llm_client
+from ai_helpers.prompt_format import (
+    PROMPT_TOKEN_BUDGET,
+    PROMPT_DATASET_TOKEN_BUDGET,
+    PROMPT_MIN_TABLE_TOKENS,
+    build_prompt_sections,
+    count_tokens,
+    format_relationships
+)
 import logging
 import dotenv
 
 # Currently use 
 dotenv.load_dotenv()
 
+INSIGHT_MODEL = "gpt-4o-mini"
+
+# Number of sample rows given to the agent.
+INSIGHT_SAMPLE_ROWS = 10
+
+# The prompt is part of the insight cache key, editing it regenerates the cached insights.
+INSIGHT_SYSTEM_PROMPT = """
+        System: “You are a data analyst. Given the dataset metadata, schema, and sample rows below, 
+        write a short overview: what the dataset is about, what the main columns mean, 
+        and 2–3 brief insights from the sample.
+
+        ## Dataset metadata:
+        - dataset_id: {dataset_id}
+        - upload_type: {upload_type}
+        - raw_byte_size: {raw_byte_size}
+        - tables: {tables}
+
+        ## Schema:
+        {schema}
+
+        ## Column profile (whole table):
+        {profile}
+
+        ## Sample rows (tab-separated, header first, long values are cut short with …):
+        {sample_rows}
+        """
+
+INSIGHT_USER_PROMPT = "Write a short overview of what the dataset is about, what the main columns mean, and 2–3 brief insights from the sample."
+
+# Number of sample rows per table given to the agent for a dataset insight (every table in one prompt).
+INSIGHT_DATASET_SAMPLE_ROWS = 5
+
+# Dataset insights are cached under this table name (see insight_cache.py).
+DATASET_INSIGHT_TABLE = "*"
+
+INSIGHT_DATASET_SYSTEM_PROMPT = """
+        System: “You are a data analyst. Given the dataset metadata, the relationships between its tables, and the schema, profile
+        and sample rows of every table below, write a short overview of the whole dataset: what it is about, what each table holds,
+        how the tables relate, and 2–3 brief insights across the tables.
+
+        ## Dataset metadata:
+        - dataset_id: {dataset_id}
+        - upload_type: {upload_type}
+        - raw_byte_size: {raw_byte_size}
+        - tables: {tables}
+
+        ## Relationships (foreign keys):
+        {relationships}
+
+        ## Tables (sample rows are tab-separated, header first, long values are cut short with …):
+        {table_sections}
+        """
+
+INSIGHT_DATASET_USER_PROMPT = "Write a short overview of the whole dataset: what it is about, what each table holds, how the tables relate, and 2–3 brief insights."
+
 class InsightAgent:
     def __init__(self, dataset_id: str):
         self.dataset_id = dataset_id
@@ -16,21 +87,22 @@ class InsightAgent:
         self.sample_rows = None
         self.system_prompt = None
         self.formatted_sample_rows = None
+        self.formatted_profile = None
+        self.formatted_schema = None
+        self.user_prompt = INSIGHT_USER_PROMPT
+        self.cache_hit = False
 
         # Retrieve the dataset object to use for the agent. 
         self.retrieve_dataset()
 
-    def run_simple_query(self, query: str):
-        client = OpenAI()
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+    async def run_simple_query(self, query: str):
+        return await get_llm_client().chat(
+            model=INSIGHT_MODEL,
             messages=[
                 {"role": "system", "content": "you are saying hello to someone, make a greeting"},
                 {"role": "user", "content": query}
             ]
         )
-        return response.choices[0].message.content
 
     def retrieve_dataset(self):
         '''
@@ -41,9 +113,10 @@ class InsightAgent:
         self.dataset = dataset
         return dataset
 
-    def retrieve_sample_rows(self, table_name: str):
+    def retrieve_sample_rows(self, table_name: str, strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0):
         '''
         Retrieve the sample rows of the dataset from the database.
+        strategy decides how the rows are picked (see db_sampling.py), the default reservoir sample is spread over the whole table instead of its first rows.
         '''
 
         if table_name is None:
@@ -52,56 +125,33 @@ class InsightAgent:
         if table_name not in self.dataset.tables:
             raise ValueError(f"Table {table_name} not found in the dataset.")
 
-        sample_rows = get_sample_rows(self.dataset, 10, table_name)
-        self.sample_rows = sample_rows
+        rows = sample_rows(self.dataset, table_name, INSIGHT_SAMPLE_ROWS, strategy, seed)
+        self.sample_rows = rows
 
-        return sample_rows
+        return rows
 
-    def value_for_prompt(self, value) -> str:
+    def retrieve_profile(self, table_name: str) -> TableProfile | None:
         '''
-        value_for_prompt is a function that turns each cell into a plain string thats simple to understand and parse.
-        eg) dates often use isoformat like 2026-03-22T00:00:00Z, but we want to turn it into a more readable format like March 22, 2026.
-        Args:
-            value: any - The value to be formatted.
-        Returns:
-            str - The formatted value.  
-        '''
-        if hasattr(value, "isoformat"):
-            try:
-                return value.isoformat()
-            except Exception:
-                return str(value)
-        return str(value)
-
-    def format_sample_rows(self, sample_rows: list[dict]) -> str:
-        '''
-        format rows is a function that formats the sample rows into a string making it easier for Agents to understand and parse information. Works for both the CSV and SQL Files
-        sample_row will be a list of dictionaries. Each dictionary will have the column names as keys and the values as the value for a row of that column.
-        Note: Sample rows is currently in the format of [{column_name: value, column_name: value, ...}, {column_name: value, column_name: value, ...}, ...].
-        text_block_str should be in the following format:
-        Row 1:
-          - column1: value1
-          - column2: value2
-          - column3: value3
-        Row 2:
-          - column1: value1
-          - column2: value2
-          - column3: value3
-        '''
-        if not sample_rows:
-            raise ValueError("No sample rows provided.")
-
-        # text_blocks will contain the sample rows in a LLM friendly format.
-        text_blocks: list[str] = []
-
-        # Iterate through each row of the sample rows and then add the row to the text_block
-        for i, row in enumerate(sample_rows, start=1):
-            block = [f"Row {i}:"]
-            for column, value in row.items():
-                block.append(f"  - {column}: {self.value_for_prompt(value)}")
-            text_blocks.append("\n".join(block))
-        
-        return "\n\n".join(text_blocks)
+        Retrieve the column profile of the table, computed at ingest (None for datasets that were never profiled).
+        '''
+        profile = get_profile(self.dataset_id)
+        if profile is None:
+            return None
+        return profile.tables.get(table_name)
+
+    def format_table_sections(self, table_name: str, rows: list[dict], table_profile: TableProfile | None):
+        '''
+        format_table_sections is a function that formats the schema, column profile and sample rows of the table for the prompt,
+        compact enough for the whole system prompt to fit PROMPT_TOKEN_BUDGET (see prompt_format.py).
+        '''
+        # The tokens of the prompt without the sections, what is left of the budget is for the sections.
+        overhead = count_tokens(INSIGHT_SYSTEM_PROMPT.format(dataset_id=self.dataset.dataset_id, upload_type=self.dataset.upload_type,
+                                                             raw_byte_size=self.dataset.raw_byte_size, tables=", ".join(self.dataset.tables),
+                                                             schema="", profile="", sample_rows=""))
+        sections = build_prompt_sections(self.dataset, table_name, rows, table_profile, PROMPT_TOKEN_BUDGET - overhead)
+        self.formatted_schema = sections["schema"]
+        self.formatted_profile = sections["profile"]
+        self.formatted_sample_rows = sections["sample_rows"]
 
     def build_system_prompt(self) -> None:
         '''
@@ -111,58 +161,190 @@ class InsightAgent:
         Returns:
             str - The system prompt for the agent.
         '''
-        system_prompt = f"""
-        System: “You are a data analyst. Given the dataset metadata, schema, and sample rows below, 
-        write a short overview: what the dataset is about, what the main columns mean, 
-        and 2–3 brief insights from the sample.
-
-        ## Dataset metadata:
-        - dataset_id: {self.dataset.dataset_id}
-        - upload_type: {self.dataset.upload_type}
-        - raw_byte_size: {self.dataset.raw_byte_size}
-        - tables: {", ".join(self.dataset.tables)}
-
-        ## Schema:
-        {self.dataset.schema}
-
-        ## Sample rows:
-        {self.formatted_sample_rows}
-        """
+        system_prompt = INSIGHT_SYSTEM_PROMPT.format(
+            dataset_id=self.dataset.dataset_id,
+            upload_type=self.dataset.upload_type,
+            raw_byte_size=self.dataset.raw_byte_size,
+            tables=", ".join(self.dataset.tables),
+            schema=self.formatted_schema,
+            profile=self.formatted_profile,
+            sample_rows=self.formatted_sample_rows,
+        )
 
         self.system_prompt = system_prompt
 
-    def run_agent(self) -> str:
-
-        client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+    async def run_agent(self) -> str:
+        '''
+        run_agent is a function that sends the built system prompt to the LLM through the shared client (see llm_client.py).
+        '''
+        return await get_llm_client().chat(
+            model=INSIGHT_MODEL,
             messages=[
                 {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": "Write a short overview of what the dataset is about, what the main columns mean, and 2–3 brief insights from the sample."}
+                {"role": "user", "content": self.user_prompt}
             ]
         )
-        return response.choices[0].message.content
-
-    def run_full_agent(self, table_name: str) -> str:
 
-        if self.dataset.upload_type == "csv":
-            sample_rows = self.retrieve_sample_rows(table_name)
-            self.formatted_sample_rows = self.format_sample_rows(sample_rows)
+    def prepare_prompt(self, table_name: str, sample_strategy: SampleStrategy, seed: int) -> bool:
+        '''
+        prepare_prompt is a function that samples the table, formats the rows and profile and builds the system prompt.
+        Returns:
+            bool - False if the upload type is not supported.
+        '''
+        if self.dataset.upload_type in PARQUET_UPLOAD_TYPES:
+            rows = self.retrieve_sample_rows(table_name, sample_strategy, seed)
+            self.format_table_sections(table_name, rows, self.retrieve_profile(table_name))
             self.build_system_prompt()
-            return self.run_agent()
+            return True
 
         # Format sample rows works for both types, currently differentiating in case of errors. 
-        elif self.dataset.upload_type == "db":
-            sample_rows = self.retrieve_sample_rows(table_name)
-            self.formatted_sample_rows = self.format_sample_rows(sample_rows)
+        elif self.dataset.upload_type in SQLITE_UPLOAD_TYPES:
+            rows = self.retrieve_sample_rows(table_name, sample_strategy, seed)
+            self.format_table_sections(table_name, rows, self.retrieve_profile(table_name))
             self.build_system_prompt()
-            return self.run_agent()
+            return True
+
+        return False
+
+    def prepare_dataset_prompt(self, sample_strategy: SampleStrategy, seed: int) -> bool:
+        '''
+        prepare_dataset_prompt is a function that builds one system prompt for every table of the dataset: the tables are sampled
+        concurrently over one attachment (see db_sampling.sample_tables), the foreign keys give the relationships,
+        and the token budget is split evenly over the tables.
+        At most one table per PROMPT_MIN_TABLE_TOKENS of the budget gets its section (the largest ones by the profile row_count),
+        the others are only named, and only the tables with a section are sampled.
+        Returns:
+            bool - False if the upload type is not supported.
+        '''
+        if self.dataset.upload_type not in PARQUET_UPLOAD_TYPES + SQLITE_UPLOAD_TYPES:
+            return False
+
+        profile = get_profile(self.dataset_id)
+        foreign_keys = get_sqlite_foreign_keys(Path(self.dataset.dataset_path)) if self.dataset.upload_type in SQLITE_UPLOAD_TYPES else []
+
+        prompt_fields = {
+            "dataset_id": self.dataset.dataset_id,
+            "upload_type": self.dataset.upload_type,
+            "raw_byte_size": self.dataset.raw_byte_size,
+            "tables": ", ".join(self.dataset.tables),
+            "relationships": format_relationships(foreign_keys),
+        }
+        overhead = count_tokens(INSIGHT_DATASET_SYSTEM_PROMPT.format(table_sections="", **prompt_fields))
+
+        shown, omitted_note = self.dataset.tables, ""
+        max_tables = max(1, (PROMPT_DATASET_TOKEN_BUDGET - overhead) // PROMPT_MIN_TABLE_TOKENS)
+        if len(self.dataset.tables) > max_tables:
+            row_counts = {name: table.row_count for name, table in profile.tables.items()} if profile else {}
+            largest = set(sorted(self.dataset.tables, key=lambda name: row_counts.get(name, 0), reverse=True)[:max_tables])
+            # Keep the dataset's order of the tables.
+            shown = [name for name in self.dataset.tables if name in largest]
+            omitted = [name for name in self.dataset.tables if name not in largest]
+            omitted_note = f"\n\nNot shown (too many tables for the prompt): {', '.join(omitted)}"
+            overhead += count_tokens(omitted_note)
+        table_budget = max(PROMPT_MIN_TABLE_TOKENS, (PROMPT_DATASET_TOKEN_BUDGET - overhead) // len(shown))
+
+        rows_by_table = sample_tables(self.dataset, shown, INSIGHT_DATASET_SAMPLE_ROWS, sample_strategy, seed)
+        blocks: list[str] = []
+        for table_name, rows in rows_by_table.items():
+            table_profile = profile.tables.get(table_name) if profile else None
+            sections = build_prompt_sections(self.dataset, table_name, rows, table_profile, table_budget, other_tables=False)
+            blocks.append(f"### {table_name}\n{sections['schema']}\nProfile:\n{sections['profile']}\nSample rows:\n{sections['sample_rows']}")
+
+        self.system_prompt = INSIGHT_DATASET_SYSTEM_PROMPT.format(table_sections="\n\n".join(blocks) + omitted_note, **prompt_fields)
+        self.user_prompt = INSIGHT_DATASET_USER_PROMPT
+        return True
+
+    def prepare(self, table_name: Optional[str], sample_strategy: SampleStrategy, seed: int) -> bool:
+        '''
+        prepare is a function that builds the prompt of one table, or of the whole dataset when table_name is None.
+        '''
+        with Stage("insight_prompt"):
+            if table_name is None:
+                return self.prepare_dataset_prompt(sample_strategy, seed)
+            return self.prepare_prompt(table_name, sample_strategy, seed)
+
+    def cache_key(self, table_name: Optional[str], sample_strategy: SampleStrategy, seed: int) -> str:
+        '''
+        cache_key is a function that returns the insight cache key of one table, or of the whole dataset when table_name is None.
+        '''
+        if table_name is None:
+            return insight_cache_key(self.dataset, DATASET_INSIGHT_TABLE, sample_strategy, seed, INSIGHT_DATASET_SAMPLE_ROWS,
+                                     INSIGHT_DATASET_SYSTEM_PROMPT + INSIGHT_DATASET_USER_PROMPT, INSIGHT_MODEL)
+        return insight_cache_key(self.dataset, table_name, sample_strategy, seed, INSIGHT_SAMPLE_ROWS,
+                                 INSIGHT_SYSTEM_PROMPT + INSIGHT_USER_PROMPT, INSIGHT_MODEL)
+
+    async def run_full_agent(self, table_name: Optional[str], sample_strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0, use_cache: bool = True) -> str:
+        '''
+        run_full_agent is a function that samples the table, builds the prompt and asks the LLM for the insight.
+        With table_name None the insight covers every table of the dataset, in one LLM call (see prepare_dataset_prompt).
+        With use_cache the response is looked up first (see insight_cache.py), self.cache_hit tells if it was.
+
+        The metadata, cache and DuckDB work is blocking, so it runs in a worker thread, only the LLM call waits on the event loop.
+        '''
+        if table_name is not None and table_name not in self.dataset.tables:
+            raise ValueError(f"Table {table_name} not found in the dataset.")
+
+        cache_key = await asyncio.to_thread(self.cache_key, table_name, sample_strategy, seed)
+        if use_cache:
+            cached = await asyncio.to_thread(get_insight, cache_key)
+            if cached is not None:
+                self.cache_hit = True
+                return cached
+
+        if not await asyncio.to_thread(self.prepare, table_name, sample_strategy, seed):
+            return None
+
+        response = await self.run_agent()
+        await asyncio.to_thread(save_insight, cache_key, self.dataset_id, table_name or DATASET_INSIGHT_TABLE, response)
+        return response
+
+    async def stream_full_agent(self, table_name: Optional[str], sample_strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0, use_cache: bool = True) -> AsyncIterator[str]:
+        '''
+        stream_full_agent is the streaming run_full_agent: it yields the insight text as the LLM produces it.
+        A cached insight is yielded in one piece. The streamed text is cached once the stream completed
+        (a stream the client stopped reading, or that produced no text, is not cached).
+        '''
+        if table_name is not None and table_name not in self.dataset.tables:
+            raise ValueError(f"Table {table_name} not found in the dataset.")
+
+        client = get_llm_client()
+        cache_key = await asyncio.to_thread(self.cache_key, table_name, sample_strategy, seed)
+        if use_cache:
+            cached = await asyncio.to_thread(get_insight, cache_key)
+            if cached is not None:
+                self.cache_hit = True
+                yield cached
+                return
+
+        # Sampling and prompt building run in a thread while the LLM connection is being opened.
+        prepared, _ = await asyncio.gather(
+            asyncio.to_thread(self.prepare, table_name, sample_strategy, seed),
+            client.warm_up()
+        )
+        if not prepared:
+            return
+
+        parts: list[str] = []
+        async for text in client.chat_stream(
+            model=INSIGHT_MODEL,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": self.user_prompt}
+            ]
+        ):
+            parts.append(text)
+            yield text
+
+        # A stream that produced no text is not an insight, the next request asks the LLM again.
+        response = "".join(parts)
+        if response.strip():
+            await asyncio.to_thread(save_insight, cache_key, self.dataset_id, table_name or DATASET_INSIGHT_TABLE, response)
 
 if __name__ == "__main__":
 
     # response1 = InsightAgent("d2808899-d2ab-405c-82e0-3e34c5517913").run_full_agent("d2808899-d2ab-405c-82e0-3e34c5517913", "ins_feat")
     # print(response1)
-    response2 = InsightAgent("56af60ba-ba76-4321-bf83-66454d972ff9").run_full_agent("56af60ba-ba76-4321-bf83-66454d972ff9", "customers")
+    response2 = asyncio.run(InsightAgent("56af60ba-ba76-4321-bf83-66454d972ff9").run_full_agent("customers"))
     print(response2)
 
     
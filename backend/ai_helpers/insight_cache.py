@@ -0,0 +1,81 @@
+import hashlib
+import json
+import threading
+from pydantic import BaseModel
+from db_helpers.db_constants import INSIGHT_CACHE_TTL_SECONDS, INSIGHT_CACHE_MAX_ENTRIES, Dataset
+from db_helpers.db_metadata import get_cached_insight, save_cached_insight, delete_cached_insights, count_cached_insights
+from db_helpers.db_services import file_fingerprint
+
+'''
+insight_cache.py is a module that caches the InsightAgent responses in the metadata database,
+so viewing the same dataset again returns the stored insight instead of sampling and calling the LLM.
+
+The key is a hash of everything the response depends on: the version of the dataset file (its size and mtime), the table,
+the sampling parameters, the prompt template and the model. A changed file or prompt gives a new key,
+so stale entries are never served, they just age out (TTL) or get evicted (LRU).
+'''
+
+class InsightCacheStats(BaseModel):
+    '''
+    InsightCacheStats is the hit/miss counts of this process and the number of cached insights.
+    '''
+    hits: int
+    misses: int
+    hit_rate: float
+    entries: int
+
+class InsightCacheCounters:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+_counters = InsightCacheCounters()
+
+def insight_cache_key(dataset: Dataset, table_name: str, sample_strategy: str, seed: int, num_rows: int, prompt_template: str, model: str) -> str:
+    '''
+    insight_cache_key is a function that builds the cache key of an insight.
+    '''
+    parts = {
+        "dataset_id": dataset.dataset_id,
+        "dataset_fingerprint": file_fingerprint(dataset.dataset_path),
+        "table_name": table_name,
+        "sample_strategy": sample_strategy,
+        "seed": seed,
+        "num_rows": num_rows,
+        "prompt_sha256": hashlib.sha256(prompt_template.encode()).hexdigest(),
+        "model": model,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def get_insight(cache_key: str) -> str | None:
+    '''
+    get_insight is a function that returns the cached insight for the key (None on a miss), and counts the hit or miss.
+    '''
+    response = get_cached_insight(cache_key, INSIGHT_CACHE_TTL_SECONDS)
+    _counters.record(response is not None)
+    return response
+
+def save_insight(cache_key: str, dataset_id: str, table_name: str, response: str):
+    save_cached_insight(cache_key, dataset_id, table_name, response, INSIGHT_CACHE_TTL_SECONDS, INSIGHT_CACHE_MAX_ENTRIES)
+
+def invalidate_insights(dataset_id: str, table_name: str | None = None) -> int:
+    '''
+    invalidate_insights is a function that drops the cached insights of a dataset (or one table), returns how many were dropped.
+    '''
+    return delete_cached_insights(dataset_id, table_name)
+
+def get_insight_cache_stats() -> InsightCacheStats:
+    with _counters.lock:
+        hits, misses = _counters.hits, _counters.misses
+    total = hits + misses
+    return InsightCacheStats(hits=hits, misses=misses, hit_rate=hits / total if total else 0.0, entries=count_cached_insights())
+
+# python3 -m ai_helpers.insight_cache
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+import httpx
+import openai
+from openai import AsyncOpenAI
+from db_helpers.db_metrics import Stage, record_llm_tokens
+
+'''
+llm_client.py is a module that holds the one async LLM client shared by the whole AI layer.
+
+- One AsyncOpenAI client (and its httpx connection pool) for the process, instead of a new client and TLS handshake per call.
+- A semaphore caps the number of completions in flight, a token bucket caps how many start per second.
+- 429s, 5xx and connection errors are retried with exponential backoff and full jitter (Retry-After is honoured when sent).
+  A streamed completion is only retried until its first token, after that the text is already with the caller.
+- Every completion is timed (the llm / llm_stream stages of db_metrics.py) and its token usage counted.
+
+Everything is async, so a slow completion waits on the event loop instead of holding a threadpool thread.
+'''
+
+# Completions running at once, and completions started per second (burst up to LLM_BURST).
+LLM_MAX_CONCURRENCY = int(os.getenv("DATASPACE_LLM_MAX_CONCURRENCY", "8"))
+LLM_REQUESTS_PER_SECOND = float(os.getenv("DATASPACE_LLM_REQUESTS_PER_SECOND", "5"))
+LLM_BURST = int(os.getenv("DATASPACE_LLM_BURST", "10"))
+
+# Retries after the first attempt, and the backoff bounds in seconds (the delay is random in [0, min(max, base * 2^attempt)]).
+LLM_MAX_RETRIES = int(os.getenv("DATASPACE_LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 20.0
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("DATASPACE_LLM_TIMEOUT_SECONDS", "60"))
+LLM_MAX_CONNECTIONS = 20
+# Idle pooled connections are closed after this long, past it the next request (probably) opens a new one.
+LLM_KEEPALIVE_SECONDS = 30.0
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+# Reading a stream can also fail with a bare httpx error (eg) the connection dropped), the SDK only wraps the errors of the request.
+STREAM_RETRYABLE_ERRORS = RETRYABLE_ERRORS + (httpx.TransportError,)
+
+class TokenBucket:
+    '''
+    TokenBucket is a class that limits how often something can start: rate tokens are added per second, up to capacity.
+    '''
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        '''
+        acquire is a function that waits until a token is available and takes it.
+        '''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def backoff_seconds(attempt: int, error: Exception, base: float = LLM_BACKOFF_BASE_SECONDS, cap: float = LLM_BACKOFF_MAX_SECONDS) -> float:
+    '''
+    backoff_seconds is a function that returns how long to wait before retry number attempt (0 based).
+    A Retry-After header from the server wins, otherwise it is "full jitter" exponential backoff.
+    '''
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class LLMClient:
+    '''
+    LLMClient is a class that sends chat completions through one pooled AsyncOpenAI client, with concurrency, rate limits and retries.
+
+    Args:
+        client: AsyncOpenAI - The client to use, defaults to one reading OPENAI_API_KEY / OPENAI_BASE_URL (tests pass one pointing at a stub).
+    '''
+    def __init__(self, client: Optional[AsyncOpenAI] = None, max_concurrency: int = LLM_MAX_CONCURRENCY, requests_per_second: float = LLM_REQUESTS_PER_SECOND,
+                 burst: int = LLM_BURST, max_retries: int = LLM_MAX_RETRIES, backoff_base: float = LLM_BACKOFF_BASE_SECONDS):
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS, keepalive_expiry=LLM_KEEPALIVE_SECONDS),
+                timeout=LLM_TIMEOUT_SECONDS
+            )
+            # The SDK's own retries are off, they would retry outside of the semaphore and rate limit.
+            client = AsyncOpenAI(http_client=http_client, max_retries=0)
+
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        # monotonic time of the last request, -inf: no connection is open yet.
+        self.last_used = float("-inf")
+
+    async def backoff(self, attempt: int, error: Exception):
+        '''
+        backoff is a function that waits before retry number attempt, or raises the error if the retries ran out.
+        Called outside the semaphore, so a backing-off request does not hold a slot.
+        '''
+        if attempt >= self.max_retries:
+            raise error
+        delay = backoff_seconds(attempt, error, base=self.backoff_base)
+        logging.warning("LLM request failed (%s), retry %d/%d in %.2fs", type(error).__name__, attempt + 1, self.max_retries, delay)
+        await asyncio.sleep(delay)
+
+    async def chat(self, messages: list[dict], model: str, **kwargs) -> str:
+        '''
+        chat is a function that sends a chat completion and returns the text of the first choice.
+
+        Raises:
+            openai.APIError - If the request failed and was not retryable, or every retry failed too.
+        '''
+        attempt = 0
+        while True:
+            try:
+                await self.bucket.acquire()
+                async with self.semaphore:
+                    with Stage("llm"):
+                        response = await self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+                    self.last_used = time.monotonic()
+                if response.usage is not None:
+                    record_llm_tokens(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+                return response.choices[0].message.content
+
+            except RETRYABLE_ERRORS as e:
+                await self.backoff(attempt, e)
+                attempt += 1
+
+    async def chat_stream(self, messages: list[dict], model: str, **kwargs) -> AsyncIterator[str]:
+        '''
+        chat_stream is a function that sends a streamed chat completion and yields the text as the model produces it.
+        The concurrency slot is held until the stream ends (or the caller stops reading it).
+
+        The request, and the reading of the stream until the first token, are retried like chat. An error after the first token
+        is raised: the text before it is already with the caller.
+
+        Raises:
+            openai.APIError - Same as chat, or the error that stopped the stream after its first token.
+        '''
+        # The last chunk then carries the token usage of the completion (with no choices).
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            async with self.semaphore:
+                with Stage("llm_stream"):
+                    started = False
+                    try:
+                        stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+                        async with stream:
+                            async for chunk in stream:
+                                if chunk.usage is not None:
+                                    record_llm_tokens(model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    started = True
+                                    yield chunk.choices[0].delta.content
+                    except STREAM_RETRYABLE_ERRORS as e:
+                        if started:
+                            raise
+                        error = e
+                    else:
+                        self.last_used = time.monotonic()
+                        return
+
+            await self.backoff(attempt, error)
+            attempt += 1
+
+    async def warm_up(self):
+        '''
+        warm_up is a function that opens a pooled connection ahead of a request (eg) while the prompt is being built),
+        so the TCP/TLS setup overlaps with that work. Only done when the pooled connections have probably expired.
+        '''
+        if time.monotonic() - self.last_used < LLM_KEEPALIVE_SECONDS:
+            return
+        self.last_used = time.monotonic()
+        try:
+            # Listing the models is free (no tokens), and leaves an open connection in the pool.
+            await self.client.models.list()
+        except openai.APIError as e:
+            logging.debug("LLM warm up failed: %s", e)
+
+    async def close(self):
+        await self.client.close()
+
+class LatencyRecorder:
+    '''
+    LatencyRecorder is a class that keeps the last window latencies of something (eg) time to first byte) for the stats routes.
+    '''
+    def __init__(self, window: int = 1000):
+        self.samples: deque[float] = deque(maxlen=window)
+        self.count = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self) -> dict[str, float]:
+        '''
+        summary is a function that returns the count (since start) and the p50/p95/max (of the window) in milliseconds.
+        '''
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"count": self.count}
+
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+        return {"count": self.count, "p50_ms": percentile(0.5), "p95_ms": percentile(0.95), "max_ms": round(ordered[-1] * 1000, 3)}
+
+# Time from a streamed insight request to its first token, see ai_routes.stream_insight.
+insight_ttfb = LatencyRecorder()
+
+# Created on first use, inside the event loop of the server.
+_llm_client: Optional[LLMClient] = None
+
+def get_llm_client() -> LLMClient:
+    '''
+    get_llm_client is a function that returns the process-wide LLMClient.
+    '''
+    global _llm_client
+    if _llm_client is None:
+        _llm_client = LLMClient()
+    return _llm_client
+
+async def close_llm_client():
+    '''
+    close_llm_client is a function that closes the pooled connections of the LLMClient (server shutdown).
+    '''
+    global _llm_client
+    if _llm_client is not None:
+        await _llm_client.close()
+        _llm_client = None
+
+# python3 -m ai_helpers.llm_client
@@ -0,0 +1,210 @@
+import logging
+import math
+import os
+from typing import Any, Optional
+from db_helpers.db_constants import Dataset, ColumnProfile, ForeignKey, TableProfile
+from db_helpers.db_profile import is_numeric_type
+
+'''
+prompt_format.py is a module that turns the schema, profile and sample rows of a table into compact prompt text
+that fits a token budget, so wide tables (hundreds of columns, long text cells) do not blow past the context limit.
+
+- Sample rows are tab-separated (one header line, one line per row) instead of one "- column: value" line per cell.
+- Long values are cut to max_cell_chars.
+- Columns are ranked with the ingest profile (empty and constant columns last), the lowest ranked are left out first.
+- The schema is summarized as "name TYPE" for the columns that are shown.
+
+Sizes are measured with tiktoken when it is installed (and its encoding can be loaded), otherwise estimated at 4 characters per token.
+'''
+
+# Token budget of the whole insight system prompt.
+PROMPT_TOKEN_BUDGET = int(os.getenv("DATASPACE_PROMPT_TOKEN_BUDGET", "3000"))
+
+# Token budget of the dataset insight prompt (every table at once), split evenly over the tables but never under PROMPT_MIN_TABLE_TOKENS each:
+# the tables past budget // PROMPT_MIN_TABLE_TOKENS are only named.
+PROMPT_DATASET_TOKEN_BUDGET = int(os.getenv("DATASPACE_PROMPT_DATASET_TOKEN_BUDGET", "12000"))
+PROMPT_MIN_TABLE_TOKENS = 200
+
+# Longest cell value before it is cut, and the floors the budget fitting will not go under.
+PROMPT_MAX_CELL_CHARS = 80
+PROMPT_MIN_CELL_CHARS = 16
+PROMPT_MIN_COLUMNS = 8
+PROMPT_MIN_ROWS = 3
+
+PROMPT_ENCODING = "o200k_base" # gpt-4o / gpt-4o-mini
+
+_encoding = None
+_encoding_loaded = False
+
+def get_encoding():
+    '''
+    get_encoding is a function that loads the tiktoken encoding once, None if tiktoken is not installed or the encoding can not be loaded
+    (tiktoken downloads it on first use).
+    '''
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(PROMPT_ENCODING)
+        except Exception as e:
+            logging.info("tiktoken not available (%s), estimating 4 characters per token", e)
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    '''
+    count_tokens is a function that returns the number of tokens of the text (an estimate without tiktoken).
+    '''
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text))
+
+def value_for_prompt(value: Any, max_chars: int = PROMPT_MAX_CELL_CHARS) -> str:
+    '''
+    value_for_prompt is a function that turns a cell into a single-line string of at most max_chars characters.
+    Tabs and newlines are escaped so they can not break the tab-separated layout.
+    '''
+    if value is None:
+        text = ""
+    elif hasattr(value, "isoformat"):
+        try:
+            text = value.isoformat()
+        except Exception:
+            text = str(value)
+    else:
+        text = str(value)
+
+    text = text.replace("\t", "\\t").replace("\r", "").replace("\n", "\\n")
+    if len(text) > max_chars:
+        text = text[:max_chars - 1] + "…"
+    return text
+
+def column_score(column: ColumnProfile, row_count: int) -> float:
+    '''
+    column_score is a function that rates how much a column tells about the table: the filled fraction,
+    0 for empty or constant columns, halved for text that is unique on every row (ids, free text).
+    '''
+    if row_count == 0:
+        return 0.0
+    filled = 1 - column.null_count / row_count
+    if filled == 0 or (column.approx_distinct is not None and column.approx_distinct <= 1):
+        return 0.0
+    if not is_numeric_type(column.column_type) and column.approx_distinct is not None and column.approx_distinct >= 0.95 * row_count:
+        return filled / 2
+    return filled
+
+def rank_columns(columns: list[str], table_profile: Optional[TableProfile]) -> list[str]:
+    '''
+    rank_columns is a function that orders the columns from most to least informative, ties keep the table order.
+    Without a profile the table order is kept.
+    '''
+    if table_profile is None or table_profile.error:
+        return list(columns)
+
+    scores = {column.column_name: column_score(column, table_profile.row_count) for column in table_profile.columns}
+    return sorted(columns, key=lambda column: -scores.get(column, 0.5))
+
+def profile_line(column: ColumnProfile) -> str:
+    '''
+    profile_line is a function that formats the profile of one column on one line.
+    eg) fare DOUBLE: 0 nulls, ~812 distinct, min 2.5, max 96.0, mean 14.2, stddev 9.8, top: 5.0, 7.5
+    '''
+    stats = [f"{column.null_count} nulls"]
+    if column.approx_distinct is not None:
+        stats.append(f"~{column.approx_distinct} distinct")
+    for name in ("min", "max", "mean", "stddev"):
+        value = getattr(column, name)
+        if value is not None:
+            stats.append(f"{name} {round(value, 4) if isinstance(value, float) else value_for_prompt(value, 24)}")
+    if column.top_values:
+        stats.append("top: " + ", ".join(value_for_prompt(value, 24) for value in column.top_values[:3]))
+    return f"{column.column_name} {column.column_type}: " + ", ".join(stats)
+
+def format_rows_tsv(rows: list[dict[str, Any]], columns: list[str], max_cell_chars: int = PROMPT_MAX_CELL_CHARS) -> str:
+    '''
+    format_rows_tsv is a function that formats rows as tab-separated text, the first line is the header.
+    '''
+    lines = ["\t".join(columns)]
+    for row in rows:
+        lines.append("\t".join(value_for_prompt(row.get(column), max_cell_chars) for column in columns))
+    return "\n".join(lines)
+
+def summarize_schema(dataset: Dataset, table_name: str, columns: list[str], total_columns: int, other_tables: bool = True) -> str:
+    '''
+    summarize_schema is a function that lists "name TYPE" for the shown columns of the table, and (with other_tables) only the column count of the other tables.
+    '''
+    types = dataset.schema.get(table_name, {})
+    # CSV datasets store the schema under the parquet file name, which is also their only table name.
+    lines = [f"{table_name} ({total_columns} columns): " + ", ".join(f"{column} {types.get(column, '')}".strip() for column in columns)]
+    if total_columns > len(columns):
+        lines[0] += f", ... (+{total_columns - len(columns)} more columns not shown)"
+
+    others = [] if not other_tables else [f"{name} ({len(dataset.schema.get(name, {}))} columns)" for name in dataset.tables if name != table_name]
+    if others:
+        lines.append("Other tables: " + ", ".join(others))
+    return "\n".join(lines)
+
+def render_sections(dataset: Dataset, table_name: str, rows: list[dict[str, Any]], table_profile: Optional[TableProfile],
+                    ranked: list[str], num_columns: int, max_cell_chars: int, num_rows: int, other_tables: bool = True) -> dict[str, str]:
+    '''
+    render_sections is a function that formats the sections with the num_columns highest ranked columns, cells cut at max_cell_chars and num_rows rows.
+    '''
+    # The shown columns keep their table order, it reads more naturally than the ranking.
+    kept = set(ranked[:num_columns])
+    shown = [column for column in (rows[0].keys() if rows else ranked) if column in kept]
+
+    profiles = {column.column_name: column for column in table_profile.columns} if table_profile and not table_profile.error else {}
+    profile_lines = [f"Rows: {table_profile.row_count}"] if profiles else []
+    profile_lines += [profile_line(profiles[column]) for column in shown if column in profiles]
+
+    return {
+        "schema": summarize_schema(dataset, table_name, shown, len(ranked), other_tables),
+        "profile": "\n".join(profile_lines) if profile_lines else "Not available.",
+        "sample_rows": format_rows_tsv(rows[:num_rows], shown, max_cell_chars) if rows else "No rows.",
+    }
+
+def build_prompt_sections(dataset: Dataset, table_name: str, rows: list[dict[str, Any]], table_profile: Optional[TableProfile],
+                          budget_tokens: int, other_tables: bool = True) -> dict[str, str]:
+    '''
+    build_prompt_sections is a function that formats the schema, profile and sample rows of a table within budget_tokens.
+
+    The sections start with every column, full rows and PROMPT_MAX_CELL_CHARS, and shrink until they fit:
+    first the least informative columns are left out (down to PROMPT_MIN_COLUMNS), then cells are cut shorter,
+    then fewer rows are shown. If the floors are reached the sections are returned as they are.
+    other_tables=False leaves the list of the other tables out of the schema (when every table is in the prompt anyway).
+
+    Returns:
+        dict[str, str] - {"schema": ..., "profile": ..., "sample_rows": ...}
+    '''
+    all_columns = list(rows[0].keys()) if rows else list(dataset.schema.get(table_name, {}).keys())
+    ranked = rank_columns(all_columns, table_profile)
+
+    num_columns = len(ranked)
+    max_cell_chars = PROMPT_MAX_CELL_CHARS
+    num_rows = len(rows)
+
+    while True:
+        sections = render_sections(dataset, table_name, rows, table_profile, ranked, num_columns, max_cell_chars, num_rows, other_tables)
+        if count_tokens("\n".join(sections.values())) <= budget_tokens:
+            return sections
+
+        if num_columns > PROMPT_MIN_COLUMNS:
+            num_columns = max(PROMPT_MIN_COLUMNS, int(num_columns * 0.75))
+        elif max_cell_chars > PROMPT_MIN_CELL_CHARS:
+            max_cell_chars = max(PROMPT_MIN_CELL_CHARS, max_cell_chars // 2)
+        elif num_rows > PROMPT_MIN_ROWS:
+            num_rows -= 1
+        else:
+            return sections
+
+def format_relationships(foreign_keys: list[ForeignKey]) -> str:
+    '''
+    format_relationships is a function that lists the foreign keys of a dataset, one per line.
+    eg) orders.customer_id -> customers.id
+    '''
+    if not foreign_keys:
+        return "None declared."
+    return "\n".join(f"{key.table_name}.{key.column_name} -> {key.ref_table}.{key.ref_column or '(primary key)'}" for key in foreign_keys)
+
+# python3 -m ai_helpers.prompt_format
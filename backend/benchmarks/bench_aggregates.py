@@ -0,0 +1,92 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.bench_utils import write_synthetic_csv
+from db_helpers import db_metadata as meta
+from db_helpers import db_routes
+from db_helpers import db_aggregates
+
+'''
+bench_aggregates.py ingests a synthetic CSV, then times the same group-by question through /db/datasets/{id}/aggregate
+on a miss (a scan of the table, then materialized), a hit (the materialized result) and a rollup (a coarser question answered
+from the materialized result), against running the same GROUP BY over the table every time.
+'''
+
+def run(rows: int, columns: int, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        db_routes.DATA_ROOT = meta.DATA_ROOT = Path(tmp) / "datasets"
+        db_aggregates.AGGREGATES_ROOT = Path(tmp) / "aggregates"
+        csv_path = write_synthetic_csv(Path(tmp) / "synthetic.csv", rows, columns)
+
+        # col_2 and col_5 are categories (about 50 values each), col_1 and col_4 floats.
+        fine = {"dimensions": ["col_2", "col_5"], "aggregates": [{"function": "count"}, {"function": "sum", "column": "col_1"},
+                                                                  {"function": "max", "column": "col_4"}]}
+        coarse = {"dimensions": ["col_2"], "aggregates": [{"function": "count"}, {"function": "sum", "column": "col_1"}]}
+
+        api = FastAPI()
+        api.include_router(db_routes.router)
+        try:
+            with TestClient(api) as client:
+                with open(csv_path, "rb") as f:
+                    dataset = client.post("/db/upload_db", params={"background": False}, files={"file": (csv_path.name, f)}).json()
+
+                def aggregate(body: dict) -> tuple[dict, float]:
+                    started = time.perf_counter()
+                    response = client.post(f"/db/datasets/{dataset['dataset_id']}/aggregate", json=body)
+                    response.raise_for_status()
+                    return response.json(), time.perf_counter() - started
+
+                def best(body: dict, expected: str) -> float:
+                    times = []
+                    for _ in range(repeat):
+                        result, seconds = aggregate(body)
+                        assert result["cache"] == expected, result["cache"]
+                        times.append(seconds)
+                    return min(times)
+
+                def scan(body: dict) -> float:
+                    # What every question cost without the cache: the same query over the table.
+                    times = []
+                    for _ in range(repeat):
+                        client.delete(f"/db/datasets/{dataset['dataset_id']}/aggregates").raise_for_status()
+                        times.append(aggregate(body)[1])
+                    return min(times)
+
+                scan_fine_seconds = scan(fine)
+                scan_coarse_seconds = scan(coarse)
+                client.delete(f"/db/datasets/{dataset['dataset_id']}/aggregates").raise_for_status()
+                result, miss_seconds = aggregate(fine)
+                hit_seconds = best(fine, "hit")
+                rolled_up, rollup_seconds = aggregate(coarse)
+                assert rolled_up["cache"] == "rollup", rolled_up["cache"]
+                # The rollup materialized the coarse result, it is now a hit too.
+                coarse_hit_seconds = best(coarse, "hit")
+        finally:
+            meta.close_metadata_stores()
+
+        return {
+            "rows": rows,
+            "groups": len(result["rows"]),
+            "scan_ms": round(scan_fine_seconds * 1000, 2),
+            "miss_ms": round(miss_seconds * 1000, 2),
+            "hit_ms": round(hit_seconds * 1000, 2),
+            "coarse_scan_ms": round(scan_coarse_seconds * 1000, 2),
+            "coarse_rollup_ms": round(rollup_seconds * 1000, 2),
+            "coarse_hit_ms": round(coarse_hit_seconds * 1000, 2),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare materialized aggregation results against scanning the table for every question.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns, args.repeat), indent=2))
+
+# python3 -m benchmarks.bench_aggregates
@@ -0,0 +1,76 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.bench_utils import write_synthetic_csv
+from db_helpers import db_metadata as meta
+from db_helpers import db_routes
+from db_helpers import db_append
+
+'''
+bench_append.py ingests a CSV through /db/upload_db (background=false, conversion and profile included), then appends batches of
+batch_percent of its rows through /db/datasets/{id}/append, and compares the time of one append (conversion and profile merge included)
+to the time of re-ingesting the whole file with the batch added. It also reports the cost of the compaction that follows.
+'''
+
+def run(rows: int, columns: int, batch_percent: float, batches: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        db_routes.DATA_ROOT = meta.DATA_ROOT = db_append.DATA_ROOT = Path(tmp) / "datasets"
+        batch_rows = max(int(rows * batch_percent / 100), 1)
+        csv_path = write_synthetic_csv(Path(tmp) / "synthetic.csv", rows, columns)
+        # Another seed, so the re-ingest is not deduplicated against the first upload.
+        batch_path = write_synthetic_csv(Path(tmp) / "batch.csv", batch_rows, columns, seed=1)
+        full_path = write_synthetic_csv(Path(tmp) / "full.csv", rows + batch_rows, columns, seed=2)
+
+        api = FastAPI()
+        api.include_router(db_routes.router)
+        try:
+            with TestClient(api) as client:
+                def upload(path: Path) -> tuple[dict, float]:
+                    started = time.perf_counter()
+                    with open(path, "rb") as f:
+                        response = client.post("/db/upload_db", params={"background": False}, files={"file": ("synthetic.csv", f)})
+                    response.raise_for_status()
+                    return response.json(), time.perf_counter() - started
+
+                dataset, _ = upload(csv_path)
+                _, reingest_seconds = upload(full_path)
+
+                append_seconds = []
+                for _ in range(batches):
+                    started = time.perf_counter()
+                    with open(batch_path, "rb") as f:
+                        client.post(f"/db/datasets/{dataset['dataset_id']}/append", files={"file": ("batch.csv", f)}).raise_for_status()
+                    append_seconds.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                db_append.compact_dataset(dataset["dataset_id"])
+                compact_seconds = time.perf_counter() - started
+        finally:
+            meta.close_metadata_stores()
+
+        mean_append = sum(append_seconds) / len(append_seconds)
+        return {
+            "rows": rows,
+            "batch_rows": batch_rows,
+            "reingest_seconds": round(reingest_seconds, 3),
+            "append_seconds": round(mean_append, 3),
+            "append_vs_reingest": round(mean_append / reingest_seconds, 4),
+            "compact_seconds": round(compact_seconds, 3),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare appending a batch to a dataset against re-ingesting the whole file.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--batch-percent", type=float, default=1.0)
+    parser.add_argument("--batches", type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns, args.batch_percent, args.batches), indent=2))
+
+# python3 -m benchmarks.bench_append
@@ -0,0 +1,80 @@
+import argparse
+import json
+import sqlite3
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from ai_helpers.insight_agent import InsightAgent
+from db_helpers import db_metadata as meta
+from db_helpers.db_constants import Dataset
+from db_helpers.db_sampling import get_sample_cache
+from db_helpers.db_services import get_sqlite_schema, get_sqlite_table_names
+
+'''
+bench_dataset_insight.py measures building the insight prompt(s) of every table of a SQLite dataset (the LLM call is left out):
+one InsightAgent per table, one after the other (what the frontend did with one request per table),
+against one dataset insight that samples the tables concurrently.
+'''
+
+def make_sqlite(path: Path, tables: int, rows: int) -> Dataset:
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE table_0 (id INTEGER PRIMARY KEY, name TEXT, amount REAL)")
+    for t in range(1, tables):
+        conn.execute(f"CREATE TABLE table_{t} (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES table_{t - 1}(id), name TEXT, amount REAL)")
+    for t in range(tables):
+        if t == 0:
+            conn.executemany("INSERT INTO table_0 (name, amount) VALUES (?, ?)", [(f"name_{i}", i * 0.5) for i in range(rows)])
+        else:
+            conn.executemany(f"INSERT INTO table_{t} (parent_id, name, amount) VALUES (?, ?, ?)", [(i, f"name_{i}", i * 0.5) for i in range(rows)])
+    conn.commit()
+    conn.close()
+    return Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size, dataset_path=str(path),
+                   tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+
+def per_table_prompts(dataset: Dataset):
+    for table_name in dataset.tables:
+        InsightAgent(dataset.dataset_id).prepare_prompt(table_name, "reservoir", 0)
+
+def dataset_prompt(dataset: Dataset):
+    InsightAgent(dataset.dataset_id).prepare_dataset_prompt("reservoir", 0)
+
+def time_run(function, dataset: Dataset, repeats: int) -> float:
+    '''
+    time_run is a function that returns the mean milliseconds per run, with the sample cache cleared before every run.
+    '''
+    total = 0.0
+    for _ in range(repeats):
+        get_sample_cache().clear()
+        started = time.perf_counter()
+        function(dataset)
+        total += time.perf_counter() - started
+    return total * 1000 / repeats
+
+def run(table_counts: list[int], rows: int, repeats: int) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        try:
+            for tables in table_counts:
+                dataset = make_sqlite(Path(tmp) / f"bench_{tables}.db", tables, rows)
+                meta.save_metadata(dataset)
+                results.append({
+                    "tables": tables,
+                    "per_table_ms": round(time_run(per_table_prompts, dataset, repeats), 3),
+                    "dataset_ms": round(time_run(dataset_prompt, dataset, repeats), 3),
+                })
+        finally:
+            meta.close_metadata_stores()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare one insight prompt per table against one dataset insight prompt.")
+    parser.add_argument("--tables", type=int, nargs="+", default=[5, 20, 40])
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.tables, args.rows, args.repeats), indent=2))
+
+# python3 -m benchmarks.bench_dataset_insight
@@ -0,0 +1,58 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.bench_utils import write_synthetic_csv
+from db_helpers import db_metadata as meta
+from db_helpers import db_routes
+
+'''
+bench_dedup.py uploads the same CSV several times through /db/upload_db (background=false, so the conversion is timed)
+and reports the time and the bytes on disk of the first upload, which converts, against the re-uploads, which only hash.
+'''
+
+def directory_bytes(path: Path) -> int:
+    return sum(file_path.stat().st_size for file_path in path.rglob("*") if file_path.is_file())
+
+def run(rows: int, columns: int, uploads: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        data_root = Path(tmp) / "datasets"
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        db_routes.DATA_ROOT = meta.DATA_ROOT = data_root
+        csv_path = write_synthetic_csv(Path(tmp) / "synthetic.csv", rows, columns)
+
+        api = FastAPI()
+        api.include_router(db_routes.router)
+        seconds = []
+        try:
+            with TestClient(api) as client:
+                for _ in range(uploads):
+                    with open(csv_path, "rb") as f:
+                        started = time.perf_counter()
+                        response = client.post("/db/upload_db", params={"background": False}, files={"file": (csv_path.name, f)})
+                        seconds.append(time.perf_counter() - started)
+                    response.raise_for_status()
+        finally:
+            meta.close_metadata_stores()
+
+        return {
+            "raw_bytes": csv_path.stat().st_size,
+            "first_upload_seconds": round(seconds[0], 3),
+            "reupload_seconds": round(sum(seconds[1:]) / max(len(seconds) - 1, 1), 3),
+            "dataset_dirs": len(list(data_root.iterdir())),
+            "bytes_on_disk": directory_bytes(data_root),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the first upload of a file against re-uploads of the same content.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=3)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns, args.uploads), indent=2))
+
+# python3 -m benchmarks.bench_dedup
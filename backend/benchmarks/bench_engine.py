@@ -0,0 +1,66 @@
+import argparse
+import json
+import sqlite3
+import tempfile
+import time
+import uuid
+from pathlib import Path
+import duckdb
+from db_helpers.db_constants import Dataset
+from db_helpers.db_services import get_sample_rows, get_sqlite_schema, get_sqlite_table_names
+
+'''
+bench_engine.py measures repeated get_sample_rows calls on the same SQLite dataset,
+through the shared DuckDB engine against a fresh duckdb.connect() + ATTACH per call (the previous behaviour).
+'''
+
+def legacy_get_sample_rows(dataset: Dataset, num_rows: int, table_name: str) -> list[dict]:
+    '''
+    legacy_get_sample_rows is get_sample_rows as it was before the DuckDB engine.
+    '''
+    conn = duckdb.connect()
+    try:
+        conn.execute(f"ATTACH DATABASE '{dataset.dataset_path}' AS sqlite_db (TYPE sqlite)")
+        dataframe = conn.execute(f"SELECT * FROM sqlite_db.{table_name} LIMIT ?", [num_rows]).fetchdf()
+    finally:
+        conn.close()
+    return dataframe.to_dict(orient="records")
+
+def make_sqlite(path: Path, tables: int, rows: int) -> Dataset:
+    conn = sqlite3.connect(str(path))
+    for t in range(tables):
+        conn.execute(f"CREATE TABLE table_{t} (id INTEGER PRIMARY KEY, name TEXT, amount REAL)")
+        conn.executemany(f"INSERT INTO table_{t} (name, amount) VALUES (?, ?)", [(f"name_{i}", i * 0.5) for i in range(rows)])
+    conn.commit()
+    conn.close()
+    return Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size, dataset_path=str(path),
+                   tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+
+def time_calls(function, dataset: Dataset, calls: int) -> float:
+    '''
+    time_calls is a function that returns the mean milliseconds per call.
+    '''
+    started = time.perf_counter()
+    for i in range(calls):
+        function(dataset, 10, dataset.tables[i % len(dataset.tables)])
+    return (time.perf_counter() - started) * 1000 / calls
+
+def run(tables: int, rows: int, calls: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        dataset = make_sqlite(Path(tmp) / "bench.db", tables, rows)
+        return {
+            "tables": tables,
+            "fresh_connect_ms_per_call": round(time_calls(legacy_get_sample_rows, dataset, calls), 3),
+            "engine_ms_per_call": round(time_calls(get_sample_rows, dataset, calls), 3),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the shared DuckDB engine against connect + ATTACH per call.")
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.tables, args.rows, args.calls), indent=2))
+
+# python3 -m benchmarks.bench_engine
@@ -0,0 +1,66 @@
+import argparse
+import io
+import json
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.bench_utils import write_synthetic_csv, write_synthetic_jsonl
+from db_helpers.db_services import save_raw_file, save_parquet_file
+from db_helpers.db_ingest import stream_csv_to_parquet, build_ingest_stats, count_parquet_rows, save_json_parquet_file
+
+'''
+bench_ingest.py compares the two-pass CSV ingest (save_raw_file + save_parquet_file) against the streaming ingest,
+and against the JSONL ingest of the same records (save_raw_file + save_json_parquet_file).
+'''
+
+class LocalUpload:
+    '''
+    LocalUpload is a stand-in for fastapi's UploadFile, save_raw_file only needs .filename and .file.
+    '''
+    def __init__(self, path: Path):
+        self.filename = path.name
+        self.file = open(path, "rb")
+
+def run(rows: int, columns: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        csv_path = write_synthetic_csv(tmp_dir / "synthetic.csv", rows, columns)
+
+        two_pass_dir = tmp_dir / "two_pass"
+        two_pass_dir.mkdir()
+        upload = LocalUpload(csv_path)
+        started = time.perf_counter()
+        raw_path, raw_size = save_raw_file(two_pass_dir, upload)
+        parquet_path = save_parquet_file(two_pass_dir, raw_path)
+        two_pass = build_ingest_stats("two_pass", count_parquet_rows(parquet_path), raw_size, started)
+        upload.file.close()
+
+        results = {"two_pass": two_pass.model_dump()}
+        for keep_raw in (True, False):
+            stream_dir = tmp_dir / f"stream_keep_raw_{keep_raw}"
+            stream_dir.mkdir()
+            with open(csv_path, "rb") as source:
+                _, _, stats = stream_csv_to_parquet(stream_dir, source, csv_path.name, keep_raw=keep_raw)
+            results[f"stream_keep_raw_{keep_raw}"] = stats.model_dump()
+
+        jsonl_path = write_synthetic_jsonl(tmp_dir / "synthetic.jsonl", rows, columns)
+        jsonl_dir = tmp_dir / "jsonl"
+        jsonl_dir.mkdir()
+        upload = LocalUpload(jsonl_path)
+        started = time.perf_counter()
+        raw_path, raw_size = save_raw_file(jsonl_dir, upload)
+        parquet_path, _ = save_json_parquet_file(jsonl_dir, raw_path, "jsonl")
+        results["jsonl"] = build_ingest_stats("two_pass", count_parquet_rows(parquet_path), raw_size, started).model_dump()
+        upload.file.close()
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two-pass and streaming CSV ingest, and JSONL ingest.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns), indent=2))
+
+# python3 -m benchmarks.bench_ingest --rows 1000000
@@ -0,0 +1,81 @@
+import argparse
+import json
+import sqlite3
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from db_helpers import db_metadata as meta
+from db_helpers.db_constants import METADATA_TABLE, Dataset
+
+'''
+bench_metadata.py measures get_dataset_by_id lookups/sec under concurrent requests,
+for the pooled MetadataStore against the previous connect-per-call path.
+'''
+
+def legacy_get_dataset_by_id(metadata_path: Path, dataset_id: str) -> Dataset:
+    '''
+    legacy_get_dataset_by_id is the lookup as it was before the MetadataStore:
+    a new connection and a CREATE TABLE IF NOT EXISTS on every call.
+    '''
+    conn = sqlite3.connect(str(metadata_path), timeout=30)
+    conn.execute(f""" CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (dataset_id TEXT PRIMARY KEY, 
+    upload_type TEXT, 
+    raw_byte_size INTEGER, 
+    dataset_path TEXT NOT NULL,
+    tables TEXT NOT NULL, 
+    schema TEXT NOT NULL)""")
+    conn.commit()
+    try:
+        row = conn.execute(f"SELECT * FROM {METADATA_TABLE} WHERE dataset_id = ?", (dataset_id,)).fetchone()
+    finally:
+        conn.close()
+    return meta.row_to_dataset(row)
+
+def measure(lookup, dataset_ids: list[str], threads: int, lookups: int) -> float:
+    '''
+    measure is a function that runs lookups spread over a thread pool and returns the lookups/sec.
+    '''
+    def worker(i: int):
+        lookup(dataset_ids[i % len(dataset_ids)])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(lookups)))
+    return lookups / (time.perf_counter() - started)
+
+def run(datasets: int, columns: int, threads: list[int], lookups: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        metadata_path = Path(tmp) / "metadata.db"
+        meta.METADATA_DB = metadata_path
+
+        schema = {"table": {f"col_{i}": "BIGINT" for i in range(columns)}}
+        dataset_ids = []
+        for _ in range(datasets):
+            dataset_id = str(uuid.uuid4())
+            meta.save_metadata(Dataset(dataset_id=dataset_id, upload_type="csv", raw_byte_size=0,
+                                       dataset_path="/tmp/table.parquet", tables=["table"], schema=schema))
+            dataset_ids.append(dataset_id)
+
+        results = {}
+        for thread_count in threads:
+            results[f"threads_{thread_count}"] = {
+                "connect_per_call_lookups_per_sec": round(measure(lambda d: legacy_get_dataset_by_id(metadata_path, d), dataset_ids, thread_count, lookups), 1),
+                "pooled_lookups_per_sec": round(measure(meta.get_dataset_by_id, dataset_ids, thread_count, lookups), 1),
+            }
+
+        meta.close_metadata_stores()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare pooled and connect-per-call metadata lookups.")
+    parser.add_argument("--datasets", type=int, default=1000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.datasets, args.columns, args.threads, args.lookups), indent=2))
+
+# python3 -m benchmarks.bench_metadata
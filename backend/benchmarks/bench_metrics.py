@@ -0,0 +1,74 @@
+import argparse
+import json
+import time
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from db_helpers import db_metrics
+from db_helpers import db_routes
+
+'''
+bench_metrics.py measures what the instrumentation costs: one Stage with the metrics on and off (against the bare block),
+and the latency of a small request (GET /db/) without the middleware, with it, and with the Server-Timing header too.
+'''
+
+def time_stage(iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with db_metrics.Stage("bench"):
+            pass
+    return (time.perf_counter() - started) / iterations
+
+def time_bare(iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        pass
+    return (time.perf_counter() - started) / iterations
+
+def time_requests(middleware: bool, requests: int) -> float:
+    api = FastAPI()
+    if middleware:
+        api.add_middleware(db_metrics.MetricsMiddleware)
+    api.include_router(db_routes.router)
+    with TestClient(api) as client:
+        for _ in range(50):
+            client.get("/db/")
+        started = time.perf_counter()
+        for _ in range(requests):
+            client.get("/db/")
+        return (time.perf_counter() - started) / requests
+
+def run(iterations: int, requests: int) -> dict:
+    bare = time_bare(iterations)
+    db_metrics.METRICS_ENABLED = True
+    enabled = time_stage(iterations)
+    db_metrics.METRICS_ENABLED = False
+    disabled = time_stage(iterations)
+
+    without = time_requests(False, requests)
+    db_metrics.METRICS_ENABLED = True
+    with_metrics = time_requests(True, requests)
+    db_metrics.SERVER_TIMING_ENABLED = True
+    with_timing = time_requests(True, requests)
+
+    return {
+        "stage_ns": {
+            "bare_block": round(bare * 1e9, 1),
+            "metrics_off": round(disabled * 1e9, 1),
+            "metrics_on": round(enabled * 1e9, 1),
+        },
+        "request_us": {
+            "no_middleware": round(without * 1e6, 1),
+            "middleware": round(with_metrics * 1e6, 1),
+            "middleware_server_timing": round(with_timing * 1e6, 1),
+        },
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cost of the stage timers and of the metrics middleware.")
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.iterations, args.requests), indent=2))
+
+# python3 -m benchmarks.bench_metrics
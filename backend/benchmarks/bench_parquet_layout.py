@@ -0,0 +1,68 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.bench_utils import write_synthetic_csv
+from db_helpers.db_constants import ParquetLayout
+from db_helpers.db_engine import DuckDBEngine, parquet_source
+from db_helpers.db_services import save_parquet_file
+
+'''
+bench_parquet_layout.py writes the same CSV with several ParquetLayouts and measures, for each one, the size on disk,
+the time to write it and the latency of a range filter (on col_1, random floats) and an equality filter (on col_2, 51 categories).
+'''
+
+LAYOUTS = {
+    "default": ParquetLayout(),
+    "zstd": ParquetLayout(compression="zstd"),
+    "zstd_sorted": ParquetLayout(compression="zstd", sort_by=["col_1"]),
+    "zstd_sorted_small_row_groups": ParquetLayout(compression="zstd", row_group_size=16_384, sort_by=["col_1"]),
+    "partitioned": ParquetLayout(partition_by="col_2"),
+}
+
+QUERIES = {
+    "range_filter": "SELECT count(*), avg(col_0) FROM {table} WHERE col_1 BETWEEN 100 AND 110",
+    "equality_filter": "SELECT count(*), avg(col_1) FROM {table} WHERE col_2 = 'category_7'",
+}
+
+def size_on_disk(path: Path) -> int:
+    if path.is_dir():
+        return sum(file_path.stat().st_size for file_path in path.rglob("*.parquet"))
+    return path.stat().st_size
+
+def run(rows: int, columns: int, repeats: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = write_synthetic_csv(Path(tmp) / "synthetic.csv", rows, columns)
+        engine = DuckDBEngine()
+        try:
+            for name, layout in LAYOUTS.items():
+                started = time.perf_counter()
+                parquet_path = save_parquet_file(Path(tmp) / name, csv_path, layout)
+                write_seconds = time.perf_counter() - started
+
+                table = parquet_source(str(parquet_path))
+                query_ms = {}
+                for query_name, sql in QUERIES.items():
+                    started = time.perf_counter()
+                    for _ in range(repeats):
+                        engine.cursor().execute(sql.format(table=table)).fetchall()
+                    query_ms[query_name] = round((time.perf_counter() - started) * 1000 / repeats, 3)
+
+                results[name] = {"bytes": size_on_disk(parquet_path), "write_seconds": round(write_seconds, 3), **query_ms}
+        finally:
+            engine.close()
+
+    return {"rows": rows, "columns": columns, "layouts": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare Parquet layouts: file size and filtered-scan latency.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns, args.repeats), indent=2))
+
+# python3 -m benchmarks.bench_parquet_layout
@@ -0,0 +1,147 @@
+import argparse
+import json
+import random
+import uuid
+from ai_helpers.insight_agent import INSIGHT_SAMPLE_ROWS, InsightAgent
+from ai_helpers.prompt_format import PROMPT_TOKEN_BUDGET, count_tokens, get_encoding
+from db_helpers.db_constants import ColumnProfile, Dataset, TableProfile
+
+'''
+bench_prompt.py measures the tokens of the insight system prompt on synthetic wide tables,
+with the token-budgeted formatter (prompt_format.py) against the previous one (a "- column: value" line per cell,
+the full schema dict and a profile line for every column).
+'''
+
+LEGACY_SYSTEM_PROMPT = """
+        System: “You are a data analyst. Given the dataset metadata, schema, and sample rows below,
+        write a short overview: what the dataset is about, what the main columns mean,
+        and 2–3 brief insights from the sample.
+
+        ## Dataset metadata:
+        - dataset_id: {dataset_id}
+        - upload_type: {upload_type}
+        - raw_byte_size: {raw_byte_size}
+        - tables: {tables}
+
+        ## Schema:
+        {schema}
+
+        ## Column profile (whole table):
+        {profile}
+
+        ## Sample rows:
+        {sample_rows}
+        """
+
+def legacy_format_profile(table_profile: TableProfile) -> str:
+    lines = [f"Rows: {table_profile.row_count}"]
+    for column in table_profile.columns:
+        stats = [f"{column.null_count} nulls"]
+        if column.approx_distinct is not None:
+            stats.append(f"~{column.approx_distinct} distinct")
+        for name in ("min", "max", "mean", "stddev"):
+            value = getattr(column, name)
+            if value is not None:
+                stats.append(f"{name} {round(value, 4) if isinstance(value, float) else value}")
+        if column.top_values:
+            stats.append("top: " + ", ".join(column.top_values[:5]))
+        lines.append(f"- {column.column_name} ({column.column_type}): " + ", ".join(stats))
+    return "\n".join(lines)
+
+def legacy_format_sample_rows(sample_rows: list[dict]) -> str:
+    text_blocks = []
+    for i, row in enumerate(sample_rows, start=1):
+        block = [f"Row {i}:"]
+        for column, value in row.items():
+            block.append(f"  - {column}: {value}")
+        text_blocks.append("\n".join(block))
+    return "\n\n".join(text_blocks)
+
+def legacy_prompt(dataset: Dataset, table_name: str, rows: list[dict], table_profile: TableProfile) -> str:
+    '''
+    legacy_prompt is the insight system prompt as it was built before prompt_format.py.
+    '''
+    return LEGACY_SYSTEM_PROMPT.format(dataset_id=dataset.dataset_id, upload_type=dataset.upload_type, raw_byte_size=dataset.raw_byte_size,
+                                       tables=", ".join(dataset.tables), schema=dataset.schema, profile=legacy_format_profile(table_profile),
+                                       sample_rows=legacy_format_sample_rows(rows))
+
+def compact_prompt(dataset: Dataset, table_name: str, rows: list[dict], table_profile: TableProfile) -> str:
+    # The agent normally loads the dataset from the metadata database, here it is set directly.
+    agent = InsightAgent.__new__(InsightAgent)
+    agent.dataset = dataset
+    agent.format_table_sections(table_name, rows, table_profile)
+    agent.build_system_prompt()
+    return agent.system_prompt
+
+def make_wide_table(num_columns: int, num_rows: int, text_chars: int, seed: int = 0) -> tuple[Dataset, list[dict], TableProfile]:
+    '''
+    make_wide_table is a function that returns a dataset with one table of num_columns columns: a mix of integers, doubles,
+    long text, constant and empty columns, num_rows sample rows of it and a matching profile.
+    '''
+    rng = random.Random(seed)
+    row_count = 100_000
+    kinds = ["BIGINT", "DOUBLE", "VARCHAR", "VARCHAR", "CONSTANT", "EMPTY"]
+    columns = {f"col_{c}_{kinds[c % len(kinds)].lower()}": kinds[c % len(kinds)] for c in range(num_columns)}
+
+    rows = []
+    for _ in range(num_rows):
+        row = {}
+        for name, kind in columns.items():
+            if kind == "BIGINT":
+                row[name] = rng.randint(0, 1_000_000)
+            elif kind == "DOUBLE":
+                row[name] = rng.random() * 1000
+            elif kind == "VARCHAR":
+                row[name] = " ".join(rng.choice(["lorem", "ipsum", "dolor", "sit", "amet"]) for _ in range(text_chars // 6))
+            elif kind == "CONSTANT":
+                row[name] = "same"
+            else:
+                row[name] = None
+        rows.append(row)
+
+    profiles = []
+    for name, kind in columns.items():
+        if kind in ("BIGINT", "DOUBLE"):
+            profiles.append(ColumnProfile(column_name=name, column_type=kind, null_count=0, approx_distinct=row_count // 2,
+                                          min=0, max=1_000_000, mean=500_000.0, stddev=288_000.0))
+        elif kind == "VARCHAR":
+            profiles.append(ColumnProfile(column_name=name, column_type=kind, null_count=row_count // 10, approx_distinct=row_count,
+                                          top_values=[rows[0][name], rows[-1][name]]))
+        elif kind == "CONSTANT":
+            profiles.append(ColumnProfile(column_name=name, column_type="VARCHAR", null_count=0, approx_distinct=1, top_values=["same"]))
+        else:
+            profiles.append(ColumnProfile(column_name=name, column_type="VARCHAR", null_count=row_count, approx_distinct=0))
+
+    schema = {name: ("VARCHAR" if kind in ("CONSTANT", "EMPTY") else kind) for name, kind in columns.items()}
+    dataset = Dataset(dataset_id=str(uuid.uuid4()), upload_type="csv", raw_byte_size=row_count * num_columns * 8,
+                      dataset_path="wide.parquet", tables=["wide"], schema={"wide": schema})
+    return dataset, rows, TableProfile(table_name="wide", row_count=row_count, columns=profiles)
+
+def run(widths: list[int], num_rows: int, text_chars: int) -> dict:
+    results = []
+    for width in widths:
+        dataset, rows, table_profile = make_wide_table(width, num_rows, text_chars)
+        legacy = count_tokens(legacy_prompt(dataset, "wide", rows, table_profile))
+        compact = count_tokens(compact_prompt(dataset, "wide", rows, table_profile))
+        results.append({
+            "columns": width,
+            "legacy_tokens": legacy,
+            "compact_tokens": compact,
+            "reduction": round(1 - compact / legacy, 3),
+        })
+    return {
+        "tokenizer": "tiktoken" if get_encoding() is not None else "estimate (4 chars/token)",
+        "budget_tokens": PROMPT_TOKEN_BUDGET,
+        "results": results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the tokens per insight prompt of the compact formatter against the previous one.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[20, 100, 300, 500])
+    parser.add_argument("--rows", type=int, default=INSIGHT_SAMPLE_ROWS)
+    parser.add_argument("--text-chars", type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.widths, args.rows, args.text_chars), indent=2))
+
+# python3 -m benchmarks.bench_prompt
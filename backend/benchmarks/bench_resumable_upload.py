@@ -0,0 +1,92 @@
+import argparse
+import hashlib
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.bench_utils import write_synthetic_csv
+from db_helpers import db_metadata as meta
+from db_helpers import db_routes
+from db_helpers import db_uploads
+
+'''
+bench_resumable_upload.py sends the same CSV through /db/upload_db in one request and through /db/uploads in chunks
+(sent by several threads at once), then measures the time to resume an upload that lost half of its chunks.
+Both modes complete with background=false, so the conversion is included in the times.
+'''
+
+def send_chunks(client: TestClient, upload_id: str, csv_path: Path, chunk_bytes: int, indexes: list[int], workers: int):
+    def put(index: int):
+        with open(csv_path, "rb") as f:
+            f.seek(index * chunk_bytes)
+            data = f.read(chunk_bytes)
+        response = client.put(f"/db/uploads/{upload_id}/chunks/{index}", content=data, headers={"X-Chunk-SHA256": hashlib.sha256(data).hexdigest()})
+        response.raise_for_status()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(put, indexes))
+
+def start_upload(client: TestClient, csv_path: Path, chunk_bytes: int) -> dict:
+    response = client.post("/db/uploads", json={"filename": csv_path.name, "total_bytes": csv_path.stat().st_size, "chunk_bytes": chunk_bytes})
+    response.raise_for_status()
+    return response.json()
+
+def run(rows: int, columns: int, chunk_bytes: int, workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        db_routes.DATA_ROOT = meta.DATA_ROOT = Path(tmp) / "datasets"
+        db_uploads.UPLOAD_ROOT = Path(tmp) / "uploads"
+        csv_path = write_synthetic_csv(Path(tmp) / "synthetic.csv", rows, columns)
+
+        api = FastAPI()
+        api.include_router(db_routes.router)
+        try:
+            with TestClient(api) as client:
+                started = time.perf_counter()
+                with open(csv_path, "rb") as f:
+                    client.post("/db/upload_db", params={"background": False}, files={"file": (csv_path.name, f)}).raise_for_status()
+                single_seconds = time.perf_counter() - started
+
+                # Another layout, so the chunked upload is converted instead of deduplicated against the first one.
+                started = time.perf_counter()
+                session = start_upload(client, csv_path, chunk_bytes)
+                send_chunks(client, session["upload_id"], csv_path, chunk_bytes, list(range(session["chunk_count"])), workers)
+                chunks_seconds = time.perf_counter() - started
+                client.post(f"/db/uploads/{session['upload_id']}/complete", params={"background": False, "compression": "zstd"}).raise_for_status()
+                chunked_seconds = time.perf_counter() - started
+
+                # A client that lost its connection halfway only sends what the server does not have.
+                session = start_upload(client, csv_path, chunk_bytes)
+                send_chunks(client, session["upload_id"], csv_path, chunk_bytes, list(range(0, session["chunk_count"], 2)), workers)
+                started = time.perf_counter()
+                received = client.get(f"/db/uploads/{session['upload_id']}").json()["received_chunks"]
+                missing = [index for index in range(session["chunk_count"]) if index not in set(received)]
+                send_chunks(client, session["upload_id"], csv_path, chunk_bytes, missing, workers)
+                resume_seconds = time.perf_counter() - started
+        finally:
+            meta.close_metadata_stores()
+
+        return {
+            "raw_bytes": csv_path.stat().st_size,
+            "chunk_bytes": chunk_bytes,
+            "chunks": session["chunk_count"],
+            "single_request_seconds": round(single_seconds, 3),
+            "chunked_send_seconds": round(chunks_seconds, 3),
+            "chunked_total_seconds": round(chunked_seconds, 3),
+            "resume_half_seconds": round(resume_seconds, 3),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a single-request upload against a resumable chunked upload.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--chunk-bytes", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.columns, args.chunk_bytes, args.workers), indent=2))
+
+# python3 -m benchmarks.bench_resumable_upload
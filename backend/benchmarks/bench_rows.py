@@ -0,0 +1,92 @@
+import argparse
+import json
+import tempfile
+import time
+import uuid
+from pathlib import Path
+import duckdb
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from db_helpers import db_metadata as meta
+from db_helpers import db_routes
+from db_helpers.db_constants import Dataset, ParquetLayout
+from db_helpers.db_engine import get_duckdb_engine, quote_literal
+from db_helpers.db_services import get_parquet_schema
+
+'''
+bench_rows.py writes a Parquet table of --rows rows (default row groups), then times /db/datasets/{id}/tables/{table}/rows
+at page 1, page --deep-page and the last page (keyset cursors), against the same page read with LIMIT ... OFFSET ...,
+which has to read every row before the page.
+'''
+
+def run(rows: int, page_size: int, deep_page: int, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        parquet_path = Path(tmp) / "events.parquet"
+
+        started = time.perf_counter()
+        duckdb.execute(f"""COPY (SELECT range AS id, range % 1000 AS user_id, (range * 7919) % 100000 / 100.0 AS amount,
+                           'event_' || (range % 20) AS kind FROM range({rows})) TO {quote_literal(str(parquet_path))} (FORMAT parquet)""")
+        write_seconds = time.perf_counter() - started
+
+        dataset = Dataset(dataset_id=str(uuid.uuid4()), upload_type="csv", raw_byte_size=parquet_path.stat().st_size, dataset_path=str(parquet_path),
+                          tables=["events"], schema=get_parquet_schema(parquet_path), layout=ParquetLayout())
+        api = FastAPI()
+        api.include_router(db_routes.router)
+        try:
+            meta.save_metadata(dataset)
+            with TestClient(api) as client:
+                url = f"/db/datasets/{dataset.dataset_id}/tables/events/rows"
+
+                def keyset(start_row: int, params: dict) -> tuple[float, dict]:
+                    # A cursor is the file and row the page starts at, so the cursor of any page of an unfiltered table is known.
+                    cursor = {"cursor": f"0:{start_row}"} if start_row else {}
+                    times = []
+                    for _ in range(repeat):
+                        began = time.perf_counter()
+                        response = client.get(url, params={"limit": page_size, **cursor, **params})
+                        response.raise_for_status()
+                        times.append(time.perf_counter() - began)
+                    return min(times), response.json()
+
+                def offset(start_row: int) -> float:
+                    cursor = get_duckdb_engine().cursor()
+                    times = []
+                    for _ in range(repeat):
+                        began = time.perf_counter()
+                        cursor.execute(f"SELECT * FROM read_parquet({quote_literal(str(parquet_path))}) LIMIT {page_size} OFFSET {start_row}").fetch_arrow_table()
+                        times.append(time.perf_counter() - began)
+                    return min(times)
+
+                pages = {"first": 0, f"page_{deep_page}": (deep_page - 1) * page_size, "last": rows - page_size}
+                results = {}
+                for name, start_row in pages.items():
+                    seconds, page = keyset(start_row, {})
+                    assert page["data"]["id"][0] == start_row
+                    results[name] = {"keyset_ms": round(seconds * 1000, 2), "offset_ms": round(offset(start_row) * 1000, 2)}
+
+                # A filter on a sorted column skips the row groups before the matching rows too.
+                seconds, page = keyset(pages[f"page_{deep_page}"], {"where": [f"id:gte:{rows // 2}"], "columns": ["id", "amount"]})
+                results["filtered_projected"] = {"keyset_ms": round(seconds * 1000, 2)}
+        finally:
+            meta.close_metadata_stores()
+
+        return {
+            "rows": rows,
+            "parquet_bytes": parquet_path.stat().st_size if parquet_path.exists() else None,
+            "write_seconds": round(write_seconds, 1),
+            "page_size": page_size,
+            "pages": results,
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare keyset pages of the rows viewer against LIMIT/OFFSET at increasing depths.")
+    parser.add_argument("--rows", type=int, default=100_000_000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--deep-page", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.page_size, args.deep_page, args.repeat), indent=2))
+
+# python3 -m benchmarks.bench_rows
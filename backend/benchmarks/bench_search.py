@@ -0,0 +1,93 @@
+import argparse
+import json
+import random
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from db_helpers import db_metadata as meta
+from db_helpers.db_constants import METADATA_TABLE
+
+'''
+bench_search.py saves datasets with random schemas straight into the metadata database (the triggers fill the search index),
+then compares the latency of search_columns (by column name, by type, by name words) to listing every dataset with list_datasets
+and filtering their schemas in Python, which is what finding a column took before the index.
+'''
+
+WORDS = ["customer", "order", "invoice", "product", "store", "region", "payment", "shipment", "account", "session", "event", "user"]
+SUFFIXES = ["id", "name", "date", "amount", "count", "code", "status", "total", "created_at", "updated_at"]
+TYPES = ["INTEGER", "BIGINT", "DOUBLE", "VARCHAR", "DATE", "TIMESTAMP", "BOOLEAN", "DECIMAL(18,3)"]
+
+def random_schema(rng: random.Random, tables: int, columns: int) -> dict[str, dict[str, str]]:
+    return {
+        f"{rng.choice(WORDS)}s_{table}": {f"{rng.choice(WORDS)}_{rng.choice(SUFFIXES)}_{column}": rng.choice(TYPES) for column in range(columns)}
+        for table in range(tables)
+    }
+
+def timed(fn, repeat: int) -> tuple[float, int]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        found = fn()
+    return (time.perf_counter() - started) / repeat, found
+
+def run(datasets: int, tables: int, columns: int, repeat: int) -> dict:
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        meta.METADATA_DB = Path(tmp) / "metadata.db"
+        try:
+            rows = []
+            for index in range(datasets):
+                schema = random_schema(rng, tables, columns)
+                rows.append((str(uuid.uuid4()), "db", 1, f"{tmp}/datasets/{index}/file_{index}.db", json.dumps(list(schema)), json.dumps(schema), "{}", None, None))
+
+            started = time.perf_counter()
+            with meta.get_metadata_store().connection() as conn:
+                conn.executemany(meta.INSERT_DATASET_SQL, rows)
+            insert_seconds = time.perf_counter() - started
+
+            def scan(match) -> int:
+                return sum(1 for dataset in meta.list_datasets() for table in dataset.schema.values() for name, column_type in table.items() if match(name, column_type))
+
+            searches = {
+                "column": (lambda: len(meta.search_columns(column="customer_id_0", limit=1000)),
+                           lambda: scan(lambda name, column_type: name.lower() == "customer_id_0")),
+                "type": (lambda: len(meta.search_columns(column_type="DECIMAL", limit=1000)),
+                         lambda: scan(lambda name, column_type: column_type.startswith("DECIMAL"))),
+                "words": (lambda: len(meta.search_columns(query="invoice total", limit=1000)),
+                          lambda: scan(lambda name, column_type: "invoice" in name and "total" in name)),
+            }
+            results = {}
+            for name, (search, scan_all) in searches.items():
+                search_seconds, hits = timed(search, repeat)
+                scan_seconds, matches = timed(scan_all, 1)
+                results[name] = {
+                    "hits": hits,
+                    "scan_matches": matches,
+                    "search_ms": round(search_seconds * 1000, 3),
+                    "list_and_filter_ms": round(scan_seconds * 1000, 1),
+                }
+
+            with meta.get_metadata_store().connection() as conn:
+                indexed = conn.execute(f"SELECT count(*) FROM {meta.COLUMNS_INDEX_TABLE}").fetchone()[0]
+                assert conn.execute(f"SELECT count(*) FROM {METADATA_TABLE}").fetchone()[0] == datasets
+        finally:
+            meta.close_metadata_stores()
+
+        return {
+            "datasets": datasets,
+            "indexed_columns": indexed,
+            "insert_seconds": round(insert_seconds, 3),
+            "searches": results,
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare /db/search against listing every dataset and filtering the schemas.")
+    parser.add_argument("--datasets", type=int, default=20_000)
+    parser.add_argument("--tables", type=int, default=3)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.datasets, args.tables, args.columns, args.repeat), indent=2))
+
+# python3 -m benchmarks.bench_search
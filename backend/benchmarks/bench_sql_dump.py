@@ -0,0 +1,43 @@
+import argparse
+import json
+import random
+import resource
+import tempfile
+from pathlib import Path
+from db_helpers.db_sql_dump import sql_dump_to_sqlite
+
+'''
+bench_sql_dump.py measures loading a mysqldump-style dump (extended INSERTs) into SQLite: rows/sec, bytes/sec
+and the peak memory of the process, which should stay flat as the dump grows.
+'''
+
+def write_synthetic_dump(path: Path, rows: int, rows_per_insert: int = 1000, seed: int = 0) -> Path:
+    '''
+    write_synthetic_dump is a function that writes a dump of one table, rows_per_insert rows per INSERT statement like mysqldump does.
+    '''
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("CREATE TABLE `events` (\n  `id` int(11) NOT NULL,\n  `kind` varchar(32) DEFAULT NULL,\n"
+                "  `amount` decimal(10,2) DEFAULT NULL,\n  `note` text,\n  PRIMARY KEY (`id`)\n) ENGINE=InnoDB;\n")
+        for start in range(0, rows, rows_per_insert):
+            values = ",".join(
+                f"({i},'kind_{rng.randint(0, 50)}',{rng.random() * 1000:.2f},'it\\'s row {i}; with a semicolon')"
+                for i in range(start, min(rows, start + rows_per_insert))
+            )
+            f.write(f"INSERT INTO `events` VALUES {values};\n")
+    return path
+
+def run(rows: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_path = write_synthetic_dump(Path(tmp) / "dump.sql", rows)
+        _, stats = sql_dump_to_sqlite(Path(tmp), dump_path)
+        return {**stats.model_dump(), "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the SQL dump ingest into SQLite.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows), indent=2))
+
+# python3 -m benchmarks.bench_sql_dump --rows 1000000
@@ -0,0 +1,90 @@
+import argparse
+import json
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from db_helpers.db_constants import Dataset
+from db_helpers.db_engine import DuckDBEngine
+from db_helpers.db_ingest import convert_sqlite_to_parquet
+from db_helpers.db_services import get_sqlite_schema, get_sqlite_table_names
+
+'''
+bench_sqlite_parquet.py measures scan-heavy queries on the same SQLite dataset, read through DuckDB's sqlite scanner
+and read from the Parquet files written by convert_sqlite_to_parquet.
+'''
+
+# {table} is replaced by the FROM clause of the events table.
+QUERIES = {
+    "count": "SELECT count(*) FROM {table}",
+    "one_column_sum": "SELECT sum(amount) FROM {table}",
+    "filtered_group_by": "SELECT kind, count(*), avg(amount) FROM {table} WHERE id > 0.9 * (SELECT max(id) FROM {table}) GROUP BY kind",
+    "distinct": "SELECT count(DISTINCT customer_id) FROM {table}",
+}
+
+def make_sqlite(path: Path, rows: int, seed: int = 0) -> Dataset:
+    '''
+    make_sqlite is a function that writes one wide-ish events table (so that reading every column costs more than reading one).
+    '''
+    rng = random.Random(seed)
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, customer_id INTEGER, kind TEXT, amount REAL, note TEXT, created_at TEXT)")
+    conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", (
+        (i, rng.randint(0, 10_000), f"kind_{rng.randint(0, 20)}", rng.random() * 1000, f"note for event {i} " * 4, f"2024-01-{1 + i % 28:02d}")
+        for i in range(rows)
+    ))
+    conn.commit()
+    conn.close()
+    return Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size, dataset_path=str(path),
+                   tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+
+def time_queries(engine: DuckDBEngine, dataset: Dataset, repeats: int) -> dict:
+    '''
+    time_queries is a function that returns the mean milliseconds of every query in QUERIES.
+    '''
+    results = {}
+    with engine.dataset(dataset) as session:
+        table = session.table("events")
+        for name, sql in QUERIES.items():
+            started = time.perf_counter()
+            for _ in range(repeats):
+                session.cursor.execute(sql.format(table=table)).fetchall()
+            results[name] = round((time.perf_counter() - started) * 1000 / repeats, 3)
+    return results
+
+def run(rows: int, repeats: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        dataset = make_sqlite(Path(tmp) / "bench.db", rows)
+        engine = DuckDBEngine()
+        try:
+            sqlite_ms = time_queries(engine, dataset, repeats)
+
+            started = time.perf_counter()
+            table_paths = convert_sqlite_to_parquet(Path(tmp), Path(dataset.dataset_path), dataset.tables)
+            convert_seconds = time.perf_counter() - started
+
+            converted = dataset.model_copy(update={"table_paths": table_paths})
+            parquet_ms = time_queries(engine, converted, repeats)
+        finally:
+            engine.close()
+
+        return {
+            "rows": rows,
+            "sqlite_bytes": dataset.raw_byte_size,
+            "parquet_bytes": sum(Path(path).stat().st_size for path in table_paths.values()),
+            "convert_seconds": round(convert_seconds, 3),
+            "sqlite_ms": sqlite_ms,
+            "parquet_ms": parquet_ms,
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare scan-heavy queries on a SQLite dataset against its Parquet conversion.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.repeats), indent=2))
+
+# python3 -m benchmarks.bench_sqlite_parquet
@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+import duckdb
+import httpx
+import pyarrow
+from fastapi import FastAPI, Request
+from openai import AsyncOpenAI
+from benchmarks.bench_ingest import LocalUpload
+from benchmarks.bench_utils import write_synthetic_csv, write_synthetic_jsonl, write_synthetic_sqlite
+from db_helpers import db_metadata as meta
+from db_helpers import db_metrics
+from db_helpers.db_ingest import build_csv_dataset, build_sqlite_dataset, save_json_parquet_file
+from db_helpers.db_profile import profile_dataset
+from db_helpers.db_sampling import get_sample_cache, sample_rows
+from db_helpers.db_services import get_sample_rows, get_sqlite_schema, get_sqlite_table_names, save_parquet_file, save_raw_file
+from ai_helpers import llm_client
+from ai_helpers.insight_agent import InsightAgent
+from ai_helpers.llm_client import LLMClient
+
+'''
+bench_suite.py runs the main paths of the backend on synthetic data of a chosen size and writes the results as JSON,
+so two commits can be compared with --compare (which exits with 1 when a metric got worse by more than --threshold).
+
+Scenarios:
+- ingest: save_raw_file + save_parquet_file of a CSV, and save_raw_file + save_json_parquet_file of the same records as JSONL.
+- sqlite_schema: get_sqlite_table_names + get_sqlite_schema of a SQLite database with --schema-tables tables.
+- metadata: list_datasets, and get_dataset_by_id lookups/sec from each of --threads threads, over --datasets saved datasets.
+- sampling: get_sample_rows (Parquet and SQLite) and sample_rows (reservoir, without and with its cache).
+- insight: the InsightAgent pipeline (sample, profile, prompt, LLM call, cache) against a stub LLM that answers after --llm-latency.
+
+Metric names carry their direction: *_per_sec is better higher, *_ms and *_seconds better lower, the others are not compared.
+The stages recorded by db_metrics.py during each scenario are kept in the results too (where the time went).
+Every latency is the median of --repeat runs, sizes come from --scale and can be overridden one by one.
+'''
+
+SCALES = {
+    "small": {"rows": 100_000, "columns": 8, "schema_tables": 1000, "datasets": 1000, "sample_rows": 10_000, "insight_tables": 5},
+    "medium": {"rows": 1_000_000, "columns": 16, "schema_tables": 5000, "datasets": 10_000, "sample_rows": 100_000, "insight_tables": 20},
+    "large": {"rows": 5_000_000, "columns": 32, "schema_tables": 20_000, "datasets": 50_000, "sample_rows": 1_000_000, "insight_tables": 50},
+}
+
+def median_ms(function: Callable, repeat: int) -> float:
+    '''
+    median_ms is a function that runs function repeat times and returns the median run in milliseconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times) * 1000, 3)
+
+def stage_totals() -> dict[str, tuple[int, float]]:
+    '''
+    stage_totals is a function that returns the count and total seconds of every stage recorded by db_metrics so far.
+    '''
+    with db_metrics.STAGE_SECONDS.lock:
+        return {label_values[0]: (sum(counts[:-1]), counts[-1]) for label_values, counts in db_metrics.STAGE_SECONDS.series.items()}
+
+def bench_ingest(config: dict, tmp: Path) -> dict:
+    csv_path = write_synthetic_csv(tmp / "ingest.csv", config["rows"], config["columns"])
+    jsonl_path = write_synthetic_jsonl(tmp / "ingest.jsonl", config["rows"], config["columns"])
+    results = {"csv_bytes": csv_path.stat().st_size, "jsonl_bytes": jsonl_path.stat().st_size}
+
+    def ingest_csv():
+        target = Path(tempfile.mkdtemp(dir=tmp))
+        started = time.perf_counter()
+        raw_path, _ = save_raw_file(target, LocalUpload(csv_path))
+        saved = time.perf_counter()
+        save_parquet_file(target, raw_path)
+        return saved - started, time.perf_counter() - saved
+
+    def ingest_jsonl():
+        target = Path(tempfile.mkdtemp(dir=tmp))
+        started = time.perf_counter()
+        raw_path, _ = save_raw_file(target, LocalUpload(jsonl_path))
+        save_json_parquet_file(target, raw_path, "jsonl")
+        return time.perf_counter() - started
+
+    csv_runs = [ingest_csv() for _ in range(config["repeat"])]
+    raw_seconds = statistics.median(run[0] for run in csv_runs)
+    parquet_seconds = statistics.median(run[1] for run in csv_runs)
+    jsonl_seconds = statistics.median(ingest_jsonl() for _ in range(config["repeat"]))
+
+    results.update({
+        "csv_save_raw_mb_per_sec": round(results["csv_bytes"] / raw_seconds / 1e6, 1),
+        "csv_save_parquet_rows_per_sec": round(config["rows"] / parquet_seconds),
+        "csv_total_seconds": round(raw_seconds + parquet_seconds, 3),
+        "jsonl_rows_per_sec": round(config["rows"] / jsonl_seconds),
+        "jsonl_total_seconds": round(jsonl_seconds, 3),
+    })
+    return results
+
+def bench_sqlite_schema(config: dict, tmp: Path) -> dict:
+    sqlite_path = write_synthetic_sqlite(tmp / "schema.db", config["schema_tables"], rows=1, columns=config["columns"])
+
+    def read_schema():
+        get_sqlite_table_names(sqlite_path)
+        get_sqlite_schema(sqlite_path)
+
+    schema_ms = median_ms(read_schema, config["repeat"])
+    return {"tables": config["schema_tables"], "schema_ms": schema_ms, "tables_per_sec": round(config["schema_tables"] / schema_ms * 1000)}
+
+def bench_metadata(config: dict, tmp: Path) -> dict:
+    schema = {"table": {f"col_{i}": "BIGINT" for i in range(config["columns"])}}
+    dataset_ids = [str(uuid.uuid4()) for _ in range(config["datasets"])]
+    rows = [(dataset_id, "csv", 0, f"{tmp}/datasets/{dataset_id}/table.parquet", json.dumps(["table"]), json.dumps(schema), "{}", None, None)
+            for dataset_id in dataset_ids]
+    # "with conn" commits, the other threads read through their own connections.
+    with meta.get_metadata_store().connection() as conn, conn:
+        conn.executemany(meta.INSERT_DATASET_SQL, rows)
+
+    results = {"datasets": config["datasets"], "list_datasets_ms": median_ms(meta.list_datasets, config["repeat"])}
+    lookups = max(1000, config["datasets"])
+    for threads in config["threads"]:
+        def lookup(i: int):
+            meta.get_dataset_by_id(dataset_ids[i % len(dataset_ids)])
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lookup, range(lookups)))
+        results[f"get_dataset_threads_{threads}_per_sec"] = round(lookups / (time.perf_counter() - started))
+    return results
+
+def bench_sampling(config: dict, tmp: Path) -> dict:
+    csv_path = write_synthetic_csv(tmp / "sample.csv", config["sample_rows"], config["columns"])
+    dataset_dir = tmp / "sample_parquet"
+    dataset_dir.mkdir()
+    parquet = build_csv_dataset(str(uuid.uuid4()), save_parquet_file(dataset_dir, csv_path), csv_path.stat().st_size)
+    sqlite_path = write_synthetic_sqlite(tmp / "sample.db", 1, config["sample_rows"], config["columns"])
+    sqlite = build_sqlite_dataset(str(uuid.uuid4()), "db", sqlite_path, sqlite_path.stat().st_size)
+    repeat = config["repeat"]
+    seeds = iter(range(1_000_000))
+
+    results = {
+        "parquet_get_sample_rows_ms": median_ms(lambda: get_sample_rows(parquet, 10, parquet.tables[0]), repeat),
+        "sqlite_get_sample_rows_ms": median_ms(lambda: get_sample_rows(sqlite, 10, sqlite.tables[0]), repeat),
+        # A new seed every run, so every run samples the table.
+        "parquet_reservoir_ms": median_ms(lambda: sample_rows(parquet, parquet.tables[0], 10, "reservoir", next(seeds)), repeat),
+        "sqlite_reservoir_ms": median_ms(lambda: sample_rows(sqlite, sqlite.tables[0], 10, "reservoir", next(seeds)), repeat),
+        "parquet_reservoir_cached_ms": median_ms(lambda: sample_rows(parquet, parquet.tables[0], 10, "reservoir", 0), repeat),
+    }
+    get_sample_cache().clear()
+    return results
+
+def stub_llm_client(latency: float) -> LLMClient:
+    '''
+    stub_llm_client is a function that returns an LLMClient whose completions are answered in process after latency seconds,
+    so the insight scenario measures the pipeline around the LLM call (with a fixed, known LLM time).
+    '''
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        prompt_tokens = sum(len(message["content"].split()) for message in body["messages"])
+        return {
+            "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "A synthetic insight."}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 3, "total_tokens": prompt_tokens + 3},
+        }
+
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app))
+    client = AsyncOpenAI(api_key="bench", base_url="http://stub/v1", http_client=http_client, max_retries=0)
+    return LLMClient(client, requests_per_second=1e6, burst=1_000_000)
+
+def bench_insight(config: dict, tmp: Path) -> dict:
+    sqlite_path = write_synthetic_sqlite(tmp / "insight.db", config["insight_tables"], config["sample_rows"] // config["insight_tables"], config["columns"])
+    dataset = build_sqlite_dataset(str(uuid.uuid4()), "db", sqlite_path, sqlite_path.stat().st_size)
+    meta.save_metadata(dataset)
+    meta.save_profile(profile_dataset(dataset))
+    table_name = dataset.tables[0]
+
+    async def run() -> dict:
+        previous = llm_client._llm_client
+        llm_client._llm_client = stub_llm_client(config["llm_latency"])
+        try:
+            async def timed(table: Optional[str], use_cache: bool) -> float:
+                times = []
+                for seed in range(config["repeat"]):
+                    get_sample_cache().clear()
+                    started = time.perf_counter()
+                    await InsightAgent(dataset.dataset_id).run_full_agent(table, seed=seed if not use_cache else 0, use_cache=use_cache)
+                    times.append(time.perf_counter() - started)
+                return round(statistics.median(times) * 1000, 3)
+
+            return {
+                "tables": config["insight_tables"],
+                "llm_latency_ms": config["llm_latency"] * 1000,
+                "table_insight_ms": await timed(table_name, use_cache=False),
+                "dataset_insight_ms": await timed(None, use_cache=False),
+                "cached_insight_ms": await timed(table_name, use_cache=True),
+            }
+        finally:
+            await llm_client._llm_client.close()
+            llm_client._llm_client = previous
+
+    return asyncio.run(run())
+
+SCENARIOS: dict[str, Callable[[dict, Path], dict]] = {
+    "ingest": bench_ingest,
+    "sqlite_schema": bench_sqlite_schema,
+    "metadata": bench_metadata,
+    "sampling": bench_sampling,
+    "insight": bench_insight,
+}
+
+def git_revision() -> dict:
+    '''
+    git_revision is a function that returns the commit the benchmarks ran on, and whether the tree had uncommitted changes.
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+def run(config: dict, scenarios: list[str]) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        meta.METADATA_DB = tmp_dir / "metadata.db"
+        try:
+            for name in scenarios:
+                scenario_dir = tmp_dir / name
+                scenario_dir.mkdir()
+                before = stage_totals()
+                results[name] = SCENARIOS[name](config, scenario_dir)
+                # The stages that ran during the scenario (the ones timed inside the functions it calls), and their total time.
+                stages = {}
+                for stage, (count, seconds) in stage_totals().items():
+                    count_before, seconds_before = before.get(stage, (0, 0.0))
+                    if count > count_before:
+                        stages[stage] = {"count": count - count_before, "seconds": round(seconds - seconds_before, 4)}
+                if stages:
+                    results[name]["stages"] = stages
+        finally:
+            meta.close_metadata_stores()
+
+    return {
+        "run": {
+            **git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "pyarrow": pyarrow.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": config,
+        },
+        "results": results,
+    }
+
+def compare(baseline: dict, current: dict, threshold: float) -> tuple[list[dict], bool]:
+    '''
+    compare is a function that compares the metrics two runs have in common.
+    Returns:
+        list[dict] - One entry per compared metric: its values, the change (positive is better) and whether it regressed.
+        bool - True if a metric got worse by more than threshold (eg) 0.1 for 10%).
+    '''
+    rows = []
+    for scenario, metrics in current["results"].items():
+        for metric, value in metrics.items():
+            old = baseline["results"].get(scenario, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+                continue
+            if metric.endswith("_per_sec"):
+                change = value / old - 1
+            elif metric.endswith("_ms") or metric.endswith("_seconds"):
+                change = old / value - 1 if value else 0.0
+            else:
+                continue
+            rows.append({"metric": f"{scenario}.{metric}", "baseline": old, "current": value, "change": round(change, 3), "regressed": change < -threshold})
+    return rows, any(row["regressed"] for row in rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ingest, metadata, sampling and insight paths on synthetic data, results as JSON.")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--rows", type=int, help="Rows of the ingest files.")
+    parser.add_argument("--columns", type=int, help="Columns of every synthetic table.")
+    parser.add_argument("--schema-tables", type=int, help="Tables of the sqlite_schema database.")
+    parser.add_argument("--datasets", type=int, help="Datasets saved for the metadata scenario.")
+    parser.add_argument("--sample-rows", type=int, help="Rows of the sampled tables (split over the tables of the insight dataset).")
+    parser.add_argument("--insight-tables", type=int, help="Tables of the insight dataset.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the stub LLM takes to answer.")
+    parser.add_argument("--output", type=Path, help="Write the results to this file instead of stdout.")
+    parser.add_argument("--compare", type=Path, nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two result files instead of running.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Relative change past which --compare reports a regression.")
+    args = parser.parse_args()
+
+    if args.compare:
+        baseline, current = (json.loads(path.read_text()) for path in args.compare)
+        rows, regressed = compare(baseline, current, args.threshold)
+        print(json.dumps({"baseline": baseline["run"]["commit"], "current": current["run"]["commit"], "threshold": args.threshold,
+                          "regressed": regressed, "metrics": rows}, indent=2))
+        sys.exit(1 if regressed else 0)
+
+    config = dict(SCALES[args.scale], threads=args.threads, repeat=args.repeat, llm_latency=args.llm_latency, scale=args.scale)
+    for key in ("rows", "columns", "schema_tables", "datasets", "sample_rows", "insight_tables"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    output = json.dumps(run(config, args.only), indent=2, default=str)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+# python3 -m benchmarks.bench_suite
@@ -0,0 +1,99 @@
+import json
+import random
+import sqlite3
+from pathlib import Path
+
+'''
+bench_utils.py is a module that contains the helpers shared by the benchmark scripts (synthetic CSV, JSONL and SQLite data generation).
+'''
+
+def write_synthetic_csv(path: Path, rows: int, columns: int = 8, seed: int = 0) -> Path:
+    '''
+    write_synthetic_csv is a function that writes a CSV of mixed integer, float and text columns.
+
+    Args:
+        path: Path - Where to write the CSV.
+        rows: int - The number of data rows.
+        columns: int - The number of columns, cycling through int, float and text.
+        seed: int - Random seed so that runs are reproducible.
+
+    Returns:
+        Path - The path to the written CSV.
+    '''
+    rng = random.Random(seed)
+    header = ",".join(f"col_{i}" for i in range(columns))
+
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for row in range(rows):
+            values = []
+            for i in range(columns):
+                if i % 3 == 0:
+                    values.append(str(row * columns + i))
+                elif i % 3 == 1:
+                    values.append(f"{rng.random() * 1000:.4f}")
+                else:
+                    values.append(f"category_{rng.randint(0, 50)}")
+            f.write(",".join(values) + "\n")
+
+    return path
+
+def write_synthetic_jsonl(path: Path, rows: int, columns: int = 8, seed: int = 0) -> Path:
+    '''
+    write_synthetic_jsonl is a function that writes the records of write_synthetic_csv as JSONL,
+    with the text columns nested under a "details" object (so the ingest has a struct to flatten).
+    '''
+    rng = random.Random(seed)
+
+    with open(path, "w") as f:
+        for row in range(rows):
+            record = {}
+            details = {}
+            for i in range(columns):
+                if i % 3 == 0:
+                    record[f"col_{i}"] = row * columns + i
+                elif i % 3 == 1:
+                    record[f"col_{i}"] = round(rng.random() * 1000, 4)
+                else:
+                    details[f"col_{i}"] = f"category_{rng.randint(0, 50)}"
+            record["details"] = details
+            f.write(json.dumps(record) + "\n")
+
+    return path
+
+def write_synthetic_sqlite(path: Path, tables: int, rows: int, columns: int = 8, seed: int = 0) -> Path:
+    '''
+    write_synthetic_sqlite is a function that writes a SQLite database of tables shaped like write_synthetic_csv,
+    each with an INTEGER PRIMARY KEY id and (after the first) a parent_id referencing the table before it.
+
+    Args:
+        path: Path - Where to write the database.
+        tables: int - The number of tables (eg) thousands, for schema extraction).
+        rows: int - The number of rows of every table.
+        columns: int - The number of columns besides the keys, cycling through int, float and text.
+        seed: int - Random seed so that runs are reproducible.
+
+    Returns:
+        Path - The path to the written database.
+    '''
+    rng = random.Random(seed)
+    types = ["INTEGER", "REAL", "TEXT"]
+    names = [f"col_{i}" for i in range(columns)]
+
+    conn = sqlite3.connect(str(path))
+    try:
+        for t in range(tables):
+            keys = "id INTEGER PRIMARY KEY" + (f", parent_id INTEGER REFERENCES table_{t - 1}(id)" if t else "")
+            conn.execute(f"CREATE TABLE table_{t} ({keys}, {', '.join(f'{name} {types[i % 3]}' for i, name in enumerate(names))})")
+            values = []
+            for row in range(rows):
+                record = [row * columns + i if i % 3 == 0 else round(rng.random() * 1000, 4) if i % 3 == 1 else f"category_{rng.randint(0, 50)}"
+                          for i in range(columns)]
+                values.append(([row + 1] if t else []) + record)
+            columns_list = (["parent_id"] if t else []) + names
+            conn.executemany(f"INSERT INTO table_{t} ({', '.join(columns_list)}) VALUES ({', '.join('?' * len(columns_list))})", values)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return path
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Optional
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .db_constants import (
+    AGGREGATES_ROOT,
+    AGGREGATE_CACHE_MAX_ENTRIES,
+    AGGREGATION_MAX_GROUPS,
+    Aggregate,
+    AggregationRequest,
+    AggregationResult,
+    Dataset
+)
+from .db_engine import get_duckdb_engine, quote_identifier, quote_literal
+from .db_metrics import Stage
+from .db_metadata import get_cached_aggregate, list_cached_aggregates, save_cached_aggregate, delete_cached_aggregates
+from .db_services import file_fingerprint
+
+'''
+db_aggregates.py is a module that computes group-by summaries of a table (counts, sums, averages, min/max and quantiles over
+chosen dimensions) and keeps every result as a small materialized Parquet file, so a question asked again does not scan the table.
+
+- A result is keyed by the fingerprint of its query (dataset, table, dimensions, aggregates) and stored with the fingerprint of
+  the table's source file. Once the source changes (eg) rows appended, a SQLite table converted to Parquet) the result is never
+  served again, the next request scans the table and replaces it, and the other results of the table are dropped.
+- A question over fewer dimensions than a materialized result, whose aggregates are counts/sums/min/max of that result,
+  is rolled up from it (a GROUP BY over its groups) instead of scanning the table.
+- A scan is one vectorized GROUP BY query over the table, every aggregate of the request in the same pass.
+'''
+
+# Aggregates that can be computed again from the per-group values of a finer result, and how.
+ROLLUP_FUNCTIONS = {"count": "sum({})::BIGINT", "sum": "sum({})", "min": "min({})", "max": "max({})"}
+
+def aggregate_name(aggregate: Aggregate) -> str:
+    '''
+    aggregate_name is a function that returns the result column of an aggregate.
+    eg) count -> count, sum of amount -> sum_amount, quantile 0.9 of amount -> quantile_0.9_amount
+    '''
+    if aggregate.column is None:
+        return aggregate.function
+    if aggregate.function == "quantile":
+        return f"quantile_{aggregate.quantile:g}_{aggregate.column}"
+    return f"{aggregate.function}_{aggregate.column}"
+
+def aggregate_expression(aggregate: Aggregate) -> str:
+    '''
+    aggregate_expression is a function that returns the DuckDB aggregate of an Aggregate, eg) quantile_cont("amount", 0.9).
+    '''
+    if aggregate.column is None:
+        return "count(*)"
+    column = quote_identifier(aggregate.column)
+    if aggregate.function == "quantile":
+        return f"quantile_cont({column}, {aggregate.quantile!r})"
+    return f"{aggregate.function}({column})"
+
+def check_request(dataset: Dataset, request: AggregationRequest) -> AggregationRequest:
+    '''
+    check_request is a function that validates an AggregationRequest against the dataset and fills in its table_name.
+    Raises:
+        ValueError - If the table, a column or an aggregate is not valid.
+    '''
+    table_name = request.table_name
+    if table_name is None:
+        if len(dataset.tables) != 1:
+            raise ValueError("table_name is required for a dataset with several tables.")
+        table_name = dataset.tables[0]
+    if table_name not in dataset.tables:
+        raise ValueError(f"Table {table_name} not found in the dataset.")
+    if not request.aggregates:
+        raise ValueError("At least one aggregate is required.")
+    if len(set(request.dimensions)) != len(request.dimensions):
+        raise ValueError("The dimensions must be different columns.")
+
+    for aggregate in request.aggregates:
+        if aggregate.column is None and aggregate.function != "count":
+            raise ValueError(f"{aggregate.function} needs a column.")
+        if aggregate.function == "quantile" and (aggregate.quantile is None or not 0 <= aggregate.quantile <= 1):
+            raise ValueError("quantile needs a quantile between 0 and 1.")
+        if aggregate.function != "quantile" and aggregate.quantile is not None:
+            raise ValueError(f"{aggregate.function} does not take a quantile.")
+
+    names = request.dimensions + [aggregate_name(aggregate) for aggregate in request.aggregates]
+    if len(set(names)) != len(names):
+        raise ValueError("The result columns must have different names (an aggregate is repeated or named like a dimension).")
+
+    # The schema lists the columns of every table, a table without one (eg) an old dataset) is left to DuckDB to check.
+    columns = dataset.schema.get(table_name)
+    if columns:
+        used = request.dimensions + [aggregate.column for aggregate in request.aggregates if aggregate.column is not None]
+        unknown = [column for column in used if column not in columns]
+        if unknown:
+            raise ValueError(f"Columns {unknown} not found in table {table_name}.")
+
+    return request.model_copy(update={"table_name": table_name})
+
+def aggregation_fingerprint(dataset_id: str, request: AggregationRequest) -> str:
+    '''
+    aggregation_fingerprint is a function that returns the cache key of a (checked) request, the same query always has the same key.
+    '''
+    parts = {"dataset_id": dataset_id, **request.model_dump()}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def group_by_sql(from_clause: str, dimensions: list[str], expressions: list[str], names: list[str]) -> str:
+    '''
+    group_by_sql is a function that returns the GROUP BY query of a result, ordered by its dimensions.
+    The LIMIT only reads one group past AGGREGATION_MAX_GROUPS, enough to tell the result is too large.
+    '''
+    columns = [quote_identifier(dimension) for dimension in dimensions]
+    select_list = columns + [f"{expression} AS {quote_identifier(name)}" for expression, name in zip(expressions, names)]
+    sql = f"SELECT {', '.join(select_list)} FROM {from_clause}"
+    if columns:
+        sql += f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}"
+    return sql + f" LIMIT {AGGREGATION_MAX_GROUPS + 1}"
+
+def rollup_sql(request: AggregationRequest, cached: list[tuple[str, str, Path, int]]) -> Optional[str]:
+    '''
+    rollup_sql is a function that returns the query answering a request from the smallest materialized result it can be rolled up from,
+    or None if there is none: the result must group by every dimension of the request and have every aggregate of it,
+    and those must be counts, sums, min or max (an average or a quantile of groups is not the one of their rows).
+    '''
+    if any(aggregate.function not in ROLLUP_FUNCTIONS for aggregate in request.aggregates):
+        return None
+
+    names = [aggregate_name(aggregate) for aggregate in request.aggregates]
+    for _, cached_request, path, _ in cached:
+        finer = AggregationRequest.model_validate_json(cached_request)
+        finer_names = {aggregate_name(aggregate) for aggregate in finer.aggregates}
+        if set(request.dimensions) <= set(finer.dimensions) and set(names) <= finer_names:
+            expressions = [ROLLUP_FUNCTIONS[aggregate.function].format(quote_identifier(name)) for aggregate, name in zip(request.aggregates, names)]
+            # The count of a table with no rows is 0, not the NULL sum of no groups.
+            if not request.dimensions:
+                expressions = [f"coalesce({expression}, 0)" if aggregate.function == "count" else expression
+                               for aggregate, expression in zip(request.aggregates, expressions)]
+            return group_by_sql(f"read_parquet({quote_literal(str(path))})", request.dimensions, expressions, names)
+    return None
+
+def json_value(value: Any) -> Any:
+    '''
+    json_value is a function that turns the DuckDB decimals of a result into numbers JSON keeps, eg) a sum of integers (HUGEINT) -> int.
+    '''
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    return value
+
+def aggregates_dir(dataset_id: str) -> Path:
+    return AGGREGATES_ROOT / dataset_id
+
+def materialize(dataset_id: str, table_name: str, fingerprint: str, source_fingerprint: str, request: AggregationRequest, table: pa.Table):
+    '''
+    materialize is a function that writes a result to its Parquet file and records it, then deletes the files of the results it replaced.
+    '''
+    path = aggregates_dir(dataset_id) / f"{fingerprint}.parquet"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written next to its final path then renamed, a concurrent reader sees the old file or the new one, never half of it.
+    temp_path = path.with_name(f"{fingerprint}.{uuid.uuid4().hex}.tmp")
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, path)
+
+    dropped = save_cached_aggregate(fingerprint, dataset_id, table_name, source_fingerprint, request.model_dump_json(), path, table.num_rows,
+                                    AGGREGATE_CACHE_MAX_ENTRIES)
+    for dropped_path in dropped:
+        dropped_path.unlink(missing_ok=True)
+
+def aggregate_dataset(dataset: Dataset, request: AggregationRequest) -> AggregationResult:
+    '''
+    aggregate_dataset is a function that computes the aggregates of a table grouped by its dimensions, from the materialized result
+    of the same query if there is a current one, else rolled up from a finer one, else with a scan of the table (which is then materialized).
+
+    Args:
+        dataset: Dataset - The dataset to aggregate.
+        request: AggregationRequest - The table, dimensions and aggregates.
+    Returns:
+        AggregationResult - One row per group, ordered by the dimensions.
+    Raises:
+        ValueError - If the request is not valid, the query fails or it has more than AGGREGATION_MAX_GROUPS groups.
+    '''
+    started = time.perf_counter()
+    request = check_request(dataset, request)
+    table_name = request.table_name
+    fingerprint = aggregation_fingerprint(dataset.dataset_id, request)
+    # The fingerprint of the table's own file, so converting or appending to one table does not drop the results of the others.
+    source_fingerprint = file_fingerprint(dataset.table_paths.get(table_name, dataset.dataset_path))
+
+    table = None
+    cache = "hit"
+    path = get_cached_aggregate(fingerprint, source_fingerprint)
+    if path is not None:
+        try:
+            table = pq.read_table(path)
+        except FileNotFoundError:
+            # Evicted by another request since the lookup.
+            table = None
+
+    if table is None:
+        cache = "rollup"
+        sql = rollup_sql(request, list_cached_aggregates(dataset.dataset_id, table_name, source_fingerprint))
+        if sql is not None:
+            try:
+                table = get_duckdb_engine().cursor().execute(sql).fetch_arrow_table()
+            except duckdb.Error:
+                table = None
+
+    if table is None:
+        cache = "miss"
+        names = [aggregate_name(aggregate) for aggregate in request.aggregates]
+        expressions = [aggregate_expression(aggregate) for aggregate in request.aggregates]
+        with get_duckdb_engine().dataset(dataset) as session:
+            try:
+                with Stage("aggregate_scan") as stage:
+                    table = session.cursor.execute(group_by_sql(session.table(table_name), request.dimensions, expressions, names)).fetch_arrow_table()
+                    stage.rows = table.num_rows
+            except duckdb.Error as e:
+                raise ValueError(f"Error aggregating table {table_name}: {e}")
+
+    if table.num_rows > AGGREGATION_MAX_GROUPS:
+        raise ValueError(f"The result has more than {AGGREGATION_MAX_GROUPS} groups, aggregate over fewer (or coarser) dimensions.")
+    if cache != "hit":
+        materialize(dataset.dataset_id, table_name, fingerprint, source_fingerprint, request, table)
+
+    rows = table.to_pylist()
+    # Only the decimal columns need converting, the other values are already Python numbers, strings or dates.
+    decimals = [field.name for field in table.schema if pa.types.is_decimal(field.type)]
+    for row in rows:
+        for name in decimals:
+            row[name] = json_value(row[name])
+
+    return AggregationResult(
+        dataset_id=dataset.dataset_id,
+        table_name=table_name,
+        fingerprint=fingerprint,
+        columns=table.column_names,
+        rows=rows,
+        cache=cache,
+        seconds=time.perf_counter() - started
+    )
+
+def invalidate_aggregates(dataset_id: str, table_name: Optional[str] = None) -> int:
+    '''
+    invalidate_aggregates is a function that drops the materialized results of a dataset (or one table), returns how many were dropped.
+    '''
+    dropped = delete_cached_aggregates(dataset_id, table_name)
+    for path in dropped:
+        path.unlink(missing_ok=True)
+    if table_name is None:
+        shutil.rmtree(aggregates_dir(dataset_id), ignore_errors=True)
+    return len(dropped)
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_aggregates
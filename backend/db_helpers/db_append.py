@@ -0,0 +1,309 @@
+import csv
+import fcntl
+import io
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+import duckdb
+from .db_constants import DATA_ROOT, DUCKDB_MEMORY_LIMIT, APPEND_COMPACT_MAX_FILES, Dataset, IngestStats, UploadType, ParquetLayout
+from .db_engine import PARQUET_UPLOAD_TYPES, get_duckdb_engine, parquet_source, quote_identifier, quote_literal
+from .db_services import copy_to_parquet
+from .db_ingest import build_ingest_stats, count_parquet_rows, flatten_columns, sniff_csv_delimiter
+from .db_profile import merge_table_profile, profile_table, profile_dataset
+from .db_metadata import (
+    get_dataset_by_id,
+    get_artifact,
+    detach_artifact,
+    update_dataset_files,
+    get_profile,
+    save_profile
+)
+
+'''
+db_append.py is a module that appends CSV/JSON/JSONL batches to an existing CSV/JSON/JSONL dataset, without re-ingesting it.
+
+A table that is appended to becomes a directory of Parquet files (tables/<table>-<id>/, with the Hive partitions of its layout if any).
+Each batch is checked against the stored schema, cast to its types and written as one more file, and the profile is updated from
+the batch alone (see merge_table_profile), so appending 1% of the rows costs about 1% of the ingest.
+Many small files slow the reads down, compact_dataset rewrites the table into one file per partition (see APPEND_COMPACT_MAX_FILES).
+
+Appends and compactions of a dataset hold its lock (a file lock, the compaction runs in the ingest process pool) so they never interleave.
+'''
+
+# Upload types a batch can be, json is an array of records (or newline-delimited), jsonl is newline-delimited.
+APPEND_BATCH_TYPES = ("csv", "json", "jsonl")
+
+@contextmanager
+def dataset_lock(dataset_id: str) -> Iterator[None]:
+    '''
+    dataset_lock is a function that holds the append lock of a dataset, across threads and processes.
+    '''
+    lock_dir = DATA_ROOT / dataset_id
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / ".append.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def link_file(source: Path, target: Path):
+    '''
+    link_file is a function that hard links a file (copies it if the file system has no hard links).
+    '''
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def link_tree(source: Path, target: Path):
+    '''
+    link_tree is a function that mirrors the files of a directory into another one with hard links (copies if the file system has none).
+    The files are never modified in place (appends and compactions write new files), so the two trees can share them.
+    '''
+    for path in source.rglob("*"):
+        if not path.is_file() or path.name == ".append.lock":
+            continue
+        linked = target / path.relative_to(source)
+        if linked.exists():
+            continue
+        linked.parent.mkdir(parents=True, exist_ok=True)
+        link_file(path, linked)
+
+def own_dataset_files(dataset: Dataset) -> Dataset:
+    '''
+    own_dataset_files is a function that gives a deduplicated dataset files of its own before they are appended to,
+    the other datasets sharing them (see clone_dataset) keep the content they were uploaded with.
+
+    Returns:
+        Dataset - The dataset, with its paths under DATA_ROOT/dataset_id and no artifact_key.
+    '''
+    if dataset.artifact_key is None:
+        return dataset
+
+    artifact = get_artifact(dataset.artifact_key)
+    if artifact is None:
+        raise ValueError(f"Artifact of dataset {dataset.dataset_id} not found.")
+    artifact_dir, refcount = artifact
+    own_dir = DATA_ROOT / dataset.dataset_id
+
+    moved_dir = None
+    if artifact_dir != own_dir:
+        link_tree(artifact_dir, own_dir)
+    elif refcount > 1:
+        # The others can not stay in this dataset's directory, it is deleted with this dataset.
+        moved_dir = DATA_ROOT / f"artifact-{uuid.uuid4()}"
+        link_tree(own_dir, moved_dir)
+
+    try:
+        files_dir = detach_artifact(dataset.dataset_id, artifact_dir, moved_dir)
+    except ValueError:
+        if moved_dir is not None:
+            shutil.rmtree(moved_dir, ignore_errors=True)
+        raise
+
+    if files_dir is not None:
+        shutil.rmtree(files_dir, ignore_errors=True)
+    return get_dataset_by_id(dataset.dataset_id)
+
+def read_csv_header(raw_path: Path) -> tuple[str, list[str]]:
+    '''
+    read_csv_header is a function that reads the delimiter and the column names of a CSV from its first lines.
+    eg) "id;name\\n1;ada\\n" -> (";", ["id", "name"])
+    '''
+    with open(raw_path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        # A few lines are enough, the sniffer's time grows with the sample.
+        sample = f.read(8 * 1024)
+    delimiter = sniff_csv_delimiter(sample)
+    header = next(csv.reader(io.StringIO(sample), delimiter=delimiter), [])
+    return delimiter, header
+
+def batch_select_sql(conn: duckdb.DuckDBPyConnection, raw_path: Path, batch_type: UploadType, schema: dict[str, str]) -> str:
+    '''
+    batch_select_sql is a function that builds the query reading a batch with the columns, names and types of the stored schema.
+    A CSV batch must have every column (in any order). JSON structs are flattened like at ingest (eg) address.city),
+    a JSON batch may leave columns out (records without the key), they are NULL.
+
+    Raises:
+        ValueError - If the batch has columns the dataset does not have, or (CSV) misses some of them.
+    '''
+    if batch_type == "csv":
+        # The types are the stored ones, so DuckDB does not need to sniff the batch (which would cost more than reading it).
+        delimiter, columns = read_csv_header(raw_path)
+        extra = [column for column in columns if column not in schema]
+        missing = [column for column in schema if column not in columns]
+        if extra or missing:
+            raise ValueError(f"The batch columns do not match the dataset, extra: {extra}, missing: {missing}.")
+        types = "{" + ", ".join(f"{quote_literal(column)}: {quote_literal(schema[column])}" for column in columns) + "}"
+        # Every file of the table has the columns in the stored order.
+        return (f"SELECT {', '.join(quote_identifier(column) for column in schema)} FROM read_csv({quote_literal(str(raw_path))}, header = true, "
+                f"auto_detect = false, delim = {quote_literal(delimiter)}, quote = '\"', escape = '\"', columns = {types})")
+
+    json_format = "newline_delimited" if batch_type == "jsonl" else "auto"
+    source = f"read_json({quote_literal(str(raw_path))}, format = {quote_literal(json_format)}, sample_size = -1)"
+    relation = conn.sql(f"SELECT * FROM {source}")
+    source = f"SELECT {', '.join(flatten_columns(relation.columns, relation.dtypes))} FROM {source}"
+
+    columns = conn.sql(source).columns
+    extra = [column for column in columns if column not in schema]
+    if extra:
+        raise ValueError(f"The batch has columns that are not in the dataset: {extra}.")
+
+    select = [f"CAST({quote_identifier(column)} AS {column_type}) AS {quote_identifier(column)}" if column in columns
+              else f"CAST(NULL AS {column_type}) AS {quote_identifier(column)}"
+              for column, column_type in schema.items()]
+    return f"SELECT {', '.join(select)} FROM ({source})"
+
+def publish_files(written: Path, table_dir: Path) -> int:
+    '''
+    publish_files is a function that moves newly written Parquet files into a table directory under unique names,
+    keeping their Hive partition directories. Each file appears at once (a rename), readers never see a partial one.
+
+    Returns:
+        int - The number of files moved.
+    '''
+    files = [written] if written.is_file() else sorted(written.rglob("*.parquet"))
+    for path in files:
+        relative = Path() if path == written else path.parent.relative_to(written)
+        (table_dir / relative).mkdir(parents=True, exist_ok=True)
+        os.replace(path, table_dir / relative / f"part-{uuid.uuid4().hex}.parquet")
+    return len(files)
+
+def table_directory(dataset: Dataset) -> Path:
+    '''
+    table_directory is a function that returns the directory of Parquet files of a dataset's table, creating it on the first append.
+    A single .parquet file is linked into a new directory, the file itself is only removed once the metadata points to the directory.
+    '''
+    dataset_path = Path(dataset.dataset_path)
+    if dataset_path.is_dir():
+        return dataset_path
+
+    table_dir = dataset_path.parent / f"{dataset.tables[0]}-{uuid.uuid4().hex[:8]}"
+    table_dir.mkdir(parents=True)
+    link_file(dataset_path, table_dir / f"part-{uuid.uuid4().hex}.parquet")
+    return table_dir
+
+def most_files_per_directory(table_dir: Path) -> int:
+    '''
+    most_files_per_directory is a function that returns the number of Parquet files in the fullest directory (partition) of a table.
+    '''
+    counts: dict[Path, int] = {}
+    for path in table_dir.rglob("*.parquet"):
+        counts[path.parent] = counts.get(path.parent, 0) + 1
+    return max(counts.values(), default=0)
+
+def append_to_dataset(dataset_id: str, raw_path: Path, batch_type: UploadType) -> tuple[IngestStats, bool]:
+    '''
+    append_to_dataset is a function that appends the rows of a CSV/JSON/JSONL batch to a dataset.
+
+    Args:
+        dataset_id: str - The id of a CSV, JSON or JSONL dataset.
+        raw_path: Path - The saved batch, it is not kept.
+        batch_type: UploadType - "csv", "json" or "jsonl", the batch does not have to be the type the dataset was uploaded as.
+    Returns:
+        IngestStats - The rows/sec and bytes/sec of the append.
+        bool - True if the table now has more than APPEND_COMPACT_MAX_FILES files in a directory and should be compacted.
+    Raises:
+        ValueError - If the dataset can not be appended to, or the batch does not fit its schema.
+    '''
+    started = time.perf_counter()
+    raw_size = raw_path.stat().st_size
+    if raw_size == 0:
+        raise ValueError(f"Uploaded file {raw_path.name} is empty.")
+    if batch_type not in APPEND_BATCH_TYPES:
+        raise ValueError(f"Batches must be CSV, JSON or JSONL, got {batch_type}.")
+
+    # Raises for an unknown dataset before its lock (and directory) is created.
+    get_dataset_by_id(dataset_id)
+    with dataset_lock(dataset_id):
+        dataset = get_dataset_by_id(dataset_id)
+        if dataset.upload_type not in PARQUET_UPLOAD_TYPES:
+            raise ValueError(f"Only CSV, JSON and JSONL datasets can be appended to, this one is {dataset.upload_type}.")
+        dataset = own_dataset_files(dataset)
+
+        table_name = dataset.tables[0]
+        layout = dataset.layout or ParquetLayout()
+        # Written next to the table (same file system) and only moved into it once complete.
+        staging_dir = Path(dataset.dataset_path).parent / f".append-{uuid.uuid4().hex}"
+        staging_dir.mkdir(parents=True)
+
+        # The engine's cursor for this thread, a new DuckDB connection per batch would cost about as much as a small batch.
+        cursor = get_duckdb_engine().cursor()
+        try:
+            try:
+                written = copy_to_parquet(cursor, batch_select_sql(cursor, raw_path, batch_type, dataset.schema[table_name]), staging_dir / "part", layout)
+            except duckdb.Error as e:
+                raise ValueError(f"The batch does not fit the schema of the dataset: {e}")
+
+            rows = count_parquet_rows(written)
+            if rows == 0:
+                raise ValueError(f"Uploaded file {raw_path.name} has no rows.")
+
+            # Only the batch is scanned, its stats are merged into the stored profile.
+            profile = get_profile(dataset_id)
+            old_table = profile.tables.get(table_name) if profile else None
+            if old_table is not None and old_table.error is None:
+                profile.tables[table_name] = merge_table_profile(cursor, old_table, parquet_source(str(written)))
+
+            table_dir = table_directory(dataset)
+            publish_files(written, table_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        update_dataset_files(dataset_id, str(table_dir), dataset.raw_byte_size + raw_size)
+        if Path(dataset.dataset_path) != table_dir:
+            Path(dataset.dataset_path).unlink(missing_ok=True)
+
+        # Nothing to merge into, profile the whole table once.
+        appended = dataset.model_copy(update={"dataset_path": str(table_dir)})
+        if profile is None:
+            profile = profile_dataset(appended)
+        elif old_table is None or old_table.error is not None:
+            with get_duckdb_engine().dataset(appended) as session:
+                profile.tables[table_name] = profile_table(session.cursor, table_name, session.table(table_name))
+        profile.created_at = time.time()
+        save_profile(profile)
+
+        return build_ingest_stats("append", rows, raw_size, started), most_files_per_directory(table_dir) > APPEND_COMPACT_MAX_FILES
+
+def compact_dataset(dataset_id: str) -> Optional[Path]:
+    '''
+    compact_dataset is a function that rewrites the appended files of a dataset's table into one file per partition, with its layout
+    (so a sorted table is sorted again across the batches). The rows and the profile do not change.
+
+    Returns:
+        Path - The new table directory, None if the dataset was never appended to.
+    Raises:
+        ValueError - If the dataset does not exist or the rewrite fails.
+    '''
+    get_dataset_by_id(dataset_id)
+    with dataset_lock(dataset_id):
+        dataset = get_dataset_by_id(dataset_id)
+        old_dir = Path(dataset.dataset_path)
+        if dataset.upload_type not in PARQUET_UPLOAD_TYPES or not old_dir.is_dir() or dataset.artifact_key is not None:
+            return None
+
+        table_name = dataset.tables[0]
+        new_dir = old_dir.parent / f"{table_name}-{uuid.uuid4().hex[:8]}"
+        layout = dataset.layout or ParquetLayout()
+        conn = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY_LIMIT})
+        try:
+            new_dir.mkdir(parents=True)
+            # Partitioned: copy_to_parquet writes new_dir itself as the directory of partitions.
+            target = new_dir if layout.partition_by else new_dir / f"part-{uuid.uuid4().hex}"
+            copy_to_parquet(conn, f"SELECT * FROM {parquet_source(str(old_dir))}", target, layout)
+        except (duckdb.Error, ValueError) as e:
+            shutil.rmtree(new_dir, ignore_errors=True)
+            raise ValueError(f"Error compacting dataset {dataset_id}: {e}")
+        finally:
+            conn.close()
+
+        update_dataset_files(dataset_id, str(new_dir), dataset.raw_byte_size)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return new_dir
+
+# python3 -m db_helpers.db_append
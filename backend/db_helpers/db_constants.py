@@ -1,6 +1,7 @@
 from pydantic import BaseModel
-from typing import Literal, Optional
+from typing import Any, Literal, Optional
 from pathlib import Path
+import os
 
 # UploadType is a literal type that represents the type of file that is being uploaded. (must be one of the following)
 UploadType = Literal["csv", "json", "jsonl", "sqlite", "sql_dump", "sql", "db", "unknown"]
@@ -17,14 +18,201 @@ METADATA_DB = BASE_DIR / "metadata.db"
 # Metadata table name in the metadata database.
 METADATA_TABLE = "datasets_metadata"
 
+# Single-row table whose revision is bumped (by triggers) on every change to the metadata table.
+METADATA_REVISION_TABLE = "metadata_revision"
+
+# Number of decoded Dataset objects kept in memory per process.
+DATASET_CACHE_SIZE = int(os.getenv("DATASPACE_DATASET_CACHE_SIZE", "4096"))
+
+# Largest page /db/datasets will return.
+DATASETS_PAGE_MAX = 500
+
+# Search index in the metadata database: one row per column of every dataset table, and the FTS5 index over their file, table and column names.
+COLUMNS_INDEX_TABLE = "dataset_columns"
+SEARCH_INDEX_TABLE = "dataset_search"
+
+# Default and largest number of hits /db/search returns.
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+
+# Number of idle metadata connections kept open per process.
+METADATA_POOL_SIZE = int(os.getenv("DATASPACE_METADATA_POOL_SIZE", "8"))
+
+# Process-wide DuckDB engine settings (see db_engine.py).
+DUCKDB_MEMORY_LIMIT = os.getenv("DATASPACE_DUCKDB_MEMORY_LIMIT", "2GB")
+DUCKDB_THREADS = int(os.getenv("DATASPACE_DUCKDB_THREADS", str(os.cpu_count() or 4)))
+# Number of SQLite datasets kept attached, the least recently used one is detached past this.
+DUCKDB_MAX_ATTACHED = int(os.getenv("DATASPACE_DUCKDB_MAX_ATTACHED", "32"))
+
+# Request and stage metrics served at /metrics (see db_metrics.py), DATASPACE_METRICS=0 turns them off.
+METRICS_ENABLED = os.getenv("DATASPACE_METRICS", "1") != "0"
+# Send the stages of each request back in a Server-Timing header (shown by the browser dev tools).
+SERVER_TIMING_ENABLED = os.getenv("DATASPACE_SERVER_TIMING", "0") == "1"
+# Upper bounds (in seconds) of the buckets of the latency histograms.
+METRICS_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Limits of the /db/datasets/{id}/query endpoint.
+QUERY_DEFAULT_ROW_LIMIT = 100_000
+QUERY_MAX_ROW_LIMIT = 10_000_000
+QUERY_DEFAULT_TIMEOUT_SECONDS = 30.0
+QUERY_MAX_TIMEOUT_SECONDS = 300.0
+# Rows per streamed Arrow record batch / NDJSON chunk.
+QUERY_BATCH_ROWS = 10_000
+
+# Default and largest page of the /db/datasets/{id}/tables/{table}/rows viewer (see db_rows.py).
+ROWS_PAGE_DEFAULT = 100
+ROWS_PAGE_MAX = 10_000
+
+# RowFilterOp is the comparison of a RowFilter, is_null and not_null take no value.
+RowFilterOp = Literal["eq", "ne", "lt", "lte", "gt", "gte", "like", "is_null", "not_null"]
+
+# Column profile table name in the metadata database. (one row per dataset, see db_profile.py)
+PROFILES_TABLE = "dataset_profiles"
+
+# Number of most frequent values and histogram bins kept per column in a profile.
+PROFILE_TOP_K = 10
+PROFILE_HISTOGRAM_BINS = 20
+
+# Insight cache table name in the metadata database. (LLM responses of the InsightAgent, see ai_helpers/insight_cache.py)
+INSIGHT_CACHE_TABLE = "insight_cache"
+
+# Cached insights older than this are generated again, and at most this many are kept (least recently used are dropped).
+INSIGHT_CACHE_TTL_SECONDS = float(os.getenv("DATASPACE_INSIGHT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+INSIGHT_CACHE_MAX_ENTRIES = int(os.getenv("DATASPACE_INSIGHT_CACHE_MAX_ENTRIES", "1000"))
+
+# Aggregation cache table name in the metadata database. (one row per materialized group-by result, see db_aggregates.py)
+AGGREGATE_CACHE_TABLE = "aggregate_cache"
+
+# Materialized group-by results, one small Parquet file per result under AGGREGATES_ROOT/dataset_id.
+AGGREGATES_ROOT = BASE_DIR / "aggregates"
+
+# At most this many results are kept (least recently used are dropped), and a result can have at most this many groups.
+AGGREGATE_CACHE_MAX_ENTRIES = int(os.getenv("DATASPACE_AGGREGATE_CACHE_MAX_ENTRIES", "1000"))
+AGGREGATION_MAX_GROUPS = 100_000
+
+# AggregateFunction is what an Aggregate computes per group, quantile is exact (quantile_cont).
+AggregateFunction = Literal["count", "sum", "avg", "min", "max", "quantile"]
+
+# SampleStrategy is how the sample rows of a table are picked (see db_sampling.py).
+SampleStrategy = Literal["head", "reservoir", "system", "stratified", "outlier"]
+
+# Strategy used by the InsightAgent unless the request asks for another one.
+SAMPLE_DEFAULT_STRATEGY: SampleStrategy = "reservoir"
+
+# Most rows a sample can have (num_rows of /db/datasets/{id}/sample), the samples are cached in memory.
+SAMPLE_MAX_ROWS = 500
+
+# Number of samples kept in memory per process, keyed by (dataset, table, strategy, seed, ...).
+SAMPLE_CACHE_SIZE = 256
+
+# The system strategy samples whole vectors until about this many rows, then picks the sample rows from those.
+SAMPLE_SYSTEM_POOL_ROWS = 100_000
+
+# A column with at most this many distinct values can be used to stratify a sample.
+SAMPLE_MAX_STRATA = 50
+
+# Tables sampled at once when a whole dataset is sampled (each on its own DuckDB cursor).
+SAMPLE_MAX_WORKERS = 8
+
+# Ingest job table name in the metadata database. (lives next to the metadata table)
+JOBS_TABLE = "ingest_jobs"
+
+# Artifact table name in the metadata database: one row per converted upload content, with the number of datasets using it.
+ARTIFACTS_TABLE = "dataset_artifacts"
+
+# Resumable uploads (see db_uploads.py): the sessions and the checksums of their received chunks, in the metadata database.
+UPLOAD_SESSIONS_TABLE = "upload_sessions"
+UPLOAD_CHUNKS_TABLE = "upload_chunks"
+
+# Files of the upload sessions in progress, moved into DATA_ROOT when the session is completed.
+UPLOAD_ROOT = BASE_DIR / "uploads"
+
+# Default and largest chunk of a resumable upload. A chunk is held in memory while it is received.
+UPLOAD_SESSION_CHUNK_BYTES = 64 * 1024 * 1024
+UPLOAD_SESSION_MAX_CHUNK_BYTES = 256 * 1024 * 1024
+
+# Upload sessions with no chunk received for this long are deleted with their partial file.
+UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("DATASPACE_UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+
+# UploadStatus is the state of a resumable upload session.
+UploadStatus = Literal["open", "completing", "completed", "failed"]
+
+# Maximum number of conversions that run at once in the ingest process pool.
+INGEST_WORKERS = int(os.getenv("DATASPACE_INGEST_WORKERS", "2"))
+
+# JobStatus is the state of a background ingest job.
+JobStatus = Literal["queued", "running", "succeeded", "failed"]
+
+# Size of each read from an upload stream (1MB).
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Streaming ingest buffers this many bytes of CSV before turning them into a Parquet row group.
+# This bounds the memory used by a streaming ingest regardless of the upload size.
+STREAM_BATCH_BYTES = 64 * 1024 * 1024
+
+# JSON/JSONL ingest infers the column types from this many records (read_json's sample_size).
+# If a later record does not fit (eg) a new key, an int column holding text) the whole file is sampled instead.
+JSON_SCHEMA_SAMPLE_ROWS = 20_000
+
+# Appended batches are written as extra Parquet files (see db_append.py). Once a directory of a table holds more than this many files,
+# a compaction job rewrites the table into one file per partition.
+APPEND_COMPACT_MAX_FILES = int(os.getenv("DATASPACE_APPEND_COMPACT_MAX_FILES", "16"))
+
+# SQL dump ingest: rows buffered per table before an executemany, and rows written per SQLite transaction.
+SQL_DUMP_BATCH_ROWS = 10_000
+SQL_DUMP_COMMIT_ROWS = 500_000
+
+# Parquet codecs supported by both DuckDB's COPY and pyarrow's ParquetWriter (the streaming ingest).
+ParquetCompression = Literal["snappy", "zstd", "gzip", "lz4", "brotli", "uncompressed"]
+
+# Server defaults of the Parquet layout written at ingest, an upload can override each of them (see ParquetLayout).
+PARQUET_COMPRESSION: ParquetCompression = os.getenv("DATASPACE_PARQUET_COMPRESSION", "snappy")
+# Only zstd takes a level (1-22), empty means the codec's default.
+PARQUET_COMPRESSION_LEVEL = int(os.getenv("DATASPACE_PARQUET_COMPRESSION_LEVEL") or 0) or None
+# DuckDB's default row group size, smaller row groups prune more finely but have more per-group overhead.
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("DATASPACE_PARQUET_ROW_GROUP_SIZE", "122880"))
+# A partition column with more distinct values than this is refused (one directory per value, many tiny files).
+PARQUET_MAX_PARTITIONS = int(os.getenv("DATASPACE_PARQUET_MAX_PARTITIONS", "1000"))
+
+class ParquetLayout(BaseModel):
+    '''
+    ParquetLayout is a model that describes how a table is written to Parquet, it is stored with the dataset.
+
+    sort_by: the rows are written in this order, so the min/max statistics of each row group let filters on these columns skip row groups.
+    partition_by: the table is written as a directory of Hive partitions, one per value (eg) tables/events/country=FR/data_0.parquet),
+      filters on the column only read the matching directories.
+    '''
+    compression: ParquetCompression = PARQUET_COMPRESSION
+    compression_level: Optional[int] = PARQUET_COMPRESSION_LEVEL
+    row_group_size: int = PARQUET_ROW_GROUP_SIZE
+    sort_by: list[str] = []
+    partition_by: Optional[str] = None
+
+class IngestStats(BaseModel):
+    '''
+    IngestStats is a model that records how long an ingest took, so the streaming and two-pass paths can be compared.
+    '''
+    mode: Literal["two_pass", "stream", "append"]
+    rows: int
+    raw_bytes: int
+    seconds: float
+    rows_per_sec: float
+    bytes_per_sec: float
+
 class Dataset(BaseModel):
     '''
     Dataset is a model that represents the metadata of a dataset that gets uploaded to the database.
 
-    tables: logical table name -> path (e.g. parquet path for CSV, or .sqlite path for SQLite).
+    tables: logical table names (the parquet file stem for CSV/JSON, the table names for SQLite).
     schema: per-table column info. Shape depends on upload_type:
       - SQLite: {"table_name": {"column_name": "SQLITE_TYPE"}, ...}
       - CSV/single table: {"parquet": {"column_name": "TYPE"}, ...} (if you add inference)
+    table_paths: table name -> Parquet file, for the SQLite tables that were converted (see convert_sqlite_to_parquet).
+      Reads of those tables go to the Parquet file instead of the SQLite database.
+    layout: the ParquetLayout the Parquet files were written with, None while the dataset has no Parquet file (SQLite).
+      A partitioned table's path is its directory instead of a .parquet file.
+    artifact_key: the sha256 of the upload plus its conversion options (see upload_artifact_key). Datasets with the same key
+      share the files of the first one, which are deleted with the last one. None for datasets saved before deduplication.
     '''
     dataset_id: str
     upload_type: UploadType
@@ -32,6 +220,179 @@ class Dataset(BaseModel):
     dataset_path: str # The dataset path.
     tables: list[str] # all the table names in the dataset.
     schema: dict[str, dict[str, str]] #schema is a dictionary of the table name and the column names and their types.
+    table_paths: dict[str, str] = {}
+    layout: Optional[ParquetLayout] = None
+    artifact_key: Optional[str] = None
+
+class DatasetSummary(BaseModel):
+    '''
+    DatasetSummary is the Dataset without its schema, for listings that only need to show the datasets.
+    '''
+    dataset_id: str
+    upload_type: UploadType
+    raw_byte_size: int
+    dataset_path: str
+    tables: list[str]
+
+class DatasetPage(BaseModel):
+    '''
+    DatasetPage is one page of the dataset listing. next_cursor is passed back as ?cursor= to get the next page (None on the last page).
+    '''
+    items: list[Dataset | DatasetSummary]
+    next_cursor: Optional[str] = None
+
+class SearchHit(BaseModel):
+    '''
+    SearchHit is one column matching a /db/search query. file_name is the last part of the dataset's path (its file or directory).
+    '''
+    dataset_id: str
+    file_name: str
+    table_name: str
+    column_name: str
+    column_type: str
+
+class QueryRequest(BaseModel):
+    '''
+    QueryRequest is the body of /db/datasets/{id}/query. The sql can read the dataset's tables by their names (eg) SELECT * FROM customers).
+    '''
+    sql: str
+    max_rows: int = QUERY_DEFAULT_ROW_LIMIT
+    timeout_seconds: float = QUERY_DEFAULT_TIMEOUT_SECONDS
+    format: Literal["arrow", "ndjson"] = "arrow"
+
+class Aggregate(BaseModel):
+    '''
+    Aggregate is one value computed per group of an AggregationRequest.
+    eg) {"function": "count"} counts the rows, {"function": "quantile", "column": "amount", "quantile": 0.9} is the 90th percentile of amount.
+    column is required by every function except count, quantile (between 0 and 1) only by quantile.
+    '''
+    function: AggregateFunction
+    column: Optional[str] = None
+    quantile: Optional[float] = None
+
+class AggregationRequest(BaseModel):
+    '''
+    AggregationRequest is the body of /db/datasets/{id}/aggregate: the aggregates of a table grouped by its dimensions
+    (no dimensions gives one row for the whole table). table_name can be left out for a dataset with a single table.
+    '''
+    table_name: Optional[str] = None
+    dimensions: list[str] = []
+    aggregates: list[Aggregate]
+
+class AggregationResult(BaseModel):
+    '''
+    AggregationResult is the result of an AggregationRequest, one row per group ordered by the dimensions.
+    cache tells where it came from: "hit" (the materialized result), "rollup" (re-aggregated from a finer materialized result)
+    or "miss" (a scan of the table).
+    '''
+    dataset_id: str
+    table_name: str
+    fingerprint: str
+    columns: list[str]
+    rows: list[dict[str, Any]]
+    cache: Literal["hit", "rollup", "miss"]
+    seconds: float
+
+class RowFilter(BaseModel):
+    '''
+    RowFilter is one condition of the rows viewer, eg) RowFilter(column="fare", op="gte", value="10") keeps the rows with fare >= 10.
+    value is a string, it is compared as the column's type.
+    '''
+    column: str
+    op: RowFilterOp
+    value: Optional[str] = None
+
+class HistogramBin(BaseModel):
+    '''
+    HistogramBin is one bin of a column histogram, it counts the values in (previous bin's upper, upper].
+    The first bin starts at the column's min.
+    '''
+    upper: float
+    count: int
+
+class ColumnProfile(BaseModel):
+    '''
+    ColumnProfile is the summary of one column computed at ingest. Stats that do not apply to the column type are None
+    (eg) mean/stddev/histogram are only computed for numeric columns).
+    '''
+    column_name: str
+    column_type: str # DuckDB type of the column.
+    null_count: int
+    approx_distinct: Optional[int] = None # HyperLogLog estimate.
+    min: Optional[int | float | str] = None
+    max: Optional[int | float | str] = None
+    mean: Optional[float] = None
+    stddev: Optional[float] = None
+    top_values: list[str] = [] # Most frequent values (approximate), most frequent first.
+    histogram: list[HistogramBin] = []
+
+class TableProfile(BaseModel):
+    '''
+    TableProfile is the profile of one table of a dataset. error is set (and columns left empty) if the table could not be read.
+    '''
+    table_name: str
+    row_count: int = 0
+    columns: list[ColumnProfile] = []
+    error: Optional[str] = None
+
+class ForeignKey(BaseModel):
+    '''
+    ForeignKey is one foreign key of a SQLite table: table_name.column_name references ref_table.ref_column.
+    ref_column is None when the key references the primary key of ref_table without naming it.
+    '''
+    table_name: str
+    column_name: str
+    ref_table: str
+    ref_column: Optional[str] = None
+
+class DatasetProfile(BaseModel):
+    '''
+    DatasetProfile is a model that represents the column profile of every table of a dataset, served by /db/datasets/{id}/profile.
+    '''
+    dataset_id: str
+    tables: dict[str, TableProfile] # table name -> profile.
+    seconds: float # How long the profiling took.
+    created_at: float # unix time.
+
+class UploadSessionRequest(BaseModel):
+    '''
+    UploadSessionRequest is the body of POST /db/uploads, which starts a resumable upload.
+    '''
+    filename: str
+    total_bytes: int
+    chunk_bytes: int = UPLOAD_SESSION_CHUNK_BYTES
+
+class UploadSession(BaseModel):
+    '''
+    UploadSession is the state of a resumable upload. Chunk i covers the bytes [i * chunk_bytes, min((i + 1) * chunk_bytes, total_bytes)).
+    received_ranges are the byte ranges [start, end) received so far, merged, so a client can tell what is left to send.
+    '''
+    upload_id: str
+    filename: str
+    upload_type: UploadType
+    total_bytes: int
+    chunk_bytes: int
+    chunk_count: int
+    status: UploadStatus
+    received_chunks: list[int] = []
+    received_ranges: list[tuple[int, int]] = []
+    dataset_id: Optional[str] = None # Set once the session is completed.
+    error: Optional[str] = None
+    created_at: float # unix time.
+    updated_at: float # unix time.
+
+class IngestJob(BaseModel):
+    '''
+    IngestJob is a model that represents the state of a background ingest job, polled through /db/jobs/{job_id}.
+    '''
+    job_id: str
+    dataset_id: str
+    status: JobStatus
+    percent: float # 0 to 100.
+    error: Optional[str] = None
+    ingest_stats: Optional[IngestStats] = None
+    created_at: float # unix time.
+    updated_at: float # unix time.
 
 if __name__ == "__main__":
     print(BASE_DIR)
@@ -0,0 +1,218 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import duckdb
+from pydantic import BaseModel
+from .db_constants import DUCKDB_MEMORY_LIMIT, DUCKDB_THREADS, DUCKDB_MAX_ATTACHED, Dataset
+
+'''
+db_engine.py is a module that keeps one DuckDB database open for the whole process.
+
+- Every thread gets its own cursor on that database (DuckDB cursors are not safe to share between threads).
+- SQLite datasets stay attached after their first read, so repeated reads skip the ATTACH (and the sqlite extension/catalog load).
+  The least recently used ones are detached once more than DUCKDB_MAX_ATTACHED are attached.
+- SQLite tables that were converted to Parquet (Dataset.table_paths) are read from the Parquet file, a SQLite dataset
+  whose tables are all converted is not attached at all.
+- Memory and threads are capped through DUCKDB_MEMORY_LIMIT and DUCKDB_THREADS.
+- Parquet metadata is cached, so repeated small reads of a file (eg) pages of the rows viewer) skip parsing its footer.
+'''
+
+# SQL dumps are loaded into a SQLite database at ingest (see db_sql_dump.py).
+SQLITE_UPLOAD_TYPES = ("db", "sqlite", "sql", "sql_dump")
+# Uploads converted into one Parquet file at ingest.
+PARQUET_UPLOAD_TYPES = ("csv", "json", "jsonl")
+
+def quote_identifier(name: str) -> str:
+    '''
+    quote_identifier is a function that quotes a table/column name for DuckDB SQL, eg) my "table" -> "my ""table""".
+    '''
+    return '"' + name.replace('"', '""') + '"'
+
+def quote_literal(value: str) -> str:
+    '''
+    quote_literal is a function that quotes a string (eg) a file path) as a DuckDB SQL literal.
+    '''
+    return "'" + value.replace("'", "''") + "'"
+
+def parquet_source(path: str) -> str:
+    '''
+    parquet_source is a function that returns the read_parquet call for a table's Parquet path.
+    A path that is not a .parquet file is a directory of Hive partitions (see ParquetLayout.partition_by), read with
+    hive_partitioning so that filters on the partition column skip the other directories.
+    eg) datasets/uuid/tables/events -> read_parquet('datasets/uuid/tables/events/**/*.parquet', hive_partitioning = true)
+    '''
+    if path.endswith(".parquet"):
+        return f"read_parquet({quote_literal(path)})"
+    return f"read_parquet({quote_literal(path + '/**/*.parquet')}, hive_partitioning = true)"
+
+class AttachedDataset(BaseModel):
+    '''
+    AttachedDataset is the bookkeeping of one SQLite dataset attached to the engine.
+    '''
+    alias: str
+    pins: int = 0 # Number of sessions currently reading it, a pinned dataset is never detached.
+
+class DatasetSession:
+    '''
+    DatasetSession is what DuckDBEngine.dataset() yields: a cursor plus the SQL to read each table of one dataset.
+    '''
+    def __init__(self, cursor: duckdb.DuckDBPyConnection, dataset: Dataset, alias: Optional[str]):
+        self.cursor = cursor
+        self.dataset = dataset
+        self.alias = alias
+
+    def table(self, table_name: str) -> str:
+        '''
+        table is a function that returns the FROM clause for a table of the dataset.
+        eg) read_parquet('datasets/uuid/tables/file.parquet') for CSV/JSON and converted SQLite tables, or "ds_uuid"."customers" for SQLite.
+
+        Args:
+            table_name: str - The table to read, must be one of dataset.tables.
+        '''
+        if table_name not in self.dataset.tables:
+            raise ValueError(f"Table {table_name} not found in the dataset.")
+
+        parquet_path = self.dataset.table_paths.get(table_name)
+        if parquet_path is not None:
+            return parquet_source(parquet_path)
+        if self.alias is None:
+            return parquet_source(self.dataset.dataset_path)
+        return f"{quote_identifier(self.alias)}.{quote_identifier(table_name)}"
+
+class DuckDBEngine:
+    '''
+    DuckDBEngine is a class that owns the process-wide DuckDB database, its per-thread cursors and the attached SQLite datasets.
+    '''
+    def __init__(self, memory_limit: str = DUCKDB_MEMORY_LIMIT, threads: int = DUCKDB_THREADS, max_attached: int = DUCKDB_MAX_ATTACHED):
+        self.conn = duckdb.connect(config={"memory_limit": memory_limit, "threads": threads})
+        # The footer of a Parquet file is parsed once (until the file changes), not on every query, which is most of the cost of a small read.
+        # Set after connecting (the parquet extension is only loaded by then), GLOBAL so the cursors of every thread have it too.
+        self.conn.execute("SET GLOBAL parquet_metadata_cache = true")
+        self.max_attached = max_attached
+        self.local = threading.local()
+        self.attached: OrderedDict[str, AttachedDataset] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        '''
+        cursor is a function that returns this thread's cursor. Queries on it must be finished before the thread runs another one.
+        '''
+        cursor = getattr(self.local, "cursor", None)
+        if cursor is None:
+            cursor = self.conn.cursor()
+            self.local.cursor = cursor
+        return cursor
+
+    def new_cursor(self) -> duckdb.DuckDBPyConnection:
+        '''
+        new_cursor is a function that returns a cursor of its own, for results that are read over a long time (eg) streamed responses).
+        The caller must close it.
+        '''
+        return self.conn.cursor()
+
+    def attach(self, dataset: Dataset) -> str:
+        '''
+        attach is a function that attaches a SQLite dataset (if it is not attached yet), pins it and returns its alias.
+        '''
+        with self.lock:
+            entry = self.attached.get(dataset.dataset_id)
+            if entry is None:
+                alias = "ds_" + dataset.dataset_id.replace("-", "_")
+                self.conn.execute(f"ATTACH {quote_literal(dataset.dataset_path)} AS {quote_identifier(alias)} (TYPE sqlite, READ_ONLY)")
+                entry = AttachedDataset(alias=alias)
+                self.attached[dataset.dataset_id] = entry
+
+            entry.pins += 1
+            self.attached.move_to_end(dataset.dataset_id)
+            self.evict()
+            return entry.alias
+
+    def release(self, dataset: Dataset):
+        '''
+        release is a function that unpins a SQLite dataset, it stays attached until it is evicted.
+        '''
+        with self.lock:
+            entry = self.attached.get(dataset.dataset_id)
+            if entry is not None:
+                entry.pins -= 1
+            self.evict()
+
+    def evict(self):
+        '''
+        evict is a function that detaches the least recently used unpinned datasets until at most max_attached are attached.
+        Must be called with the lock held.
+        '''
+        for dataset_id in list(self.attached):
+            if len(self.attached) <= self.max_attached:
+                break
+            entry = self.attached[dataset_id]
+            if entry.pins == 0:
+                self.conn.execute(f"DETACH {quote_identifier(entry.alias)}")
+                del self.attached[dataset_id]
+
+    def detach(self, dataset_id: str):
+        '''
+        detach is a function that detaches a dataset right away (eg) before its file is deleted or replaced).
+        '''
+        with self.lock:
+            entry = self.attached.pop(dataset_id, None)
+            if entry is not None:
+                self.conn.execute(f"DETACH {quote_identifier(entry.alias)}")
+
+    @contextmanager
+    def dataset(self, dataset: Dataset, cursor: Optional[duckdb.DuckDBPyConnection] = None) -> Iterator[DatasetSession]:
+        '''
+        dataset is a context manager that gives a DatasetSession to read a dataset's tables.
+        For SQLite datasets the attachment is pinned for as long as the session is open (unless every table was converted to Parquet).
+
+        Args:
+            dataset: Dataset - The dataset to read.
+            cursor: duckdb.DuckDBPyConnection - The cursor to use, defaults to this thread's cursor.
+        '''
+        if dataset.upload_type in PARQUET_UPLOAD_TYPES:
+            yield DatasetSession(cursor or self.cursor(), dataset, None)
+            return
+
+        if dataset.upload_type not in SQLITE_UPLOAD_TYPES:
+            raise ValueError(f"Unsupported upload type: {dataset.upload_type}")
+
+        if all(table_name in dataset.table_paths for table_name in dataset.tables):
+            yield DatasetSession(cursor or self.cursor(), dataset, None)
+            return
+
+        alias = self.attach(dataset)
+        try:
+            yield DatasetSession(cursor or self.cursor(), dataset, alias)
+        finally:
+            self.release(dataset)
+
+    def close(self):
+        with self.lock:
+            self.attached.clear()
+            self.conn.close()
+
+# Created on first use, so processes that never query (eg) the ingest workers) do not open one.
+_engine: Optional[DuckDBEngine] = None
+_engine_lock = threading.Lock()
+
+def get_duckdb_engine() -> DuckDBEngine:
+    '''
+    get_duckdb_engine is a function that returns the process-wide DuckDBEngine.
+    '''
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = DuckDBEngine()
+    return _engine
+
+def close_duckdb_engine():
+    '''
+    close_duckdb_engine is a function that closes the process-wide DuckDBEngine (server shutdown).
+    '''
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.close()
+            _engine = None
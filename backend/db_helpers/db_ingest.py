@@ -0,0 +1,533 @@
+import csv
+import io
+import logging
+import re
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+import duckdb
+from duckdb.sqltypes import DuckDBPyType
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from .db_constants import UPLOAD_CHUNK_BYTES, STREAM_BATCH_BYTES, JSON_SCHEMA_SAMPLE_ROWS, DUCKDB_MEMORY_LIMIT, Dataset, IngestStats, UploadType, ParquetLayout
+from .db_engine import quote_identifier, quote_literal
+from .db_services import save_parquet_file, copy_to_parquet, parquet_copy_options, get_parquet_schema, get_sqlite_schema, get_sqlite_table_names
+
+'''
+db_ingest.py is a module that contains the streaming ingest functions.
+Unlike save_raw_file + save_parquet_file (which write the whole upload to disk and then read it back),
+these functions convert the upload into Parquet while it is being read.
+'''
+
+def build_ingest_stats(mode: str, rows: int, raw_bytes: int, started: float) -> IngestStats:
+    '''
+    build_ingest_stats is a function that builds the throughput numbers for an ingest.
+
+    Args:
+        mode: str - "two_pass" or "stream".
+        rows: int - The number of rows that were written to Parquet.
+        raw_bytes: int - The number of bytes read from the upload.
+        started: float - The time.perf_counter() value when the ingest started.
+
+    Returns:
+        IngestStats - The rows/sec and bytes/sec of the ingest.
+    '''
+    seconds = max(time.perf_counter() - started, 1e-9)
+    return IngestStats(
+        mode=mode,
+        rows=rows,
+        raw_bytes=raw_bytes,
+        seconds=round(seconds, 6),
+        rows_per_sec=round(rows / seconds, 2),
+        bytes_per_sec=round(raw_bytes / seconds, 2),
+    )
+
+def count_parquet_rows(parquet_path: Path) -> int:
+    '''
+    count_parquet_rows is a function that counts the rows of a parquet file from its footer (no scan of the data).
+    For a partitioned table (a directory) it adds up the footers of its files.
+    '''
+    if parquet_path.is_dir():
+        return sum(pq.ParquetFile(str(path)).metadata.num_rows for path in parquet_path.rglob("*.parquet"))
+    return pq.ParquetFile(str(parquet_path)).metadata.num_rows
+
+def apply_layout(parquet_path: Path, layout: ParquetLayout) -> Path:
+    '''
+    apply_layout is a function that rewrites a Parquet file written in arrival order (the streaming ingest) with the layout's
+    sort order and partitioning, which need every row before the first one can be written. Nothing is done if the layout has neither.
+
+    Returns:
+        Path - The rewritten file, or directory when the layout is partitioned.
+    '''
+    if not layout.sort_by and not layout.partition_by:
+        return parquet_path
+
+    staged_path = parquet_path.with_name(parquet_path.stem + ".unsorted.parquet")
+    parquet_path.rename(staged_path)
+    conn = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY_LIMIT})
+    try:
+        return copy_to_parquet(conn, f"SELECT * FROM read_parquet({quote_literal(str(staged_path))})", parquet_path.with_suffix(""), layout)
+    except duckdb.Error as e:
+        raise ValueError(f"Error applying the Parquet layout to {parquet_path.name}: {e}")
+    finally:
+        conn.close()
+        staged_path.unlink(missing_ok=True)
+
+def find_record_boundary(buffer: bytearray, limit: int) -> int:
+    '''
+    find_record_boundary is a function that finds the end of the last complete CSV record in the first limit bytes of the buffer.
+    A newline inside a quoted value is not a record boundary, so we walk back until the number of quotes before the cut is even.
+
+    Args:
+        buffer: bytearray - The buffered CSV bytes. The buffer always starts at a record boundary.
+        limit: int - Only records that end before this index are considered.
+
+    Returns:
+        int - The index just after the last complete record, or -1 if there is no complete record before limit.
+    '''
+    cut = buffer.rfind(b"\n", 0, limit)
+    if cut == -1:
+        return -1
+
+    quotes = buffer.count(b'"', 0, cut)
+    while quotes % 2:
+        previous = buffer.rfind(b"\n", 0, cut)
+        if previous == -1:
+            return -1
+        quotes -= buffer.count(b'"', previous, cut)
+        cut = previous
+
+    return cut + 1
+
+def sniff_csv_delimiter(sample: str) -> str:
+    '''
+    sniff_csv_delimiter is a function that guesses the delimiter of a CSV from its first lines (comma if it can not tell).
+    eg) "id;name\\n1;ada\\n" -> ";"
+    '''
+    # Only complete lines, a cut line would skew the counts of the sniffer.
+    sample = sample[:sample.rfind("\n") + 1] or sample
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
+def widen_csv_type(current: pa.DataType, new: pa.DataType) -> pa.DataType:
+    '''
+    widen_csv_type is a function that returns a type that holds the values of both types of a CSV column.
+    eg) int64 + double -> double, null (an empty column) + int64 -> int64, int64 + string -> string
+    '''
+    if current.equals(new) or pa.types.is_null(new):
+        return current
+    if pa.types.is_null(current):
+        return new
+    if pa.types.is_integer(current) and pa.types.is_integer(new):
+        return pa.int64()
+    if (pa.types.is_integer(current) or pa.types.is_floating(current)) and (pa.types.is_integer(new) or pa.types.is_floating(new)):
+        return pa.float64()
+    # Any other mix (eg) a number column that later holds text, dates and timestamps) is kept as text, every value can be written as one.
+    return pa.string()
+
+class CsvParquetStreamer:
+    '''
+    CsvParquetStreamer is a class that turns batches of CSV bytes into row groups of a single Parquet file.
+
+    The delimiter is sniffed and the schema inferred from the first batch, every later batch is parsed with the same delimiter and column types
+    so that all the row groups share one schema. A later batch that does not fit them (eg) 1.5 in an int column, text in a column
+    that was empty so far) widens the column types (see widen_csv_type), and the row groups already written are rewritten with them.
+    A batch that can not be parsed at all (eg) a record with more fields than the header) raises a ValueError.
+    The compression and row group size come from the layout, its sort order and partitioning are applied afterwards (see apply_layout).
+    '''
+    def __init__(self, parquet_path: Path, layout: Optional[ParquetLayout] = None):
+        self.parquet_path = parquet_path
+        self.layout = layout or ParquetLayout()
+        self.header: Optional[bytes] = None
+        self.delimiter = ","
+        self.schema: Optional[pa.Schema] = None
+        self.writer: Optional[pq.ParquetWriter] = None
+        self.rows = 0
+
+    def read_batch(self, data: bytes, column_types: Optional[pa.Schema]) -> pa.Table:
+        return pa_csv.read_csv(
+            io.BytesIO(data),
+            parse_options=pa_csv.ParseOptions(delimiter=self.delimiter, newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types) if column_types else pa_csv.ConvertOptions(),
+        )
+
+    def write_batch(self, batch: bytes):
+        '''
+        write_batch is a function that parses a batch of complete CSV records and writes it as a row group.
+        '''
+        if not batch.strip():
+            return
+
+        if self.header is None:
+            # The first batch carries the header line, we keep it to prefix every later batch.
+            header_end = batch.find(b"\n")
+            self.header = batch if header_end == -1 else batch[:header_end + 1]
+            # A few lines are enough, the sniffer's time grows with the sample.
+            self.delimiter = sniff_csv_delimiter(batch[:8 * 1024].decode("utf-8-sig", errors="replace"))
+            data = batch
+        else:
+            data = self.header + batch
+
+        try:
+            # Until the first row group is written the types are still being inferred.
+            table = self.read_batch(data, self.schema)
+        except pa.ArrowInvalid as e:
+            if self.schema is None:
+                raise ValueError(f"Streaming ingest could not parse batch: {e}")
+            # The batch does not fit the types so far, read it with its own types and widen the schema to hold both.
+            try:
+                table = self.read_batch(data, None)
+                self.widen_schema(table.schema)
+                table = table.cast(self.schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError(f"Streaming ingest could not parse batch: {e}")
+
+        if self.writer is None:
+            # A header with no rows says nothing about the column types, wait for the next batch.
+            if table.num_rows == 0:
+                return
+            self.schema = table.schema
+            self.writer = self.open_writer()
+
+        self.writer.write_table(table, row_group_size=self.layout.row_group_size)
+        self.rows += table.num_rows
+
+    def widen_schema(self, batch_schema: pa.Schema):
+        '''
+        widen_schema is a function that widens the column types to hold the ones of a batch, and rewrites the row groups
+        written so far with the new types (one row group in memory at a time). Nothing is rewritten if the types already hold the batch.
+        '''
+        if batch_schema.names != self.schema.names:
+            raise ValueError(f"Streaming ingest got columns {batch_schema.names}, expected {self.schema.names}.")
+        widened = pa.schema([field.with_type(widen_csv_type(field.type, batch_field.type)) for field, batch_field in zip(self.schema, batch_schema)])
+        if widened.equals(self.schema):
+            return
+
+        logging.info("Streaming ingest of %s widens its schema to %s", self.parquet_path.name, widened)
+        self.schema = widened
+        if self.writer is None:
+            return
+
+        self.writer.close()
+        staged_path = self.parquet_path.with_name(self.parquet_path.stem + ".narrow.parquet")
+        self.parquet_path.rename(staged_path)
+        try:
+            written = pq.ParquetFile(str(staged_path))
+            self.writer = self.open_writer()
+            for index in range(written.num_row_groups):
+                self.writer.write_table(written.read_row_group(index).cast(widened), row_group_size=self.layout.row_group_size)
+        finally:
+            staged_path.unlink(missing_ok=True)
+
+    def open_writer(self) -> pq.ParquetWriter:
+        # pyarrow calls the uncompressed codec "none".
+        compression = "none" if self.layout.compression == "uncompressed" else self.layout.compression
+        return pq.ParquetWriter(str(self.parquet_path), self.schema, compression=compression, compression_level=self.layout.compression_level)
+
+    def close(self):
+        '''
+        close is a function that writes the Parquet footer. A CSV with only a header still produces a (empty) Parquet file.
+        '''
+        if self.writer is None and self.header is not None:
+            table = pa_csv.read_csv(io.BytesIO(self.header), parse_options=pa_csv.ParseOptions(delimiter=self.delimiter))
+            self.schema = table.schema
+            self.writer = self.open_writer()
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def stream_csv_to_parquet(dataset_dir: Path, source: BinaryIO, filename: str, keep_raw: bool = True, batch_bytes: int = STREAM_BATCH_BYTES,
+                          on_progress: Optional[Callable[[int], None]] = None, layout: Optional[ParquetLayout] = None,
+                          digest=None) -> tuple[Path, Optional[Path], IngestStats]:
+    '''
+    stream_csv_to_parquet is a function that converts a CSV stream into a Parquet file in one pass.
+    The upload is read in 1MB chunks, buffered up to batch_bytes and each batch of complete records becomes a Parquet row group.
+    Memory is bounded by batch_bytes no matter how large the upload is.
+
+    Args:
+        dataset_dir: Path - The dataset directory (Must Exist). The Parquet file goes under dataset_dir/tables.
+        source: BinaryIO - The CSV stream, eg) UploadFile.file.
+        filename: str - The name of the uploaded file, used for the raw copy and the Parquet file name.
+        keep_raw: bool - If True, the raw CSV is also written to dataset_dir while streaming. If False no raw copy is kept.
+            With a raw copy, a batch that can not be parsed (eg) a record with more fields than the header) falls back to the two-pass conversion,
+            without one a ValueError is raised.
+        batch_bytes: int - The number of buffered bytes that triggers a new row group.
+        on_progress: Callable[[int], None] - Called with the number of bytes read so far after each row group.
+        layout: ParquetLayout - How to write the Parquet file, defaults to the server defaults.
+        digest: A hashlib object (eg) hashlib.sha256()) updated with every chunk of the upload.
+
+    Returns:
+        Path - The path to the Parquet file. eg) format -> datasets/uuid/tables/file_name.parquet (a directory when partitioned)
+        Path | None - The path to the raw copy, None when keep_raw is False.
+        IngestStats - rows/sec and bytes/sec of the ingest.
+    '''
+    if not dataset_dir.exists():
+        raise FileNotFoundError(f"Dataset directory {dataset_dir} does not exist.")
+
+    started = time.perf_counter()
+
+    tables_dir = dataset_dir / "tables"
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    parquet_path = tables_dir / f"{Path(filename).stem}.parquet"
+    raw_path = dataset_dir / filename if keep_raw else None
+
+    layout = layout or ParquetLayout()
+    streamer = CsvParquetStreamer(parquet_path, layout)
+    buffer = bytearray()
+    size = 0
+    raw_file = open(raw_path, "wb") if raw_path else None
+    fallback_error: Optional[ValueError] = None
+
+    try:
+        while True:
+            chunk = source.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+
+            if raw_file:
+                raw_file.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            size += len(chunk)
+
+            # Once streaming has failed we only finish copying the raw file for the two-pass fallback.
+            if fallback_error:
+                continue
+
+            buffer += chunk
+            while len(buffer) >= batch_bytes:
+                cut = find_record_boundary(buffer, batch_bytes)
+                if cut == -1:
+                    # A single record is longer than a batch, take it whole if it is complete.
+                    cut = find_record_boundary(buffer, len(buffer))
+                # If there is no complete record yet (eg) a very long quoted value), keep buffering.
+                if cut <= 0:
+                    break
+                try:
+                    streamer.write_batch(bytes(buffer[:cut]))
+                except ValueError as e:
+                    if not raw_file:
+                        raise
+                    fallback_error = e
+                    buffer.clear()
+                    break
+                del buffer[:cut]
+                if on_progress:
+                    on_progress(size)
+
+        if not fallback_error:
+            try:
+                # Whatever is left is the final (possibly unterminated) record.
+                streamer.write_batch(bytes(buffer))
+                streamer.close()
+            except ValueError as e:
+                if not raw_file:
+                    raise
+                fallback_error = e
+
+    except Exception:
+        if streamer.writer is not None:
+            streamer.writer.close()
+        parquet_path.unlink(missing_ok=True)
+        raise
+
+    finally:
+        if raw_file:
+            raw_file.close()
+
+    if streamer.header is None:
+        parquet_path.unlink(missing_ok=True)
+        raise ValueError(f"Uploaded file {filename} is empty.")
+
+    if fallback_error:
+        # A later batch could not be parsed (eg) a record with more fields than the header), types that do not fit are widened instead.
+        # The raw copy is complete, so let DuckDB sniff the whole file instead.
+        logging.warning("Streaming ingest of %s fell back to two-pass: %s", filename, fallback_error)
+        if streamer.writer is not None:
+            streamer.writer.close()
+        parquet_path.unlink(missing_ok=True)
+        parquet_path = save_parquet_file(dataset_dir, raw_path, layout)
+        return parquet_path, raw_path, build_ingest_stats("two_pass", count_parquet_rows(parquet_path), size, started)
+
+    parquet_path = apply_layout(parquet_path, layout)
+    return parquet_path, raw_path, build_ingest_stats("stream", streamer.rows, size, started)
+
+def flatten_columns(names: list[str], types: list[DuckDBPyType], parent_sql: str = "", parent_name: str = "") -> list[str]:
+    '''
+    flatten_columns is a function that builds the select list that turns struct columns into one column per field, recursively.
+    eg) address STRUCT(city VARCHAR, geo STRUCT(lat DOUBLE)) -> "address.city" VARCHAR, "address.geo.lat" DOUBLE
+    Lists are kept as list columns, expanding them would change the number of rows.
+    '''
+    select: list[str] = []
+    for name, column_type in zip(names, types):
+        expression = f"struct_extract({parent_sql}, {quote_literal(name)})" if parent_sql else quote_identifier(name)
+        column_name = f"{parent_name}.{name}" if parent_name else name
+
+        if column_type.id == "struct" and column_type.children:
+            fields = column_type.children
+            select += flatten_columns([field for field, _ in fields], [field_type for _, field_type in fields], expression, column_name)
+        else:
+            select.append(f"{expression} AS {quote_identifier(column_name)}")
+    return select
+
+def write_json_parquet(conn: duckdb.DuckDBPyConnection, raw_path: Path, target: Path, json_format: str, sample_size: int, layout: ParquetLayout) -> Path:
+    '''
+    write_json_parquet is a function that copies the records of a JSON file into a Parquet file with the structs flattened.
+    DuckDB streams the file from disk to the Parquet row groups, it is never loaded whole (nor into Python).
+    (Unless the layout sorts the rows, then DuckDB sorts them first, spilling to disk past its memory limit.)
+    '''
+    source = f"read_json({quote_literal(str(raw_path))}, format = {quote_literal(json_format)}, sample_size = {int(sample_size)})"
+    # Binding the query is enough to get the inferred types, no records are read past the sample.
+    relation = conn.sql(f"SELECT * FROM {source}")
+    select = flatten_columns(relation.columns, relation.dtypes)
+    return copy_to_parquet(conn, f"SELECT {', '.join(select)} FROM {source}", target, layout)
+
+def save_json_parquet_file(dataset_dir: Path, raw_path: Path, upload_type: UploadType, sample_size: int = JSON_SCHEMA_SAMPLE_ROWS,
+                           layout: Optional[ParquetLayout] = None) -> tuple[Path, IngestStats]:
+    '''
+    save_json_parquet_file is a function that converts a saved JSON (array of records or newline-delimited) or JSONL upload into Parquet.
+
+    The column types are inferred from the first sample_size records. A record that does not fit them (eg) a key that was not in the sample)
+    makes DuckDB fail the copy, it is then retried with the types inferred from the whole file.
+
+    Args:
+        dataset_dir: Path - The dataset directory. The Parquet file goes under dataset_dir/tables.
+        raw_path: Path - The saved upload.
+        upload_type: UploadType - "json" or "jsonl".
+        layout: ParquetLayout - How to write the Parquet file, defaults to the server defaults.
+
+    Returns:
+        Path - The path to the Parquet file. eg) format -> datasets/uuid/tables/file_name.parquet (a directory when partitioned)
+        IngestStats - rows/sec and bytes/sec of the conversion.
+
+    Raises:
+        ValueError - If the file is empty or is not valid JSON.
+    '''
+    started = time.perf_counter()
+    raw_size = raw_path.stat().st_size
+    if raw_size == 0:
+        raise ValueError(f"Uploaded file {raw_path.name} is empty.")
+
+    tables_dir = dataset_dir / "tables"
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    target = tables_dir / raw_path.stem
+    layout = layout or ParquetLayout()
+
+    # "auto" reads both a top-level array of records and newline-delimited records.
+    json_format = "newline_delimited" if upload_type == "jsonl" else "auto"
+
+    conn = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY_LIMIT})
+    try:
+        try:
+            parquet_path = write_json_parquet(conn, raw_path, target, json_format, sample_size, layout)
+        except duckdb.InvalidInputException as e:
+            # copy_to_parquet already removed the partial output.
+            logging.warning("JSON ingest of %s does not fit the sampled schema, sampling the whole file: %s", raw_path.name, e)
+            parquet_path = write_json_parquet(conn, raw_path, target, json_format, -1, layout)
+    except duckdb.Error as e:
+        raise ValueError(f"Error reading JSON file {raw_path.name}: {e}")
+    finally:
+        conn.close()
+
+    return parquet_path, build_ingest_stats("two_pass", count_parquet_rows(parquet_path), raw_size, started)
+
+def build_parquet_dataset(dataset_id: str, upload_type: UploadType, parquet_path: Path, raw_size: int, layout: Optional[ParquetLayout] = None) -> Dataset:
+    '''
+    build_parquet_dataset is a function that builds the metadata of an upload that was converted into one Parquet file (CSV, JSON, JSONL).
+    One logical "table" (the parquet); key = file stem for consistency. layout is what the file was written with (None for the server defaults).
+    '''
+    return Dataset(
+        dataset_id=dataset_id,
+        upload_type=upload_type,
+        raw_byte_size=raw_size,
+        dataset_path=str(parquet_path),
+        tables=[parquet_path.stem], # the table key will be the parquet path. 
+        schema=get_parquet_schema(parquet_path),
+        layout=layout or ParquetLayout(),
+    )
+
+def build_csv_dataset(dataset_id: str, parquet_path: Path, raw_size: int, layout: Optional[ParquetLayout] = None) -> Dataset:
+    '''
+    build_csv_dataset is a function that builds the metadata of a CSV upload once its Parquet file exists.
+    '''
+    return build_parquet_dataset(dataset_id, "csv", parquet_path, raw_size, layout)
+
+def build_sqlite_dataset(dataset_id: str, upload_type: UploadType, raw_path: Path, raw_size: int) -> Dataset:
+    '''
+    build_sqlite_dataset is a function that builds the metadata of a SQLite upload, retrieving the tables and schema from the raw db file.
+    '''
+    return Dataset(
+        dataset_id=dataset_id,
+        upload_type=upload_type,
+        raw_byte_size=raw_size,
+        dataset_path=str(raw_path),
+        tables=get_sqlite_table_names(raw_path),
+        schema=get_sqlite_schema(raw_path),
+    )
+
+def convert_sqlite_to_parquet(dataset_dir: Path, sqlite_path: Path, table_names: list[str], on_progress: Optional[Callable[[int], None]] = None,
+                              layout: Optional[ParquetLayout] = None) -> dict[str, str]:
+    '''
+    convert_sqlite_to_parquet is a function that writes every table of a SQLite database into its own Parquet file.
+    DuckDB's sqlite scanner reads every column of every row, Parquet lets scans skip the columns and row groups they do not need.
+
+    A table that can not be read (eg) a column holding values of mixed types) is left out and keeps being read from SQLite.
+    The layout applies to every table, its sort and partition columns only to the tables that have them.
+
+    Args:
+        dataset_dir: Path - The dataset directory. The Parquet files go under dataset_dir/tables.
+        sqlite_path: Path - The SQLite database.
+        table_names: list[str] - The tables to convert.
+        on_progress: Callable[[int], None] - Called with the number of tables done after each table.
+        layout: ParquetLayout - How to write the Parquet files, defaults to the server defaults.
+
+    Returns:
+        dict[str, str] - Table name -> Parquet path, for Dataset.table_paths. eg) {"customers": "datasets/uuid/tables/customers.parquet"}
+    '''
+    tables_dir = dataset_dir / "tables"
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    table_paths: dict[str, str] = {}
+    # Names of the files already there (eg) tables converted by an earlier run), so they are not overwritten.
+    used_names = {path.stem.lower() for path in tables_dir.iterdir()}
+    layout = layout or ParquetLayout()
+    # An invalid layout fails the whole conversion instead of leaving every table on SQLite.
+    parquet_copy_options(layout)
+
+    conn = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY_LIMIT})
+    try:
+        conn.execute(f"ATTACH {quote_literal(str(sqlite_path))} AS source (TYPE sqlite, READ_ONLY)")
+        for done, table_name in enumerate(table_names, start=1):
+            # Table names can hold any character, the file name keeps the safe ones. eg) "order items" -> order_items.parquet
+            base_name = file_name = re.sub(r"[^\w-]", "_", table_name)
+            suffix = 1
+            while file_name.lower() in used_names:
+                suffix += 1
+                file_name = f"{base_name}_{suffix}"
+            used_names.add(file_name.lower())
+
+            try:
+                select_sql = f"SELECT * FROM source.{quote_identifier(table_name)}"
+                columns = set(conn.sql(select_sql).columns)
+                table_layout = layout.model_copy(update={
+                    "sort_by": [column for column in layout.sort_by if column in columns],
+                    "partition_by": layout.partition_by if layout.partition_by in columns else None,
+                })
+                table_paths[table_name] = str(copy_to_parquet(conn, select_sql, tables_dir / file_name, table_layout))
+            except (duckdb.Error, ValueError) as e:
+                logging.warning("Table %s of %s stays on SQLite, it could not be converted to Parquet: %s", table_name, sqlite_path.name, e)
+
+            if on_progress:
+                on_progress(done)
+    finally:
+        conn.close()
+
+    return table_paths
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_ingest
@@ -0,0 +1,327 @@
+import logging
+import multiprocessing
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional
+from .db_constants import INGEST_WORKERS, IngestStats, UploadType, ParquetLayout
+from .db_metadata import create_job, update_job, save_metadata, save_profile, get_dataset_by_id, save_table_paths, delete_dataset, fail_interrupted_jobs
+from .db_profile import profile_dataset
+from .db_services import save_parquet_file
+from .db_sql_dump import sql_dump_to_sqlite
+from .db_ingest import (
+    stream_csv_to_parquet,
+    build_ingest_stats,
+    count_parquet_rows,
+    save_json_parquet_file,
+    build_csv_dataset,
+    build_parquet_dataset,
+    build_sqlite_dataset,
+    convert_sqlite_to_parquet
+)
+from .db_engine import SQLITE_UPLOAD_TYPES
+from .db_append import compact_dataset
+from .db_metrics import Stage, collect_stages, record_stages
+
+'''
+db_jobs.py is a module that runs the ingest conversions in the background on a bounded process pool.
+The upload route only saves the upload (or streams a CSV into Parquet) and returns a job id, the state of the job is stored in the jobs table
+of the metadata database (see db_metadata.py) and polled through /db/jobs/{job_id}.
+'''
+
+# The process pool is created on first use, so importing this module (eg) in the worker processes) does not start one.
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_ingest_executor() -> ProcessPoolExecutor:
+    '''
+    get_ingest_executor is a function that returns the process pool used for ingest jobs.
+    The pool has INGEST_WORKERS processes, which caps how many conversions run at once, extra jobs wait in the queue.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn instead of fork, forking a process that has DuckDB threads running is not safe.
+            _executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def shutdown_ingest_executor():
+    '''
+    shutdown_ingest_executor is a function that stops the ingest process pool when the server shuts down.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def clean_interrupted_jobs() -> int:
+    '''
+    clean_interrupted_jobs is a function that fails the jobs the last server run left queued or running (see fail_interrupted_jobs)
+    and deletes the directories of the uploads they were ingesting, like a failed ingest job does. Called when the server starts.
+    Returns:
+        int - The number of upload directories deleted.
+    '''
+    dataset_dirs = fail_interrupted_jobs()
+    for dataset_dir in dataset_dirs:
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+    return len(dataset_dirs)
+
+def run_ingest_job(job_id: str, dataset_id: str, dataset_dir: str, raw_path: Optional[str], upload_type: UploadType, raw_size: int, stream: bool = False, keep_raw: bool = True,
+                   to_parquet: bool = False, layout: Optional[ParquetLayout] = None, artifact_key: Optional[str] = None, parquet_path: Optional[str] = None,
+                   ingest_stats: Optional[IngestStats] = None) -> list[tuple]:
+    '''
+    run_ingest_job is a function that converts a saved upload into a dataset. It runs inside an ingest worker process.
+    The stages of the job are timed here and returned, submit_job records them in the metrics of the server process.
+
+    Progress: the conversion is 0-80%, schema extraction (and to_parquet) 90%, column profile 95%, saving the metadata 100%.
+
+    Args:
+        job_id: str - The id of the job to report progress to.
+        dataset_id: str - The id of the dataset being created.
+        dataset_dir: str - The dataset directory (contains the raw upload).
+        raw_path: str - The path to the saved raw upload, None when a CSV was streamed into parquet_path without a raw copy.
+        upload_type: UploadType - The type of the upload.
+        raw_size: int - The size of the raw upload in bytes.
+        stream: bool - Convert the CSV with the streaming ingest (reports progress as it goes) instead of DuckDB's read_csv.
+        keep_raw: bool - Keep the raw CSV/JSON/SQL dump once it is converted.
+        to_parquet: bool - (SQLite, SQL dump) Also write every table into its own Parquet file, reads then go to Parquet.
+        layout: ParquetLayout - How the Parquet files are written, defaults to the server defaults.
+        artifact_key: str - The key of the upload content (see upload_artifact_key), later uploads of the same content reuse this dataset's files.
+        parquet_path: str - (CSV) The Parquet file the upload route already streamed the request into, with its ingest_stats. The job then skips the conversion.
+    Returns:
+        list[tuple] - The stages of the job, see db_metrics.collect_stages.
+    '''
+    layout = layout or ParquetLayout()
+    dataset_dir = Path(dataset_dir)
+    raw_path = Path(raw_path) if raw_path else None
+    parquet_path = Path(parquet_path) if parquet_path else None
+    reported = [0]
+
+    def on_progress(bytes_read: int):
+        # Only write to the jobs table when the percentage moved by at least 1.
+        percent = int(80 * bytes_read / max(raw_size, 1))
+        if percent > reported[0]:
+            reported[0] = percent
+            update_job(job_id, percent=percent)
+
+    with collect_stages() as stages:
+        ingest_job(job_id, dataset_id, dataset_dir, raw_path, upload_type, raw_size, stream, keep_raw, to_parquet, layout, artifact_key, on_progress,
+                   parquet_path, ingest_stats)
+    return stages
+
+def ingest_job(job_id: str, dataset_id: str, dataset_dir: Path, raw_path: Optional[Path], upload_type: UploadType, raw_size: int, stream: bool, keep_raw: bool, to_parquet: bool,
+               layout: ParquetLayout, artifact_key: Optional[str], on_progress, parquet_path: Optional[Path] = None, ingest_stats: Optional[IngestStats] = None):
+    '''
+    ingest_job is a function that runs the steps of run_ingest_job, a failure is recorded on the job and the dataset directory is removed
+    (and the dataset deleted again if it was already saved).
+    '''
+    saved = False
+    try:
+        update_job(job_id, status="running")
+
+        if upload_type == "csv" and parquet_path is not None:
+            # The upload route streamed the request into Parquet already, only the metadata is left.
+            update_job(job_id, percent=80)
+            with Stage("schema"):
+                new_dataset = build_csv_dataset(dataset_id, parquet_path, raw_size, layout)
+
+        elif upload_type == "csv":
+            started = time.perf_counter()
+            if stream:
+                try:
+                    with open(raw_path, "rb") as source, Stage("stream_csv", size=raw_size) as stage:
+                        # The raw file is already on disk, so the streamer does not need to write another copy.
+                        parquet_path, _, ingest_stats = stream_csv_to_parquet(dataset_dir, source, raw_path.name, keep_raw=False, on_progress=on_progress, layout=layout)
+                        stage.rows = ingest_stats.rows
+                except ValueError as e:
+                    logging.warning("Streaming ingest of %s fell back to two-pass: %s", raw_path.name, e)
+                    stream = False
+
+            if not stream:
+                with Stage("save_parquet", size=raw_size) as stage:
+                    parquet_path = save_parquet_file(dataset_dir, raw_path, layout)
+                    stage.rows = count_parquet_rows(parquet_path)
+                ingest_stats = build_ingest_stats("two_pass", stage.rows, raw_size, started)
+
+            update_job(job_id, percent=80)
+            with Stage("schema"):
+                new_dataset = build_csv_dataset(dataset_id, parquet_path, raw_size, layout)
+
+            if not keep_raw:
+                raw_path.unlink(missing_ok=True)
+
+        elif upload_type == "json" or upload_type == "jsonl":
+            with Stage("save_parquet", size=raw_size) as stage:
+                parquet_path, ingest_stats = save_json_parquet_file(dataset_dir, raw_path, upload_type, layout=layout)
+                stage.rows = ingest_stats.rows
+            update_job(job_id, percent=80)
+            with Stage("schema"):
+                new_dataset = build_parquet_dataset(dataset_id, upload_type, parquet_path, raw_size, layout)
+
+            if not keep_raw:
+                raw_path.unlink(missing_ok=True)
+
+        elif upload_type == "sql" or upload_type == "sql_dump":
+            with Stage("load_sql_dump", size=raw_size) as stage:
+                sqlite_path, ingest_stats = sql_dump_to_sqlite(dataset_dir, raw_path, on_progress=on_progress)
+                stage.rows = ingest_stats.rows
+            update_job(job_id, percent=80)
+            with Stage("schema"):
+                new_dataset = build_sqlite_dataset(dataset_id, upload_type, sqlite_path, raw_size)
+
+            if not keep_raw:
+                raw_path.unlink(missing_ok=True)
+
+        elif upload_type == "db" or upload_type == "sqlite":
+            # There is no conversion for SQLite, the slow part is reading the tables and schema.
+            with Stage("schema"):
+                new_dataset = build_sqlite_dataset(dataset_id, upload_type, raw_path, raw_size)
+
+        else:
+            raise ValueError(f"Unsupported upload type: {upload_type}")
+
+        if to_parquet and upload_type in SQLITE_UPLOAD_TYPES:
+            update_job(job_id, percent=85)
+            with Stage("convert_parquet"):
+                new_dataset.table_paths = convert_sqlite_to_parquet(dataset_dir, Path(new_dataset.dataset_path), new_dataset.tables, layout=layout)
+            new_dataset.layout = layout
+
+        update_job(job_id, percent=90)
+        with Stage("profile"):
+            profile = profile_dataset(new_dataset)
+        update_job(job_id, percent=95)
+        new_dataset.artifact_key = artifact_key
+        with Stage("save_metadata"):
+            save_metadata(new_dataset, artifact_dir=dataset_dir)
+            saved = True
+            save_profile(profile)
+        update_job(job_id, status="succeeded", percent=100, ingest_stats=ingest_stats)
+
+    except Exception as e:
+        logging.exception("Ingest job %s failed", job_id)
+        update_job(job_id, status="failed", error=str(e))
+        files_dir = dataset_dir
+        if saved:
+            # The metadata points at the directory, delete the dataset first. Its files stay if an upload of the
+            # same content already reuses them (delete_dataset returns None).
+            try:
+                files_dir = delete_dataset(dataset_id)
+            except Exception:
+                logging.exception("Could not delete dataset %s of failed ingest job %s", dataset_id, job_id)
+                files_dir = None
+        if files_dir is not None:
+            shutil.rmtree(files_dir, ignore_errors=True)
+
+def run_convert_job(job_id: str, dataset_id: str, layout: Optional[ParquetLayout] = None):
+    '''
+    run_convert_job is a function that writes the tables of a saved SQLite dataset into Parquet files. It runs inside an ingest worker process.
+    The dataset stays readable from SQLite while the job runs, reads switch to Parquet once the table paths are saved.
+    Tables that already have a Parquet file are skipped, so a job can be re-run to retry the ones that failed.
+
+    Progress: one step per table up to 95%, saving the table paths 100%.
+
+    Args:
+        job_id: str - The id of the job to report progress to.
+        dataset_id: str - The id of the SQLite dataset to convert.
+        layout: ParquetLayout - How the Parquet files are written, defaults to the layout of the tables converted before (or the server defaults).
+    '''
+    try:
+        update_job(job_id, status="running")
+        dataset = get_dataset_by_id(dataset_id)
+        if dataset.upload_type not in SQLITE_UPLOAD_TYPES:
+            raise ValueError(f"Only SQLite datasets can be converted to Parquet, {dataset_id} is {dataset.upload_type}.")
+
+        sqlite_path = Path(dataset.dataset_path)
+        layout = layout or dataset.layout or ParquetLayout()
+        remaining = [table_name for table_name in dataset.tables if table_name not in dataset.table_paths]
+        table_paths = convert_sqlite_to_parquet(sqlite_path.parent, sqlite_path, remaining, layout=layout,
+                                                on_progress=lambda done: update_job(job_id, percent=int(95 * done / len(remaining))))
+        save_table_paths(dataset_id, {**dataset.table_paths, **table_paths}, layout)
+        update_job(job_id, status="succeeded", percent=100)
+
+    except Exception as e:
+        logging.exception("Convert job %s failed", job_id)
+        update_job(job_id, status="failed", error=str(e))
+
+def run_compact_job(job_id: str, dataset_id: str):
+    '''
+    run_compact_job is a function that merges the files appended to a dataset (see compact_dataset). It runs inside an ingest worker process.
+    '''
+    try:
+        update_job(job_id, status="running")
+        compact_dataset(dataset_id)
+        update_job(job_id, status="succeeded", percent=100)
+
+    except Exception as e:
+        logging.exception("Compact job %s failed", job_id)
+        update_job(job_id, status="failed", error=str(e))
+
+def submit_job(dataset_id: str, function, *args) -> str:
+    '''
+    submit_job is a function that queues function(job_id, *args) on the ingest process pool and returns the job id right away.
+    '''
+    job_id = str(uuid.uuid4())
+    create_job(job_id, dataset_id)
+
+    try:
+        future = get_ingest_executor().submit(function, job_id, *args)
+    except BrokenProcessPool:
+        # A crashed worker breaks the whole pool, start a new one.
+        shutdown_ingest_executor()
+        future = get_ingest_executor().submit(function, job_id, *args)
+
+    def on_done(done: Future):
+        # The job functions record their own errors, this only catches a worker process that died (eg) out of memory).
+        error = done.exception() if not done.cancelled() else None
+        if error is not None:
+            update_job(job_id, status="failed", error=f"Ingest worker crashed: {error}")
+        elif not done.cancelled() and done.result():
+            # The stages timed in the worker process (see run_ingest_job), into the metrics of this one.
+            record_stages(done.result())
+
+    future.add_done_callback(on_done)
+    return job_id
+
+def create_finished_job(dataset_id: str) -> str:
+    '''
+    create_finished_job is a function that records a job that is already done, for uploads that needed no conversion (deduplicated).
+    '''
+    job_id = str(uuid.uuid4())
+    create_job(job_id, dataset_id)
+    update_job(job_id, status="succeeded", percent=100)
+    return job_id
+
+def submit_ingest_job(dataset_id: str, dataset_dir: Path, raw_path: Optional[Path], upload_type: UploadType, raw_size: int, stream: bool = False, keep_raw: bool = True,
+                      to_parquet: bool = False, layout: Optional[ParquetLayout] = None, artifact_key: Optional[str] = None, parquet_path: Optional[Path] = None,
+                      ingest_stats: Optional[IngestStats] = None) -> str:
+    '''
+    submit_ingest_job is a function that queues the conversion of a saved upload (or the rest of the ingest of a streamed CSV, see run_ingest_job) and returns right away.
+
+    Returns:
+        str - The id of the job, to poll with get_job.
+    '''
+    return submit_job(dataset_id, run_ingest_job, dataset_id, str(dataset_dir), str(raw_path) if raw_path else None, upload_type, raw_size, stream, keep_raw, to_parquet,
+                      layout, artifact_key, str(parquet_path) if parquet_path else None, ingest_stats)
+
+def submit_convert_job(dataset_id: str, layout: Optional[ParquetLayout] = None) -> str:
+    '''
+    submit_convert_job is a function that queues the conversion of a SQLite dataset's tables into Parquet (see run_convert_job).
+
+    Returns:
+        str - The id of the job, to poll with get_job.
+    '''
+    return submit_job(dataset_id, run_convert_job, dataset_id, layout)
+
+def submit_compact_job(dataset_id: str) -> str:
+    '''
+    submit_compact_job is a function that queues the compaction of the files appended to a dataset (see run_compact_job).
+
+    Returns:
+        str - The id of the job, to poll with get_job.
+    '''
+    return submit_job(dataset_id, run_compact_job, dataset_id)
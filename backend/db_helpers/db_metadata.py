@@ -1,7 +1,40 @@
 import sqlite3
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from .db_constants import METADATA_DB, METADATA_TABLE, Dataset
+from .db_constants import (
+    DATA_ROOT,
+    METADATA_DB,
+    METADATA_TABLE,
+    METADATA_REVISION_TABLE,
+    JOBS_TABLE,
+    PROFILES_TABLE,
+    INSIGHT_CACHE_TABLE,
+    AGGREGATE_CACHE_TABLE,
+    ARTIFACTS_TABLE,
+    UPLOAD_SESSIONS_TABLE,
+    UPLOAD_CHUNKS_TABLE,
+    COLUMNS_INDEX_TABLE,
+    SEARCH_INDEX_TABLE,
+    METADATA_POOL_SIZE,
+    DATASET_CACHE_SIZE,
+    SEARCH_DEFAULT_LIMIT,
+    Dataset,
+    DatasetSummary,
+    DatasetPage,
+    IngestJob,
+    IngestStats,
+    DatasetProfile,
+    ParquetLayout,
+    UploadSession,
+    SearchHit
+)
+from typing import Iterator, Optional
 import json
+import re
+import time
 
 
 ########################################################
@@ -9,49 +42,664 @@ import json
 ########################################################
 '''
 db_metadata.py is a module that contains the functions to interact with the metadata database.
+
+Connections come from a MetadataStore (one per metadata db path), which keeps a pool of long-lived
+sqlite3 connections in WAL mode. The schema is migrated once per process, not on every call.
 '''
 
-def connect_metadata_db():
+# Adds the columns of metadata rows ({row}, from {source}) to the search index, the last segment of dataset_path is the file name.
+INDEX_COLUMNS_SQL = f"""INSERT INTO {COLUMNS_INDEX_TABLE} (dataset_id, file_name, table_name, column_name, column_type)
+    SELECT {{row}}.dataset_id, replace({{row}}.dataset_path, rtrim({{row}}.dataset_path, replace({{row}}.dataset_path, '/', '')), ''),
+    tables.key, columns.key, columns.value
+    FROM {{source}}json_each({{row}}.schema) AS tables, json_each(tables.value) AS columns WHERE tables.type = 'object'"""
+
+# MIGRATIONS[i] moves the metadata database from PRAGMA user_version i to i + 1. Only append to this list.
+MIGRATIONS: list[list[str]] = [
+    # 1: dataset metadata.
+    [f""" CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (dataset_id TEXT PRIMARY KEY,
+    upload_type TEXT,
+    raw_byte_size INTEGER,
+    dataset_path TEXT NOT NULL,
+    tables TEXT NOT NULL,
+    schema TEXT NOT NULL)"""],
+
+    # 2: background ingest jobs, see db_jobs.py.
+    [f""" CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (job_id TEXT PRIMARY KEY,
+    dataset_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    percent REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    ingest_stats TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL)"""],
+
+    # 3: revision counter, bumped by triggers on every change to the metadata table (from any process).
+    # Caches and ETags compare it instead of re-reading the metadata.
+    [f"CREATE TABLE IF NOT EXISTS {METADATA_REVISION_TABLE} (id INTEGER PRIMARY KEY CHECK (id = 1), revision INTEGER NOT NULL)",
+     f"INSERT OR IGNORE INTO {METADATA_REVISION_TABLE} (id, revision) VALUES (1, 0)"] +
+    [f"""CREATE TRIGGER IF NOT EXISTS {METADATA_TABLE}_{event.lower()}_revision AFTER {event} ON {METADATA_TABLE}
+    BEGIN UPDATE {METADATA_REVISION_TABLE} SET revision = revision + 1 WHERE id = 1; END"""
+     for event in ("INSERT", "UPDATE", "DELETE")],
+
+    # 4: column profiles computed at ingest, see db_profile.py.
+    [f""" CREATE TABLE IF NOT EXISTS {PROFILES_TABLE} (dataset_id TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    created_at REAL NOT NULL)"""],
+
+    # 5: cached InsightAgent responses, see ai_helpers/insight_cache.py.
+    [f""" CREATE TABLE IF NOT EXISTS {INSIGHT_CACHE_TABLE} (cache_key TEXT PRIMARY KEY,
+    dataset_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL)""",
+     f"CREATE INDEX IF NOT EXISTS {INSIGHT_CACHE_TABLE}_dataset ON {INSIGHT_CACHE_TABLE} (dataset_id, table_name)",
+     f"CREATE INDEX IF NOT EXISTS {INSIGHT_CACHE_TABLE}_last_used ON {INSIGHT_CACHE_TABLE} (last_used_at)"],
+
+    # 6: Parquet files of the converted SQLite tables, see convert_sqlite_to_parquet in db_ingest.py.
+    [f"ALTER TABLE {METADATA_TABLE} ADD COLUMN table_paths TEXT NOT NULL DEFAULT '{{}}'"],
+
+    # 7: ParquetLayout the dataset's Parquet files were written with (NULL while it has none).
+    [f"ALTER TABLE {METADATA_TABLE} ADD COLUMN layout TEXT"],
+
+    # 8: deduplicated uploads, datasets with the same artifact_key share the files of one artifact directory.
+    [f""" CREATE TABLE IF NOT EXISTS {ARTIFACTS_TABLE} (artifact_key TEXT PRIMARY KEY,
+    artifact_dir TEXT NOT NULL,
+    refcount INTEGER NOT NULL,
+    created_at REAL NOT NULL)""",
+     f"ALTER TABLE {METADATA_TABLE} ADD COLUMN artifact_key TEXT",
+     f"CREATE INDEX IF NOT EXISTS {METADATA_TABLE}_artifact ON {METADATA_TABLE} (artifact_key)"],
+
+    # 9: resumable uploads, see db_uploads.py.
+    [f""" CREATE TABLE IF NOT EXISTS {UPLOAD_SESSIONS_TABLE} (upload_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    upload_type TEXT NOT NULL,
+    total_bytes INTEGER NOT NULL,
+    chunk_bytes INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    dataset_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL)""",
+     f"CREATE INDEX IF NOT EXISTS {UPLOAD_SESSIONS_TABLE}_updated ON {UPLOAD_SESSIONS_TABLE} (updated_at)",
+     f""" CREATE TABLE IF NOT EXISTS {UPLOAD_CHUNKS_TABLE} (upload_id TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (upload_id, chunk_index))"""],
+
+    # 10: search index, see search_columns. Triggers keep it in the transaction of every change to the metadata table,
+    # the FTS5 index holds no copy of the names (content=), it reads them from the columns table.
+    [f""" CREATE TABLE IF NOT EXISTS {COLUMNS_INDEX_TABLE} (id INTEGER PRIMARY KEY,
+    dataset_id TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    column_type TEXT NOT NULL)""",
+     f"CREATE INDEX IF NOT EXISTS {COLUMNS_INDEX_TABLE}_dataset ON {COLUMNS_INDEX_TABLE} (dataset_id)",
+     f"CREATE INDEX IF NOT EXISTS {COLUMNS_INDEX_TABLE}_column ON {COLUMNS_INDEX_TABLE} (column_name COLLATE NOCASE)",
+     f"CREATE INDEX IF NOT EXISTS {COLUMNS_INDEX_TABLE}_type ON {COLUMNS_INDEX_TABLE} (column_type COLLATE NOCASE)",
+     f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_INDEX_TABLE} USING fts5(file_name, table_name, column_name,
+    content='{COLUMNS_INDEX_TABLE}', content_rowid='id')""",
+     f"""CREATE TRIGGER IF NOT EXISTS {COLUMNS_INDEX_TABLE}_insert_search AFTER INSERT ON {COLUMNS_INDEX_TABLE}
+    BEGIN INSERT INTO {SEARCH_INDEX_TABLE} (rowid, file_name, table_name, column_name) VALUES (new.id, new.file_name, new.table_name, new.column_name); END""",
+     f"""CREATE TRIGGER IF NOT EXISTS {COLUMNS_INDEX_TABLE}_delete_search AFTER DELETE ON {COLUMNS_INDEX_TABLE}
+    BEGIN INSERT INTO {SEARCH_INDEX_TABLE} ({SEARCH_INDEX_TABLE}, rowid, file_name, table_name, column_name)
+    VALUES ('delete', old.id, old.file_name, old.table_name, old.column_name); END""",
+     f"""CREATE TRIGGER IF NOT EXISTS {METADATA_TABLE}_insert_columns AFTER INSERT ON {METADATA_TABLE}
+    BEGIN {INDEX_COLUMNS_SQL.format(row="new", source="")}; END""",
+     f"""CREATE TRIGGER IF NOT EXISTS {METADATA_TABLE}_delete_columns AFTER DELETE ON {METADATA_TABLE}
+    BEGIN DELETE FROM {COLUMNS_INDEX_TABLE} WHERE dataset_id = old.dataset_id; END""",
+     f"""CREATE TRIGGER IF NOT EXISTS {METADATA_TABLE}_update_columns AFTER UPDATE OF schema, dataset_path ON {METADATA_TABLE}
+    BEGIN DELETE FROM {COLUMNS_INDEX_TABLE} WHERE dataset_id = old.dataset_id; {INDEX_COLUMNS_SQL.format(row="new", source="")}; END""",
+     # The datasets saved before the index.
+     INDEX_COLUMNS_SQL.format(row="m", source=f"{METADATA_TABLE} AS m, ")],
+
+    # 11: materialized group-by results, see db_aggregates.py.
+    [f""" CREATE TABLE IF NOT EXISTS {AGGREGATE_CACHE_TABLE} (fingerprint TEXT PRIMARY KEY,
+    dataset_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    source_fingerprint TEXT NOT NULL,
+    request TEXT NOT NULL,
+    path TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL)""",
+     f"CREATE INDEX IF NOT EXISTS {AGGREGATE_CACHE_TABLE}_dataset ON {AGGREGATE_CACHE_TABLE} (dataset_id, table_name)",
+     f"CREATE INDEX IF NOT EXISTS {AGGREGATE_CACHE_TABLE}_last_used ON {AGGREGATE_CACHE_TABLE} (last_used_at)"],
+]
+
+# The statements are kept as constants so that every call sends the same SQL text,
+# which lets sqlite3's per-connection statement cache reuse the prepared statement.
+DATASET_COLUMNS = "dataset_id, upload_type, raw_byte_size, dataset_path, tables, schema, table_paths, layout, artifact_key"
+INSERT_DATASET_SQL = f"INSERT INTO {METADATA_TABLE} ({DATASET_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+DELETE_DATASET_SQL = f"DELETE FROM {METADATA_TABLE} WHERE dataset_id = ?"
+SELECT_DATASET_ARTIFACT_SQL = f"SELECT artifact_key FROM {METADATA_TABLE} WHERE dataset_id = ?"
+# Any dataset of the artifact will do, they all describe the same files.
+SELECT_ARTIFACT_DATASET_SQL = f"SELECT {DATASET_COLUMNS} FROM {METADATA_TABLE} WHERE artifact_key = ? LIMIT 1"
+UPDATE_DATASET_FILES_SQL = f"UPDATE {METADATA_TABLE} SET dataset_path = ?, raw_byte_size = ? WHERE dataset_id = ?"
+# Moves the paths of datasets from one directory to another, the directory is a prefix of dataset_path and of every table_paths value.
+MOVE_DATASET_PATHS_SQL = f"UPDATE {METADATA_TABLE} SET dataset_path = replace(dataset_path, ?1, ?2), table_paths = replace(table_paths, ?1, ?2)"
+CLEAR_DATASET_ARTIFACT_SQL = f"UPDATE {METADATA_TABLE} SET artifact_key = NULL WHERE dataset_id = ?"
+UPDATE_TABLE_PATHS_SQL = f"UPDATE {METADATA_TABLE} SET table_paths = ?, layout = ? WHERE dataset_id = ?"
+SELECT_DATASETS_SQL = f"SELECT {DATASET_COLUMNS} FROM {METADATA_TABLE}"
+SELECT_REVISION_SQL = f"SELECT revision FROM {METADATA_REVISION_TABLE} WHERE id = 1"
+# Pages are keyed on rowid (upload order). A LIMIT of -1 means no limit in SQLite.
+SELECT_DATASET_ID_PAGE_SQL = f"SELECT rowid, dataset_id FROM {METADATA_TABLE} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+SELECT_SUMMARY_PAGE_SQL = f"SELECT rowid, dataset_id, upload_type, raw_byte_size, dataset_path, tables FROM {METADATA_TABLE} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+
+JOB_COLUMNS = "job_id, dataset_id, status, percent, error, ingest_stats, created_at, updated_at"
+INSERT_JOB_SQL = f"INSERT INTO {JOBS_TABLE} (job_id, dataset_id, status, percent, created_at, updated_at) VALUES (?, ?, 'queued', 0, ?, ?)"
+# COALESCE keeps the current value for the arguments that were not given.
+UPDATE_JOB_SQL = f"""UPDATE {JOBS_TABLE} SET status = COALESCE(?, status), percent = COALESCE(?, percent),
+error = COALESCE(?, error), ingest_stats = COALESCE(?, ingest_stats), updated_at = ? WHERE job_id = ?"""
+SELECT_JOB_SQL = f"SELECT {JOB_COLUMNS} FROM {JOBS_TABLE} WHERE job_id = ?"
+# OR REPLACE: a profile computed on demand (see get_profile_route) and the ingest one may race, either is fine.
+SAVE_PROFILE_SQL = f"INSERT OR REPLACE INTO {PROFILES_TABLE} (dataset_id, profile, created_at) VALUES (?, ?, ?)"
+SELECT_PROFILE_SQL = f"SELECT profile FROM {PROFILES_TABLE} WHERE dataset_id = ?"
+DELETE_PROFILE_SQL = f"DELETE FROM {PROFILES_TABLE} WHERE dataset_id = ?"
+# A deduplicated dataset gets the profile of the dataset it shares its files with, under its own id.
+COPY_PROFILE_SQL = f"""INSERT OR REPLACE INTO {PROFILES_TABLE} (dataset_id, profile, created_at)
+SELECT ?, json_set(profile, '$.dataset_id', ?), created_at FROM {PROFILES_TABLE} WHERE dataset_id = ?"""
+
+SELECT_ARTIFACT_SQL = f"SELECT artifact_dir, refcount FROM {ARTIFACTS_TABLE} WHERE artifact_key = ?"
+INSERT_ARTIFACT_SQL = f"INSERT INTO {ARTIFACTS_TABLE} (artifact_key, artifact_dir, refcount, created_at) VALUES (?, ?, 1, ?)"
+ACQUIRE_ARTIFACT_SQL = f"UPDATE {ARTIFACTS_TABLE} SET refcount = refcount + 1 WHERE artifact_key = ?"
+RELEASE_ARTIFACT_SQL = f"UPDATE {ARTIFACTS_TABLE} SET refcount = refcount - 1 WHERE artifact_key = ?"
+DELETE_ARTIFACT_SQL = f"DELETE FROM {ARTIFACTS_TABLE} WHERE artifact_key = ?"
+MOVE_ARTIFACT_SQL = f"UPDATE {ARTIFACTS_TABLE} SET artifact_dir = ? WHERE artifact_key = ?"
+
+SELECT_INSIGHT_SQL = f"SELECT response, created_at FROM {INSIGHT_CACHE_TABLE} WHERE cache_key = ?"
+TOUCH_INSIGHT_SQL = f"UPDATE {INSIGHT_CACHE_TABLE} SET last_used_at = ? WHERE cache_key = ?"
+SAVE_INSIGHT_SQL = f"INSERT OR REPLACE INTO {INSIGHT_CACHE_TABLE} (cache_key, dataset_id, table_name, response, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)"
+DELETE_EXPIRED_INSIGHTS_SQL = f"DELETE FROM {INSIGHT_CACHE_TABLE} WHERE created_at < ?"
+# Keeps the max_entries most recently used rows. (LIMIT -1 OFFSET n skips the first n)
+EVICT_INSIGHTS_SQL = f"DELETE FROM {INSIGHT_CACHE_TABLE} WHERE cache_key IN (SELECT cache_key FROM {INSIGHT_CACHE_TABLE} ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)"
+COUNT_INSIGHTS_SQL = f"SELECT count(*) FROM {INSIGHT_CACHE_TABLE}"
+DELETE_DATASET_INSIGHTS_SQL = f"DELETE FROM {INSIGHT_CACHE_TABLE} WHERE dataset_id = ?"
+
+# A result is only served while the source file it was computed from is unchanged (same fingerprint).
+SELECT_AGGREGATE_SQL = f"SELECT path FROM {AGGREGATE_CACHE_TABLE} WHERE fingerprint = ? AND source_fingerprint = ?"
+TOUCH_AGGREGATE_SQL = f"UPDATE {AGGREGATE_CACHE_TABLE} SET last_used_at = ? WHERE fingerprint = ?"
+SELECT_TABLE_AGGREGATES_SQL = f"""SELECT fingerprint, request, path, row_count FROM {AGGREGATE_CACHE_TABLE}
+    WHERE dataset_id = ? AND table_name = ? AND source_fingerprint = ? ORDER BY row_count"""
+SAVE_AGGREGATE_SQL = f"""INSERT OR REPLACE INTO {AGGREGATE_CACHE_TABLE}
+    (fingerprint, dataset_id, table_name, source_fingerprint, request, path, row_count, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+# The results of the table computed from an older version of its source, they can not be served anymore.
+DELETE_STALE_AGGREGATES_SQL = f"DELETE FROM {AGGREGATE_CACHE_TABLE} WHERE dataset_id = ? AND table_name = ? AND source_fingerprint != ? RETURNING path"
+EVICT_AGGREGATES_SQL = f"""DELETE FROM {AGGREGATE_CACHE_TABLE} WHERE fingerprint IN
+    (SELECT fingerprint FROM {AGGREGATE_CACHE_TABLE} ORDER BY last_used_at DESC LIMIT -1 OFFSET ?) RETURNING path"""
+DELETE_DATASET_AGGREGATES_SQL = f"DELETE FROM {AGGREGATE_CACHE_TABLE} WHERE dataset_id = ?"
+
+UPLOAD_SESSION_COLUMNS = "upload_id, filename, upload_type, total_bytes, chunk_bytes, status, dataset_id, error, created_at, updated_at"
+INSERT_UPLOAD_SESSION_SQL = f"INSERT INTO {UPLOAD_SESSIONS_TABLE} ({UPLOAD_SESSION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+SELECT_UPLOAD_SESSION_SQL = f"SELECT {UPLOAD_SESSION_COLUMNS} FROM {UPLOAD_SESSIONS_TABLE} WHERE upload_id = ?"
+SELECT_UPLOAD_CHUNKS_SQL = f"SELECT chunk_index FROM {UPLOAD_CHUNKS_TABLE} WHERE upload_id = ? ORDER BY chunk_index"
+# The chunk is only recorded while the session is open, the rowcount of the touch tells whether it still was.
+TOUCH_OPEN_UPLOAD_SESSION_SQL = f"UPDATE {UPLOAD_SESSIONS_TABLE} SET updated_at = ? WHERE upload_id = ? AND status = 'open'"
+SAVE_UPLOAD_CHUNK_SQL = f"INSERT OR REPLACE INTO {UPLOAD_CHUNKS_TABLE} (upload_id, chunk_index, sha256) VALUES (?, ?, ?)"
+UPDATE_UPLOAD_STATUS_SQL = f"""UPDATE {UPLOAD_SESSIONS_TABLE} SET status = ?, dataset_id = COALESCE(?, dataset_id), error = ?, updated_at = ?
+    WHERE upload_id = ? AND status = ?"""
+SELECT_EXPIRED_UPLOADS_SQL = f"SELECT upload_id FROM {UPLOAD_SESSIONS_TABLE} WHERE updated_at < ?"
+DELETE_UPLOAD_SESSION_SQL = f"DELETE FROM {UPLOAD_SESSIONS_TABLE} WHERE upload_id = ?"
+DELETE_UPLOAD_CHUNKS_SQL = f"DELETE FROM {UPLOAD_CHUNKS_TABLE} WHERE upload_id = ?"
+
+# The datasets of the interrupted jobs that were never saved (an ingest), not the saved ones (a conversion, a compaction, an ingest that saved its metadata).
+SELECT_INTERRUPTED_UPLOADS_SQL = f"""SELECT DISTINCT dataset_id FROM {JOBS_TABLE} WHERE status IN ('queued', 'running')
+    AND dataset_id NOT IN (SELECT dataset_id FROM {METADATA_TABLE})"""
+FAIL_INTERRUPTED_JOBS_SQL = f"UPDATE {JOBS_TABLE} SET status = 'failed', error = 'Interrupted by a server restart.', updated_at = ? WHERE status IN ('queued', 'running')"
+
+def open_metadata_connection(metadata_path: Path) -> sqlite3.Connection:
     '''
-    connect_metadata_db is a function that ensures that the metadata SQLite schema matches the current Dataset model
+    open_metadata_connection is a function that opens a sqlite3 connection to the metadata database, set up for sharing between threads.
 
-    - If Not it will create the table.
-    - Possibly add a deletion migration deletion. 
-    - Function requires fixes.
+    - check_same_thread=False: a pooled connection is handed to whichever request thread needs it (one thread at a time).
+    - WAL: readers do not block the writer (eg) a dashboard load while an ingest job saves its metadata).
     '''
+    conn = sqlite3.connect(str(metadata_path), check_same_thread=False, timeout=30, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
-    metadata_path = Path(METADATA_DB)
-    conn = sqlite3.connect(str(metadata_path))
+def migrate_metadata_db(metadata_path: Optional[Path] = None):
+    '''
+    migrate_metadata_db is a function that brings the metadata database schema up to date with MIGRATIONS.
+    The version is tracked with PRAGMA user_version, so every migration runs once per database.
 
-    conn.execute(f""" CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (dataset_id TEXT PRIMARY KEY, 
-    upload_type TEXT, 
-    raw_byte_size INTEGER, 
-    dataset_path TEXT NOT NULL,
-    tables TEXT NOT NULL, 
-    schema TEXT NOT NULL)""")
+    Args:
+        metadata_path: Path - The metadata database, defaults to METADATA_DB.
+    '''
+    conn = open_metadata_connection(Path(metadata_path or METADATA_DB))
+    try:
+        # BEGIN IMMEDIATE takes the write lock, so two processes starting at once do not both migrate.
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        conn.commit()
+    finally:
+        conn.close()
 
-    conn.commit()
-    return conn
+class DatasetCache:
+    '''
+    DatasetCache is a class that keeps decoded Dataset objects in memory (LRU), so json.loads of the schema only happens once per dataset.
+
+    The cache belongs to one metadata revision: when the revision changes (save_metadata in this or any other process)
+    every entry is dropped. The cached objects are shared, treat them as read-only.
+    '''
+    def __init__(self, max_entries: int = DATASET_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, Dataset] = OrderedDict()
+        self.revision: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def sync(self, revision: int):
+        '''
+        sync is a function that drops every entry if the metadata changed since they were cached.
+        '''
+        with self.lock:
+            if revision != self.revision:
+                self.entries.clear()
+                self.revision = revision
+
+    def get(self, dataset_id: str) -> Optional[Dataset]:
+        with self.lock:
+            dataset = self.entries.get(dataset_id)
+            if dataset is not None:
+                self.entries.move_to_end(dataset_id)
+            return dataset
+
+    def put(self, dataset: Dataset, revision: int):
+        with self.lock:
+            # A dataset read at an older revision than the cache's may be stale, do not keep it.
+            if revision != self.revision:
+                return
+            self.entries[dataset.dataset_id] = dataset
+            self.entries.move_to_end(dataset.dataset_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.revision = None
+
+class MetadataStore:
+    '''
+    MetadataStore is a class that keeps a pool of long-lived connections to one metadata database.
+    The database is migrated when the store is created, so the functions below never run CREATE TABLE.
+    '''
+    def __init__(self, metadata_path: Path, pool_size: int = METADATA_POOL_SIZE):
+        self.metadata_path = metadata_path
+        self.pool_size = pool_size
+        self.pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.cache = DatasetCache()
+        migrate_metadata_db(metadata_path)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        '''
+        connection is a context manager that lends a pooled connection and gives it back afterwards.
+        If the pool is empty a new connection is opened, and it is only kept if the pool has room for it.
+        '''
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = open_metadata_connection(self.metadata_path)
+
+        try:
+            yield conn
+        except BaseException:
+            # Never give a connection with a half-finished transaction to the next caller.
+            conn.rollback()
+            raise
+        finally:
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        '''
+        close is a function that closes all the pooled connections.
+        '''
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+# One store per metadata database path. Looked up with the current METADATA_DB on every call, so tests can point it at a temporary database.
+_stores: dict[str, MetadataStore] = {}
+_stores_lock = threading.Lock()
+
+def get_metadata_store() -> MetadataStore:
+    '''
+    get_metadata_store is a function that returns the store for the current METADATA_DB, creating (and migrating) it on first use.
+    '''
+    key = str(Path(METADATA_DB).resolve())
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                store = MetadataStore(Path(key))
+                _stores[key] = store
+    return store
+
+def close_metadata_stores():
+    '''
+    close_metadata_stores is a function that closes every pooled metadata connection (server shutdown).
+    '''
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
 
+def connect_metadata_db():
+    '''
+    connect_metadata_db is a function that opens a standalone connection to the metadata database, with the schema up to date.
+    The helpers below use the pooled connections of get_metadata_store() instead, the caller must close this one.
+    '''
+    store = get_metadata_store()
+    return open_metadata_connection(store.metadata_path)
 
-def save_metadata(dataset: Dataset):
+def row_to_dataset(row: tuple) -> Dataset:
+    '''
+    row_to_dataset is a function that converts a metadata row (in DATASET_COLUMNS order) into a Dataset object.
+    '''
+    return Dataset(
+        dataset_id=row[0],
+        upload_type=row[1],
+        raw_byte_size=row[2],
+        dataset_path=row[3],
+        tables=json.loads(row[4]),
+        schema=json.loads(row[5]),
+        table_paths=json.loads(row[6]),
+        layout=json.loads(row[7]) if row[7] else None,
+        artifact_key=row[8]
+    )
+
+def dataset_to_row(dataset: Dataset) -> tuple:
+    '''
+    dataset_to_row is a function that converts a Dataset object into a metadata row (in DATASET_COLUMNS order).
+    '''
+    data = dataset.model_dump()
+    return (data["dataset_id"], data["upload_type"], data["raw_byte_size"], data["dataset_path"], json.dumps(data["tables"]), json.dumps(data["schema"]),
+            json.dumps(data["table_paths"]), json.dumps(data["layout"]) if data["layout"] else None, data["artifact_key"])
+
+def register_artifact(conn: sqlite3.Connection, artifact_key: str, artifact_dir: Path) -> bool:
+    '''
+    register_artifact is a function that records one more dataset using the files of an artifact. Must run inside a write transaction.
+
+    Returns:
+        bool - False if the artifact already exists in another directory (the same content finished converting twice at once),
+            the dataset then keeps its own files and is not deduplicated.
+    '''
+    row = conn.execute(SELECT_ARTIFACT_SQL, (artifact_key,)).fetchone()
+    if row is None:
+        conn.execute(INSERT_ARTIFACT_SQL, (artifact_key, str(artifact_dir), time.time()))
+        return True
+    if row[0] != str(artifact_dir):
+        return False
+    conn.execute(ACQUIRE_ARTIFACT_SQL, (artifact_key,))
+    return True
+
+def save_metadata(dataset: Dataset, artifact_dir: Optional[Path] = None):
     '''
     save_metadata is a function that saves the metadata of a dataset to the metadata database.
     Args:
         dataset: Dataset - The dataset to save the metadata of.
+        artifact_dir: Path - The directory holding the dataset's files. If dataset.artifact_key is set, later uploads of the
+            same content reuse these files (see clone_dataset).
     '''
 
-    data = dataset.model_dump()
-    # get the connection to the metadata database.
-    conn = connect_metadata_db()
+    # get a pooled connection to the metadata database, "with conn" commits (or rolls back on error).
+    store = get_metadata_store()
+    with store.connection() as conn, conn:
+        if dataset.artifact_key is not None and artifact_dir is not None:
+            # IMMEDIATE: the artifact lookup and the refcount update can not interleave with another process.
+            conn.execute("BEGIN IMMEDIATE")
+            if not register_artifact(conn, dataset.artifact_key, artifact_dir):
+                dataset = dataset.model_copy(update={"artifact_key": None})
+        elif dataset.artifact_key is not None:
+            raise ValueError("A dataset with an artifact_key needs its artifact_dir.")
+        conn.execute(INSERT_DATASET_SQL, dataset_to_row(dataset))
 
-    try: 
-        conn.execute(f"INSERT INTO {METADATA_TABLE} (dataset_id, upload_type, raw_byte_size, dataset_path, tables, schema) VALUES (?, ?, ?, ?, ?, ?)",
-        (data["dataset_id"], data["upload_type"], data["raw_byte_size"], data["dataset_path"], json.dumps(data["tables"]), json.dumps(data["schema"])))
-        conn.commit()
+    # The insert bumped the revision, other processes notice it on their next read, this one can drop its cache right away.
+    store.cache.invalidate()
 
-    finally:
-        conn.close()
+def clone_dataset(artifact_key: str, dataset_id: str) -> Optional[Dataset]:
+    '''
+    clone_dataset is a function that saves a new dataset that reuses the files (and profile) of an existing artifact, no conversion needed.
+    Args:
+        artifact_key: str - The key of the upload, see upload_artifact_key.
+        dataset_id: str - The id of the new dataset.
+    Returns:
+        Dataset - The new dataset, or None if no dataset has this artifact_key (the upload must be converted).
+    '''
+    store = get_metadata_store()
+    with store.connection() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(SELECT_ARTIFACT_DATASET_SQL, (artifact_key,)).fetchone()
+        if row is None:
+            return None
+
+        dataset = row_to_dataset(row).model_copy(update={"dataset_id": dataset_id})
+        conn.execute(ACQUIRE_ARTIFACT_SQL, (artifact_key,))
+        conn.execute(INSERT_DATASET_SQL, dataset_to_row(dataset))
+        conn.execute(COPY_PROFILE_SQL, (dataset_id, dataset_id, row[0]))
+
+    store.cache.invalidate()
+    return dataset
+
+def delete_dataset(dataset_id: str) -> Optional[Path]:
+    '''
+    delete_dataset is a function that deletes the metadata, profile, cached insights and aggregates of a dataset, and releases its artifact.
+    Args:
+        dataset_id: str - The id of the dataset.
+    Returns:
+        Path - The directory of files to delete, None while other datasets still use the artifact.
+    Raises:
+        ValueError - If the dataset does not exist.
+    '''
+    store = get_metadata_store()
+    with store.connection() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(SELECT_DATASET_ARTIFACT_SQL, (dataset_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Dataset with id {dataset_id} not found.")
+
+        conn.execute(DELETE_DATASET_SQL, (dataset_id,))
+        conn.execute(DELETE_PROFILE_SQL, (dataset_id,))
+        conn.execute(DELETE_DATASET_INSIGHTS_SQL, (dataset_id,))
+        conn.execute(DELETE_DATASET_AGGREGATES_SQL, (dataset_id,))
+
+        artifact_key = row[0]
+        if artifact_key is None:
+            # Saved before deduplication (or lost a race to convert), its files are its own.
+            files_dir = DATA_ROOT / dataset_id
+        else:
+            conn.execute(RELEASE_ARTIFACT_SQL, (artifact_key,))
+            artifact_dir, refcount = conn.execute(SELECT_ARTIFACT_SQL, (artifact_key,)).fetchone()
+            files_dir = None
+            if refcount <= 0:
+                conn.execute(DELETE_ARTIFACT_SQL, (artifact_key,))
+                files_dir = Path(artifact_dir)
+
+    store.cache.invalidate()
+    return files_dir
+
+def get_artifact(artifact_key: str) -> Optional[tuple[Path, int]]:
+    '''
+    get_artifact is a function that returns the directory of an artifact and the number of datasets using it, None if it does not exist.
+    '''
+    with get_metadata_store().connection() as conn:
+        row = conn.execute(SELECT_ARTIFACT_SQL, (artifact_key,)).fetchone()
+    return (Path(row[0]), row[1]) if row else None
+
+def detach_artifact(dataset_id: str, artifact_dir: Path, moved_dir: Optional[Path] = None) -> Optional[Path]:
+    '''
+    detach_artifact is a function that makes a deduplicated dataset the only user of its files, before they are changed (eg) appended to).
+    The caller has already linked the files to where they go:
+        - The artifact is in the dataset's own directory and other datasets use it: the others move to moved_dir.
+        - The artifact is in another dataset's directory: this dataset moves to its own directory, DATA_ROOT/dataset_id.
+    Afterwards the dataset has no artifact_key, and its files are DATA_ROOT/dataset_id like a dataset that was never deduplicated.
+
+    Args:
+        dataset_id: str - The id of the dataset.
+        artifact_dir: Path - The artifact directory the caller linked the files from.
+        moved_dir: Path - The new artifact directory, for the first case.
+    Returns:
+        Path - The artifact directory to delete, when this dataset was its last user.
+    Raises:
+        ValueError - If the dataset does not exist, or its artifact moved since artifact_dir was read.
+    '''
+    own_dir = str(DATA_ROOT / dataset_id)
+    store = get_metadata_store()
+    files_dir = None
+    with store.connection() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(SELECT_DATASET_ARTIFACT_SQL, (dataset_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Dataset with id {dataset_id} not found.")
+        artifact_key = row[0]
+        if artifact_key is None:
+            return None
+
+        current_dir, refcount = conn.execute(SELECT_ARTIFACT_SQL, (artifact_key,)).fetchone()
+        if current_dir != str(artifact_dir):
+            raise ValueError(f"The files of dataset {dataset_id} moved in the meantime, try again.")
+
+        if current_dir != own_dir:
+            conn.execute(MOVE_DATASET_PATHS_SQL + " WHERE dataset_id = ?3", (current_dir, own_dir, dataset_id))
+        elif refcount > 1:
+            if moved_dir is None:
+                raise ValueError("Other datasets use these files, they need a moved_dir.")
+            conn.execute(MOVE_ARTIFACT_SQL, (str(moved_dir), artifact_key))
+            conn.execute(MOVE_DATASET_PATHS_SQL + " WHERE artifact_key = ?3 AND dataset_id != ?4", (own_dir, str(moved_dir), artifact_key, dataset_id))
+
+        conn.execute(RELEASE_ARTIFACT_SQL, (artifact_key,))
+        if refcount <= 1:
+            conn.execute(DELETE_ARTIFACT_SQL, (artifact_key,))
+            if current_dir != own_dir:
+                files_dir = Path(current_dir)
+        conn.execute(CLEAR_DATASET_ARTIFACT_SQL, (dataset_id,))
+
+    store.cache.invalidate()
+    return files_dir
+
+def update_dataset_files(dataset_id: str, dataset_path: str, raw_byte_size: int):
+    '''
+    update_dataset_files is a function that records new files for a dataset (eg) after an append or a compaction), reads go to them from then on.
+    Args:
+        dataset_id: str - The id of the dataset.
+        dataset_path: str - The new dataset path.
+        raw_byte_size: int - The size of everything uploaded to the dataset.
+    '''
+    store = get_metadata_store()
+    with store.connection() as conn, conn:
+        updated = conn.execute(UPDATE_DATASET_FILES_SQL, (dataset_path, raw_byte_size, dataset_id)).rowcount
+
+    if updated == 0:
+        raise ValueError(f"Dataset with id {dataset_id} not found.")
+    store.cache.invalidate()
+
+def get_artifact_refcount(artifact_key: str) -> int:
+    '''
+    get_artifact_refcount is a function that returns the number of datasets using an artifact (0 if it does not exist).
+    '''
+    with get_metadata_store().connection() as conn:
+        row = conn.execute(SELECT_ARTIFACT_SQL, (artifact_key,)).fetchone()
+    return row[1] if row else 0
+
+def save_table_paths(dataset_id: str, table_paths: dict[str, str], layout: Optional[ParquetLayout] = None):
+    '''
+    save_table_paths is a function that records the Parquet files of a dataset's converted tables, reads switch to them from then on.
+    Args:
+        dataset_id: str - The id of the dataset.
+        table_paths: dict[str, str] - Table name -> Parquet path, replaces the previous ones.
+        layout: ParquetLayout - The layout the Parquet files were written with.
+    '''
+    store = get_metadata_store()
+    with store.connection() as conn, conn:
+        updated = conn.execute(UPDATE_TABLE_PATHS_SQL, (json.dumps(table_paths), layout.model_dump_json() if layout else None, dataset_id)).rowcount
+
+    if updated == 0:
+        raise ValueError(f"Dataset with id {dataset_id} not found.")
+    store.cache.invalidate()
+
+def read_revision(conn: sqlite3.Connection) -> int:
+    '''
+    read_revision is a function that reads the metadata revision, which changes whenever a dataset is saved.
+    '''
+    return conn.execute(SELECT_REVISION_SQL).fetchone()[0]
+
+def get_metadata_revision() -> int:
+    '''
+    get_metadata_revision is a function that returns the current metadata revision. Used as the ETag of the dataset routes.
+    '''
+    with get_metadata_store().connection() as conn:
+        return read_revision(conn)
+
+def load_datasets(conn: sqlite3.Connection, cache: DatasetCache, dataset_ids: list[str]) -> list[Dataset]:
+    '''
+    load_datasets is a function that returns the datasets with the given ids (in that order), decoding only the ones that are not cached.
+    '''
+    revision = read_revision(conn)
+    cache.sync(revision)
+    found = {dataset_id: cache.get(dataset_id) for dataset_id in dataset_ids}
+    missing = [dataset_id for dataset_id, dataset in found.items() if dataset is None]
+
+    # SQLite limits the number of ? in one statement, so look the missing ones up in chunks.
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        placeholders = ", ".join("?" for _ in chunk)
+        for row in conn.execute(f"{SELECT_DATASETS_SQL} WHERE dataset_id IN ({placeholders})", chunk):
+            dataset = row_to_dataset(row)
+            cache.put(dataset, revision)
+            found[dataset.dataset_id] = dataset
+
+    return [found[dataset_id] for dataset_id in dataset_ids if found[dataset_id] is not None]
+
+def list_datasets_page(limit: Optional[int] = None, cursor: Optional[str] = None, summary: bool = False) -> DatasetPage:
+    '''
+    list_datasets_page is a function that lists the datasets one page at a time, in upload order.
+    Args:
+        limit: int - The page size. None returns every dataset after the cursor.
+        cursor: str - The next_cursor of the previous page. None starts at the first dataset.
+        summary: bool - If True the items are DatasetSummary objects (no schema is read or decoded).
+    Returns:
+        DatasetPage - The datasets of the page and the cursor of the next page.
+    '''
+    try:
+        after = int(cursor) if cursor else 0
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    # Fetch one extra row to know if there is a next page.
+    fetch = -1 if limit is None else limit + 1
+    store = get_metadata_store()
+
+    with store.connection() as conn:
+        if summary:
+            rows = conn.execute(SELECT_SUMMARY_PAGE_SQL, (after, fetch)).fetchall()
+            page_rows = rows if limit is None else rows[:limit]
+            items = [DatasetSummary(
+                dataset_id=row[1],
+                upload_type=row[2],
+                raw_byte_size=row[3],
+                dataset_path=row[4],
+                tables=json.loads(row[5])
+            ) for row in page_rows]
+        else:
+            rows = conn.execute(SELECT_DATASET_ID_PAGE_SQL, (after, fetch)).fetchall()
+            page_rows = rows if limit is None else rows[:limit]
+            items = load_datasets(conn, store.cache, [row[1] for row in page_rows])
+
+    has_more = limit is not None and len(rows) > limit
+    return DatasetPage(items=items, next_cursor=str(page_rows[-1][0]) if has_more else None)
 
 def list_datasets():
     '''
@@ -61,59 +709,370 @@ def list_datasets():
     Returns:
         list[Dataset] - A list of all the datasets in the metadata database.
     '''
-    conn = connect_metadata_db()
-    try:
-        cursor = conn.execute(f"SELECT * FROM {METADATA_TABLE}").fetchall()
-    finally:
-        conn.close()
-
-    # convert the cursor (query for all the metadata rows) into a list of Dataset objects and then return. 
-    return [Dataset(
-        dataset_id=row[0],
-        upload_type=row[1],
-        raw_byte_size=row[2],
-        dataset_path=row[3],
-        tables=json.loads(row[4]),
-        schema=json.loads(row[5])
-    ) for row in cursor]
+    return list_datasets_page().items
 
 def get_dataset_by_id(dataset_id: str) -> Dataset:
     '''
     get_dataset_by_id is a function that gets a dataset by its indivual id, from the metadata database.
-    Args: 
+    Args:
         dataset_id: str - The id of the dataset to get.
     returns:
         Dataset - The dataset object with the given id.
     '''
-    conn = connect_metadata_db()
+    store = get_metadata_store()
     try:
-        # Create a tuple of the dataset id, so that it can be used in the query. we need the , at the end to make it a tuple.
-        db_tuple = (dataset_id,)
-        cursor = conn.execute(f"SELECT * FROM {METADATA_TABLE} WHERE dataset_id = ?", db_tuple).fetchone()
-
-        # If the dataset is not found, raise an error.
-        if cursor is None:
-            raise ValueError(f"Dataset with id {dataset_id} not found.")
+        with store.connection() as conn:
+            # A cached dataset is only used if no dataset was saved since it was cached.
+            datasets = load_datasets(conn, store.cache, [dataset_id])
 
     except sqlite3.OperationalError as e:
         raise ValueError(f"Metadata table not initialized: or error retrieving dataset: {e}")
 
-    finally:
-        conn.close()
+    # If the dataset is not found, raise an error.
+    if not datasets:
+        raise ValueError(f"Dataset with id {dataset_id} not found.")
 
-    return Dataset(
-        dataset_id=cursor[0],
-        upload_type=cursor[1],
-        raw_byte_size=cursor[2],
-        dataset_path=cursor[3],
-        tables=json.loads(cursor[4]),
-        schema=json.loads(cursor[5])
+    return datasets[0]
+
+def search_columns(query: Optional[str] = None, column: Optional[str] = None, column_type: Optional[str] = None, table: Optional[str] = None,
+                   limit: int = SEARCH_DEFAULT_LIMIT) -> list[SearchHit]:
+    '''
+    search_columns is a function that finds the columns of every dataset matching a search, from the search index (no schema is decoded).
+    The filters that are given must all match.
+
+    Args:
+        query: str - Words to find in the file, table or column names, each one a prefix. eg) "cust id" matches customer_id in customers.csv
+        column: str - An exact column name (case insensitive). eg) customer_id
+        column_type: str - A DuckDB/SQLite type, with or without its parameters. eg) DECIMAL matches DECIMAL(18,3)
+        table: str - An exact table name (case insensitive).
+        limit: int - The maximum number of hits, the best matches of query first (else the oldest datasets first).
+    Returns:
+        list[SearchHit] - The matching columns.
+    Raises:
+        ValueError - If no filter is given, or query has no words.
+    '''
+    # The WHERE clause depends on the filters, there are only a few combinations so the statement cache still holds them all.
+    conditions = []
+    params: list = []
+    if query is not None:
+        words = re.findall(r"\w+", query)
+        if not words:
+            raise ValueError("The search query has no words.")
+        source = f"{SEARCH_INDEX_TABLE} JOIN {COLUMNS_INDEX_TABLE} AS c ON c.id = {SEARCH_INDEX_TABLE}.rowid"
+        conditions.append(f"{SEARCH_INDEX_TABLE} MATCH ?")
+        # Quoted, so that words like AND or NOT are not FTS5 operators, and * makes each one a prefix.
+        params.append(" ".join(f'"{word}"*' for word in words))
+        order_by = f"{SEARCH_INDEX_TABLE}.rank"
+    else:
+        source = f"{COLUMNS_INDEX_TABLE} AS c"
+        order_by = "c.id"
+
+    if column is not None:
+        conditions.append("c.column_name = ? COLLATE NOCASE")
+        params.append(column)
+    if column_type is not None:
+        # % and _ in the type are matched as themselves, not as LIKE wildcards.
+        conditions.append("(c.column_type = ? COLLATE NOCASE OR c.column_type LIKE ? ESCAPE '\\')")
+        escaped = column_type.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params += [column_type, escaped + "(%"]
+    if table is not None:
+        conditions.append("c.table_name = ? COLLATE NOCASE")
+        params.append(table)
+    if not conditions:
+        raise ValueError("Search by at least one of q, column, type or table.")
+
+    sql = (f"SELECT c.dataset_id, c.file_name, c.table_name, c.column_name, c.column_type FROM {source} "
+           f"WHERE {' AND '.join(conditions)} ORDER BY {order_by} LIMIT ?")
+    with get_metadata_store().connection() as conn:
+        rows = conn.execute(sql, (*params, limit)).fetchall()
+
+    return [SearchHit(dataset_id=row[0], file_name=row[1], table_name=row[2], column_name=row[3], column_type=row[4]) for row in rows]
+
+def save_profile(profile: DatasetProfile):
+    '''
+    save_profile is a function that saves the column profile of a dataset, replacing the previous one.
+    Args:
+        profile: DatasetProfile - The profile to save.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(SAVE_PROFILE_SQL, (profile.dataset_id, profile.model_dump_json(), profile.created_at))
+
+def get_profile(dataset_id: str) -> Optional[DatasetProfile]:
+    '''
+    get_profile is a function that gets the saved column profile of a dataset.
+    Args:
+        dataset_id: str - The id of the dataset.
+    Returns:
+        DatasetProfile - The profile, or None if the dataset was never profiled.
+    '''
+    with get_metadata_store().connection() as conn:
+        row = conn.execute(SELECT_PROFILE_SQL, (dataset_id,)).fetchone()
+
+    return DatasetProfile.model_validate_json(row[0]) if row else None
+
+def get_cached_insight(cache_key: str, ttl_seconds: float) -> Optional[str]:
+    '''
+    get_cached_insight is a function that gets a cached insight response, and marks it as recently used.
+    Args:
+        cache_key: str - The key of the insight (see ai_helpers/insight_cache.py).
+        ttl_seconds: float - Entries older than this are treated as missing.
+    Returns:
+        str - The cached response, or None if it is not cached (or expired).
+    '''
+    now = time.time()
+    with get_metadata_store().connection() as conn, conn:
+        row = conn.execute(SELECT_INSIGHT_SQL, (cache_key,)).fetchone()
+        if row is None or row[1] < now - ttl_seconds:
+            return None
+        conn.execute(TOUCH_INSIGHT_SQL, (now, cache_key))
+    return row[0]
+
+def save_cached_insight(cache_key: str, dataset_id: str, table_name: str, response: str, ttl_seconds: float, max_entries: int):
+    '''
+    save_cached_insight is a function that caches an insight response, then drops the expired entries
+    and the least recently used ones past max_entries.
+    '''
+    now = time.time()
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(SAVE_INSIGHT_SQL, (cache_key, dataset_id, table_name, response, now, now))
+        conn.execute(DELETE_EXPIRED_INSIGHTS_SQL, (now - ttl_seconds,))
+        conn.execute(EVICT_INSIGHTS_SQL, (max_entries,))
+
+def delete_cached_insights(dataset_id: str, table_name: Optional[str] = None) -> int:
+    '''
+    delete_cached_insights is a function that removes the cached insights of a dataset (or of one of its tables).
+    Returns:
+        int - The number of insights removed.
+    '''
+    sql = f"DELETE FROM {INSIGHT_CACHE_TABLE} WHERE dataset_id = ?"
+    params: tuple = (dataset_id,)
+    if table_name is not None:
+        sql += " AND table_name = ?"
+        params += (table_name,)
+
+    with get_metadata_store().connection() as conn, conn:
+        return conn.execute(sql, params).rowcount
+
+def count_cached_insights() -> int:
+    with get_metadata_store().connection() as conn:
+        return conn.execute(COUNT_INSIGHTS_SQL).fetchone()[0]
+
+def get_cached_aggregate(fingerprint: str, source_fingerprint: str) -> Optional[Path]:
+    '''
+    get_cached_aggregate is a function that gets the Parquet file of a materialized group-by result, and marks it as recently used.
+    Args:
+        fingerprint: str - The fingerprint of the query (see db_aggregates.aggregation_fingerprint).
+        source_fingerprint: str - The fingerprint of the table's source file now, a result computed from another version is treated as missing.
+    Returns:
+        Path - The Parquet file of the result, or None if it is not cached (or stale).
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        row = conn.execute(SELECT_AGGREGATE_SQL, (fingerprint, source_fingerprint)).fetchone()
+        if row is None:
+            return None
+        conn.execute(TOUCH_AGGREGATE_SQL, (time.time(), fingerprint))
+    return Path(row[0])
+
+def list_cached_aggregates(dataset_id: str, table_name: str, source_fingerprint: str) -> list[tuple[str, str, Path, int]]:
+    '''
+    list_cached_aggregates is a function that lists the materialized results of a table that are still current, the smallest first.
+    Returns:
+        list[tuple[str, str, Path, int]] - The fingerprint, request (JSON), Parquet file and number of rows of each result.
+    '''
+    with get_metadata_store().connection() as conn:
+        rows = conn.execute(SELECT_TABLE_AGGREGATES_SQL, (dataset_id, table_name, source_fingerprint)).fetchall()
+    return [(row[0], row[1], Path(row[2]), row[3]) for row in rows]
+
+def save_cached_aggregate(fingerprint: str, dataset_id: str, table_name: str, source_fingerprint: str, request: str, path: Path, row_count: int,
+                          max_entries: int) -> list[Path]:
+    '''
+    save_cached_aggregate is a function that records a materialized group-by result (replacing the previous one of the same query),
+    then drops the stale results of the table and the least recently used ones past max_entries.
+    Returns:
+        list[Path] - The Parquet files of the dropped results, for the caller to delete.
+    '''
+    now = time.time()
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(SAVE_AGGREGATE_SQL, (fingerprint, dataset_id, table_name, source_fingerprint, request, str(path), row_count, now, now))
+        dropped = conn.execute(DELETE_STALE_AGGREGATES_SQL, (dataset_id, table_name, source_fingerprint)).fetchall()
+        dropped += conn.execute(EVICT_AGGREGATES_SQL, (max_entries,)).fetchall()
+    return [Path(row[0]) for row in dropped]
+
+def delete_cached_aggregates(dataset_id: str, table_name: Optional[str] = None) -> list[Path]:
+    '''
+    delete_cached_aggregates is a function that removes the materialized results of a dataset (or of one of its tables).
+    Returns:
+        list[Path] - The Parquet files of the removed results, for the caller to delete.
+    '''
+    sql = f"DELETE FROM {AGGREGATE_CACHE_TABLE} WHERE dataset_id = ?"
+    params: tuple = (dataset_id,)
+    if table_name is not None:
+        sql += " AND table_name = ?"
+        params += (table_name,)
+
+    with get_metadata_store().connection() as conn, conn:
+        rows = conn.execute(sql + " RETURNING path", params).fetchall()
+    return [Path(row[0]) for row in rows]
+
+def create_job(job_id: str, dataset_id: str):
+    '''
+    create_job is a function that records a new queued ingest job in the jobs table.
+    Args:
+        job_id: str - The id of the job.
+        dataset_id: str - The id of the dataset the job is creating.
+    '''
+    now = time.time()
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(INSERT_JOB_SQL, (job_id, dataset_id, now, now))
+
+def update_job(job_id: str, status: Optional[str] = None, percent: Optional[float] = None, error: Optional[str] = None, ingest_stats: Optional[IngestStats] = None):
+    '''
+    update_job is a function that updates the state of an ingest job. Only the arguments that are given are changed.
+    Args:
+        job_id: str - The id of the job.
+        status: str - The new JobStatus.
+        percent: float - How far along the job is (0 to 100).
+        error: str - The error message if the job failed.
+        ingest_stats: IngestStats - The throughput of the conversion once it is done.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(UPDATE_JOB_SQL,
+        (status, percent, error, ingest_stats.model_dump_json() if ingest_stats else None, time.time(), job_id))
+
+def get_job(job_id: str) -> IngestJob:
+    '''
+    get_job is a function that gets the state of an ingest job by its id.
+    Args:
+        job_id: str - The id of the job.
+    Returns:
+        IngestJob - The job with the given id.
+    '''
+    with get_metadata_store().connection() as conn:
+        row = conn.execute(SELECT_JOB_SQL, (job_id,)).fetchone()
+
+    if row is None:
+        raise ValueError(f"Job with id {job_id} not found.")
+
+    return IngestJob(
+        job_id=row[0],
+        dataset_id=row[1],
+        status=row[2],
+        percent=row[3],
+        error=row[4],
+        ingest_stats=json.loads(row[5]) if row[5] else None,
+        created_at=row[6],
+        updated_at=row[7]
     )
 
+def fail_interrupted_jobs() -> list[Path]:
+    '''
+    fail_interrupted_jobs is a function that marks the jobs that were queued or running when the server stopped as failed.
+    Their worker processes are gone, so they would otherwise stay "running" forever.
+    Returns:
+        list[Path] - The directories of the interrupted uploads that were never saved as datasets (with their raw upload), for the caller to delete.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        dataset_ids = [row[0] for row in conn.execute(SELECT_INTERRUPTED_UPLOADS_SQL).fetchall()]
+        conn.execute(FAIL_INTERRUPTED_JOBS_SQL, (time.time(),))
+    return [DATA_ROOT / dataset_id for dataset_id in dataset_ids]
+
+def create_upload_session(session: UploadSession):
+    '''
+    create_upload_session is a function that records a new resumable upload session, see db_uploads.py.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(INSERT_UPLOAD_SESSION_SQL, (session.upload_id, session.filename, session.upload_type, session.total_bytes, session.chunk_bytes,
+                                                 session.status, session.dataset_id, session.error, session.created_at, session.updated_at))
+
+def merge_chunk_ranges(chunk_indexes: list[int], chunk_bytes: int, total_bytes: int) -> list[tuple[int, int]]:
+    '''
+    merge_chunk_ranges is a function that turns sorted chunk indexes into the byte ranges [start, end) they cover, adjacent chunks merged.
+    eg) [0, 1, 2, 5] with chunk_bytes=10, total_bytes=58 -> [(0, 30), (50, 58)]
+    '''
+    ranges = []
+    for index in chunk_indexes:
+        start, end = index * chunk_bytes, min((index + 1) * chunk_bytes, total_bytes)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def get_upload_session(upload_id: str) -> UploadSession:
+    '''
+    get_upload_session is a function that gets a resumable upload session with the chunks received so far.
+    Args:
+        upload_id: str - The id of the upload session.
+    Returns:
+        UploadSession - The session, received_chunks and received_ranges filled in.
+    Raises:
+        ValueError - If the session does not exist (or was garbage collected).
+    '''
+    with get_metadata_store().connection() as conn:
+        row = conn.execute(SELECT_UPLOAD_SESSION_SQL, (upload_id,)).fetchone()
+        chunks = [chunk_row[0] for chunk_row in conn.execute(SELECT_UPLOAD_CHUNKS_SQL, (upload_id,))]
+
+    if row is None:
+        raise ValueError(f"Upload session with id {upload_id} not found.")
+
+    total_bytes, chunk_bytes = row[3], row[4]
+    return UploadSession(
+        upload_id=row[0],
+        filename=row[1],
+        upload_type=row[2],
+        total_bytes=total_bytes,
+        chunk_bytes=chunk_bytes,
+        chunk_count=-(-total_bytes // chunk_bytes),
+        status=row[5],
+        dataset_id=row[6],
+        error=row[7],
+        created_at=row[8],
+        updated_at=row[9],
+        received_chunks=chunks,
+        received_ranges=merge_chunk_ranges(chunks, chunk_bytes, total_bytes)
+    )
+
+def save_upload_chunk(upload_id: str, chunk_index: int, sha256: str) -> bool:
+    '''
+    save_upload_chunk is a function that records a chunk written to the file of an upload session (a resent chunk replaces the previous one).
+    Returns:
+        bool - False if the session is no longer open (completed, or being completed), the chunk is then not recorded.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        if conn.execute(TOUCH_OPEN_UPLOAD_SESSION_SQL, (time.time(), upload_id)).rowcount == 0:
+            return False
+        conn.execute(SAVE_UPLOAD_CHUNK_SQL, (upload_id, chunk_index, sha256))
+    return True
+
+def update_upload_status(upload_id: str, from_status: str, status: str, dataset_id: Optional[str] = None, error: Optional[str] = None) -> bool:
+    '''
+    update_upload_status is a function that moves an upload session from one UploadStatus to another, only if it is still in from_status.
+    eg) update_upload_status(upload_id, "open", "completing") lets exactly one of two concurrent /complete requests go on.
+    Returns:
+        bool - True if the status was changed.
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        return conn.execute(UPDATE_UPLOAD_STATUS_SQL, (status, dataset_id, error, time.time(), upload_id, from_status)).rowcount > 0
+
+def list_expired_upload_sessions(idle_seconds: float) -> list[str]:
+    '''
+    list_expired_upload_sessions is a function that returns the ids of the upload sessions with no activity for idle_seconds.
+    '''
+    with get_metadata_store().connection() as conn:
+        return [row[0] for row in conn.execute(SELECT_EXPIRED_UPLOADS_SQL, (time.time() - idle_seconds,))]
+
+def delete_upload_session(upload_id: str):
+    '''
+    delete_upload_session is a function that deletes an upload session and its chunk records (not its file, see gc_upload_sessions).
+    '''
+    with get_metadata_store().connection() as conn, conn:
+        conn.execute(DELETE_UPLOAD_CHUNKS_SQL, (upload_id,))
+        conn.execute(DELETE_UPLOAD_SESSION_SQL, (upload_id,))
+
 # python -m db_helpers.db_metadata
 
 if __name__ == "__main__":
     migrate_metadata_db()
 
 
-
@@ -0,0 +1,239 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+from fastapi import APIRouter, Response
+from starlette.datastructures import MutableHeaders
+from .db_constants import METRICS_ENABLED, METRICS_SECONDS_BUCKETS, SERVER_TIMING_ENABLED
+
+'''
+db_metrics.py is a module that records where the time of the server goes, and serves it at /metrics in the Prometheus text format.
+
+- Every request is timed by its route (eg) /db/datasets/{dataset_id}, not one series per id), method and status.
+- The stages of a request are timed with Stage (saving the upload, converting it, reading its schema, profiling, DuckDB reads,
+  LLM calls...), with the bytes and rows they processed, and the LLM calls count their prompt and completion tokens.
+- The stages of the current request are also kept in a contextvar, the middleware sends them in a Server-Timing header
+  when SERVER_TIMING_ENABLED. asyncio.to_thread and the threadpool of the sync routes copy the context, so a stage timed on
+  their threads is part of its request too. Ingest jobs run in other processes, they send their stages back with their result.
+- With METRICS_ENABLED off the middleware is not installed and a Stage only checks the flag.
+
+The metrics are per process: with several server workers each one has its own, like every Prometheus client.
+'''
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: Optional[str] = None) -> str:
+    '''
+    format_labels is a function that formats the labels of a sample, eg) {stage="save_raw",le="0.5"}.
+    '''
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    pairs = [f'{name}="{value}"' for name, value in zip(names, escaped)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    '''
+    Counter is a class that keeps a running total per combination of label values (a Prometheus counter).
+    '''
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float, *label_values: str):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.labels, label_values)} {value}" for label_values, value in values]
+        return lines
+
+class Histogram:
+    '''
+    Histogram is a class that counts observations into buckets per combination of label values (a Prometheus histogram).
+    The counts are kept per bucket and made cumulative (le="...") when rendered.
+    '''
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple[float, ...] = METRICS_SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count of each bucket..., count above the last bucket, sum]
+        self.series: dict[tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        # The first bucket whose upper bound is >= value.
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = [(label_values, list(counts)) for label_values, counts in self.series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + (None,), counts):
+                total += count
+                le = 'le="+Inf"' if bound is None else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {total}")
+        return lines
+
+REQUEST_SECONDS = Histogram("dataspace_http_request_seconds", "Time to handle an HTTP request, until the end of its response body.", ("method", "route", "status"))
+STAGE_SECONDS = Histogram("dataspace_stage_seconds", "Time spent in a stage of a request or ingest job.", ("stage",))
+STAGE_BYTES = Counter("dataspace_stage_bytes_total", "Bytes read or written by a stage.", ("stage",))
+STAGE_ROWS = Counter("dataspace_stage_rows_total", "Rows read or written by a stage.", ("stage",))
+LLM_TOKENS = Counter("dataspace_llm_tokens_total", "Tokens of the LLM calls, by model and kind (prompt, completion).", ("model", "kind"))
+
+METRICS = [REQUEST_SECONDS, STAGE_SECONDS, STAGE_BYTES, STAGE_ROWS, LLM_TOKENS]
+
+# Stages recorded in the current request or job: (stage, seconds, bytes, rows). None when nothing collects them.
+_stages: ContextVar[Optional[list[tuple[str, float, Optional[int], Optional[int]]]]] = ContextVar("dataspace_stages", default=None)
+
+def record_stage(stage: str, seconds: float, size: Optional[int] = None, rows: Optional[int] = None):
+    '''
+    record_stage is a function that records a stage that took seconds, and the bytes (size) and rows it processed if known.
+    '''
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.observe(seconds, stage)
+    if size is not None:
+        STAGE_BYTES.inc(size, stage)
+    if rows is not None:
+        STAGE_ROWS.inc(rows, stage)
+    stages = _stages.get()
+    if stages is not None:
+        stages.append((stage, seconds, size, rows))
+
+def record_llm_tokens(model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    '''
+    record_llm_tokens is a function that counts the tokens of an LLM call (from the usage the API returned).
+    '''
+    if not METRICS_ENABLED:
+        return
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, model, "prompt")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, model, "completion")
+
+class Stage:
+    '''
+    Stage is a class that times a block of work as a stage, the block is recorded even if it raises. eg)
+        with Stage("save_parquet") as stage:
+            parquet_path = save_parquet_file(dataset_dir, raw_path, layout)
+            stage.rows = count_parquet_rows(parquet_path)
+    '''
+    __slots__ = ("name", "size", "rows", "started")
+
+    def __init__(self, name: str, size: Optional[int] = None, rows: Optional[int] = None):
+        self.name = name
+        self.size = size
+        self.rows = rows
+
+    def __enter__(self) -> "Stage":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if METRICS_ENABLED:
+            record_stage(self.name, time.perf_counter() - self.started, self.size, self.rows)
+
+@contextmanager
+def collect_stages() -> Iterator[list[tuple[str, float, Optional[int], Optional[int]]]]:
+    '''
+    collect_stages is a function that collects the stages recorded inside the block (in this context), eg) the stages of an ingest job
+    that are sent back to the server process.
+    '''
+    stages = []
+    token = _stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _stages.reset(token)
+
+def record_stages(stages: list[tuple[str, float, Optional[int], Optional[int]]]):
+    '''
+    record_stages is a function that records the stages collected in another process (see collect_stages).
+    '''
+    for stage, seconds, size, rows in stages:
+        record_stage(stage, seconds, size, rows)
+
+def server_timing(stages: list[tuple[str, float, Optional[int], Optional[int]]], total: float) -> str:
+    '''
+    server_timing is a function that formats the stages of a request as a Server-Timing header, a stage run several times is summed.
+    eg) save_raw;dur=12.1, save_parquet;dur=80.4, total;dur=95.0
+    '''
+    durations: dict[str, float] = {}
+    for stage, seconds, _, _ in stages:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+def render_metrics() -> str:
+    '''
+    render_metrics is a function that returns every metric of this process in the Prometheus text format.
+    '''
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+class MetricsMiddleware:
+    '''
+    MetricsMiddleware is an ASGI middleware that times every HTTP request, and sends its stages in a Server-Timing header when SERVER_TIMING_ENABLED.
+    A plain ASGI middleware (not BaseHTTPMiddleware): the route runs in the context the stages are collected in, and nothing is buffered.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        stages = [] if SERVER_TIMING_ENABLED else None
+        token = _stages.set(stages)
+        # An app that raises before it responds is a 500 to the client.
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # The route returned by now (for a streamed response, the stages before its body started).
+                if stages is not None:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing(stages, time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stages.reset(token)
+            # The router sets the matched route in the scope, requests that match none share one series.
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], getattr(route, "path", "unmatched"), str(status))
+
+router = APIRouter(tags=["metrics"])
+
+@router.get("/metrics")
+def metrics_route() -> Response:
+    '''
+    Metrics is a service that returns the request, stage and LLM token metrics of this server process, for Prometheus to scrape.
+    '''
+    return Response(render_metrics(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+# python3 -m db_helpers.db_metrics
@@ -0,0 +1,275 @@
+import bisect
+import math
+import time
+from typing import Any, Optional
+import duckdb
+from .db_constants import (
+    PROFILE_TOP_K,
+    PROFILE_HISTOGRAM_BINS,
+    Dataset,
+    DatasetProfile,
+    TableProfile,
+    ColumnProfile,
+    HistogramBin
+)
+from .db_engine import get_duckdb_engine, quote_identifier
+
+'''
+db_profile.py is a module that computes the column profile of a dataset at ingest:
+null counts, min/max, mean/stddev, approximate distinct counts (HyperLogLog), top values and histograms.
+
+Every stat of every column of a table comes out of one aggregate query (one scan), numeric histograms need the
+min/max of that scan for their bins, so they are one more aggregate query over the numeric columns only.
+The profile is stored in the metadata database (see db_metadata.save_profile) so describing a dataset never scans it again.
+'''
+
+NUMERIC_TYPES = {
+    "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT",
+    "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "UHUGEINT",
+    "FLOAT", "DOUBLE",
+}
+
+def is_numeric_type(column_type: str) -> bool:
+    return column_type in NUMERIC_TYPES or column_type.startswith("DECIMAL")
+
+def is_nested_type(column_type: str) -> bool:
+    '''
+    is_nested_type is a function that checks for LIST/STRUCT/MAP/ARRAY columns, which only get a null count.
+    '''
+    return column_type.endswith("]") or column_type.startswith(("STRUCT", "MAP", "UNION"))
+
+def column_aggregates(column_name: str, column_type: str) -> list[str]:
+    '''
+    column_aggregates is a function that returns the aggregate expressions profiling one column, in the order read by build_column_profile.
+    '''
+    column = quote_identifier(column_name)
+    aggregates = [f"count({column})"]
+    if is_nested_type(column_type):
+        return aggregates
+
+    aggregates.append(f"approx_count_distinct({column})")
+    if is_numeric_type(column_type):
+        aggregates += [f"min({column})", f"max({column})", f"avg({column})::DOUBLE", f"stddev_samp({column})::DOUBLE"]
+    else:
+        aggregates += [f"min({column})::VARCHAR", f"max({column})::VARCHAR"]
+    aggregates.append(f"approx_top_k({column}, {PROFILE_TOP_K})::VARCHAR[]")
+    return aggregates
+
+def json_number(value: Any) -> Any:
+    '''
+    json_number is a function that turns DuckDB numbers that JSON does not know (Decimal, hugeint) into a float/int.
+    '''
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return float(value)
+
+def build_column_profile(column_name: str, column_type: str, row_count: int, values: list) -> ColumnProfile:
+    '''
+    build_column_profile is a function that builds the ColumnProfile from the values of its column_aggregates.
+    '''
+    profile = ColumnProfile(column_name=column_name, column_type=column_type, null_count=row_count - values[0])
+    if len(values) == 1:
+        return profile
+
+    profile.approx_distinct = values[1]
+    profile.min = json_number(values[2])
+    profile.max = json_number(values[3])
+    if is_numeric_type(column_type):
+        profile.mean = values[4]
+        profile.stddev = values[5]
+    profile.top_values = [value for value in values[-1] or [] if value is not None]
+    return profile
+
+def add_histograms(cursor: duckdb.DuckDBPyConnection, from_clause: str, columns: list[ColumnProfile]):
+    '''
+    add_histograms is a function that fills in the equal-width histograms of the numeric columns in one more scan.
+    '''
+    binned = [column for column in columns if is_numeric_type(column.column_type) and column.min is not None]
+    if not binned:
+        return
+
+    aggregates = []
+    params = []
+    for column in binned:
+        # The bins span the column's [min, max] (from the first scan), the last upper bound is the max.
+        aggregates.append(f"histogram({quote_identifier(column.column_name)}, equi_width_bins(?, ?, {PROFILE_HISTOGRAM_BINS}, false))")
+        params += [column.min, column.max]
+
+    row = cursor.execute(f"SELECT {', '.join(aggregates)} FROM {from_clause}", params).fetchone()
+    for column, histogram in zip(binned, row):
+        column.histogram = [HistogramBin(upper=float(upper), count=count) for upper, count in (histogram or {}).items()]
+
+def profile_columns(cursor: duckdb.DuckDBPyConnection, from_clause: str) -> tuple[int, list[ColumnProfile]]:
+    '''
+    profile_columns is a function that computes the row count and the stats of every column of a table in one scan (no histograms).
+    '''
+    # The DuckDB types (not the declared SQLite ones) decide which stats apply.
+    columns = cursor.execute(f"DESCRIBE SELECT * FROM {from_clause}").fetchall()
+    aggregates_per_column = [column_aggregates(column[0], column[1]) for column in columns]
+    select_list = ["count(*)"] + [aggregate for aggregates in aggregates_per_column for aggregate in aggregates]
+    row = cursor.execute(f"SELECT {', '.join(select_list)} FROM {from_clause}").fetchone()
+
+    row_count = row[0]
+    profiles = []
+    position = 1
+    for column, aggregates in zip(columns, aggregates_per_column):
+        values = list(row[position:position + len(aggregates)])
+        position += len(aggregates)
+        profiles.append(build_column_profile(column[0], column[1], row_count, values))
+    return row_count, profiles
+
+def profile_table(cursor: duckdb.DuckDBPyConnection, table_name: str, from_clause: str) -> TableProfile:
+    '''
+    profile_table is a function that profiles every column of one table.
+
+    Args:
+        cursor: duckdb.DuckDBPyConnection - The cursor to run the profile on.
+        table_name: str - The name of the table (for the profile).
+        from_clause: str - The SQL to read the table, eg) read_parquet('...') or "ds_uuid"."customers".
+    '''
+    try:
+        row_count, profiles = profile_columns(cursor, from_clause)
+        add_histograms(cursor, from_clause, profiles)
+        return TableProfile(table_name=table_name, row_count=row_count, columns=profiles)
+
+    except duckdb.Error as e:
+        # eg) a SQLite column holding values of mixed types, the other tables are still profiled.
+        return TableProfile(table_name=table_name, error=str(e))
+
+def merge_bound(old: Any, new: Any, pick) -> Any:
+    '''
+    merge_bound is a function that combines two min (pick=min) or max (pick=max) values, either of which can be None.
+    '''
+    if old is None or new is None:
+        return new if old is None else old
+    return pick(old, new)
+
+def merge_distinct(old: ColumnProfile, old_values: int, new: ColumnProfile, new_values: int) -> Optional[int]:
+    '''
+    merge_distinct is a function that estimates the distinct count of the union of two sets of rows from their own estimates.
+    The HyperLogLog sketches are not kept, so: a column that is (almost) unique on both sides is taken as a key and the counts add up,
+    otherwise the appended values are taken to be mostly the existing ones (eg) categories) and the larger count is kept.
+    '''
+    if old.approx_distinct is None or new.approx_distinct is None:
+        return old.approx_distinct if new.approx_distinct is None else new.approx_distinct
+    if old.approx_distinct >= 0.9 * old_values and new.approx_distinct >= 0.9 * new_values:
+        return min(old.approx_distinct + new.approx_distinct, old_values + new_values)
+    return max(old.approx_distinct, new.approx_distinct)
+
+def merge_moments(old: ColumnProfile, old_values: int, new: ColumnProfile, new_values: int) -> tuple[Optional[float], Optional[float]]:
+    '''
+    merge_moments is a function that combines the mean and sample stddev of two sets of rows (Chan et al.'s parallel variance).
+    old_values / new_values are the non-null counts the stats were computed over.
+    '''
+    if new_values == 0 or new.mean is None:
+        return old.mean, old.stddev
+    if old_values == 0 or old.mean is None:
+        return new.mean, new.stddev
+
+    values = old_values + new_values
+    delta = new.mean - old.mean
+    mean = old.mean + delta * new_values / values
+    # stddev_samp is NULL for a single value, its sum of squared deviations is 0.
+    m2 = (old.stddev or 0.0) ** 2 * (old_values - 1) + (new.stddev or 0.0) ** 2 * (new_values - 1) + delta ** 2 * old_values * new_values / values
+    return mean, math.sqrt(m2 / (values - 1))
+
+def rebin_histogram(old: ColumnProfile, bins: list[HistogramBin]) -> list[HistogramBin]:
+    '''
+    rebin_histogram is a function that adds the counts of an existing histogram (old, with its own min) into bins with (possibly) wider bounds.
+    Every old bin goes to the new bin holding its midpoint, which is the same bin when the bounds did not change.
+    '''
+    if not bins or not old.histogram:
+        return bins or old.histogram
+
+    uppers = [bin.upper for bin in bins]
+    counts = [bin.count for bin in bins]
+    lower = float(old.min)
+    for old_bin in old.histogram:
+        index = min(bisect.bisect_left(uppers, (lower + old_bin.upper) / 2), len(bins) - 1)
+        counts[index] += old_bin.count
+        lower = old_bin.upper
+    return [HistogramBin(upper=upper, count=count) for upper, count in zip(uppers, counts)]
+
+def merge_table_profile(cursor: duckdb.DuckDBPyConnection, old: TableProfile, from_clause: str) -> TableProfile:
+    '''
+    merge_table_profile is a function that updates the profile of a table with rows appended to it, scanning only the new rows.
+
+    Counts, nulls, min/max, mean and stddev are exact. The distinct counts (see merge_distinct) and top values (the existing ones first,
+    then the new ones) are estimates. The histograms keep equal-width bins over the new [min, max], the appended rows are binned exactly
+    and the existing bins are moved to the new bins by their midpoint (exact while the bounds do not change).
+
+    Args:
+        cursor: duckdb.DuckDBPyConnection - The cursor to run the profile on.
+        old: TableProfile - The profile of the table before the append, without error.
+        from_clause: str - The SQL to read the appended rows only.
+    Returns:
+        TableProfile - The profile of the whole table.
+    '''
+    try:
+        row_count, new_columns = profile_columns(cursor, from_clause)
+    except duckdb.Error as e:
+        return TableProfile(table_name=old.table_name, error=str(e))
+
+    old_columns = {column.column_name: column for column in old.columns}
+    merged = []
+    rebinned = []
+    for new in new_columns:
+        previous = old_columns.get(new.column_name)
+        if previous is None:
+            merged.append(new)
+            continue
+
+        old_values = old.row_count - previous.null_count
+        new_values = row_count - new.null_count
+        column = previous.model_copy(deep=True)
+        column.null_count = previous.null_count + new.null_count
+        column.approx_distinct = merge_distinct(previous, old_values, new, new_values)
+        column.min = merge_bound(previous.min, new.min, min)
+        column.max = merge_bound(previous.max, new.max, max)
+        if is_numeric_type(column.column_type):
+            column.mean, column.stddev = merge_moments(previous, old_values, new, new_values)
+        column.top_values = list(dict.fromkeys(previous.top_values + new.top_values))[:PROFILE_TOP_K]
+        merged.append(column)
+
+        # Bin the new rows with the bounds of the merged column, then fold the existing bins into them.
+        new.min, new.max = column.min, column.max
+        rebinned.append((column, previous, new))
+
+    try:
+        add_histograms(cursor, from_clause, [new for _, _, new in rebinned])
+    except duckdb.Error as e:
+        return TableProfile(table_name=old.table_name, error=str(e))
+    for column, previous, new in rebinned:
+        if is_numeric_type(column.column_type):
+            column.histogram = rebin_histogram(previous, new.histogram)
+
+    return TableProfile(table_name=old.table_name, row_count=old.row_count + row_count, columns=merged)
+
+def profile_dataset(dataset: Dataset) -> DatasetProfile:
+    '''
+    profile_dataset is a function that profiles every table of a dataset.
+
+    Args:
+        dataset: Dataset - The dataset to profile (its files must exist, it does not need to be saved yet).
+
+    Returns:
+        DatasetProfile - The profile of the dataset, to save with save_profile.
+    '''
+    started = time.perf_counter()
+    tables: dict[str, TableProfile] = {}
+
+    with get_duckdb_engine().dataset(dataset) as session:
+        for table_name in dataset.tables:
+            tables[table_name] = profile_table(session.cursor, table_name, session.table(table_name))
+
+    return DatasetProfile(
+        dataset_id=dataset.dataset_id,
+        tables=tables,
+        seconds=time.perf_counter() - started,
+        created_at=time.time()
+    )
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_profile
@@ -0,0 +1,224 @@
+import io
+import json
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from typing import Any, Iterator
+import duckdb
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from .db_constants import QUERY_BATCH_ROWS, QUERY_MAX_ROW_LIMIT, QUERY_MAX_TIMEOUT_SECONDS, Dataset, QueryRequest
+from .db_engine import get_duckdb_engine, quote_identifier
+from .db_metrics import Stage, record_stage
+
+'''
+db_query.py is a module that runs read-only SQL over one dataset and streams the result in batches
+(Arrow IPC, or NDJSON as a fallback), so a large result is never built in Python memory all at once.
+'''
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# query_id -> cursor of the running query, so a query can be cancelled from another request.
+_running_queries: dict[str, duckdb.DuckDBPyConnection] = {}
+_running_lock = threading.Lock()
+
+def collect_table_refs(node: Any, refs: list[dict], cte_names: set[str]):
+    '''
+    collect_table_refs is a function that walks the json_serialize_sql tree and collects every table and table function reference.
+    '''
+    if isinstance(node, dict):
+        if node.get("type") in ("BASE_TABLE", "TABLE_FUNCTION"):
+            refs.append(node)
+        for entry in node.get("cte_map", {}).get("map", []) if isinstance(node.get("cte_map"), dict) else []:
+            cte_names.add(entry["key"])
+        for value in node.values():
+            collect_table_refs(value, refs, cte_names)
+    elif isinstance(node, list):
+        for value in node:
+            collect_table_refs(value, refs, cte_names)
+
+def validate_read_only_sql(sql: str, table_names: list[str]):
+    '''
+    validate_read_only_sql is a function that checks that the sql is one SELECT that only reads the dataset's own tables.
+
+    Table functions (read_csv, read_parquet, ...), file paths and qualified names are rejected,
+    so a query can not read files or the other datasets attached to the shared DuckDB engine.
+
+    Raises:
+        ValueError - If the sql is not allowed.
+    '''
+    try:
+        statements = duckdb.extract_statements(sql)
+    except duckdb.Error as e:
+        raise ValueError(f"Invalid SQL: {e}")
+
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("Only a single SELECT statement is allowed.")
+
+    tree = json.loads(duckdb.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    if tree.get("error"):
+        raise ValueError(f"Invalid SQL: {tree.get('error_message')}")
+
+    refs: list[dict] = []
+    cte_names: set[str] = set()
+    collect_table_refs(tree["statements"], refs, cte_names)
+
+    for ref in refs:
+        if ref["type"] == "TABLE_FUNCTION":
+            raise ValueError(f"Table function {ref['function'].get('function_name')} is not allowed.")
+        if ref.get("catalog_name") or ref.get("schema_name"):
+            raise ValueError(f"Qualified table {ref['table_name']} is not allowed.")
+        if ref["table_name"] not in table_names and ref["table_name"] not in cte_names:
+            raise ValueError(f"Table {ref['table_name']} not found in the dataset.")
+
+def cancel_query(query_id: str) -> bool:
+    '''
+    cancel_query is a function that interrupts a running query.
+    Returns:
+        bool - False if no query with that id is running.
+    '''
+    with _running_lock:
+        cursor = _running_queries.get(query_id)
+    if cursor is None:
+        return False
+    cursor.interrupt()
+    return True
+
+def encode_ndjson(batch: pa.RecordBatch) -> bytes:
+    '''
+    encode_ndjson is a function that turns a record batch into newline-delimited JSON rows.
+    Values JSON does not know (dates, decimals, ...) are written as strings.
+    '''
+    return "".join(json.dumps(row, default=str) + "\n" for row in batch.to_pylist()).encode()
+
+class QueryStream:
+    '''
+    QueryStream is a class that runs a query on its own cursor and streams the result batches.
+
+    The query is started in __init__ so that SQL errors are raised before the response starts.
+    The timeout interrupts the cursor, and so does closing the stream early (eg) the client disconnected).
+    '''
+    def __init__(self, dataset: Dataset, request: QueryRequest):
+        '''
+        Raises:
+            ValueError - If the sql or the limits are not allowed, or the query fails.
+            TimeoutError - If the query timed out before its first batch.
+        '''
+        validate_read_only_sql(request.sql, dataset.tables)
+
+        if request.max_rows < 1 or request.max_rows > QUERY_MAX_ROW_LIMIT:
+            raise ValueError(f"max_rows must be between 1 and {QUERY_MAX_ROW_LIMIT}.")
+        if request.timeout_seconds <= 0 or request.timeout_seconds > QUERY_MAX_TIMEOUT_SECONDS:
+            raise ValueError(f"timeout_seconds must be between 0 and {QUERY_MAX_TIMEOUT_SECONDS}.")
+
+        self.query_id = str(uuid.uuid4())
+        self.format = request.format
+        self.timed_out = False
+        self.resources = ExitStack()
+
+        engine = get_duckdb_engine()
+        # A cursor of its own: the result is read over many requests' worth of time, and can be interrupted on its own.
+        self.cursor = engine.new_cursor()
+        self.resources.callback(self.cursor.close)
+
+        try:
+            session = self.resources.enter_context(engine.dataset(dataset, self.cursor))
+            # Temporary views only exist on this cursor, they expose each table under its own name.
+            for table_name in dataset.tables:
+                self.cursor.execute(f"CREATE TEMP VIEW {quote_identifier(table_name)} AS SELECT * FROM {session.table(table_name)}")
+
+            with _running_lock:
+                _running_queries[self.query_id] = self.cursor
+            self.resources.callback(self.unregister)
+
+            self.timer = threading.Timer(request.timeout_seconds, self.on_timeout)
+            self.timer.daemon = True
+            self.timer.start()
+            self.resources.callback(self.timer.cancel)
+
+            with Stage("query"):
+                # The limit is put on the parsed statement, the sql text may end with a semicolon or a comment.
+                self.reader = self.cursor.sql(request.sql).limit(int(request.max_rows)).fetch_record_batch(QUERY_BATCH_ROWS)
+        except duckdb.Error as e:
+            self.resources.close()
+            # Queries that need their whole input first (eg) GROUP BY, ORDER BY) run inside execute, so they time out here.
+            if self.timed_out:
+                raise TimeoutError(f"Query timed out after {request.timeout_seconds} seconds.")
+            raise ValueError(f"Error running query: {e}")
+        except BaseException:
+            self.resources.close()
+            raise
+
+    @property
+    def media_type(self) -> str:
+        return ARROW_MEDIA_TYPE if self.format == "arrow" else NDJSON_MEDIA_TYPE
+
+    def on_timeout(self):
+        self.timed_out = True
+        self.cursor.interrupt()
+
+    def unregister(self):
+        with _running_lock:
+            _running_queries.pop(self.query_id, None)
+
+    def batches(self) -> Iterator[pa.RecordBatch]:
+        '''
+        batches is a function that yields the record batches until the result ends, the query times out or it is cancelled.
+        '''
+        while True:
+            try:
+                yield self.reader.read_next_batch()
+            except StopIteration:
+                return
+
+    def __iter__(self) -> Iterator[bytes]:
+        '''
+        Iterating a QueryStream yields the encoded response body, one chunk per batch.
+        A query that is interrupted midway ends the stream early, NDJSON gets a final {"error": ...} line
+        (Arrow has no way to send an error once the stream started, the stream just ends without its end marker).
+        The rows and bytes sent are recorded as the query_stream stage.
+        '''
+        started = time.perf_counter()
+        rows = 0
+        size = 0
+        try:
+            if self.format == "arrow":
+                sink = io.BytesIO()
+                writer = ipc.new_stream(sink, self.reader.schema)
+                for batch in self.batches():
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+                    # Hand out what the writer produced for this batch and reuse the buffer for the next one.
+                    chunk = sink.getvalue()
+                    size += len(chunk)
+                    yield chunk
+                    sink.seek(0)
+                    sink.truncate()
+                writer.close()
+                # The end-of-stream marker (and the schema, for an empty result).
+                yield sink.getvalue()
+            else:
+                for batch in self.batches():
+                    rows += batch.num_rows
+                    chunk = encode_ndjson(batch)
+                    size += len(chunk)
+                    yield chunk
+
+        except (duckdb.Error, pa.ArrowException, OSError) as e:
+            # The interrupt of a timeout/cancel surfaces from the Arrow reader as an OSError.
+            if self.format == "ndjson":
+                reason = "Query timed out." if self.timed_out else f"Query stopped: {e}"
+                yield (json.dumps({"error": reason}) + "\n").encode()
+        finally:
+            self.close()
+            record_stage("query_stream", time.perf_counter() - started, size, rows)
+
+    def close(self):
+        '''
+        close is a function that interrupts the query if it is still running and releases the cursor and the dataset.
+        '''
+        if self.timer.is_alive():
+            self.cursor.interrupt()
+        self.resources.close()
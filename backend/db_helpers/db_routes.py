@@ -1,16 +1,90 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from fastapi import UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import UploadFile, File, Request, Response, Query
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import Literal, Optional
 import uuid
+import hashlib
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+import time
 from .db_services import (
     detect_upload_type,
     save_raw_file,
     save_parquet_file,
-    get_parquet_schema,
-    get_sqlite_schema,
-    get_sqlite_table_names
+    parquet_copy_options,
+    upload_artifact_key,
+)
+from .db_engine import SQLITE_UPLOAD_TYPES, get_duckdb_engine
+from .db_constants import (
+    DATA_ROOT,
+    DATASETS_PAGE_MAX,
+    SEARCH_DEFAULT_LIMIT,
+    SEARCH_MAX_LIMIT,
+    ROWS_PAGE_DEFAULT,
+    SAMPLE_DEFAULT_STRATEGY,
+    SAMPLE_MAX_ROWS,
+    Dataset,
+    DatasetPage,
+    DatasetProfile,
+    IngestJob,
+    IngestStats,
+    QueryRequest,
+    AggregationRequest,
+    AggregationResult,
+    SearchHit,
+    SampleStrategy,
+    ParquetLayout,
+    ParquetCompression,
+    UploadType,
+    UploadSession,
+    UploadSessionRequest
+)
+from .db_metadata import (
+    save_metadata,
+    list_datasets,
+    list_datasets_page,
+    get_dataset_by_id,
+    get_metadata_revision,
+    get_job,
+    save_profile,
+    get_profile,
+    clone_dataset,
+    delete_dataset,
+    get_upload_session,
+    update_upload_status,
+    search_columns
+)
+from .db_ingest import (
+    stream_csv_to_parquet,
+    build_ingest_stats,
+    count_parquet_rows,
+    save_json_parquet_file,
+    build_csv_dataset,
+    build_parquet_dataset,
+    build_sqlite_dataset,
+    convert_sqlite_to_parquet
+)
+from .db_jobs import submit_ingest_job, submit_convert_job, submit_compact_job, create_finished_job
+from .db_append import APPEND_BATCH_TYPES, append_to_dataset
+from .db_sql_dump import sql_dump_to_sqlite
+from .db_query import ARROW_MEDIA_TYPE, QueryStream, cancel_query
+from .db_rows import parse_row_filter, read_rows, encode_rows_page
+from .db_profile import profile_dataset
+from .db_sampling import sample_rows
+from .db_aggregates import aggregate_dataset, invalidate_aggregates, aggregates_dir
+from .db_metrics import Stage
+from .db_uploads import (
+    start_upload_session,
+    write_upload_chunk,
+    missing_chunks,
+    complete_upload_file,
+    restore_upload_file,
+    upload_session_dir,
+    gc_upload_sessions
 )
-from .db_constants import DATA_ROOT, Dataset
-from .db_metadata import save_metadata, list_datasets, get_dataset_by_id
 
 
 router = APIRouter(prefix="/db", tags=["db"])
@@ -20,24 +94,335 @@ def read_root():
     # Return a JSON response to the frontend
     return {"message": "Welcome to the DB Helper API"}
 
+def revision_etag(request: Request, response: Response) -> Optional[Response]:
+    '''
+    revision_etag is a function that sets the ETag of a dataset route to the metadata revision.
+    If the client already has the listing for this revision (If-None-Match) it returns an empty 304 response to send instead.
+    '''
+    etag = f'W/"{get_metadata_revision()}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
 @router.get("/datasets/{dataset_id}")
-def get_dataset_route(dataset_id: str) -> Dataset:
+def get_dataset_route(dataset_id: str, request: Request, response: Response) -> Dataset:
     '''
     Get dataset is a service that allows for the frontend to get a dataset by its id.
     '''
-    return get_dataset_by_id(dataset_id)
+    # A missing dataset is a 404 whatever ETag the client sends.
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    not_modified = revision_etag(request, response)
+    if not_modified:
+        return not_modified
+    return dataset
 
 @router.get("/datasets")
-def list_datasets_route() -> list[Dataset]:
+def list_datasets_route(request: Request, response: Response, limit: Optional[int] = None, cursor: Optional[str] = None, summary: bool = False) -> list[Dataset] | DatasetPage:
     '''
     List datasets is a service that allows for the frontend to list all the datasets in the database.
+
+    Without query params this returns every dataset (list[Dataset]). With limit, cursor or summary it returns a DatasetPage:
+        limit: int - The page size (at most DATASETS_PAGE_MAX).
+        cursor: str - The next_cursor of the previous page.
+        summary: bool - Leave the schema out of each dataset.
+    The response has an ETag, a request with a matching If-None-Match gets an empty 304.
+    '''
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+
+    not_modified = revision_etag(request, response)
+    if not_modified:
+        return not_modified
+
+    if limit is None and cursor is None and not summary:
+        return list_datasets()
+
+    page_size = min(limit or DATASETS_PAGE_MAX, DATASETS_PAGE_MAX)
+
+    try:
+        return list_datasets_page(page_size, cursor, summary)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/search")
+def search_route(q: Optional[str] = None, column: Optional[str] = None, type: Optional[str] = None, table: Optional[str] = None,
+                 limit: int = SEARCH_DEFAULT_LIMIT) -> list[SearchHit]:
+    '''
+    Search is a service that allows for the frontend to find the columns of every dataset, by name or by type, from the search index.
+
+    Query params (at least one, the ones given must all match):
+        q: str - Words to find in the file, table or column names, each one a prefix. eg) q=cust id
+        column: str - An exact column name (case insensitive). eg) column=customer_id
+        type: str - A column type, with or without its parameters. eg) type=DECIMAL
+        table: str - An exact table name (case insensitive).
+        limit: int - The maximum number of hits (at most SEARCH_MAX_LIMIT).
+    '''
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+
+    try:
+        return search_columns(q, column, type, table, min(limit, SEARCH_MAX_LIMIT))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/datasets/{dataset_id}/profile")
+def get_profile_route(dataset_id: str) -> DatasetProfile:
+    '''
+    Get profile is a service that returns the column profile of a dataset (null counts, min/max, mean/stddev, distinct counts, top values, histograms).
+    The profile is computed at ingest, datasets uploaded before profiling existed are profiled (and saved) on their first request.
+    '''
+    profile = get_profile(dataset_id)
+    if profile is not None:
+        return profile
+
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    profile = profile_dataset(dataset)
+    save_profile(profile)
+    return profile
+
+@router.get("/datasets/{dataset_id}/sample")
+def get_sample_route(dataset_id: str, table_name: str, num_rows: int = 10, strategy: SampleStrategy = SAMPLE_DEFAULT_STRATEGY, seed: int = 0, stratify_by: Optional[str] = None) -> list[dict]:
+    '''
+    Get sample is a service that returns sample rows of a table, picked with a sampling strategy (head, reservoir, system, stratified, outlier).
+    The same seed gives the same rows, and repeated requests are served from a cache.
+    '''
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if num_rows < 1 or num_rows > SAMPLE_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"num_rows must be between 1 and {SAMPLE_MAX_ROWS}")
+
+    try:
+        return sample_rows(dataset, table_name, num_rows, strategy, seed, stratify_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/datasets/{dataset_id}/tables/{table_name}/rows")
+def get_rows_route(dataset_id: str, table_name: str, columns: list[str] = Query([]), where: list[str] = Query([]), cursor: Optional[str] = None,
+                   limit: int = ROWS_PAGE_DEFAULT, format: Literal["json", "arrow"] = "json") -> Response:
     '''
-    return list_datasets()
+    Get rows is a service that allows for the frontend to page through the rows of a table (in storage order).
+
+    Query params:
+        columns: str - A column to return, repeated for several (every column by default). eg) columns=id&columns=fare
+        where: str - A filter column:op[:value], repeated for several (all must match), op is one of
+            eq, ne, lt, lte, gt, gte, like, is_null, not_null. eg) where=fare:gte:10&where=city:eq:austin
+        cursor: str - The next_cursor of the previous page, every page costs the same however deep it is.
+        limit: int - The page size (at most ROWS_PAGE_MAX).
+        format: str - "json" (columnar: {"columns", "data": {column: values}, "row_count", "next_cursor"}) or "arrow" (Arrow IPC stream).
+    The X-Next-Cursor header has the cursor of the next page, it is missing on the last page.
+    '''
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        filters = [parse_row_filter(text) for text in where]
+        table, next_cursor = read_rows(dataset, table_name, columns, filters, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else {}
+    media_type = ARROW_MEDIA_TYPE if format == "arrow" else "application/json"
+    return Response(content=encode_rows_page(table, next_cursor, format), media_type=media_type, headers=headers)
+
+@router.post("/datasets/{dataset_id}/aggregate")
+def aggregate_dataset_route(dataset_id: str, request: AggregationRequest) -> AggregationResult:
+    '''
+    Aggregate dataset is a service that returns group-by summaries of a table: counts, sums, averages, min/max and quantiles per
+    value of the dimensions, eg) {"dimensions": ["city"], "aggregates": [{"function": "count"}, {"function": "avg", "column": "fare"}]}.
+    Results are materialized and served again (or rolled up to fewer dimensions) until the table's data changes.
+    '''
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        return aggregate_dataset(dataset, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/datasets/{dataset_id}/aggregates")
+def invalidate_aggregates_route(dataset_id: str, table_name: Optional[str] = None) -> dict:
+    '''
+    Invalidate aggregates is a service that drops the materialized results of a dataset (or only of table_name), the next request scans the table again.
+    '''
+    removed = invalidate_aggregates(dataset_id, table_name)
+    return {"message": "Aggregates invalidated", "removed": removed}
+
+@router.post("/datasets/{dataset_id}/query")
+def query_dataset_route(dataset_id: str, request: QueryRequest) -> StreamingResponse:
+    '''
+    Query dataset is a service that runs a read-only SELECT over the tables of a dataset and streams the result.
+    The tables are queried by name (eg) SELECT * FROM customers), format is "arrow" (Arrow IPC stream) or "ndjson".
+    The X-Query-Id header of the response can be used to cancel the query with DELETE /db/queries/{query_id}.
+    '''
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        stream = QueryStream(dataset, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TimeoutError as e:
+        raise HTTPException(status_code=408, detail=str(e))
+
+    return StreamingResponse(stream, media_type=stream.media_type, headers={"X-Query-Id": stream.query_id})
+
+@router.delete("/queries/{query_id}")
+def cancel_query_route(query_id: str) -> dict:
+    '''
+    Cancel query is a service that stops a running /query request.
+    '''
+    if not cancel_query(query_id):
+        raise HTTPException(status_code=404, detail=f"Query with id {query_id} is not running.")
+    return {"message": "Query cancelled"}
+
+def parquet_layout_params(compression: Optional[ParquetCompression] = None, compression_level: Optional[int] = None, row_group_size: Optional[int] = None,
+                          sort_by: Optional[str] = None, partition_by: Optional[str] = None) -> ParquetLayout:
+    '''
+    parquet_layout_params is a dependency that reads the ParquetLayout of an upload or conversion from its query params.
+    The params that are not given keep the server defaults. sort_by is comma separated, eg) ?sort_by=country,created_at&partition_by=year
+    '''
+    values = {}
+    if compression is not None:
+        # The server's default level belongs to the server's default codec.
+        values["compression"] = compression
+        values["compression_level"] = compression_level
+    elif compression_level is not None:
+        values["compression_level"] = compression_level
+    if row_group_size is not None:
+        values["row_group_size"] = row_group_size
+    if sort_by:
+        values["sort_by"] = [column.strip() for column in sort_by.split(",") if column.strip()]
+    if partition_by:
+        values["partition_by"] = partition_by
+
+    layout = ParquetLayout(**values)
+    try:
+        parquet_copy_options(layout)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return layout
+
+@router.post("/datasets/{dataset_id}/convert")
+def convert_dataset_route(dataset_id: str, response: Response, layout: ParquetLayout = Depends(parquet_layout_params)) -> dict:
+    '''
+    Convert dataset is a service that queues the conversion of a SQLite dataset's tables into Parquet files (202 + job_id).
+    Reads keep going to SQLite until the job is done, then go to the Parquet files.
+    The layout query params are the ones of /db/upload_db, the sort and partition columns apply to the tables that have them.
+    '''
+    try:
+        dataset = get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if dataset.upload_type not in SQLITE_UPLOAD_TYPES:
+        raise HTTPException(status_code=400, detail=f"Only SQLite datasets can be converted to Parquet, this one is {dataset.upload_type}.")
+
+    job_id = submit_convert_job(dataset_id, layout)
+    response.status_code = 202
+    return {"message": "Conversion accepted", "dataset_id": dataset_id, "job_id": job_id}
+
+@router.post("/datasets/{dataset_id}/append")
+def append_dataset_route(dataset_id: str, file: UploadFile = File(...)) -> dict:
+    '''
+    Append dataset is a service that adds the rows of a CSV, JSON or JSONL batch to an existing CSV/JSON/JSONL dataset, keeping its dataset_id.
+    The batch must have the columns of the dataset (a JSON batch may leave some out, they are NULL) and values that cast to their types.
+    Only the batch is converted and profiled. Once the table has too many small files a compaction job is queued (compaction_job_id).
+    '''
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+
+    batch_type = detect_upload_type(file.filename)
+    if batch_type not in APPEND_BATCH_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported batch type: {batch_type}")
+
+    try:
+        get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    with tempfile.TemporaryDirectory() as batch_dir:
+        raw_path, _ = save_raw_file(Path(batch_dir), file)
+        try:
+            ingest_stats, needs_compaction = append_to_dataset(dataset_id, raw_path, batch_type)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    result = {"message": "Rows appended", "dataset_id": dataset_id, "ingest_stats": ingest_stats.model_dump()}
+    if needs_compaction:
+        result["compaction_job_id"] = submit_compact_job(dataset_id)
+    return result
+
+@router.post("/datasets/{dataset_id}/compact")
+def compact_dataset_route(dataset_id: str, response: Response) -> dict:
+    '''
+    Compact dataset is a service that queues the rewrite of the files appended to a dataset into one file per partition (202 + job_id).
+    Reads keep going to the appended files until the job is done.
+    '''
+    try:
+        get_dataset_by_id(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    job_id = submit_compact_job(dataset_id)
+    response.status_code = 202
+    return {"message": "Compaction accepted", "dataset_id": dataset_id, "job_id": job_id}
+
+@router.get("/jobs/{job_id}")
+def get_job_route(job_id: str) -> IngestJob:
+    '''
+    Get job is a service that allows for the frontend to poll the status, percent done and error of a background ingest job.
+    '''
+    try:
+        return get_job(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 @router.post("/upload_db")
-def upload_db(file: UploadFile = File(...)) -> dict:
+def upload_db(response: Response, file: UploadFile = File(...), stream: bool = False, keep_raw: bool = True, background: bool = True, to_parquet: bool = False,
+              layout: ParquetLayout = Depends(parquet_layout_params)) -> dict:
     '''
     Upload db is a service that allows for the frontend to send a request object containing the file to be uploaded to the database. 
+
+    By default the upload is saved and the conversion runs as a background job (202 + job_id, poll /db/jobs/{job_id}),
+    a CSV with stream=true is converted while it is read and the job does the rest (schema, profile, metadata).
+    With background=false the conversion runs inside the request and the response is sent once the dataset is saved.
+
+    Query params:
+        stream: bool - (CSV only) Convert the CSV into Parquet row groups while reading the request, instead of saving it and reading it back with DuckDB.
+            This is one pass also with background: the conversion runs in the request, the job only reads the schema, profiles and saves.
+        keep_raw: bool - (CSV, JSON, JSONL, SQL dump) Keep a copy of the raw upload next to the converted file.
+        to_parquet: bool - (SQLite, SQL dump) Also write every table into its own Parquet file, which reads then use instead of SQLite.
+            An existing SQLite dataset can be converted later with /db/datasets/{dataset_id}/convert.
+        compression: str - Parquet codec (snappy, zstd, gzip, lz4, brotli, uncompressed), compression_level: int - zstd level.
+        row_group_size: int - Rows per Parquet row group.
+        sort_by: str - Comma separated columns to sort the rows by, filters on them can then skip row groups.
+        partition_by: str - Column to write Hive partitions by (one directory per value), filters on it only read the matching ones.
+        The params that are not given keep the server defaults (DATASPACE_PARQUET_*), the layout is stored with the dataset.
+
+    JSON (an array of records, or newline-delimited) and JSONL are converted into Parquet by DuckDB's read_json, nested objects become
+    one column per field (eg) address.city).
+    SQL dumps (.sql, .sql_dump from mysqldump / pg_dump) are loaded statement by statement into a SQLite database.
+
+    Uploading content that was already converted with the same options (to_parquet and layout) costs one hash pass:
+    the new dataset shares the files of the first one and the response has "deduplicated": true.
     '''
 
     # If no file is provided, raise an error.
@@ -46,52 +431,249 @@ def upload_db(file: UploadFile = File(...)) -> dict:
 
     # Detect the type of the file.
     upload_type = detect_upload_type(file.filename)
+    if upload_type not in ("csv", "json", "jsonl", "db", "sqlite", "sql", "sql_dump"):
+        raise HTTPException(status_code=400, detail=f"Unsupported upload type: {upload_type}")
 
     # Give dataset a unique id, and then its directory, From this current directory, we will create the copy of the file.
     dataset_id = str(uuid.uuid4())
     dataset_dir = DATA_ROOT / dataset_id
     dataset_dir.mkdir(parents=True, exist_ok=True)
 
+    # The upload is hashed while it is written, if the same content was already converted with the same options
+    # the new dataset reuses its files and nothing is converted.
+    digest = hashlib.sha256()
+    raw_path, parquet_path, ingest_stats = None, None, None
+
+    try:
+        if upload_type == "csv" and stream:
+            # Save raw CSV and Parquet in one pass, the content is only known once it is converted. The worker processes of
+            # the background jobs can not read the request, so a background upload is streamed here too, not saved and read back.
+            try:
+                with Stage("stream_csv") as stage:
+                    parquet_path, _, ingest_stats = stream_csv_to_parquet(dataset_dir, file.file, file.filename, keep_raw=keep_raw, layout=layout, digest=digest)
+                    stage.size, stage.rows = ingest_stats.raw_bytes, ingest_stats.rows
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Error streaming CSV: {e}")
+            raw_size = ingest_stats.raw_bytes
+        else:
+            with Stage("save_raw") as stage:
+                raw_path, raw_size = save_raw_file(dataset_dir, file, digest)
+                stage.size = raw_size
+
+        return ingest_upload(response, dataset_id, dataset_dir, upload_type, raw_path, raw_size, digest.hexdigest(), stream=stream, keep_raw=keep_raw,
+                             background=background, to_parquet=to_parquet, layout=layout, parquet_path=parquet_path, ingest_stats=ingest_stats)
+    except Exception:
+        # Nothing was saved for this dataset, do not leave its partial files behind.
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        raise
+
+def ingest_upload(response: Response, dataset_id: str, dataset_dir: Path, upload_type: UploadType, raw_path: Optional[Path], raw_size: int, sha256: str,
+                  stream: bool, keep_raw: bool, background: bool, to_parquet: bool, layout: ParquetLayout,
+                  parquet_path: Optional[Path] = None, ingest_stats: Optional[IngestStats] = None) -> dict:
+    '''
+    ingest_upload is a function that turns an upload saved in its dataset directory into a dataset, shared by /db/upload_db and /db/uploads/{upload_id}/complete.
+    The upload is deduplicated, or its conversion is queued (background), or it is converted, profiled and saved here.
+    Args:
+        raw_path: Path - The raw upload in dataset_dir, None when a CSV was already streamed into parquet_path (with its ingest_stats).
+        sha256: str - The hex sha256 of the upload, see upload_artifact_key.
+        The other args are the query params of /db/upload_db.
+    Returns:
+        dict - The response of the upload route.
+    '''
+    artifact_key = upload_artifact_key(sha256, upload_type, to_parquet, layout)
+    existing = clone_dataset(artifact_key, dataset_id)
+    if existing is not None:
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        result = {"message": "File already uploaded, reusing its converted files", "dataset_id": dataset_id, "deduplicated": True}
+        if background:
+            # Clients of the background mode poll a job, give them one that is already done.
+            result["job_id"] = create_finished_job(dataset_id)
+        return result
+
+    if background:
+        # The worker processes can not read the request, so the upload is saved (or already streamed into Parquet) first and the rest is queued.
+        job_id = submit_ingest_job(dataset_id, dataset_dir, raw_path, upload_type, raw_size, stream=stream, keep_raw=keep_raw, to_parquet=to_parquet,
+                                   layout=layout, artifact_key=artifact_key, parquet_path=parquet_path, ingest_stats=ingest_stats)
+        response.status_code = 202
+        return {"message": "File upload accepted", "dataset_id": dataset_id, "job_id": job_id}
+
     if upload_type == "csv":
-        # Save raw CSV and Parquet. One logical "table" (the parquet); key = file stem for consistency.
-        raw_path, raw_size = save_raw_file(dataset_dir, file)
-        parquet_path = save_parquet_file(dataset_dir, raw_path)
-        table_key = parquet_path.stem 
-        schema = get_parquet_schema(parquet_path)
-
-        new_dataset = Dataset(
-            dataset_id=dataset_id,
-            upload_type=upload_type,
-            raw_byte_size=raw_size,
-            dataset_path=str(parquet_path),
-            tables=[table_key], # the table key will be the parquet path. 
-            schema=schema,
-        )
+        if parquet_path is None:
+            started = time.perf_counter()
+            try:
+                with Stage("save_parquet", size=raw_size) as stage:
+                    parquet_path = save_parquet_file(dataset_dir, raw_path, layout)
+                    stage.rows = count_parquet_rows(parquet_path)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            ingest_stats = build_ingest_stats("two_pass", stage.rows, raw_size, started)
+            if not keep_raw:
+                raw_path.unlink(missing_ok=True)
+
+        with Stage("schema"):
+            new_dataset = build_csv_dataset(dataset_id, parquet_path, raw_size, layout)
+
+    if upload_type == "json" or upload_type == "jsonl":
+        try:
+            with Stage("save_parquet", size=raw_size) as stage:
+                parquet_path, ingest_stats = save_json_parquet_file(dataset_dir, raw_path, upload_type, layout=layout)
+                stage.rows = ingest_stats.rows
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not keep_raw:
+            raw_path.unlink(missing_ok=True)
+
+        with Stage("schema"):
+            new_dataset = build_parquet_dataset(dataset_id, upload_type, parquet_path, raw_size, layout)
+
+    if upload_type == "sql" or upload_type == "sql_dump":
+        try:
+            with Stage("load_sql_dump", size=raw_size) as stage:
+                sqlite_path, ingest_stats = sql_dump_to_sqlite(dataset_dir, raw_path)
+                stage.rows = ingest_stats.rows
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not keep_raw:
+            raw_path.unlink(missing_ok=True)
+
+        with Stage("schema"):
+            new_dataset = build_sqlite_dataset(dataset_id, upload_type, sqlite_path, raw_size)
 
     if upload_type == "db" or upload_type == "sqlite":
-        # If its a SQL db, save the raw db file, and then retrieve the tables and schema for metadata.
-        raw_path, raw_size = save_raw_file(dataset_dir, file)
-        table_names = get_sqlite_table_names(raw_path)
-
-    
-        # tables = {name: str(raw_path) for name in table_names}
-        schema = get_sqlite_schema(raw_path)
-
-        new_dataset = Dataset(
-            dataset_id=dataset_id,
-            upload_type=upload_type,
-            raw_byte_size=raw_size,
-            dataset_path=str(raw_path),
-            tables=table_names,
-            schema=schema,
-        )
+        # If its a SQL db, the raw db file is the dataset, retrieve the tables and schema for metadata.
+        with Stage("schema"):
+            new_dataset = build_sqlite_dataset(dataset_id, upload_type, raw_path, raw_size)
+
+    if to_parquet and upload_type in SQLITE_UPLOAD_TYPES:
+        with Stage("convert_parquet"):
+            new_dataset.table_paths = convert_sqlite_to_parquet(dataset_dir, Path(new_dataset.dataset_path), new_dataset.tables, layout=layout)
+        new_dataset.layout = layout
+
+    with Stage("profile"):
+        profile = profile_dataset(new_dataset)
+    new_dataset.artifact_key = artifact_key
 
     # Save the metadata of the dataset to the database.
     try:
-        print("Saving metadata: ", new_dataset)
-        save_metadata(new_dataset)
-        return {"message": "File uploaded successfully"}
+        logging.info("Saving metadata of dataset %s (%s, tables: %s)", dataset_id, upload_type, ", ".join(new_dataset.tables))
+        with Stage("save_metadata"):
+            save_metadata(new_dataset, artifact_dir=dataset_dir)
+            save_profile(profile)
+        result = {"message": "File uploaded successfully", "dataset_id": dataset_id}
+        if ingest_stats:
+            result["ingest_stats"] = ingest_stats.model_dump()
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error saving metadata: {e}")
 
-    
\ No newline at end of file
+@router.post("/uploads")
+def start_upload_route(request: UploadSessionRequest) -> UploadSession:
+    '''
+    Start upload is a service that opens a resumable upload, for files too large to send in one request.
+    The client then PUTs the chunks (in any order, in parallel if it wants) to /db/uploads/{upload_id}/chunks/{chunk_index},
+    can GET /db/uploads/{upload_id} to see which byte ranges arrived (eg) after a dropped connection), and calls
+    /db/uploads/{upload_id}/complete once every chunk is there.
+    '''
+    upload_type = detect_upload_type(request.filename)
+    if upload_type not in ("csv", "json", "jsonl", "db", "sqlite", "sql", "sql_dump"):
+        raise HTTPException(status_code=400, detail=f"Unsupported upload type: {upload_type}")
+
+    # Abandoned sessions are cleaned up as new ones come in, on top of the cleanup at startup.
+    gc_upload_sessions()
+    try:
+        return start_upload_session(request, upload_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/uploads/{upload_id}")
+def get_upload_route(upload_id: str) -> UploadSession:
+    '''
+    Get upload is a service that returns the state of a resumable upload: its status, and the chunks and byte ranges received so far.
+    '''
+    try:
+        return get_upload_session(upload_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.put("/uploads/{upload_id}/chunks/{chunk_index}")
+async def put_upload_chunk_route(upload_id: str, chunk_index: int, request: Request) -> dict:
+    '''
+    Put upload chunk is a service that receives one chunk of a resumable upload as the raw request body.
+    Chunk i is the bytes [i * chunk_bytes, (i + 1) * chunk_bytes) of the file (the last one is shorter).
+    An X-Chunk-SHA256 header (hex) is checked against the received bytes, a mismatch is a 400 and the chunk can be sent again.
+    '''
+    try:
+        session = await run_in_threadpool(get_upload_session, upload_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if session.status != "open":
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is {session.status}, it no longer accepts chunks.")
+
+    # Refuse oversized bodies before reading them into memory.
+    content_length = request.headers.get("content-length")
+    if content_length is not None and int(content_length) > session.chunk_bytes:
+        raise HTTPException(status_code=413, detail=f"Chunks of this upload are at most {session.chunk_bytes} bytes.")
+
+    data = await request.body()
+    try:
+        recorded = await run_in_threadpool(write_upload_chunk, session, chunk_index, data, request.headers.get("x-chunk-sha256"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not recorded:
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} was completed while the chunk was written.")
+
+    return {"upload_id": upload_id, "chunk_index": chunk_index, "bytes": len(data)}
+
+@router.post("/uploads/{upload_id}/complete")
+def complete_upload_route(upload_id: str, response: Response, stream: bool = False, keep_raw: bool = True, background: bool = True, to_parquet: bool = False,
+                          layout: ParquetLayout = Depends(parquet_layout_params)) -> dict:
+    '''
+    Complete upload is a service that ingests a resumable upload once every chunk is received. The query params and the response
+    are the ones of /db/upload_db (stream only applies to background jobs, the file is already on disk).
+    If the ingest fails the upload goes back to open, so it can be completed again without sending the chunks again.
+    '''
+    try:
+        session = get_upload_session(upload_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    missing = missing_chunks(session)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Upload {upload_id} is missing {len(missing)} chunks, eg) {missing[:10]}.")
+    # Only one request completes the upload, and no chunk is recorded from here on.
+    if not update_upload_status(upload_id, "open", "completing"):
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is not open.")
+
+    dataset_id = str(uuid.uuid4())
+    dataset_dir = DATA_ROOT / dataset_id
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        raw_path, raw_size, sha256 = complete_upload_file(session, dataset_dir)
+        result = ingest_upload(response, dataset_id, dataset_dir, session.upload_type, raw_path, raw_size, sha256, stream=stream, keep_raw=keep_raw,
+                               background=background, to_parquet=to_parquet, layout=layout)
+    except Exception as e:
+        restore_upload_file(session, dataset_dir / session.filename)
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        update_upload_status(upload_id, "completing", "open", error=str(getattr(e, "detail", e)))
+        raise
+
+    update_upload_status(upload_id, "completing", "completed", dataset_id=dataset_id)
+    shutil.rmtree(upload_session_dir(upload_id), ignore_errors=True)
+    return {**result, "upload_id": upload_id}
+
+@router.delete("/datasets/{dataset_id}")
+def delete_dataset_route(dataset_id: str) -> dict:
+    '''
+    Delete dataset is a service that removes a dataset. Its files are only deleted once no other dataset uses them
+    (a re-upload of the same content shares the files of the first upload).
+    '''
+    get_duckdb_engine().detach(dataset_id)
+    try:
+        files_dir = delete_dataset(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if files_dir is not None:
+        shutil.rmtree(files_dir, ignore_errors=True)
+    shutil.rmtree(aggregates_dir(dataset_id), ignore_errors=True)
+    return {"message": "Dataset deleted", "dataset_id": dataset_id, "files_deleted": files_dir is not None}
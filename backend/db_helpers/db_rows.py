@@ -0,0 +1,245 @@
+import io
+import json
+import re
+import sqlite3
+from pathlib import Path
+from typing import Any, Literal, Optional
+import duckdb
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from .db_constants import ROWS_PAGE_MAX, Dataset, RowFilter
+from .db_engine import PARQUET_UPLOAD_TYPES, get_duckdb_engine, quote_identifier, quote_literal
+from .db_metrics import Stage
+
+'''
+db_rows.py is a module that pages through the rows of a table for the dataset viewer, with column projection,
+filters pushed down to the scan and keyset (seek) pagination, so the 10,000th page costs the same as the first one.
+
+- Parquet tables are paged by position: the cursor is the file and the row number (file_row_number) the next page starts at.
+  DuckDB skips every row group before that row from the Parquet metadata, and the filters skip the row groups
+  their min/max rule out. A partitioned (or appended) table is paged file by file, in path order.
+- SQLite tables are paged by rowid with sqlite3 directly (WHERE rowid >= ? ORDER BY rowid is a seek on the table's b-tree),
+  DuckDB's SQLite scanner would read the whole table for every page.
+
+Rows come back in storage order, a cursor is only valid for the version of the table it was made on.
+'''
+
+# SQL of each RowFilterOp, the same in DuckDB and SQLite.
+FILTER_OPERATORS = {"eq": "=", "ne": "!=", "lt": "<", "lte": "<=", "gt": ">", "gte": ">=", "like": "LIKE", "is_null": "IS NULL", "not_null": "IS NOT NULL"}
+
+# column:op or column:op:value, the column is everything before the first :op (the value can hold ":", eg) a timestamp).
+FILTER_PATTERN = re.compile(r"(?P<column>.+?):(?P<op>eq|ne|lte|lt|gte|gt|like|is_null|not_null)(?::(?P<value>.*))?", re.DOTALL)
+
+# Name the position of each row is read under, it is not part of the page.
+ROW_NUMBER_COLUMN = "file_row_number"
+
+def parse_row_filter(text: str) -> RowFilter:
+    '''
+    parse_row_filter is a function that parses a filter of the rows viewer query string.
+    eg) fare:gte:10 -> fare >= '10', city:eq:austin -> city = 'austin', tip:is_null -> tip IS NULL
+    Raises:
+        ValueError - If the filter is not column:op[:value], or the value is missing (or given to is_null/not_null).
+    '''
+    match = FILTER_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(f"Invalid filter {text}, expected column:op:value with op one of {', '.join(FILTER_OPERATORS)}.")
+
+    row_filter = RowFilter(column=match["column"], op=match["op"], value=match["value"])
+    if row_filter.op in ("is_null", "not_null") and row_filter.value is not None:
+        raise ValueError(f"Invalid filter {text}, {row_filter.op} takes no value.")
+    if row_filter.op not in ("is_null", "not_null") and row_filter.value is None:
+        raise ValueError(f"Invalid filter {text}, {row_filter.op} needs a value.")
+    return row_filter
+
+def filter_clauses(filters: list[RowFilter]) -> tuple[list[str], list[Any]]:
+    '''
+    filter_clauses is a function that returns the WHERE conditions of the filters and their parameters.
+    '''
+    clauses = []
+    params = []
+    for row_filter in filters:
+        clause = f"{quote_identifier(row_filter.column)} {FILTER_OPERATORS[row_filter.op]}"
+        if row_filter.value is not None:
+            clause += " ?"
+            params.append(row_filter.value)
+        clauses.append(clause)
+    return clauses, params
+
+def check_columns(dataset: Dataset, table_name: str, columns: list[str], filters: list[RowFilter]):
+    '''
+    check_columns is a function that checks the projected and filtered columns against the schema of the table.
+    Raises:
+        ValueError - If the table or a column does not exist.
+    '''
+    if table_name not in dataset.tables:
+        raise ValueError(f"Table {table_name} not found in the dataset.")
+    if len(set(columns)) != len(columns):
+        raise ValueError("A column is projected twice.")
+
+    # A table without a schema (eg) an old dataset) is left to the engine to check.
+    schema = dataset.schema.get(table_name)
+    if schema:
+        unknown = [column for column in columns + [row_filter.column for row_filter in filters] if column not in schema]
+        if unknown:
+            raise ValueError(f"Columns {unknown} not found in table {table_name}.")
+
+def parse_cursor(cursor: Optional[str], parts: int) -> tuple[int, ...]:
+    '''
+    parse_cursor is a function that reads the next_cursor of a previous page, eg) "3:1200" -> (3, 1200). No cursor is the first page.
+    '''
+    if cursor is None:
+        return (0,) * parts
+    try:
+        values = tuple(int(value) for value in cursor.split(":"))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if len(values) != parts:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
+
+def parquet_files(path: str) -> list[str]:
+    '''
+    parquet_files is a function that returns the Parquet files of a table, in the order they are paged.
+    '''
+    if path.endswith(".parquet"):
+        return [path]
+    return sorted(str(file_path) for file_path in Path(path).rglob("*.parquet"))
+
+def read_parquet_page(path: str, columns: list[str], filters: list[RowFilter], cursor: Optional[str], limit: int) -> tuple[pa.Table, Optional[str]]:
+    '''
+    read_parquet_page is a function that reads a page of a Parquet table (file or directory), starting at the cursor's file and row.
+    Every file read is one query that seeks to its start row, one more row than needed tells whether another page follows.
+    '''
+    file_index, start_row = parse_cursor(cursor, 2)
+    files = parquet_files(path)
+    # Partition columns come from the directory names of each file, like parquet_source reads them.
+    options = "file_row_number = true" + ("" if path.endswith(".parquet") else ", hive_partitioning = true")
+    select_list = ", ".join([quote_identifier(column) for column in columns] + [ROW_NUMBER_COLUMN]) if columns else "*"
+    clauses, params = filter_clauses(filters)
+    where = "".join(f" AND {clause}" for clause in clauses)
+
+    cursor_db = get_duckdb_engine().cursor()
+    pieces = []
+    remaining = limit
+    next_cursor = None
+    while file_index < len(files):
+        # Without filters the page is exactly the next remaining + 1 rows, bounding the range on both sides reads only their row groups
+        # (with an open range the top-n keeps decoding the following row groups until its threshold prunes them).
+        bound = "" if filters else f" AND {ROW_NUMBER_COLUMN} < {start_row + remaining + 1}"
+        sql = (f"SELECT {select_list} FROM read_parquet({quote_literal(files[file_index])}, {options}) "
+               f"WHERE {ROW_NUMBER_COLUMN} >= ?{bound}{where} ORDER BY {ROW_NUMBER_COLUMN} LIMIT ?")
+        try:
+            table = cursor_db.execute(sql, [start_row, *params, remaining + 1]).fetch_arrow_table()
+        except duckdb.Error as e:
+            raise ValueError(f"Error reading rows: {e}")
+
+        if table.num_rows > remaining:
+            next_cursor = f"{file_index}:{table.column(ROW_NUMBER_COLUMN)[remaining].as_py()}"
+            pieces.append(table.slice(0, remaining))
+            break
+        pieces.append(table)
+        remaining -= table.num_rows
+        file_index += 1
+        start_row = 0
+
+    if not pieces:
+        # A cursor past the last file, the page is empty (the columns still come from the first file).
+        sql = f"SELECT {select_list} FROM read_parquet({quote_literal(files[0])}, {options}) LIMIT 0" if files else None
+        if sql is None:
+            return pa.table({}), None
+        pieces.append(cursor_db.execute(sql).fetch_arrow_table())
+
+    page = pa.concat_tables(pieces) if len(pieces) > 1 else pieces[0]
+    return page.drop_columns([ROW_NUMBER_COLUMN]), next_cursor
+
+def column_array(values: list) -> pa.Array:
+    '''
+    column_array is a function that turns the values of a SQLite column into an Arrow array.
+    SQLite columns can mix types (eg) numbers and text), such a column is sent as text.
+    '''
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+def read_sqlite_page(sqlite_path: str, table_name: str, columns: list[str], filters: list[RowFilter], cursor: Optional[str],
+                     limit: int) -> tuple[pa.Table, Optional[str]]:
+    '''
+    read_sqlite_page is a function that reads a page of a SQLite table by rowid, starting at the cursor's rowid.
+    Raises:
+        ValueError - If the query fails (eg) a WITHOUT ROWID table, which has no order to seek on).
+    '''
+    select_list = ", ".join(quote_identifier(column) for column in columns) if columns else "*"
+    clauses, params = filter_clauses(filters)
+    if cursor is not None:
+        clauses.insert(0, "rowid >= ?")
+        params.insert(0, parse_cursor(cursor, 1)[0])
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT rowid, {select_list} FROM {quote_identifier(table_name)}{where} ORDER BY rowid LIMIT ?"
+
+    # Read only, the file belongs to the dataset.
+    conn = sqlite3.connect(Path(sqlite_path).as_uri() + "?mode=ro", uri=True)
+    try:
+        result = conn.execute(sql, [*params, limit + 1])
+        names = [description[0] for description in result.description][1:]
+        rows = result.fetchall()
+    except sqlite3.Error as e:
+        raise ValueError(f"Error reading rows of {table_name}: {e}")
+    finally:
+        conn.close()
+
+    next_cursor = str(rows[limit][0]) if len(rows) > limit else None
+    rows = rows[:limit]
+    return pa.table({name: column_array([row[index + 1] for row in rows]) for index, name in enumerate(names)}), next_cursor
+
+def read_rows(dataset: Dataset, table_name: str, columns: list[str], filters: list[RowFilter], cursor: Optional[str], limit: int) -> tuple[pa.Table, Optional[str]]:
+    '''
+    read_rows is a function that reads one page of the rows of a table.
+
+    Args:
+        dataset: Dataset - The dataset to read.
+        table_name: str - The table to read, must be one of dataset.tables.
+        columns: list[str] - The columns to return, every column if empty.
+        filters: list[RowFilter] - The conditions the rows must all match.
+        cursor: str - The next_cursor of the previous page, None for the first page.
+        limit: int - The number of rows of the page (at most ROWS_PAGE_MAX).
+    Returns:
+        pa.Table - The rows of the page.
+        str - The cursor of the next page, None on the last page.
+    Raises:
+        ValueError - If a column, a filter or the cursor is not valid.
+    '''
+    check_columns(dataset, table_name, columns, filters)
+    if not 1 <= limit <= ROWS_PAGE_MAX:
+        raise ValueError(f"limit must be between 1 and {ROWS_PAGE_MAX}.")
+
+    parquet_path = dataset.table_paths.get(table_name)
+    if parquet_path is None and dataset.upload_type in PARQUET_UPLOAD_TYPES:
+        parquet_path = dataset.dataset_path
+    with Stage("read_rows") as stage:
+        if parquet_path is not None:
+            page, next_cursor = read_parquet_page(parquet_path, columns, filters, cursor, limit)
+        else:
+            page, next_cursor = read_sqlite_page(dataset.dataset_path, table_name, columns, filters, cursor, limit)
+        stage.size, stage.rows = page.nbytes, page.num_rows
+    return page, next_cursor
+
+def encode_rows_page(table: pa.Table, next_cursor: Optional[str], format: Literal["json", "arrow"]) -> bytes:
+    '''
+    encode_rows_page is a function that encodes a page as an Arrow IPC stream, or as columnar JSON:
+        {"columns": ["id", "city"], "data": {"id": [1, 2], "city": ["austin", "boston"]}, "row_count": 2, "next_cursor": "0:2"}
+    Values JSON does not know (dates, decimals, ...) are written as strings.
+    '''
+    if format == "arrow":
+        sink = io.BytesIO()
+        with ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+
+    page = {"columns": table.column_names, "data": table.to_pydict(), "row_count": table.num_rows, "next_cursor": next_cursor}
+    return json.dumps(page, default=str).encode()
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_rows
@@ -0,0 +1,255 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+import duckdb
+from .db_constants import (
+    SAMPLE_CACHE_SIZE,
+    SAMPLE_SYSTEM_POOL_ROWS,
+    SAMPLE_MAX_STRATA,
+    SAMPLE_MAX_WORKERS,
+    Dataset,
+    DatasetProfile,
+    SampleStrategy,
+    TableProfile
+)
+from .db_engine import get_duckdb_engine, quote_identifier
+from .db_metrics import Stage
+from .db_metadata import get_profile
+from .db_profile import is_numeric_type
+from .db_services import file_fingerprint
+
+'''
+db_sampling.py is a module that picks representative sample rows of a table (LIMIT n only returns the first rows,
+which on sorted or clustered data are often all alike).
+
+Strategies:
+- head: the first rows (SELECT ... LIMIT n), the previous behaviour.
+- reservoir: a uniform random sample. Each row gets the priority hash(row, seed) and the n lowest are kept
+  (min_by(row, priority, n)), which is a reservoir sample that is the same for the same seed.
+- system: DuckDB's USING SAMPLE (system, seed), which keeps whole vectors of rows, then a reservoir sample of those.
+- stratified: a reservoir sample per value of a low-cardinality column, so every group shows up.
+- outlier: half of the rows are the ones furthest from the column means (z-score), the other half a reservoir sample.
+
+Every strategy is one streaming scan (or less, for system/head) that keeps at most n rows per group in memory,
+regardless of the table size. The per-column stats they need (row count, mean/stddev, distinct counts) come from
+the profile computed at ingest (see db_profile.py), without it they fall back to reservoir.
+'''
+
+# Name the table is read under in the sampling queries (the row struct of min_by / hash).
+SOURCE_ALIAS = "sample_source"
+
+class SampleCache:
+    '''
+    SampleCache is a class that keeps the most recently used samples (LRU), so repeated insight calls do not scan the table again.
+    The cached lists are shared, treat them as read-only.
+    '''
+    def __init__(self, max_entries: int = SAMPLE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, list[dict[str, Any]]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[list[dict[str, Any]]]:
+        with self.lock:
+            rows = self.entries.get(key)
+            if rows is not None:
+                self.entries.move_to_end(key)
+            return rows
+
+    def put(self, key: tuple, rows: list[dict[str, Any]]):
+        with self.lock:
+            self.entries[key] = rows
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_sample_cache = SampleCache()
+
+def get_sample_cache() -> SampleCache:
+    return _sample_cache
+
+def reservoir_sql(from_clause: str, count_param: str = "$num_rows") -> str:
+    '''
+    reservoir_sql is a function that returns the query for a seeded reservoir sample, parameters $seed and count_param (the number of rows).
+    '''
+    # The inner unnest turns the list of picked rows into one row struct per row, the outer one turns the struct back into columns.
+    picked = f"SELECT unnest(min_by({SOURCE_ALIAS}, hash({SOURCE_ALIAS}, $seed), {count_param})) AS sample_row FROM {from_clause} AS {SOURCE_ALIAS}"
+    return f"SELECT unnest(sample_row) FROM ({picked})"
+
+def system_sql(from_clause: str, table_profile: Optional[TableProfile], seed: int) -> str:
+    '''
+    system_sql is a function that returns the query for a system sample: about SAMPLE_SYSTEM_POOL_ROWS rows in whole vectors,
+    then a reservoir sample of them. Without a profile the whole table is the pool (same as reservoir).
+    '''
+    percent = 100.0
+    if table_profile is not None and table_profile.row_count > 0:
+        percent = min(100.0, 100.0 * SAMPLE_SYSTEM_POOL_ROWS / table_profile.row_count)
+
+    # USING SAMPLE does not take parameters, the seed is an int so it is safe to inline.
+    pool = f"(SELECT * FROM {from_clause} USING SAMPLE {percent:.6f} PERCENT (system, {int(seed)}))"
+    return reservoir_sql(pool)
+
+def pick_strata_column(table_profile: Optional[TableProfile]) -> Optional[str]:
+    '''
+    pick_strata_column is a function that picks the column to stratify by: the non-numeric column with the fewest distinct values (at least 2).
+    '''
+    if table_profile is None:
+        return None
+
+    candidates = [
+        column for column in table_profile.columns
+        if column.approx_distinct is not None and 2 <= column.approx_distinct <= SAMPLE_MAX_STRATA
+    ]
+    # Prefer categories (eg) status, city) over numbers that happen to have few values.
+    candidates.sort(key=lambda column: (is_numeric_type(column.column_type), column.approx_distinct))
+    return candidates[0].column_name if candidates else None
+
+def stratified_sql(from_clause: str, stratify_by: str, strata: int, num_rows: int) -> str:
+    '''
+    stratified_sql is a function that returns the query for a stratified sample: the first row of every group, then the second, ...
+    until num_rows, so every group is in the sample when there are fewer groups than rows.
+    '''
+    per_group = max(1, -(-num_rows // max(strata, 1)))
+    return f"""WITH strata AS (
+        SELECT min_by({SOURCE_ALIAS}, hash({SOURCE_ALIAS}, $seed), {per_group}) AS picked
+        FROM {from_clause} AS {SOURCE_ALIAS} GROUP BY {SOURCE_ALIAS}.{quote_identifier(stratify_by)}
+    ), ranked AS (
+        SELECT unnest(picked) AS sample_row, unnest(range(len(picked))) AS sample_rank FROM strata
+    )
+    SELECT unnest(sample_row) FROM ranked ORDER BY sample_rank, hash(sample_row, $seed) LIMIT $num_rows"""
+
+def outlier_sql(from_clause: str, table_profile: Optional[TableProfile]) -> Optional[str]:
+    '''
+    outlier_sql is a function that returns the query for an outlier-biased sample, or None if the table has no numeric column to score.
+    The score of a row is its largest |value - mean| / stddev, the top rows are kept with a bounded top-n (ORDER BY ... LIMIT).
+    The rest is topped up from a reservoir sample of num_rows rows without the outliers, so the sample has num_rows rows
+    (unless the table is smaller) even when the reservoir picked some of the outliers too.
+    '''
+    if table_profile is None:
+        return None
+
+    scores = []
+    for column in table_profile.columns:
+        if is_numeric_type(column.column_type) and column.mean is not None and column.stddev:
+            name = quote_identifier(column.column_name)
+            scores.append(f"coalesce(abs(({SOURCE_ALIAS}.{name} - {column.mean!r}) / {column.stddev!r}), 0)")
+
+    if not scores:
+        return None
+
+    score = scores[0] if len(scores) == 1 else f"greatest({', '.join(scores)})"
+    outliers = f"SELECT * FROM {from_clause} AS {SOURCE_ALIAS} ORDER BY {score} DESC LIMIT $num_outliers"
+    # The outliers come first, then the picked rows that are not outliers (EXCEPT, so no row is shown twice) in seeded order.
+    # MATERIALIZED: the outliers are read once, and the SQLite scanner can not be copied into both references of an inlined CTE.
+    return f"""WITH outliers AS MATERIALIZED ({outliers}), picked AS ({reservoir_sql(from_clause)}), ranked AS (
+        SELECT outlier_row AS sample_row, 0 AS sample_group, 0 AS sample_rank FROM outliers AS outlier_row
+        UNION ALL
+        SELECT picked_row, 1, hash(picked_row, $seed) FROM (SELECT * FROM picked EXCEPT SELECT * FROM outliers) AS picked_row
+    )
+    SELECT unnest(sample_row) FROM ranked ORDER BY sample_group, sample_rank LIMIT $num_rows"""
+
+def sample_rows(dataset: Dataset, table_name: str, num_rows: int, strategy: SampleStrategy = "reservoir", seed: int = 0, stratify_by: Optional[str] = None,
+                profile: Optional[DatasetProfile] = None) -> list[dict[str, Any]]:
+    '''
+    sample_rows is a function that returns num_rows sample rows of a table, picked with the given strategy. Results are cached.
+
+    Args:
+        dataset: Dataset - The dataset to sample.
+        table_name: str - The table to sample, must be one of dataset.tables.
+        num_rows: int - The number of rows to return (fewer if the table is smaller).
+        strategy: SampleStrategy - How to pick the rows, see the module docstring.
+        seed: int - The same seed gives the same sample.
+        stratify_by: str - The column to stratify by, defaults to the lowest-cardinality column of the profile.
+        profile: DatasetProfile - The profile of the dataset if the caller has it already, otherwise it is read from the metadata database when needed.
+
+    Returns:
+        list[dict[str, Any]] - The rows, as {column_name: value}.
+    '''
+    if table_name not in dataset.tables:
+        raise ValueError(f"Table {table_name} not found in the dataset.")
+    if num_rows < 1:
+        raise ValueError("num_rows must be at least 1.")
+
+    # The fingerprint (the file's size and mtime) keeps a rewritten file from serving old samples.
+    key = (dataset.dataset_id, file_fingerprint(dataset.dataset_path), table_name, strategy, seed, num_rows, stratify_by)
+    cache = get_sample_cache()
+    rows = cache.get(key)
+    if rows is not None:
+        return rows
+
+    table_profile = None
+    if strategy in ("system", "stratified", "outlier"):
+        profile = profile or get_profile(dataset.dataset_id)
+        table_profile = profile.tables.get(table_name) if profile else None
+
+    params: dict[str, Any] = {"seed": seed, "num_rows": num_rows}
+
+    with get_duckdb_engine().dataset(dataset) as session:
+        from_clause = session.table(table_name)
+        sql = None
+
+        if strategy == "head":
+            sql = f"SELECT * FROM {from_clause} LIMIT $num_rows"
+            params.pop("seed")
+        elif strategy == "system":
+            sql = system_sql(from_clause, table_profile, seed)
+        elif strategy == "stratified":
+            column = stratify_by or pick_strata_column(table_profile)
+            if column is not None:
+                # The number of groups decides how many rows each group contributes.
+                distinct = {c.column_name: c.approx_distinct for c in table_profile.columns} if table_profile else {}
+                sql = stratified_sql(from_clause, column, distinct.get(column) or SAMPLE_MAX_STRATA, num_rows)
+        elif strategy == "outlier":
+            sql = outlier_sql(from_clause, table_profile)
+            if sql is not None:
+                params["num_outliers"] = (num_rows + 1) // 2
+
+        if sql is None:
+            # reservoir, or a strategy that had nothing to work with (eg) no profile, no numeric column).
+            sql = reservoir_sql(from_clause)
+
+        try:
+            with Stage("sample") as stage:
+                dataframe = session.cursor.execute(sql, params).fetchdf()
+                stage.rows = len(dataframe)
+        except duckdb.Error as e:
+            raise ValueError(f"Error sampling table {table_name}: {e}")
+
+    rows = dataframe.to_dict(orient="records")
+    cache.put(key, rows)
+    return rows
+
+def sample_tables(dataset: Dataset, table_names: list[str], num_rows: int, strategy: SampleStrategy = "reservoir", seed: int = 0,
+                  max_workers: int = SAMPLE_MAX_WORKERS) -> dict[str, list[dict[str, Any]]]:
+    '''
+    sample_tables is a function that samples several tables of a dataset at once, for insights over the whole dataset.
+
+    The dataset is attached (SQLite) and its profile read once for the whole batch, then the tables are sampled
+    concurrently by up to max_workers threads, each on its own DuckDB cursor. A table that can not be sampled gets no rows
+    instead of failing the batch.
+
+    Returns:
+        dict[str, list[dict[str, Any]]] - table name -> sample rows, in the order of table_names.
+    '''
+    profile = get_profile(dataset.dataset_id) if strategy in ("system", "stratified", "outlier") else None
+    def sample_table(table_name: str) -> list[dict[str, Any]]:
+        try:
+            return sample_rows(dataset, table_name, num_rows, strategy, seed, profile=profile)
+        except ValueError as e:
+            logging.warning("Skipping table %s of %s: %s", table_name, dataset.dataset_id, e)
+            return []
+
+    # The outer session pins the attachment, the sessions of the workers reuse it instead of attaching again.
+    with get_duckdb_engine().dataset(dataset):
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(table_names)))) as pool:
+            return dict(zip(table_names, pool.map(sample_table, table_names)))
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_sampling
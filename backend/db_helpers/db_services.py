@@ -1,10 +1,15 @@
 import os
+import hashlib
+import json
 import sqlite3
 import duckdb
 import uuid
 from pathlib import Path
+from typing import Optional
 import logging
-from .db_constants import Dataset
+import shutil
+from .db_constants import DUCKDB_MEMORY_LIMIT, PARQUET_MAX_PARTITIONS, Dataset, ForeignKey, ParquetLayout
+from .db_engine import get_duckdb_engine, parquet_source, quote_identifier, quote_literal
 from db_helpers.db_constants import DATA_ROOT, METADATA_DB, METADATA_TABLE
 from fastapi import UploadFile
 
@@ -36,16 +41,19 @@ def detect_upload_type(filename: str):
         return "sqlite"
     elif extension == ".sql_dump":
         return "sql_dump"
+    elif extension == ".sql":
+        return "sql"
     else:
         return "unknown"
 
-def save_raw_file(dataset_dir: Path, file: UploadFile) -> Path:
+def save_raw_file(dataset_dir: Path, file: UploadFile, digest=None) -> Path:
     '''
     save_raw_file is a function that saves the raw file to the dataset directory.
 
     Args:
         dataset_dir: Path - The directory to save the raw file to. (Must Exist) Will be the dataset directory under its uuid.
         file: UploadFile - The file to save.
+        digest: A hashlib object (eg) hashlib.sha256()) updated with every chunk, so the upload is hashed while it is written.
 
     Returns:
         Path - The path to the saved raw file.
@@ -69,11 +77,81 @@ def save_raw_file(dataset_dir: Path, file: UploadFile) -> Path:
 
             f.write(chunk)
             size += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
 
     # returns raw_saving_path(Path), size(int)
     return raw_saving_path, size
 
-def save_parquet_file(dataset_dir: Path, raw_csv_path: Path) -> Path:
+def upload_artifact_key(sha256: str, upload_type: str, to_parquet: bool, layout: ParquetLayout) -> str:
+    '''
+    upload_artifact_key is a function that builds the key under which the converted files of an upload are shared (see clone_dataset).
+    The same bytes converted with other options give other files, so the options are part of the key.
+    eg) 9f86d081...:csv:3b5e1c0a2f4d6e8b
+    '''
+    options = json.dumps({"to_parquet": to_parquet, "layout": layout.model_dump()}, sort_keys=True)
+    return f"{sha256}:{upload_type}:{hashlib.sha256(options.encode()).hexdigest()[:16]}"
+
+def parquet_copy_options(layout: ParquetLayout) -> str:
+    '''
+    parquet_copy_options is a function that turns a ParquetLayout into the options of a DuckDB COPY ... TO.
+    eg) (FORMAT parquet, COMPRESSION zstd, COMPRESSION_LEVEL 9, ROW_GROUP_SIZE 122880, PARTITION_BY ("country"))
+
+    Raises:
+        ValueError - If a compression level is given for another codec than zstd, or the row group size is not positive.
+    '''
+    if layout.compression_level is not None and layout.compression != "zstd":
+        raise ValueError(f"compression_level is only supported by zstd, not {layout.compression}.")
+    if layout.row_group_size < 1:
+        raise ValueError("row_group_size must be positive.")
+
+    options = ["FORMAT parquet", f"COMPRESSION {layout.compression}", f"ROW_GROUP_SIZE {int(layout.row_group_size)}"]
+    if layout.compression_level is not None:
+        options.append(f"COMPRESSION_LEVEL {int(layout.compression_level)}")
+    if layout.partition_by:
+        options.append(f"PARTITION_BY ({quote_identifier(layout.partition_by)})")
+    return f"({', '.join(options)})"
+
+def copy_to_parquet(conn: duckdb.DuckDBPyConnection, select_sql: str, target: Path, layout: ParquetLayout) -> Path:
+    '''
+    copy_to_parquet is a function that writes the result of a query to Parquet with the given layout.
+
+    Args:
+        conn: duckdb.DuckDBPyConnection - The connection to run the COPY on.
+        select_sql: str - The query whose rows are written, eg) SELECT * FROM read_csv('people.csv').
+        target: Path - The path without extension, eg) datasets/uuid/tables/people.
+        layout: ParquetLayout - The compression, row groups, sort order and partitioning.
+
+    Returns:
+        Path - target.parquet, or the target directory when the layout is partitioned.
+
+    Raises:
+        ValueError - If the layout is invalid (eg) compression_level without zstd, too many partitions).
+        duckdb.Error - If the query fails (eg) a sort column that is not in the table), the partial output is removed.
+    '''
+    options = parquet_copy_options(layout)
+    output = target if layout.partition_by else target.with_name(target.name + ".parquet")
+
+    try:
+        if layout.partition_by:
+            partitions = conn.execute(f"SELECT approx_count_distinct({quote_identifier(layout.partition_by)}) FROM ({select_sql})").fetchone()[0]
+            if partitions > PARQUET_MAX_PARTITIONS:
+                raise ValueError(f"Partitioning by {layout.partition_by} would write about {partitions} partitions, the limit is {PARQUET_MAX_PARTITIONS}.")
+
+        # Sorted rows give every row group a narrow min/max range per sort column, which is what lets filters skip them.
+        order_by = f" ORDER BY {', '.join(quote_identifier(column) for column in layout.sort_by)}" if layout.sort_by else ""
+        conn.execute(f"COPY (SELECT * FROM ({select_sql}){order_by}) TO {quote_literal(str(output))} {options}")
+
+    except duckdb.Error:
+        if output.is_dir():
+            shutil.rmtree(output, ignore_errors=True)
+        else:
+            output.unlink(missing_ok=True)
+        raise
+
+    return output
+
+def save_parquet_file(dataset_dir: Path, raw_csv_path: Path, layout: Optional[ParquetLayout] = None) -> Path:
     '''
     save_parquet_file is a function that saves the parquet file to the dataset directory. 
     Will be under the tables directory under its uuid.
@@ -81,20 +159,28 @@ def save_parquet_file(dataset_dir: Path, raw_csv_path: Path) -> Path:
     Args:
         dataset_dir: Path - The directory to save the parquet file to. (
         raw_csv_path: the path to the raw csv file.
+        layout: ParquetLayout - How to write the Parquet file, defaults to the server defaults.
 
     Returns:
         Path - The path to the saved parquet file. eg) format -> datasets/uuid/tables/file_name.parquet
+            (datasets/uuid/tables/file_name when the layout is partitioned)
+
+    Raises:
+        ValueError - If the CSV can not be read or the layout does not fit it.
     '''
 
     # Make a tables directory for storing a parquet file. 
     tables_dir = dataset_dir / "tables"
     tables_dir.mkdir(parents=True, exist_ok=True)
 
-    parquet_path = tables_dir / f"{raw_csv_path.stem}.parquet" 
     # read the csv file from its path and write it to the parquet file in the tables directory where we want to store it. 
-    duckdb.read_csv(str(raw_csv_path)).write_parquet(str(parquet_path))
-
-    return parquet_path
+    conn = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY_LIMIT})
+    try:
+        return copy_to_parquet(conn, f"SELECT * FROM read_csv({quote_literal(str(raw_csv_path))})", tables_dir / raw_csv_path.stem, layout or ParquetLayout())
+    except duckdb.Error as e:
+        raise ValueError(f"Error converting {raw_csv_path.name} to Parquet: {e}")
+    finally:
+        conn.close()
 
 def get_parquet_schema(parquet_path: Path) -> dict[str, str]:
     '''
@@ -109,7 +195,7 @@ def get_parquet_schema(parquet_path: Path) -> dict[str, str]:
     '''
 
     schema: dict[str, dict[str, str]] = {}
-    result = duckdb.execute("DESCRIBE (SELECT * FROM read_parquet(?))", [str(parquet_path)]).fetchall()
+    result = duckdb.execute(f"DESCRIBE (SELECT * FROM {parquet_source(str(parquet_path))})").fetchall()
 
     # eg return) {"column_name": "TYPE"}
     # parquet_path.stem is the name of the parquet file without the extension. 
@@ -155,15 +241,64 @@ def get_sqlite_schema(sqlite_path: Path) -> dict:
     schema: dict[str, dict[str, str]] = {}
 
     conn = sqlite3.connect(str(sqlite_path))
-
-    # For each table get the information about the table, getting the column names and their types. 
-    for table in table_names:
-        # Fetching all of the columns in the table and their types
-        cursor = conn.execute(f"PRAGMA table_info({table})")
-        schema[table] = {column[1]: column[2] or "TEXT" for column in cursor.fetchall()}
+    try:
+        # For each table get the information about the table, getting the column names and their types. 
+        for table in table_names:
+            # Fetching all of the columns in the table and their types, the table name is a parameter
+            # so any name works (eg) a reserved word like order, or a name with spaces from a SQL dump).
+            cursor = conn.execute("SELECT * FROM pragma_table_info(?)", (table,))
+            schema[table] = {column[1]: column[2] or "TEXT" for column in cursor.fetchall()}
+    finally:
+        conn.close()
 
     return schema
 
+def get_sqlite_foreign_keys(sqlite_path: Path) -> list[ForeignKey]:
+    '''
+    get_sqlite_foreign_keys is a function that gets the foreign keys of every table of the sqlite database (PRAGMA foreign_key_list).
+    A composite key gives one ForeignKey per column.
+
+    Args:
+        sqlite_path: Path - The path to the sqlite database.
+    '''
+    foreign_keys: list[ForeignKey] = []
+
+    conn = sqlite3.connect(str(sqlite_path))
+    try:
+        for table in get_sqlite_table_names(sqlite_path):
+            # Rows are (id, seq, table, from, to, on_update, on_delete, match).
+            for row in conn.execute("SELECT * FROM pragma_foreign_key_list(?)", (table,)).fetchall():
+                foreign_keys.append(ForeignKey(table_name=table, column_name=row[3], ref_table=row[2], ref_column=row[4]))
+    finally:
+        conn.close()
+
+    return foreign_keys
+
+
+def file_fingerprint(path: Path) -> str:
+    '''
+    file_fingerprint is a function that returns a fingerprint of a file's version: the hash of its path, size and mtime.
+    Rewriting the file (an append, a compaction, a conversion) changes it, and it is computed from one stat, without reading the file,
+    so the caches keyed on it (samples, aggregates, insights) cost nothing to look up on the first request after a restart.
+    For a directory (a partitioned or appended Parquet table) it is the hash of its path and the newest mtime of it and its
+    partition directories: files are only ever added, replaced or removed there by a rename (a directory entry change), which
+    moves the mtime of the directory holding them, so only the directories are stat-ed, not every file.
+
+    Args:
+        path: Path - The file or directory to fingerprint.
+    '''
+    if os.path.isdir(path):
+        newest_mtime = 0
+        directories = [os.fspath(path)]
+        while directories:
+            directory = directories.pop()
+            newest_mtime = max(newest_mtime, os.stat(directory).st_mtime_ns)
+            with os.scandir(directory) as entries:
+                directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        return hashlib.sha256(f"{path}:{newest_mtime}".encode()).hexdigest()
+
+    stat = os.stat(path)
+    return hashlib.sha256(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
 
 def get_sample_rows(dataset: Dataset, num_rows: int, table_name: str) -> list[dict[str, any]]:
     '''
@@ -172,33 +307,19 @@ def get_sample_rows(dataset: Dataset, num_rows: int, table_name: str) -> list[di
 
     For CSV -> Parquet: we will read the parquet file and return the sample rows.
     For SQLite we will read the SQLite database and return the sample rows. 
+    Reads go through the process-wide DuckDB engine, so a SQLite dataset is only attached on its first read.
     '''
     if table_name is None:
         raise ValueError("No table name provided.")
 
-    #Initialize duckDB connection.
-    conn = duckdb.connect()
-    dataset_path = dataset.dataset_path
-
-    try:
-        if dataset.upload_type == "csv":
-            # If csv then we load in the parquet file and return the sample rows. There is only one table in the dataset.
-            dataframe = conn.execute("SELECT * FROM read_parquet(?) LIMIT ?", [dataset_path, num_rows]).fetchdf()
-
-        # If its a db type then it is an sqlite database. 
-        elif dataset.upload_type == "db":
-            # if sqlite then we moust attach the sqlite file into DuckDB and expose it with the name sqlite_db.
-            conn.execute(f"ATTACH DATABASE '{dataset_path}' AS sqlite_db (TYPE sqlite)")
-            dataframe = conn.execute(f"SELECT * FROM sqlite_db.{table_name} LIMIT ?", [num_rows]).fetchdf()
-
-    finally:
-        conn.close()
+    with get_duckdb_engine().dataset(dataset) as session:
+        # session.table gives read_parquet(...) for CSV, or the table of the attached sqlite database.
+        dataframe = session.cursor.execute(f"SELECT * FROM {session.table(table_name)} LIMIT ?", [num_rows]).fetchdf()
 
     return dataframe.to_dict(orient="records")    
 
 # Potential next functions to add
 # - Save JSON Files
-# - Conversion function of SQL to CSV (this can be done by converting each table into a parquet file.)
 # - Conversion of CSV to SQL (this can be done by converting each parquet file into a table in the sqlite database.)
 
 
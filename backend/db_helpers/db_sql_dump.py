@@ -0,0 +1,530 @@
+import codecs
+import logging
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterator, Optional
+from .db_constants import UPLOAD_CHUNK_BYTES, SQL_DUMP_BATCH_ROWS, SQL_DUMP_COMMIT_ROWS, IngestStats
+from .db_engine import quote_identifier
+from .db_ingest import build_ingest_stats
+
+'''
+db_sql_dump.py is a module that loads a SQL text dump (mysqldump, pg_dump, or a plain .sql script) into a SQLite database,
+so the dataset is then read like any SQLite upload.
+
+The dump is read in chunks and split into statements as it goes, memory holds one statement (and one batch of rows per table)
+no matter how large the dump is. Only the statements that carry the data are run:
+- CREATE TABLE is rewritten for SQLite: column types are reduced to SQLite's affinities (INTEGER, REAL, NUMERIC, TEXT, BLOB),
+  PRIMARY KEY and FOREIGN KEY are kept, MySQL indexes and table options are dropped.
+- INSERT / REPLACE values are parsed and batched into executemany calls, in large transactions.
+- pg_dump's COPY ... FROM stdin blocks are read line by line and batched the same way.
+Everything else (SET, LOCK TABLES, ALTER TABLE, CREATE INDEX, sequences, grants, ...) is skipped.
+'''
+
+# An identifier as written by mysqldump (`name`), pg_dump ("name" or name) or SQL Server ([name]), optionally schema qualified.
+IDENTIFIER = r'(?:`[^`]+`|"(?:[^"]|"")+"|\[[^\]]+\]|[\w$]+)'
+QUALIFIED_IDENTIFIER = rf'{IDENTIFIER}(?:\s*\.\s*{IDENTIFIER})*'
+
+# Tokens that matter when splitting statements: strings, quoted identifiers, comments and the ; that ends a statement.
+# Each opener also matches up to the end of the buffer, so a token cut by the chunk boundary is recognized as incomplete.
+SPLIT_TOKEN_BACKSLASH = re.compile(r"""'(?:[^'\\]|\\.|'')*(?:'|\Z)|"(?:[^"]|"")*(?:"|\Z)|`[^`]*(?:`|\Z)|--[^\n]*(?:\n|\Z)|\#[^\n]*(?:\n|\Z)|/\*.*?(?:\*/|\Z)|;""", re.S)
+SPLIT_TOKEN_STANDARD = re.compile(r"""'(?:[^']|'')*(?:'|\Z)|"(?:[^"]|"")*(?:"|\Z)|`[^`]*(?:`|\Z)|--[^\n]*(?:\n|\Z)|\#[^\n]*(?:\n|\Z)|/\*.*?(?:\*/|\Z)|;""", re.S)
+
+LEADING_COMMENTS = re.compile(r"^(?:\s+|--[^\n]*(?:\n|$)|\#[^\n]*(?:\n|$)|/\*.*?\*/)*", re.S)
+
+CREATE_TABLE = re.compile(rf"^CREATE\s+(?:(?:GLOBAL\s+|LOCAL\s+)?(?:TEMP|TEMPORARY|UNLOGGED)\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<table>{QUALIFIED_IDENTIFIER})\s*\(", re.I)
+INSERT = re.compile(rf"^(?:INSERT|REPLACE)(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE|OR\s+\w+))*\s+INTO\s+(?P<table>{QUALIFIED_IDENTIFIER})\s*(?:\((?P<columns>[^)]*)\))?\s*VALUES\s*", re.I)
+COPY_FROM_STDIN = re.compile(rf"^COPY\s+(?P<table>{QUALIFIED_IDENTIFIER})\s*(?:\((?P<columns>[^)]*)\))?\s+FROM\s+stdin", re.I)
+STANDARD_STRINGS = re.compile(r"^SET\s+standard_conforming_strings\s*=\s*'?(?P<value>on|off)'?", re.I)
+
+# One value of an INSERT ... VALUES list.
+VALUE_TOKEN_BACKSLASH = re.compile(r"""\s*(?:(?P<string>[EeNnBb]?'(?:[^'\\]|\\.|'')*')|(?P<hex>0x[0-9A-Fa-f]+|[Xx]'[0-9A-Fa-f]*')|(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![\w.])|(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<other>[^\s,()']+))""", re.S)
+VALUE_TOKEN_STANDARD = re.compile(r"""\s*(?:(?P<string>[Ee]'(?:[^'\\]|\\.|'')*'|[NnBb]?'(?:[^']|'')*')|(?P<hex>0x[0-9A-Fa-f]+|[Xx]'[0-9A-Fa-f]*')|(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![\w.])|(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<other>[^\s,()']+))""", re.S)
+
+# MySQL string escapes, and the escapes of pg_dump's COPY text format.
+MYSQL_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+# Table-level definitions that are not needed to read the data: MySQL indexes, unique/check/exclusion constraints.
+# (KEY / INDEX only with a column list, so a column named key is still a column.)
+SKIPPED_DEFINITION = re.compile(r"^(?:CONSTRAINT\s|(?:UNIQUE|FULLTEXT|SPATIAL)\b|(?:KEY|INDEX)\s*(?:[^\s(]+\s*)?\(|CHECK\s*\(|EXCLUDE\b|LIKE\s)", re.I)
+
+# Keywords that end the type of a column definition.
+COLUMN_CONSTRAINTS = re.compile(r"\s(?:NOT|NULL|DEFAULT|PRIMARY|REFERENCES|UNIQUE|CHECK|COLLATE|COMMENT|AUTO_INCREMENT|AUTOINCREMENT|GENERATED|CONSTRAINT|ON|IDENTITY)\b", re.I)
+
+def unquote_identifier(name: str) -> str:
+    '''
+    unquote_identifier is a function that returns the bare name of a (possibly schema qualified) identifier.
+    eg) `shop`.`orders` -> orders, public."Order Items" -> Order Items
+    '''
+    parts = re.findall(IDENTIFIER, name)
+    last = parts[-1] if parts else name.strip()
+    if last[0] in "`[":
+        return last[1:-1]
+    if last[0] == '"':
+        return last[1:-1].replace('""', '"')
+    return last
+
+def split_top_level(text: str) -> list[str]:
+    '''
+    split_top_level is a function that splits text on the commas outside of parentheses, strings and quoted identifiers.
+    '''
+    parts: list[str] = []
+    depth = 0
+    start = 0
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\" and quote == "'":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+def closing_parenthesis(text: str, start: int) -> int:
+    '''
+    closing_parenthesis is a function that returns the index of the ) that closes the ( just before start (len(text) if there is none).
+    '''
+    depth = 1
+    quote = None
+    i = start
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\" and quote == "'":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return len(text)
+
+def sqlite_affinity(declared_type: str) -> str:
+    '''
+    sqlite_affinity is a function that reduces a MySQL/PostgreSQL column type to the SQLite affinity it stores as.
+    Dates and times are kept as TEXT, so values like MySQL's 0000-00-00 do not break reading them back.
+    eg) int(11) unsigned -> INTEGER, character varying(255) -> TEXT, numeric(10,2) -> NUMERIC
+    '''
+    upper = declared_type.upper()
+    if "INTERVAL" in upper or "POINT" in upper:
+        return "TEXT"
+    if "INT" in upper or "BOOL" in upper or "SERIAL" in upper:
+        return "INTEGER"
+    if "CHAR" in upper or "CLOB" in upper or "TEXT" in upper:
+        return "TEXT"
+    if "BLOB" in upper or "BINARY" in upper or "BYTEA" in upper:
+        return "BLOB"
+    if "REAL" in upper or "FLOA" in upper or "DOUB" in upper:
+        return "REAL"
+    if "DEC" in upper or "NUM" in upper:
+        return "NUMERIC"
+    return "TEXT"
+
+def column_list(columns: str) -> list[str]:
+    return [unquote_identifier(column) for column in split_top_level(columns)]
+
+def translate_create_table(statement: str) -> Optional[tuple[str, str]]:
+    '''
+    translate_create_table is a function that rewrites a CREATE TABLE statement for SQLite.
+
+    Returns:
+        tuple[str, str] - The table name and the SQLite statement, None if the statement is not a CREATE TABLE.
+    '''
+    match = CREATE_TABLE.match(statement)
+    if match is None:
+        return None
+
+    table = unquote_identifier(match.group("table"))
+    # The body ends at the parenthesis that closes the one the match ended on.
+    items = split_top_level(statement[match.end():closing_parenthesis(statement, match.end())])
+    definitions: list[str] = []
+
+    for item in items:
+        upper = item.upper()
+        keys = re.findall(r"\(([^)]*)\)", item)
+
+        if "PRIMARY KEY" in upper and upper.startswith(("PRIMARY", "CONSTRAINT")) and keys:
+            definitions.append(f"PRIMARY KEY ({', '.join(quote_identifier(c) for c in column_list(keys[0]))})")
+
+        elif "FOREIGN KEY" in upper and upper.startswith(("FOREIGN", "CONSTRAINT")):
+            references = re.search(rf"REFERENCES\s+(?P<table>{QUALIFIED_IDENTIFIER})\s*(?:\((?P<columns>[^)]*)\))?", item, re.I)
+            if keys and references:
+                ref_columns = f" ({', '.join(quote_identifier(c) for c in column_list(references.group('columns')))})" if references.group("columns") else ""
+                definitions.append(f"FOREIGN KEY ({', '.join(quote_identifier(c) for c in column_list(keys[0]))}) "
+                                   f"REFERENCES {quote_identifier(unquote_identifier(references.group('table')))}{ref_columns}")
+
+        elif SKIPPED_DEFINITION.match(item):
+            # MySQL indexes and other constraints are not needed to read the data.
+            continue
+
+        else:
+            name_match = re.match(IDENTIFIER, item)
+            if name_match is None:
+                continue
+            rest = item[name_match.end():]
+            constraint = COLUMN_CONSTRAINTS.search(rest)
+            declared_type = rest[:constraint.start()] if constraint else rest
+
+            definition = f"{quote_identifier(unquote_identifier(name_match.group()))} {sqlite_affinity(declared_type)}"
+            if re.search(r"\bPRIMARY\s+KEY\b", rest, re.I):
+                definition += " PRIMARY KEY"
+            references = re.search(rf"\bREFERENCES\s+(?P<table>{QUALIFIED_IDENTIFIER})\s*(?:\((?P<columns>[^)]*)\))?", rest, re.I)
+            if references:
+                definition += f" REFERENCES {quote_identifier(unquote_identifier(references.group('table')))}"
+                if references.group("columns"):
+                    definition += f" ({', '.join(quote_identifier(c) for c in column_list(references.group('columns')))})"
+            definitions.append(definition)
+
+    if not definitions:
+        return None
+    return table, f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({', '.join(definitions)})"
+
+UNESCAPE = re.compile(r"\\(.)|''", re.S)
+
+def unescape_string(token: str, backslash_escapes: bool) -> str:
+    '''
+    unescape_string is a function that turns a quoted SQL string into its value. eg) 'it''s' -> it's, 'a\\nb' -> a<newline>b (MySQL).
+    A prefix (E'...' escaped, N'...' national) is dropped, E'...' always uses backslash escapes.
+    '''
+    if token[0] != "'":
+        backslash_escapes = backslash_escapes or token[0] in "Ee"
+        token = token[1:]
+    inner = token[1:-1]
+    if "\\" not in inner and "''" not in inner:
+        return inner
+    if not backslash_escapes:
+        return inner.replace("''", "'")
+
+    def replace(match: re.Match) -> str:
+        char = match.group(1)
+        if char is None:
+            return "'"
+        return MYSQL_ESCAPES.get(char, char)
+
+    return UNESCAPE.sub(replace, inner)
+
+def parse_values(values: str, backslash_escapes: bool) -> list[list[Any]]:
+    '''
+    parse_values is a function that parses the (...), (...) list of an INSERT into rows of Python values.
+    Anything after the list (eg) ON DUPLICATE KEY UPDATE) is ignored.
+
+    Raises:
+        ValueError - If a value is an expression (eg) a function call) instead of a literal.
+    '''
+    token_re = VALUE_TOKEN_BACKSLASH if backslash_escapes else VALUE_TOKEN_STANDARD
+    rows: list[list[Any]] = []
+    row: Optional[list[Any]] = None
+
+    # findall gives one tuple of groups per token (only the matched one is not empty), without a Match object per value.
+    for string, hex_value, number, open_, close, comma, other in token_re.findall(values):
+        if comma:
+            continue
+        elif row is not None and number:
+            row.append(int(number) if number.lstrip("+-").isdigit() else float(number))
+        elif row is not None and string:
+            row.append(unescape_string(string, backslash_escapes))
+        elif open_:
+            if row is not None:
+                raise ValueError(f"Unsupported expression in INSERT values near: {row[-1:]}")
+            row = []
+        elif close:
+            if row is None:
+                break
+            rows.append(row)
+            row = None
+        elif row is None:
+            # Past the last row (eg) ON DUPLICATE KEY UPDATE ...).
+            if rows:
+                break
+            raise ValueError(f"Unexpected token in INSERT values: {(string or hex_value or number or other)[:80]}")
+        elif hex_value:
+            row.append(bytes.fromhex(hex_value[2:] if hex_value[0] == "0" else hex_value[2:-1]))
+        else:
+            upper = other.upper()
+            if upper == "NULL":
+                row.append(None)
+            elif upper in ("TRUE", "FALSE"):
+                row.append(1 if upper == "TRUE" else 0)
+            elif other.startswith("::") or upper.startswith("_"):
+                # A PostgreSQL cast ('2024-01-01'::date) or a MySQL charset introducer (_binary '...'), the value is the string.
+                continue
+            else:
+                raise ValueError(f"Unsupported expression in INSERT values: {other[:80]}")
+
+    return rows
+
+def parse_copy_line(line: str) -> list[Optional[str]]:
+    '''
+    parse_copy_line is a function that parses one data line of pg_dump's COPY text format (tab-separated, \\N is NULL).
+    '''
+    values: list[Optional[str]] = []
+    for field in line.split("\t"):
+        if field == "\\N":
+            values.append(None)
+        elif "\\" in field:
+            values.append(re.sub(r"\\(.)", lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), field))
+        else:
+            values.append(field)
+    return values
+
+class SqlDumpReader:
+    '''
+    SqlDumpReader is a class that reads a SQL dump in chunks and yields it as events:
+        ("statement", text) - a complete statement without its ; and leading comments.
+        ("copy_row", line) - a data line of a COPY ... FROM stdin block (after the COPY statement itself).
+
+    Strings use MySQL's backslash escapes until the dump sets standard_conforming_strings = on (pg_dump does).
+    '''
+    def __init__(self, source: BinaryIO, chunk_bytes: int = UPLOAD_CHUNK_BYTES, on_progress: Optional[Callable[[int], None]] = None):
+        self.source = source
+        self.chunk_bytes = chunk_bytes
+        self.on_progress = on_progress
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.bytes_read = 0
+        self.backslash_escapes = True
+        self.buffer = ""
+        self.eof = False
+
+    def read_more(self) -> bool:
+        '''
+        read_more is a function that appends the next chunk to the buffer, False at the end of the dump.
+        '''
+        if self.eof:
+            return False
+        chunk = self.source.read(self.chunk_bytes)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.decoder.decode(b"", final=True)
+            return False
+        self.bytes_read += len(chunk)
+        self.buffer += self.decoder.decode(chunk)
+        if self.on_progress:
+            self.on_progress(self.bytes_read)
+        return True
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        start = 0 # start of the current statement in the buffer.
+        scan = 0 # where the search for the next token resumes.
+
+        while True:
+            token_re = SPLIT_TOKEN_BACKSLASH if self.backslash_escapes else SPLIT_TOKEN_STANDARD
+            match = token_re.search(self.buffer, scan)
+
+            # A token that reaches the end of the buffer may continue in the next chunk.
+            if match is None or (match.group() != ";" and match.end() == len(self.buffer) and not self.eof):
+                if match is not None:
+                    scan = match.start()
+                else:
+                    # Nothing to resume in the scanned text, except a - or / that starts a comment in the next chunk.
+                    scan = max(start, len(self.buffer) - 1)
+                # Drop what was consumed, so the buffer only holds the current statement.
+                self.buffer = self.buffer[start:]
+                scan -= start
+                start = 0
+                if self.read_more():
+                    continue
+                if match is None or self.eof:
+                    statement = LEADING_COMMENTS.sub("", self.buffer).strip()
+                    if statement:
+                        yield "statement", statement
+                    return
+                continue
+
+            if match.group() != ";":
+                scan = match.end()
+                continue
+
+            statement = LEADING_COMMENTS.sub("", self.buffer[start:match.start()]).strip()
+            start = scan = match.end()
+            if not statement:
+                continue
+
+            standard = STANDARD_STRINGS.match(statement)
+            if standard:
+                self.backslash_escapes = standard.group("value").lower() == "off"
+
+            yield "statement", statement
+
+            if COPY_FROM_STDIN.match(statement):
+                start = scan = yield from self.copy_rows(start)
+
+    def copy_rows(self, start: int) -> Iterator[tuple[str, str]]:
+        '''
+        copy_rows is a function that yields the data lines that follow a COPY ... FROM stdin statement, up to the \\. line.
+        Returns the position after the block.
+        '''
+        # The data starts on the line after the statement.
+        while True:
+            newline = self.buffer.find("\n", start)
+            if newline != -1:
+                start = newline + 1
+                break
+            if not self.read_more():
+                return len(self.buffer)
+
+        while True:
+            newline = self.buffer.find("\n", start)
+            if newline == -1:
+                self.buffer = self.buffer[start:]
+                start = 0
+                if self.read_more():
+                    continue
+                newline = len(self.buffer)
+
+            line = self.buffer[start:newline].rstrip("\r")
+            start = min(newline + 1, len(self.buffer))
+            if line == "\\.":
+                return start
+            if newline == len(self.buffer) and not line:
+                return start
+            yield "copy_row", line
+
+class SqliteBatchWriter:
+    '''
+    SqliteBatchWriter is a class that buffers rows per (table, columns) and writes them with executemany,
+    committing every SQL_DUMP_COMMIT_ROWS rows.
+    '''
+    def __init__(self, conn: sqlite3.Connection, batch_rows: int = SQL_DUMP_BATCH_ROWS, commit_rows: int = SQL_DUMP_COMMIT_ROWS):
+        self.conn = conn
+        self.batch_rows = batch_rows
+        self.commit_rows = commit_rows
+        self.batches: dict[tuple[str, tuple[str, ...]], list[list[Any]]] = {}
+        self.tables: set[str] = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.rows = 0
+        self.uncommitted = 0
+
+    def create_table(self, table: str, sql: str):
+        self.conn.execute(sql)
+        self.tables.add(table)
+
+    def add(self, table: str, columns: tuple[str, ...], rows: list[list[Any]]):
+        if table not in self.tables:
+            if not columns:
+                raise ValueError(f"Rows for table {table} come before its CREATE TABLE.")
+            # Data without a CREATE TABLE (eg) a data-only dump), the columns are untyped.
+            self.create_table(table, f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({', '.join(quote_identifier(c) for c in columns)})")
+
+        batch = self.batches.setdefault((table, columns), [])
+        batch.extend(rows)
+        if len(batch) >= self.batch_rows:
+            self.flush(table, columns)
+
+    def flush(self, table: str, columns: tuple[str, ...]):
+        batch = self.batches.pop((table, columns), None)
+        if not batch:
+            return
+
+        width = len(columns) if columns else len(batch[0])
+        target = f"{quote_identifier(table)} ({', '.join(quote_identifier(c) for c in columns)})" if columns else quote_identifier(table)
+        try:
+            self.conn.executemany(f"INSERT INTO {target} VALUES ({', '.join('?' * width)})", batch)
+        except sqlite3.Error as e:
+            raise ValueError(f"Error inserting into {table}: {e}")
+
+        self.rows += len(batch)
+        self.uncommitted += len(batch)
+        if self.uncommitted >= self.commit_rows:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        for table, columns in list(self.batches):
+            self.flush(table, columns)
+        self.conn.commit()
+
+def sql_dump_to_sqlite(dataset_dir: Path, raw_path: Path, on_progress: Optional[Callable[[int], None]] = None) -> tuple[Path, IngestStats]:
+    '''
+    sql_dump_to_sqlite is a function that loads a saved SQL dump into a new SQLite database next to it.
+
+    Args:
+        dataset_dir: Path - The dataset directory, the database is written to dataset_dir/<dump name>.db.
+        raw_path: Path - The saved dump.
+        on_progress: Callable[[int], None] - Called with the number of bytes read so far.
+
+    Returns:
+        Path - The path to the SQLite database.
+        IngestStats - rows/sec and bytes/sec of the load.
+
+    Raises:
+        ValueError - If the dump has no tables, or a statement with data could not be loaded.
+    '''
+    started = time.perf_counter()
+    sqlite_path = dataset_dir / f"{raw_path.stem}.db"
+    sqlite_path.unlink(missing_ok=True)
+
+    conn = sqlite3.connect(str(sqlite_path))
+    # The database is new and only kept if the whole dump loads, so it does not need a journal.
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    writer = SqliteBatchWriter(conn)
+    skipped = 0
+
+    try:
+        with open(raw_path, "rb") as source:
+            reader = SqlDumpReader(source, on_progress=on_progress)
+            copy_target: Optional[tuple[str, tuple[str, ...]]] = None
+
+            for kind, text in reader:
+                if kind == "copy_row":
+                    if copy_target is not None:
+                        writer.add(copy_target[0], copy_target[1], [parse_copy_line(text)])
+                    continue
+
+                copy_target = None
+                insert = INSERT.match(text)
+                if insert:
+                    columns = tuple(column_list(insert.group("columns"))) if insert.group("columns") else ()
+                    writer.add(unquote_identifier(insert.group("table")), columns, parse_values(text[insert.end():], reader.backslash_escapes))
+                    continue
+
+                copy = COPY_FROM_STDIN.match(text)
+                if copy:
+                    columns = tuple(column_list(copy.group("columns"))) if copy.group("columns") else ()
+                    copy_target = (unquote_identifier(copy.group("table")), columns)
+                    continue
+
+                created = translate_create_table(text)
+                if created:
+                    writer.create_table(*created)
+                    continue
+
+                skipped += 1
+
+        writer.close()
+        if not writer.tables:
+            raise ValueError(f"No tables found in {raw_path.name}.")
+
+    except (ValueError, sqlite3.Error) as e:
+        conn.close()
+        sqlite_path.unlink(missing_ok=True)
+        raise ValueError(f"Error loading SQL dump {raw_path.name}: {e}")
+
+    conn.close()
+    logging.info("Loaded %s: %d rows into %d tables, %d statements skipped", raw_path.name, writer.rows, len(writer.tables), skipped)
+    return sqlite_path, build_ingest_stats("stream", writer.rows, raw_path.stat().st_size, started)
+
+if __name__ == "__main__":
+    pass
+
+# python3 -m db_helpers.db_sql_dump
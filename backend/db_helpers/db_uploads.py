@@ -0,0 +1,176 @@
+import hashlib
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from .db_constants import (
+    UPLOAD_ROOT,
+    UPLOAD_SESSION_MAX_CHUNK_BYTES,
+    UPLOAD_SESSION_TTL_SECONDS,
+    UploadSession,
+    UploadSessionRequest,
+    UploadType
+)
+from .db_metadata import (
+    create_upload_session,
+    get_upload_session,
+    save_upload_chunk,
+    list_expired_upload_sessions,
+    delete_upload_session
+)
+
+'''
+db_uploads.py is a module that contains the file side of the resumable uploads (/db/uploads).
+
+A session preallocates its file under UPLOAD_ROOT/upload_id, every chunk is written straight at its offset
+(so chunks can arrive in any order, or in parallel) and its sha256 is recorded in the metadata database.
+Once every chunk is there, complete_upload_file moves the file into the dataset directory and the upload
+goes through the same ingest as /db/upload_db. Sessions idle for UPLOAD_SESSION_TTL_SECONDS are garbage collected.
+'''
+
+def upload_session_dir(upload_id: str) -> Path:
+    '''
+    upload_session_dir is a function that returns the directory holding the file of an upload session.
+    '''
+    return UPLOAD_ROOT / upload_id
+
+def upload_session_file(session: UploadSession) -> Path:
+    '''
+    upload_session_file is a function that returns the path of the (partial) file of an upload session.
+    '''
+    return upload_session_dir(session.upload_id) / session.filename
+
+def start_upload_session(request: UploadSessionRequest, upload_type: UploadType) -> UploadSession:
+    '''
+    start_upload_session is a function that creates a resumable upload session and preallocates its file.
+    Args:
+        request: UploadSessionRequest - The file name, its size and the chunk size the client will send.
+        upload_type: UploadType - The type detected from the file name.
+    Returns:
+        UploadSession - The new open session.
+    Raises:
+        ValueError - If the sizes are not valid.
+    '''
+    if request.total_bytes <= 0:
+        raise ValueError("total_bytes must be positive.")
+    if not 0 < request.chunk_bytes <= UPLOAD_SESSION_MAX_CHUNK_BYTES:
+        raise ValueError(f"chunk_bytes must be between 1 and {UPLOAD_SESSION_MAX_CHUNK_BYTES}.")
+
+    now = time.time()
+    session = UploadSession(
+        upload_id=str(uuid.uuid4()),
+        # Only the name, the file stays inside its session directory.
+        filename=Path(request.filename).name,
+        upload_type=upload_type,
+        total_bytes=request.total_bytes,
+        chunk_bytes=request.chunk_bytes,
+        chunk_count=-(-request.total_bytes // request.chunk_bytes),
+        status="open",
+        created_at=now,
+        updated_at=now
+    )
+
+    file_path = upload_session_file(session)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Sized up front (sparse on most file systems), each chunk then only has to seek to its offset.
+    with open(file_path, "wb") as f:
+        f.truncate(session.total_bytes)
+
+    create_upload_session(session)
+    return session
+
+def chunk_range(session: UploadSession, chunk_index: int) -> tuple[int, int]:
+    '''
+    chunk_range is a function that returns the byte range [start, end) of a chunk of an upload session.
+    eg) total_bytes=250, chunk_bytes=100 -> chunk 0 is (0, 100), chunk 2 is (200, 250)
+    Raises:
+        ValueError - If the index is outside of the file.
+    '''
+    if not 0 <= chunk_index < session.chunk_count:
+        raise ValueError(f"Chunk index {chunk_index} is out of range, the upload has {session.chunk_count} chunks.")
+    start = chunk_index * session.chunk_bytes
+    return start, min(start + session.chunk_bytes, session.total_bytes)
+
+def write_upload_chunk(session: UploadSession, chunk_index: int, data: bytes, expected_sha256: Optional[str] = None) -> bool:
+    '''
+    write_upload_chunk is a function that writes one chunk at its offset in the file of an upload session and records its checksum.
+    Sending a chunk again overwrites it, so a client can retry any chunk that failed.
+    Args:
+        session: UploadSession - The open session.
+        chunk_index: int - The index of the chunk.
+        data: bytes - The content of the chunk, exactly the size of its range.
+        expected_sha256: str - The hex sha256 the client computed, the chunk is rejected if it does not match.
+    Returns:
+        bool - False if the session was closed in the meantime (the chunk is then not recorded).
+    Raises:
+        ValueError - If the index, the size or the checksum is wrong.
+    '''
+    start, end = chunk_range(session, chunk_index)
+    if len(data) != end - start:
+        raise ValueError(f"Chunk {chunk_index} must be {end - start} bytes, got {len(data)}.")
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    if expected_sha256 is not None and expected_sha256.lower() != sha256:
+        raise ValueError(f"Checksum mismatch for chunk {chunk_index}: expected {expected_sha256}, got {sha256}.")
+
+    # r+b does not truncate, each chunk only touches its own range so parallel writers do not overlap.
+    with open(upload_session_file(session), "r+b") as f:
+        f.seek(start)
+        f.write(data)
+
+    return save_upload_chunk(session.upload_id, chunk_index, sha256)
+
+def missing_chunks(session: UploadSession) -> list[int]:
+    '''
+    missing_chunks is a function that returns the indexes of the chunks an upload session has not received yet.
+    '''
+    received = set(session.received_chunks)
+    return [index for index in range(session.chunk_count) if index not in received]
+
+def complete_upload_file(session: UploadSession, dataset_dir: Path) -> tuple[Path, int, str]:
+    '''
+    complete_upload_file is a function that moves the assembled file of an upload session into a dataset directory.
+    Args:
+        session: UploadSession - The session, with every chunk received.
+        dataset_dir: Path - The dataset directory (Must Exist).
+    Returns:
+        Path - The path of the raw file in the dataset directory.
+        int - Its size.
+        str - The hex sha256 of the whole file, which keys the deduplication of the upload (see upload_artifact_key).
+    '''
+    file_path = upload_session_file(session)
+
+    # One sequential pass, the chunk checksums can not be combined into the checksum of the whole file.
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+
+    raw_path = dataset_dir / session.filename
+    shutil.move(file_path, raw_path)
+    return raw_path, session.total_bytes, digest.hexdigest()
+
+def restore_upload_file(session: UploadSession, raw_path: Path):
+    '''
+    restore_upload_file is a function that moves the file back into its session directory when the ingest of a completed upload failed,
+    so that the client can complete it again (eg) with other options) instead of sending every chunk again.
+    '''
+    if raw_path.exists():
+        upload_session_dir(session.upload_id).mkdir(parents=True, exist_ok=True)
+        shutil.move(raw_path, upload_session_file(session))
+
+def gc_upload_sessions(idle_seconds: float = UPLOAD_SESSION_TTL_SECONDS) -> int:
+    '''
+    gc_upload_sessions is a function that deletes the upload sessions with no activity for idle_seconds, and their partial files.
+    Called when the server starts and when a new session is started.
+    Returns:
+        int - The number of sessions deleted.
+    '''
+    expired = list_expired_upload_sessions(idle_seconds)
+    for upload_id in expired:
+        delete_upload_session(upload_id)
+        shutil.rmtree(upload_session_dir(upload_id), ignore_errors=True)
+    return len(expired)
+
+# python3 -m db_helpers.db_uploads
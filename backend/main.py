@@ -1,9 +1,31 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from db_helpers import db_routes
+from db_helpers.db_metadata import migrate_metadata_db, close_metadata_stores
+from db_helpers.db_jobs import clean_interrupted_jobs, shutdown_ingest_executor
+from db_helpers.db_uploads import gc_upload_sessions
+from db_helpers.db_engine import close_duckdb_engine
+from db_helpers import db_metrics
+from db_helpers.db_constants import METRICS_ENABLED
 from ai_helpers import ai_routes
+from ai_helpers.llm_client import close_llm_client
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One-time schema migration, the request handlers never run CREATE TABLE.
+    migrate_metadata_db()
+    # Jobs that were running when the server last stopped lost their worker processes, and their uploads will never be converted.
+    clean_interrupted_jobs()
+    # Resumable uploads that were abandoned (no chunk for UPLOAD_SESSION_TTL_SECONDS) and their partial files.
+    gc_upload_sessions()
+    yield
+    shutdown_ingest_executor()
+    close_duckdb_engine()
+    close_metadata_stores()
+    await close_llm_client()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -11,11 +33,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the frontend read the stage timings of its requests.
+    expose_headers=["Server-Timing"],
 )
 
+# Times every request (and its stages) for /metrics, not installed at all when the metrics are off.
+if METRICS_ENABLED:
+    app.add_middleware(db_metrics.MetricsMiddleware)
+
 app.include_router(db_routes.router)
 app.include_router(ai_routes.router)
+app.include_router(db_metrics.router)
 
 
 
-# uvicorn main:app --reload
\ No newline at end of file
+# uvicorn main:app --reload
@@ -0,0 +1,473 @@
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from typing import Optional
+import httpx
+import openai
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+# Important as the db_metadata uses .db_constants at import time.
+# we are effectively changing db_helpers.db_metadata.METADATA_DB = db_path (temporary path)
+from db_helpers import db_metadata as meta
+from db_helpers.db_constants import ColumnProfile, Dataset, DatasetProfile, TableProfile
+from db_helpers.db_services import get_sqlite_table_names, get_sqlite_schema
+from db_helpers import db_aggregates
+from db_helpers import db_metrics
+from db_helpers.db_constants import Aggregate, AggregationRequest
+from ai_helpers.insight_agent import InsightAgent
+from ai_helpers import insight_agent
+from ai_helpers.aggregation_agent import AggregationAgent
+from ai_helpers import insight_cache
+from ai_helpers import ai_routes, llm_client
+from ai_helpers.llm_client import LLMClient, TokenBucket
+from ai_helpers.prompt_format import build_prompt_sections, count_tokens, format_rows_tsv
+
+@pytest.fixture
+def temp_metadata_db(tmp_path, monkeypatch):
+    db_path = tmp_path / "metadata.db"
+    monkeypatch.setattr(meta, "METADATA_DB", db_path)
+    conn = meta.connect_metadata_db()
+    conn.close()
+    yield db_path
+
+@pytest.fixture
+def saved_dataset(temp_metadata_db, tmp_path) -> Dataset:
+    '''
+    saved_dataset is a small SQLite dataset saved in the temporary metadata database.
+    '''
+    path = tmp_path / "shop.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, city TEXT)")
+    conn.executemany("INSERT INTO customers (name, city) VALUES (?, ?)", [(f"customer_{i}", ["austin", "boston"][i % 2]) for i in range(50)])
+    conn.commit()
+    conn.close()
+
+    dataset = Dataset(
+        dataset_id=str(uuid.uuid4()),
+        upload_type="db",
+        raw_byte_size=path.stat().st_size,
+        dataset_path=str(path),
+        tables=get_sqlite_table_names(path),
+        schema=get_sqlite_schema(path),
+    )
+    meta.save_metadata(dataset)
+    return dataset
+
+@pytest.fixture
+def llm_calls(monkeypatch) -> list[str]:
+    '''
+    llm_calls replaces the LLM round trip of the InsightAgent, and records the system prompts it was sent.
+    '''
+    calls: list[str] = []
+
+    async def fake_run_agent(agent: InsightAgent) -> str:
+        calls.append(agent.system_prompt)
+        return f"insight #{len(calls)}"
+
+    monkeypatch.setattr(InsightAgent, "run_agent", fake_run_agent)
+    return calls
+
+def test_insight_cache(saved_dataset, llm_calls):
+    '''
+    test_insight_cache checks that a repeated insight is served from the cache, that the key covers the sampling parameters
+    and the dataset content, and that invalidating drops the cached insights.
+    '''
+    stats = insight_cache.get_insight_cache_stats()
+
+    first = asyncio.run(InsightAgent(saved_dataset.dataset_id).run_full_agent("customers"))
+    agent = InsightAgent(saved_dataset.dataset_id)
+    assert asyncio.run(agent.run_full_agent("customers")) == first
+    assert agent.cache_hit
+    assert len(llm_calls) == 1
+    assert "customer_" in llm_calls[0]
+
+    # Another seed samples other rows, so it is another insight.
+    asyncio.run(InsightAgent(saved_dataset.dataset_id).run_full_agent("customers", seed=1))
+    assert len(llm_calls) == 2
+
+    # A changed file changes the fingerprint.
+    conn = sqlite3.connect(saved_dataset.dataset_path)
+    conn.execute("INSERT INTO customers (name, city) VALUES ('late', 'chicago')")
+    conn.commit()
+    conn.close()
+    assert asyncio.run(InsightAgent(saved_dataset.dataset_id).run_full_agent("customers")) == "insight #3"
+
+    after = insight_cache.get_insight_cache_stats()
+    assert after.hits - stats.hits == 1
+    assert after.misses - stats.misses == 3
+    assert after.entries == 3
+
+    assert insight_cache.invalidate_insights(saved_dataset.dataset_id, "customers") == 3
+    asyncio.run(InsightAgent(saved_dataset.dataset_id).run_full_agent("customers"))
+    assert len(llm_calls) == 4
+
+def stub_usage(body: dict) -> dict:
+    # One token per word, the reply echoes the last message.
+    prompt_tokens = sum(len(message["content"].split(" ")) for message in body["messages"])
+    completion_tokens = len(body["messages"][-1]["content"].split(" "))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+def make_stub_llm(latency: float = 0.0, fail_first: int = 0, fail_status: int = 429, reply: Optional[str] = None) -> tuple[FastAPI, dict]:
+    '''
+    make_stub_llm returns a stub of the chat completions API (and its counters) that answers after latency seconds
+    and fails the first fail_first requests with fail_status. The reply is the last message, unless reply is given.
+    '''
+    app = FastAPI()
+    state = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state["requests"] += 1
+        if state["requests"] <= fail_first:
+            return JSONResponse({"error": {"message": "slow down", "type": "rate_limit"}}, status_code=fail_status, headers={"retry-after": "0"})
+
+        if body.get("stream"):
+            async def chunks():
+                # One word per chunk, an empty reply sends no content at all.
+                text = body["messages"][-1]["content"] if reply is None else reply
+                for word in text.split(" ") if text else []:
+                    await asyncio.sleep(latency)
+                    delta = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                             "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                    yield f"data: {json.dumps(delta)}\n\n"
+                if body.get("stream_options", {}).get("include_usage"):
+                    # The usage comes last, in a chunk with no choices.
+                    usage = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"], "choices": [], "usage": stub_usage(body)}
+                    yield f"data: {json.dumps(usage)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(latency)
+        state["in_flight"] -= 1
+        return {
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": body["messages"][-1]["content"]}}],
+            "usage": stub_usage(body),
+        }
+
+    @app.get("/v1/models")
+    async def models():
+        state["warm_ups"] = state.get("warm_ups", 0) + 1
+        return {"object": "list", "data": []}
+
+    return app, state
+
+def stub_client(app: FastAPI, **kwargs) -> LLMClient:
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app))
+    client = AsyncOpenAI(api_key="test", base_url="http://stub/v1", http_client=http_client, max_retries=0)
+    return LLMClient(client, **kwargs)
+
+def test_llm_client_limits_concurrency():
+    '''
+    test_llm_client_limits_concurrency checks that no more than max_concurrency completions are in flight at once.
+    '''
+    app, state = make_stub_llm(latency=0.05)
+
+    async def run():
+        client = stub_client(app, max_concurrency=3, requests_per_second=1000, burst=1000)
+        replies = await asyncio.gather(*(client.chat([{"role": "user", "content": f"q{i}"}], model="stub") for i in range(12)))
+        await client.close()
+        return replies
+
+    assert asyncio.run(run()) == [f"q{i}" for i in range(12)]
+    assert state["max_in_flight"] == 3
+
+def test_llm_client_retries_rate_limits():
+    '''
+    test_llm_client_retries_rate_limits checks that 429/5xx are retried, and raised once the retries run out.
+    '''
+    async def ask(app: FastAPI, max_retries: int) -> str:
+        client = stub_client(app, max_retries=max_retries, backoff_base=0.01)
+        try:
+            return await client.chat([{"role": "user", "content": "hi"}], model="stub")
+        finally:
+            await client.close()
+
+    app, state = make_stub_llm(fail_first=2)
+    assert asyncio.run(ask(app, max_retries=2)) == "hi"
+    assert state["requests"] == 3
+
+    app, state = make_stub_llm(fail_first=5, fail_status=503)
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(ask(app, max_retries=1))
+    assert state["requests"] == 2
+
+    # Client errors (eg) a bad request) are not retried.
+    app, state = make_stub_llm(fail_first=5, fail_status=400)
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(ask(app, max_retries=3))
+    assert state["requests"] == 1
+
+class FailingStream:
+    '''
+    FailingStream is a streamed completion that yields the texts, then raises error (if any).
+    '''
+    def __init__(self, texts: list[str], error: Optional[Exception] = None):
+        self.texts = texts
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for text in self.texts:
+            yield openai.types.chat.ChatCompletionChunk(id="stub", object="chat.completion.chunk", created=0, model="stub",
+                                                        choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}])
+        if self.error is not None:
+            raise self.error
+
+def test_llm_stream_retries_before_first_token(monkeypatch):
+    '''
+    test_llm_stream_retries_before_first_token checks that a stream failing before its first token is retried,
+    and that one failing after it raises (its text is already with the caller).
+    '''
+    rate_limited = openai.RateLimitError("slow down", response=httpx.Response(429, request=httpx.Request("POST", "http://stub/v1")), body=None)
+    streams: list[FailingStream] = []
+
+    async def create(**kwargs) -> FailingStream:
+        return streams.pop(0)
+
+    async def read(client: LLMClient) -> list[str]:
+        return [text async for text in client.chat_stream([{"role": "user", "content": "hi"}], model="stub")]
+
+    client = stub_client(make_stub_llm()[0], backoff_base=0.01)
+    monkeypatch.setattr(client.client.chat.completions, "create", create)
+
+    streams += [FailingStream([], rate_limited), FailingStream([], httpx.ReadError("connection reset")), FailingStream(["hello", " world"])]
+    assert asyncio.run(read(client)) == ["hello", " world"]
+    assert streams == []
+
+    streams += [FailingStream(["hello"], rate_limited), FailingStream(["never read"])]
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(read(client))
+    assert len(streams) == 1
+
+def test_token_bucket_rate():
+    '''
+    test_token_bucket_rate checks that past the burst, acquires are spaced by 1 / rate.
+    '''
+    async def run() -> float:
+        bucket = TokenBucket(rate=50, capacity=2)
+        started = time.monotonic()
+        for _ in range(7):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 2 from the burst, then 5 at 50/s.
+    assert 0.08 <= asyncio.run(run()) < 0.5
+
+def test_stream_insight(saved_dataset, monkeypatch):
+    '''
+    test_stream_insight checks that the streamed insight arrives as token events, records the time to first token,
+    and fills the insight cache so the next request is a single cached event.
+    '''
+    app, state = make_stub_llm(latency=0.01)
+    monkeypatch.setattr(llm_client, "_llm_client", stub_client(app))
+    api = FastAPI()
+    api.include_router(ai_routes.router)
+    ttfb_count = llm_client.insight_ttfb.count
+
+    def stream_events() -> list[tuple[str, dict]]:
+        with TestClient(api) as client:
+            response = client.post(f"/ai/dataset/{saved_dataset.dataset_id}/insight/stream", params={"table_name": "customers"})
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = []
+        for block in response.text.strip().split("\n\n"):
+            event_line, data_line = block.split("\n")
+            events.append((event_line.removeprefix("event: "), json.loads(data_line.removeprefix("data: "))))
+        return events
+
+    events = stream_events()
+    tokens = [data["text"] for event, data in events if event == "token"]
+    # The stub echoes the user prompt word by word.
+    assert len(tokens) > 5
+    assert "".join(tokens).startswith("Write a short overview")
+    assert events[-1][0] == "done" and events[-1][1]["cached"] is False
+    assert state["warm_ups"] == 1
+    assert llm_client.insight_ttfb.count == ttfb_count + 1
+
+    events = stream_events()
+    assert [event for event, _ in events] == ["token", "done"]
+    assert events[0][1]["text"] == "".join(tokens)
+    assert events[1][1]["cached"] is True
+
+def test_stream_insight_empty(saved_dataset, monkeypatch):
+    '''
+    test_stream_insight_empty checks that a stream that produced no text is not cached.
+    '''
+    app, state = make_stub_llm(reply="")
+    monkeypatch.setattr(llm_client, "_llm_client", stub_client(app))
+    api = FastAPI()
+    api.include_router(ai_routes.router)
+
+    with TestClient(api) as client:
+        for _ in range(2):
+            response = client.post(f"/ai/dataset/{saved_dataset.dataset_id}/insight/stream", params={"table_name": "customers"})
+            assert "event: token" not in response.text
+    assert state["requests"] == 2
+
+def test_prompt_sections_fit_budget():
+    # 200 columns: every tenth is empty, the rest long text.
+    columns = [f"col_{c}" for c in range(200)]
+    rows = [{column: (None if c % 10 == 0 else "word " * 60) for c, column in enumerate(columns)} for _ in range(10)]
+    table_profile = TableProfile(table_name="wide", row_count=1000, columns=[
+        ColumnProfile(column_name=column, column_type="VARCHAR", null_count=1000 if c % 10 == 0 else 0, approx_distinct=0 if c % 10 == 0 else 40)
+        for c, column in enumerate(columns)
+    ])
+    dataset = Dataset(dataset_id="wide", upload_type="csv", raw_byte_size=0, dataset_path="wide.parquet", tables=["wide"],
+                      schema={"wide": {column: "VARCHAR" for column in columns}})
+
+    sections = build_prompt_sections(dataset, "wide", rows, table_profile, 1500)
+    assert count_tokens("\n".join(sections.values())) <= 1500
+
+    header, *lines = sections["sample_rows"].split("\n")
+    shown = header.split("\t")
+    # The empty columns are the first to be left out, and long cells are cut short.
+    assert 0 < len(shown) < len(columns)
+    assert not any(columns.index(column) % 10 == 0 for column in shown)
+    assert all(len(cell) <= 80 and cell.endswith("…") for cell in lines[0].split("\t"))
+    assert "more columns not shown" in sections["schema"]
+
+    # A generous budget keeps everything.
+    sections = build_prompt_sections(dataset, "wide", rows[:1], table_profile, 1_000_000)
+    assert len(sections["sample_rows"].split("\n")[0].split("\t")) == len(columns)
+
+    # Tabs and newlines in values can not break the layout.
+    assert format_rows_tsv([{"a": "x\ty", "b": "line\nbreak"}], ["a", "b"]) == "a\tb\nx\\ty\tline\\nbreak"
+
+def test_dataset_insight(temp_metadata_db, tmp_path, llm_calls):
+    '''
+    test_dataset_insight checks that an insight without table_name samples every table into one prompt, with the foreign keys.
+    '''
+    path = tmp_path / "store.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers(id), total REAL)")
+    conn.execute("CREATE TABLE refunds (id INTEGER PRIMARY KEY, order_id INTEGER REFERENCES orders, reason TEXT)")
+    conn.executemany("INSERT INTO customers (name) VALUES (?)", [(f"customer_{i}",) for i in range(20)])
+    conn.executemany("INSERT INTO orders (customer_id, total) VALUES (?, ?)", [(i % 20, i * 1.5) for i in range(100)])
+    conn.executemany("INSERT INTO refunds (order_id, reason) VALUES (?, ?)", [(i, "damaged") for i in range(5)])
+    conn.commit()
+    conn.close()
+
+    dataset = Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size, dataset_path=str(path),
+                      tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+    meta.save_metadata(dataset)
+
+    first = asyncio.run(InsightAgent(dataset.dataset_id).run_full_agent(None))
+    assert len(llm_calls) == 1
+    prompt = llm_calls[0]
+    assert "orders.customer_id -> customers.id" in prompt
+    assert "refunds.order_id -> orders.(primary key)" in prompt
+    for table in ("customers", "orders", "refunds"):
+        assert f"### {table}" in prompt
+    assert "customer_" in prompt and "damaged" in prompt
+
+    agent = InsightAgent(dataset.dataset_id)
+    assert asyncio.run(agent.run_full_agent(None)) == first
+    assert agent.cache_hit and len(llm_calls) == 1
+
+    # The dataset insight is cached apart from the table insights.
+    asyncio.run(InsightAgent(dataset.dataset_id).run_full_agent("orders"))
+    assert len(llm_calls) == 2
+
+def test_dataset_insight_many_tables(temp_metadata_db, tmp_path, llm_calls, monkeypatch):
+    '''
+    test_dataset_insight_many_tables checks that the dataset prompt stays under its budget when the tables do not all fit,
+    the largest tables get a section and the others are only named.
+    '''
+    monkeypatch.setattr(insight_agent, "PROMPT_DATASET_TOKEN_BUDGET", 2000)
+    path = tmp_path / "wide.db"
+    conn = sqlite3.connect(str(path))
+    for i in range(40):
+        conn.execute(f"CREATE TABLE t{i} (id INTEGER PRIMARY KEY, label TEXT, amount REAL)")
+        conn.executemany(f"INSERT INTO t{i} (label, amount) VALUES (?, ?)", [(f"label_{j}", j * 0.5) for j in range(i + 1)])
+    conn.commit()
+    conn.close()
+
+    dataset = Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size, dataset_path=str(path),
+                      tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+    meta.save_metadata(dataset)
+    meta.save_profile(DatasetProfile(dataset_id=dataset.dataset_id, seconds=0.0, created_at=time.time(),
+                                     tables={f"t{i}": TableProfile(table_name=f"t{i}", row_count=i + 1) for i in range(40)}))
+
+    asyncio.run(InsightAgent(dataset.dataset_id).run_full_agent(None))
+    prompt = llm_calls[0]
+    assert count_tokens(prompt) <= 2000
+    assert "### t39" in prompt and "### t0\n" not in prompt
+    assert "Not shown (too many tables for the prompt): t0, " in prompt
+
+def test_aggregation_agent(saved_dataset, tmp_path, monkeypatch):
+    '''
+    test_aggregation_agent checks that repeated aggregations are served from the materialized results (or rolled up from them),
+    and that a change to the source file invalidates them.
+    '''
+    monkeypatch.setattr(db_aggregates, "AGGREGATES_ROOT", tmp_path / "aggregates")
+    by_city = AggregationRequest(dimensions=["city"], aggregates=[Aggregate(function="count"), Aggregate(function="max", column="id")])
+    total = AggregationRequest(aggregates=[Aggregate(function="count")])
+    median = AggregationRequest(aggregates=[Aggregate(function="quantile", column="id", quantile=0.5)])
+
+    agent = AggregationAgent(saved_dataset.dataset_id)
+    first, = asyncio.run(agent.run_aggregations([by_city]))
+    assert first.cache == "miss"
+    assert first.rows == [{"city": "austin", "count": 25, "max_id": 49}, {"city": "boston", "count": 25, "max_id": 50}]
+    assert json.loads(agent.format_aggregations())[0]["rows"] == [["austin", 25, 49], ["boston", 25, 50]]
+
+    again, rolled_up, computed = asyncio.run(agent.run_aggregations([by_city, total, median]))
+    assert again.cache == "hit" and again.rows == first.rows
+    assert rolled_up.cache == "rollup" and rolled_up.rows == [{"count": 50}]
+    assert computed.cache == "miss" and computed.rows == [{"quantile_0.5_id": 25.5}]
+
+    with pytest.raises(ValueError):
+        agent.aggregate(AggregationRequest(dimensions=["country"], aggregates=[Aggregate(function="count")]))
+    with pytest.raises(ValueError):
+        agent.aggregate(AggregationRequest(aggregates=[Aggregate(function="sum")]))
+
+    conn = sqlite3.connect(saved_dataset.dataset_path)
+    conn.execute("INSERT INTO customers (name, city) VALUES ('customer_50', 'chicago')")
+    conn.commit()
+    conn.close()
+    changed = agent.aggregate(by_city)
+    assert changed.cache == "miss" and changed.rows[2] == {"city": "chicago", "count": 1, "max_id": 51}
+    # The results of the old file were dropped with their Parquet files.
+    assert len(list((tmp_path / "aggregates" / saved_dataset.dataset_id).glob("*.parquet"))) == 1
+    assert db_aggregates.invalidate_aggregates(saved_dataset.dataset_id) == 1
+
+def test_llm_metrics():
+    '''
+    test_llm_metrics checks that completions, streamed or not, are timed as stages and count the tokens of their usage.
+    '''
+    app, _ = make_stub_llm()
+
+    def tokens(kind: str) -> float:
+        return db_metrics.LLM_TOKENS.values.get(("stub-metrics", kind), 0)
+
+    def calls(stage: str) -> int:
+        counts = db_metrics.STAGE_SECONDS.series.get((stage,))
+        return sum(counts[:-1]) if counts else 0
+
+    async def run() -> str:
+        client = stub_client(app)
+        reply = await client.chat([{"role": "system", "content": "be brief"}, {"role": "user", "content": "one two three"}], model="stub-metrics")
+        streamed = [text async for text in client.chat_stream([{"role": "user", "content": "four five"}], model="stub-metrics")]
+        await client.close()
+        return reply + " | " + "".join(streamed)
+
+    llm_calls, stream_calls = calls("llm"), calls("llm_stream")
+    assert asyncio.run(run()) == "one two three | four five "
+    # 2 + 3 prompt words and 3 completion words, then 2 and 2.
+    assert tokens("prompt") == 7 and tokens("completion") == 5
+    assert calls("llm") == llm_calls + 1 and calls("llm_stream") == stream_calls + 1
+
+# python3 -m pytest -q tests/test_agent.py
@@ -1,16 +1,41 @@
 from pathlib import Path
+import hashlib
+import io
+import json
+import os
+import sqlite3
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
 import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
 # Important as the db_metadata uses .db_constants at import time. 
 # we are effectively changing db_helpers.db_metadata.METADATA_DB = db_path (temporary path)
 from db_helpers import db_metadata as meta
-from db_helpers.db_constants import Dataset
+from db_helpers import db_routes
+from db_helpers import db_uploads
+from db_helpers import db_append
+from db_helpers import db_metrics
+from db_helpers import db_jobs
+from db_helpers.db_constants import Dataset, QueryRequest, ParquetLayout
 from db_helpers.db_services import (
     detect_upload_type,
+    file_fingerprint,
     get_sample_rows,
     get_sqlite_table_names,
     get_sqlite_schema,
+    save_parquet_file,
 )
+from db_helpers.db_ingest import stream_csv_to_parquet, count_parquet_rows, save_json_parquet_file, build_csv_dataset
+from db_helpers.db_jobs import run_ingest_job, run_convert_job
+from db_helpers.db_sql_dump import SqlDumpReader, sql_dump_to_sqlite
+from db_helpers.db_engine import DuckDBEngine
+from db_helpers.db_query import QueryStream
+from db_helpers.db_profile import profile_dataset
+from db_helpers.db_sampling import sample_rows, get_sample_cache
 
 @pytest.fixture
 def temp_metadata_db(tmp_path, monkeypatch):
@@ -101,6 +126,978 @@ def test_get_sample_rows_sql():
 
     
 
+def test_ingest_job_failure_after_save(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_ingest_job_failure_after_save checks that a job failing after the dataset was saved deletes the dataset with its directory,
+    so no metadata is left pointing at removed files.
+    '''
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(db_jobs, "save_profile", fail)
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path)
+    dataset_dir = tmp_path / "dataset-late"
+    dataset_dir.mkdir()
+    raw_path = dataset_dir / "people.csv"
+    raw_path.write_text("name,age\nada,36\n")
+
+    meta.create_job("job-late", "dataset-late")
+    run_ingest_job("job-late", "dataset-late", str(dataset_dir), str(raw_path), "csv", raw_path.stat().st_size)
+
+    job = meta.get_job("job-late")
+    assert job.status == "failed" and job.error == "disk full"
+    with pytest.raises(ValueError):
+        meta.get_dataset_by_id("dataset-late")
+    assert not dataset_dir.exists()
+
+def test_clean_interrupted_jobs(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_clean_interrupted_jobs checks that the jobs a restart interrupted are failed, and that only the directories of the uploads
+    that were never saved are deleted (a conversion of a saved dataset keeps its files).
+    '''
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path)
+    for dataset_id in ("upload-lost", "dataset-saved"):
+        (tmp_path / dataset_id).mkdir()
+        (tmp_path / dataset_id / "raw.csv").write_text("a\n1\n")
+    meta.save_metadata(Dataset(dataset_id="dataset-saved", upload_type="csv", raw_byte_size=4, dataset_path=str(tmp_path / "dataset-saved" / "raw.csv"),
+                               tables=["raw"], schema={"raw": {"a": "BIGINT"}}))
+    meta.create_job("job-ingest", "upload-lost")
+    meta.create_job("job-convert", "dataset-saved")
+    meta.update_job("job-convert", status="running")
+
+    assert db_jobs.clean_interrupted_jobs() == 1
+    assert meta.get_job("job-ingest").status == "failed" and meta.get_job("job-convert").status == "failed"
+    assert not (tmp_path / "upload-lost").exists()
+    assert (tmp_path / "dataset-saved" / "raw.csv").exists()
+
+def test_stream_csv_to_parquet(tmp_path):
+    '''
+    test_stream_csv_to_parquet checks that a CSV streamed in small batches ends up as several row groups of one parquet file,
+    and that a quoted value with a newline in it is not split between batches.
+    '''
+    lines = ["id,name,score"] + [f'{i},"name {i}\nsecond line",{i * 0.5}' for i in range(500)]
+    csv_bytes = ("\n".join(lines) + "\n").encode()
+
+    parquet_path, raw_path, stats = stream_csv_to_parquet(tmp_path, io.BytesIO(csv_bytes), "scores.csv", keep_raw=False, batch_bytes=4096)
+
+    assert raw_path is None
+    assert not (tmp_path / "scores.csv").exists()
+    assert stats.mode == "stream"
+    assert stats.rows == 500
+    assert stats.raw_bytes == len(csv_bytes)
+    assert count_parquet_rows(parquet_path) == 500
+    assert pq.ParquetFile(str(parquet_path)).metadata.num_row_groups > 1
+
+    rows = duckdb.execute("SELECT name FROM read_parquet(?) WHERE id = 499", [str(parquet_path)]).fetchall()
+    assert rows == [("name 499\nsecond line",)]
+
+def test_stream_csv_delimiters(tmp_path):
+    '''
+    test_stream_csv_delimiters checks that a semicolon or tab separated CSV streams into the same columns as the two-pass conversion.
+    '''
+    for delimiter, name in ((";", "semicolon"), ("\t", "tab")):
+        lines = [delimiter.join(["id", "name", "score"])] + [delimiter.join([str(i), f"name {i}", str(i * 0.5)]) for i in range(300)]
+        csv_bytes = ("\n".join(lines) + "\n").encode()
+        dataset_dir = tmp_path / name
+        dataset_dir.mkdir()
+
+        parquet_path, _, stats = stream_csv_to_parquet(dataset_dir, io.BytesIO(csv_bytes), f"{name}.csv", keep_raw=False, batch_bytes=1024)
+        assert stats.mode == "stream"
+        table = pq.read_table(str(parquet_path))
+        assert table.column_names == ["id", "name", "score"]
+        assert table.num_rows == 300
+        assert table.column("name")[299].as_py() == "name 299"
+
+def test_stream_csv_widens_types(tmp_path):
+    '''
+    test_stream_csv_widens_types checks that a later batch that does not fit the types of the first one widens them
+    (int -> double, empty -> text, int -> text) and rewrites the rows already written, without a raw copy to fall back to.
+    '''
+    lines = ["id,amount,note,code"] + [f"{i},{i},,{i}" for i in range(300)] + ["300,1.5,late note,not-a-number"]
+    csv_bytes = ("\n".join(lines) + "\n").encode()
+
+    parquet_path, raw_path, stats = stream_csv_to_parquet(tmp_path, io.BytesIO(csv_bytes), "codes.csv", keep_raw=False, batch_bytes=1024)
+
+    assert raw_path is None
+    assert stats.mode == "stream" and stats.rows == 301
+    assert pq.ParquetFile(str(parquet_path)).metadata.num_row_groups > 1
+    table = pq.read_table(str(parquet_path))
+    assert [str(field.type) for field in table.schema] == ["int64", "double", "string", "string"]
+    assert table.column("amount").to_pylist()[:2] == [0.0, 1.0] and table.column("amount")[300].as_py() == 1.5
+    assert table.column("note")[0].as_py() is None and table.column("note")[300].as_py() == "late note"
+    assert table.column("code")[7].as_py() == "7" and table.column("code")[300].as_py() == "not-a-number"
+
+def test_stream_csv_falls_back_to_two_pass(tmp_path):
+    '''
+    A later record with more fields than the header can not be streamed,
+    with a raw copy the ingest falls back to the two-pass conversion instead of failing.
+    '''
+    lines = ["id,code"] + [f"{i},{i}" for i in range(300)] + ["300,1,extra"]
+    csv_bytes = ("\n".join(lines) + "\n").encode()
+
+    parquet_path, raw_path, stats = stream_csv_to_parquet(tmp_path, io.BytesIO(csv_bytes), "codes.csv", batch_bytes=1024)
+
+    assert stats.mode == "two_pass"
+    assert raw_path.read_bytes() == csv_bytes
+    # The same Parquet file as the two-pass conversion of the raw copy.
+    two_pass_dir = tmp_path / "two_pass"
+    two_pass_dir.mkdir()
+    assert pq.read_table(str(parquet_path)).equals(pq.read_table(str(save_parquet_file(two_pass_dir, raw_path))))
+
+    with pytest.raises(ValueError):
+        stream_csv_to_parquet(tmp_path, io.BytesIO(csv_bytes), "codes.csv", keep_raw=False, batch_bytes=1024)
+
+def test_run_ingest_job(temp_metadata_db, tmp_path):
+    '''
+    test_run_ingest_job runs a background ingest job in this process and checks the job state and the saved dataset.
+    '''
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    raw_path = dataset_dir / "people.csv"
+    raw_path.write_text("name,age\nada,36\ngrace,45\n")
+
+    meta.create_job("job-1", "dataset-1")
+    assert meta.get_job("job-1").status == "queued"
+
+    run_ingest_job("job-1", "dataset-1", str(dataset_dir), str(raw_path), "csv", raw_path.stat().st_size, stream=True, keep_raw=False)
+
+    job = meta.get_job("job-1")
+    assert job.status == "succeeded"
+    assert job.percent == 100
+    assert job.ingest_stats.rows == 2
+    assert not raw_path.exists()
+    assert meta.get_dataset_by_id("dataset-1").tables == ["people"]
+
+    # A job that fails records the error and removes the half-built dataset directory.
+    meta.create_job("job-2", "dataset-2")
+    run_ingest_job("job-2", "dataset-2", str(tmp_path / "missing"), str(tmp_path / "missing" / "x.db"), "db", 0)
+    job = meta.get_job("job-2")
+    assert job.status == "failed"
+    assert job.error
+
+def test_metadata_store_pool(temp_metadata_db):
+    '''
+    test_metadata_store_pool checks that the metadata database is migrated once (WAL, user_version) and that
+    pooled connections can be shared by concurrent lookups.
+    '''
+    conn = meta.connect_metadata_db()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(meta.MIGRATIONS)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+    dataset_ids = [str(uuid.uuid4()) for _ in range(20)]
+    for dataset_id in dataset_ids:
+        meta.save_metadata(Dataset(dataset_id=dataset_id, upload_type="csv", raw_byte_size=1,
+                                   dataset_path="/tmp/t.parquet", tables=["t"], schema={"t": {"a": "BIGINT"}}))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        loaded = list(pool.map(meta.get_dataset_by_id, dataset_ids * 5))
+
+    assert [dataset.dataset_id for dataset in loaded] == dataset_ids * 5
+    assert meta.get_metadata_store().pool.qsize() <= meta.get_metadata_store().pool_size
+
+def test_list_datasets_page(temp_metadata_db):
+    '''
+    test_list_datasets_page walks the listing with cursors and checks that saving a dataset invalidates the cached Datasets.
+    '''
+    for i in range(5):
+        meta.save_metadata(Dataset(dataset_id=f"dataset-{i}", upload_type="csv", raw_byte_size=i,
+                                   dataset_path=f"/tmp/{i}.parquet", tables=["t"], schema={"t": {"a": "BIGINT"}}))
+
+    first = meta.list_datasets_page(limit=2, summary=True)
+    assert [item.dataset_id for item in first.items] == ["dataset-0", "dataset-1"]
+    assert "schema" not in first.items[0].model_dump()
+
+    second = meta.list_datasets_page(limit=2, cursor=first.next_cursor)
+    last = meta.list_datasets_page(limit=2, cursor=second.next_cursor)
+    assert [item.dataset_id for item in second.items + last.items] == ["dataset-2", "dataset-3", "dataset-4"]
+    assert last.next_cursor is None
+
+    # The second call is served from the cache, a save drops the cache and moves the revision.
+    revision = meta.get_metadata_revision()
+    assert meta.get_dataset_by_id("dataset-3") is meta.get_dataset_by_id("dataset-3")
+    meta.save_metadata(Dataset(dataset_id="dataset-5", upload_type="csv", raw_byte_size=5,
+                               dataset_path="/tmp/5.parquet", tables=["t"], schema={"t": {"a": "BIGINT"}}))
+    assert meta.get_metadata_revision() == revision + 1
+    assert meta.get_metadata_store().cache.get("dataset-3") is None
+    assert len(meta.list_datasets()) == 6
+
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    with TestClient(api) as client:
+        assert client.get("/db/datasets", params={"limit": 0}).status_code == 400
+        assert client.get("/db/datasets", params={"limit": -1}).status_code == 400
+        assert len(client.get("/db/datasets", params={"limit": 2}).json()["items"]) == 2
+
+        etag = client.get("/db/datasets/dataset-3").headers["etag"]
+        assert client.get("/db/datasets/dataset-3", headers={"If-None-Match": etag}).status_code == 304
+        # The ETag is the metadata revision, a missing dataset must not get a 304 with it.
+        assert client.get("/db/datasets/missing", headers={"If-None-Match": etag}).status_code == 404
+
+def make_sqlite_dataset(path: Path, tables: dict[str, int]) -> Dataset:
+    '''
+    make_sqlite_dataset writes a small SQLite database ({table_name: row_count}) and returns its Dataset, without going through the upload route.
+    '''
+    conn = sqlite3.connect(str(path))
+    for table, row_count in tables.items():
+        conn.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, name TEXT, amount REAL)")
+        conn.executemany(f"INSERT INTO {table} (name, amount) VALUES (?, ?)", [(f"{table}_{i}", i * 1.5) for i in range(row_count)])
+    conn.commit()
+    conn.close()
+
+    return Dataset(
+        dataset_id=str(uuid.uuid4()),
+        upload_type="db",
+        raw_byte_size=path.stat().st_size,
+        dataset_path=str(path),
+        tables=get_sqlite_table_names(path),
+        schema=get_sqlite_schema(path),
+    )
+
+def test_duckdb_engine_keeps_recent_datasets_attached(tmp_path):
+    '''
+    test_duckdb_engine_keeps_recent_datasets_attached checks that repeated reads reuse the attachment,
+    and that the least recently used dataset is detached once more than max_attached are attached.
+    '''
+    engine = DuckDBEngine(memory_limit="256MB", threads=2, max_attached=2)
+    datasets = [make_sqlite_dataset(tmp_path / f"db_{i}.db", {"orders": 3}) for i in range(3)]
+
+    for _ in range(2):
+        with engine.dataset(datasets[0]) as session:
+            assert session.cursor.execute(f"SELECT count(*) FROM {session.table('orders')}").fetchone()[0] == 3
+    assert list(engine.attached) == [datasets[0].dataset_id]
+
+    for dataset in datasets[1:]:
+        with engine.dataset(dataset) as session:
+            session.cursor.execute(f"SELECT * FROM {session.table('orders')}").fetchall()
+
+    assert list(engine.attached) == [datasets[1].dataset_id, datasets[2].dataset_id]
+    attached_aliases = {row[0] for row in engine.conn.execute("SELECT database_name FROM duckdb_databases()").fetchall()}
+    assert "ds_" + datasets[0].dataset_id.replace("-", "_") not in attached_aliases
+
+    with pytest.raises(ValueError):
+        with engine.dataset(datasets[1]) as session:
+            session.table("missing_table")
+    engine.close()
+
+def test_query_stream(tmp_path):
+    '''
+    test_query_stream checks that /query only runs SELECTs over the dataset's tables, applies the row limit,
+    streams Arrow or NDJSON, and stops a query that runs past its timeout.
+    '''
+    dataset = make_sqlite_dataset(tmp_path / "shop.db", {"orders": 25_000, "customers": 10})
+
+    for sql in [
+        "DROP TABLE orders",
+        "SELECT 1; SELECT 2",
+        "SELECT * FROM read_csv('/etc/passwd')",
+        "SELECT * FROM missing_table",
+        "SELECT * FROM main.orders",
+    ]:
+        with pytest.raises(ValueError):
+            QueryStream(dataset, QueryRequest(sql=sql))
+
+    stream = QueryStream(dataset, QueryRequest(sql="SELECT id, name FROM orders ORDER BY id", max_rows=20_001))
+    table = ipc.open_stream(b"".join(stream)).read_all()
+    assert table.num_rows == 20_001
+    assert table.column_names == ["id", "name"]
+
+    # A trailing semicolon or comment is part of a valid statement.
+    for sql in ["SELECT id FROM orders ORDER BY id;", "SELECT id FROM orders ORDER BY id -- all rows"]:
+        table = ipc.open_stream(b"".join(QueryStream(dataset, QueryRequest(sql=sql, max_rows=5)))).read_all()
+        assert table.column("id").to_pylist() == [1, 2, 3, 4, 5]
+
+    sql = "WITH big AS (SELECT id FROM orders WHERE id <= 3) SELECT big.id, c.name FROM big JOIN customers c ON c.id = big.id ORDER BY big.id"
+    lines = b"".join(QueryStream(dataset, QueryRequest(sql=sql, format="ndjson"))).decode().splitlines()
+    assert lines == ['{"id": 1, "name": "customers_0"}', '{"id": 2, "name": "customers_1"}', '{"id": 3, "name": "customers_2"}']
+
+    with pytest.raises(TimeoutError):
+        QueryStream(dataset, QueryRequest(sql="SELECT a.id, count(*) FROM orders a, orders b GROUP BY a.id", timeout_seconds=0.2))
+
+    # A query that already streams rows is cut off midway, NDJSON ends with an error line.
+    stream = QueryStream(dataset, QueryRequest(sql="SELECT a.id, b.id FROM orders a, orders b", max_rows=10_000_000, format="ndjson", timeout_seconds=0.2))
+    lines = b"".join(stream).decode().splitlines()
+    assert len(lines) < 10_000_000
+    assert lines[-1] == '{"error": "Query timed out."}'
+
+def test_profile_dataset(temp_metadata_db, tmp_path):
+    '''
+    test_profile_dataset checks the column stats of a profile, that a table that can not be read only fails its own profile,
+    and that a saved profile is read back from the metadata database.
+    '''
+    dataset = make_sqlite_dataset(tmp_path / "shop.db", {"orders": 100})
+    conn = sqlite3.connect(dataset.dataset_path)
+    conn.execute("UPDATE orders SET name = NULL WHERE id <= 10")
+    conn.execute("CREATE TABLE broken (amount INTEGER)")
+    conn.execute("INSERT INTO broken VALUES (1), ('not a number')")
+    conn.commit()
+    conn.close()
+    dataset.tables.append("broken")
+
+    profile = profile_dataset(dataset)
+    orders = profile.tables["orders"]
+    assert orders.row_count == 100
+    columns = {column.column_name: column for column in orders.columns}
+
+    amount = columns["amount"]
+    assert (amount.min, amount.max, amount.mean) == (0.0, 148.5, 74.25)
+    assert sum(histogram_bin.count for histogram_bin in amount.histogram) == 100
+    assert amount.histogram[-1].upper == 148.5
+    assert 90 <= amount.approx_distinct <= 110
+
+    name = columns["name"]
+    assert name.null_count == 10
+    assert name.mean is None and name.histogram == []
+    assert len(name.top_values) == 10
+
+    assert profile.tables["broken"].error is not None
+
+    meta.save_profile(profile)
+    assert meta.get_profile(dataset.dataset_id) == profile
+    assert meta.get_profile("missing") is None
+
+def test_sample_rows_strategies(temp_metadata_db, tmp_path):
+    '''
+    test_sample_rows_strategies checks that the sampling strategies spread over the table (unlike head),
+    give the same rows for the same seed, cover every group when stratified and pick up outliers.
+    '''
+    path = tmp_path / "sorted.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE rides (id INTEGER, city TEXT, fare REAL)")
+    # Sorted by city, with one fare far from the others.
+    rides = [(i, ["austin", "boston", "chicago", "denver"][i // 5000], 10.0 + i % 7) for i in range(20_000)]
+    rides[12_345] = (12_345, "chicago", 5000.0)
+    conn.executemany("INSERT INTO rides VALUES (?, ?, ?)", rides)
+    # Small enough that the reservoir picks outliers too.
+    conn.execute("CREATE TABLE tolls (id INTEGER, fare REAL)")
+    conn.executemany("INSERT INTO tolls VALUES (?, ?)", [(i, float(i * i)) for i in range(6)])
+    conn.commit()
+    conn.close()
+    dataset = Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=path.stat().st_size,
+                      dataset_path=str(path), tables=get_sqlite_table_names(path), schema=get_sqlite_schema(path))
+    meta.save_profile(profile_dataset(dataset))
+    get_sample_cache().clear()
+
+    assert {row["city"] for row in sample_rows(dataset, "rides", 8, "head")} == {"austin"}
+
+    reservoir = sample_rows(dataset, "rides", 8, "reservoir", seed=7)
+    assert len(reservoir) == 8
+    assert len({row["city"] for row in reservoir}) > 1
+    get_sample_cache().clear()
+    assert sample_rows(dataset, "rides", 8, "reservoir", seed=7) == reservoir
+    assert sample_rows(dataset, "rides", 8, "reservoir", seed=8) != reservoir
+
+    stratified = sample_rows(dataset, "rides", 4, "stratified", seed=7)
+    assert sorted(row["city"] for row in stratified) == ["austin", "boston", "chicago", "denver"]
+
+    outlier = sample_rows(dataset, "rides", 4, "outlier", seed=7)
+    assert len(outlier) == 4
+    assert 5000.0 in [row["fare"] for row in outlier]
+    for seed in range(5):
+        assert sorted(row["id"] for row in sample_rows(dataset, "tolls", 6, "outlier", seed=seed)) == [0, 1, 2, 3, 4, 5]
+        assert len(sample_rows(dataset, "tolls", 5, "outlier", seed=seed)) == 5
+
+    assert len(sample_rows(dataset, "rides", 8, "system", seed=7)) == 8
+
+    # Cached: the same list object comes back.
+    assert sample_rows(dataset, "rides", 4, "outlier", seed=7) is outlier
+
+def test_background_stream_upload(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_background_stream_upload checks that a background CSV upload with stream=true is converted while the request is read
+    (no raw copy is saved and read back) and that the job registers the dataset with the streaming stats.
+    '''
+    monkeypatch.setattr(db_routes, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path / "datasets")
+
+    def no_raw_copy(*args, **kwargs):
+        raise AssertionError("the upload was saved to disk before the conversion")
+
+    def run_in_process(dataset_id, *args, **kwargs) -> str:
+        # The job runs here instead of in the process pool, with the arguments the pool would get.
+        meta.create_job("job-stream", dataset_id)
+        run_ingest_job("job-stream", dataset_id, *(str(arg) if isinstance(arg, Path) else arg for arg in args),
+                       **{key: str(value) if isinstance(value, Path) else value for key, value in kwargs.items()})
+        return "job-stream"
+
+    monkeypatch.setattr(db_routes, "save_raw_file", no_raw_copy)
+    monkeypatch.setattr(db_routes, "submit_ingest_job", run_in_process)
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    content = "name,age\nada,36\ngrace,45\n"
+
+    with TestClient(api) as client:
+        response = client.post("/db/upload_db", params={"stream": True, "keep_raw": False}, files={"file": ("people.csv", content)})
+    assert response.status_code == 202
+    job = meta.get_job(response.json()["job_id"])
+    assert job.status == "succeeded", job.error
+    assert job.ingest_stats.mode == "stream" and job.ingest_stats.rows == 2
+    dataset = meta.get_dataset_by_id(response.json()["dataset_id"])
+    assert dataset.schema == {"people": {"name": "VARCHAR", "age": "BIGINT"}}
+    assert not (Path(dataset.dataset_path).parent.parent / "people.csv").exists()
+
+def test_json_ingest(temp_metadata_db, tmp_path):
+    '''
+    test_json_ingest checks that JSON and JSONL uploads become Parquet with flattened structs, also when a record
+    only seen after the schema sample adds a key, and that a background job registers the dataset.
+    '''
+    records = [{"id": i, "address": {"city": "austin", "geo": {"lat": 30.2}}, "tags": ["a", "b"]} for i in range(50)]
+    records.append({"id": 50, "address": {"city": "boston", "geo": {"lat": 42.3}}, "tags": [], "late_key": "x"})
+    jsonl_path = tmp_path / "people.jsonl"
+    jsonl_path.write_text("\n".join(json.dumps(record) for record in records) + "\n")
+
+    parquet_path, stats = save_json_parquet_file(tmp_path, jsonl_path, "jsonl", sample_size=10)
+    table = pq.read_table(parquet_path)
+    assert table.column_names == ["id", "address.city", "address.geo.lat", "tags", "late_key"]
+    assert table.num_rows == stats.rows == 51
+    assert table.column("address.geo.lat")[50].as_py() == 42.3
+
+    # A top-level array of records.
+    json_path = tmp_path / "orders.json"
+    json_path.write_text(json.dumps([{"order": 1, "customer": {"name": "ada"}}, {"order": 2, "customer": {"name": "grace"}}]))
+    parquet_path, _ = save_json_parquet_file(tmp_path, json_path, "json")
+    assert pq.read_table(parquet_path).to_pylist() == [{"order": 1, "customer.name": "ada"}, {"order": 2, "customer.name": "grace"}]
+
+    broken_path = tmp_path / "broken.jsonl"
+    broken_path.write_text('{"id": 1}\n{oops\n')
+    with pytest.raises(ValueError):
+        save_json_parquet_file(tmp_path, broken_path, "jsonl")
+
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    raw_path = dataset_dir / "people.jsonl"
+    raw_path.write_bytes(jsonl_path.read_bytes())
+    meta.create_job("job-json", "dataset-json")
+    run_ingest_job("job-json", "dataset-json", str(dataset_dir), str(raw_path), "jsonl", raw_path.stat().st_size)
+    assert meta.get_job("job-json").status == "succeeded"
+
+    dataset = meta.get_dataset_by_id("dataset-json")
+    assert dataset.upload_type == "jsonl"
+    assert dataset.schema["people"]["address.city"] == "VARCHAR"
+    assert {row["address.city"] for row in sample_rows(dataset, "people", 100, "head")} == {"austin", "boston"}
+
+MYSQL_DUMP = """-- MySQL dump 10.13
+/*!40101 SET NAMES utf8 */;
+DROP TABLE IF EXISTS `customers`;
+CREATE TABLE `customers` (
+  `id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `name` varchar(64) NOT NULL DEFAULT '',
+  `note` text,
+  PRIMARY KEY (`id`),
+  KEY `idx_name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+CREATE TABLE `orders` (
+  `id` int(11) NOT NULL,
+  `customer_id` int(11) DEFAULT NULL,
+  `total` decimal(10,2) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  CONSTRAINT `fk_customer` FOREIGN KEY (`customer_id`) REFERENCES `customers` (`id`)
+) ENGINE=InnoDB;
+LOCK TABLES `customers` WRITE;
+INSERT INTO `customers` VALUES (1,'ada','likes; semicolons'),(2,'o\\'brien','line\\nbreak'),(3,'grace',NULL);
+UNLOCK TABLES;
+# a MySQL comment
+INSERT INTO `orders` (`id`, `customer_id`, `total`) VALUES (1,1,9.50),(2,2,-3.25),(3,1,100);
+CREATE TABLE `order` (
+  `id` int(11) NOT NULL,
+  `line item` varchar(32) DEFAULT NULL
+) ENGINE=InnoDB;
+INSERT INTO `order` VALUES (1,'reserved word');
+"""
+
+PG_DUMP = """--
+-- PostgreSQL database dump
+--
+SET standard_conforming_strings = on;
+CREATE TABLE public.events (
+    id integer NOT NULL,
+    kind character varying(32),
+    path text,
+    CONSTRAINT events_pkey PRIMARY KEY (id)
+);
+COPY public.events (id, kind, path) FROM stdin;
+1\tclick\tC:\\\\temp
+2\tview\t\\N
+\\.
+INSERT INTO public.events VALUES (3, 'it''s', 'C:\\dir');
+SELECT pg_catalog.setval('public.events_id_seq', 3, true);
+"""
+
+def test_sql_dump_ingest(temp_metadata_db, tmp_path):
+    '''
+    test_sql_dump_ingest loads a mysqldump and a pg_dump style dump into SQLite, and checks that chunk boundaries
+    anywhere (inside strings, comments, COPY lines) do not change how the dump is split.
+    '''
+    for dump in (MYSQL_DUMP, PG_DUMP):
+        whole = list(SqlDumpReader(io.BytesIO(dump.encode()), chunk_bytes=1 << 20))
+        assert list(SqlDumpReader(io.BytesIO(dump.encode()), chunk_bytes=3)) == whole
+
+    dump_path = tmp_path / "shop.sql"
+    dump_path.write_text(MYSQL_DUMP)
+    sqlite_path, stats = sql_dump_to_sqlite(tmp_path, dump_path)
+    assert stats.rows == 7
+    # A reserved word as a table name and a column name with a space.
+    assert get_sqlite_schema(sqlite_path)["order"] == {"id": "INTEGER", "line item": "TEXT"}
+    conn = sqlite3.connect(str(sqlite_path))
+    assert conn.execute("SELECT name, note FROM customers ORDER BY id").fetchall() == [
+        ("ada", "likes; semicolons"), ("o'brien", "line\nbreak"), ("grace", None)
+    ]
+    assert conn.execute("SELECT sum(total) FROM orders").fetchone()[0] == 106.25
+    assert conn.execute("SELECT \"table\", \"from\", \"to\" FROM pragma_foreign_key_list('orders')").fetchall() == [("customers", "customer_id", "id")]
+    conn.close()
+
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    raw_path = dataset_dir / "events.sql"
+    raw_path.write_text(PG_DUMP)
+    meta.create_job("job-sql", "dataset-sql")
+    run_ingest_job("job-sql", "dataset-sql", str(dataset_dir), str(raw_path), "sql", raw_path.stat().st_size, keep_raw=False)
+    job = meta.get_job("job-sql")
+    assert job.status == "succeeded", job.error
+    assert job.ingest_stats.rows == 3
+    assert not raw_path.exists()
+
+    dataset = meta.get_dataset_by_id("dataset-sql")
+    assert dataset.tables == ["events"]
+    assert dataset.schema["events"] == {"id": "INTEGER", "kind": "TEXT", "path": "TEXT"}
+    conn = sqlite3.connect(dataset.dataset_path)
+    assert conn.execute("SELECT kind, path FROM events ORDER BY id").fetchall() == [("click", "C:\\temp"), ("view", None), ("it's", "C:\\dir")]
+    conn.close()
+    assert len(sample_rows(dataset, "events", 10, "head")) == 3
+
+    bad_path = tmp_path / "bad.sql"
+    bad_path.write_text("SET x = 1;")
+    with pytest.raises(ValueError):
+        sql_dump_to_sqlite(tmp_path, bad_path)
+
+def test_convert_sqlite_to_parquet(temp_metadata_db, tmp_path):
+    '''
+    test_convert_sqlite_to_parquet runs a convert job on a saved SQLite dataset and checks that reads switch to the Parquet files,
+    that a table that can not be converted stays on SQLite, and that a fully converted dataset is not attached.
+    '''
+    sqlite_path = tmp_path / "shop.db"
+    dataset = make_sqlite_dataset(sqlite_path, {"orders": 3, "customers": 5})
+    conn = sqlite3.connect(str(sqlite_path))
+    # DuckDB's sqlite scanner fails on a column whose values do not fit its declared type.
+    conn.execute("CREATE TABLE mixed (id INTEGER, value INTEGER)")
+    conn.executemany("INSERT INTO mixed VALUES (?, ?)", [(1, 10), (2, "not a number")])
+    conn.commit()
+    conn.close()
+    dataset.tables = get_sqlite_table_names(sqlite_path)
+    dataset.schema = get_sqlite_schema(sqlite_path)
+    meta.save_metadata(dataset)
+
+    meta.create_job("job-convert", dataset.dataset_id)
+    run_convert_job("job-convert", dataset.dataset_id)
+    job = meta.get_job("job-convert")
+    assert job.status == "succeeded"
+
+    converted = meta.get_dataset_by_id(dataset.dataset_id)
+    assert set(converted.table_paths) == {"orders", "customers"}
+    assert pq.ParquetFile(converted.table_paths["customers"]).metadata.num_rows == 5
+
+    engine = DuckDBEngine(memory_limit="256MB", threads=2)
+    with engine.dataset(converted) as session:
+        assert session.table("orders").startswith("read_parquet(")
+        assert session.cursor.execute(f"SELECT sum(amount) FROM {session.table('orders')}").fetchone()[0] == 4.5
+        assert session.table("mixed").startswith('"ds_')
+
+    # Once every table has a Parquet file the SQLite database is not attached anymore.
+    engine.detach(converted.dataset_id)
+    converted.tables = ["orders", "customers"]
+    with engine.dataset(converted) as session:
+        assert session.cursor.execute(f"SELECT count(*) FROM {session.table('customers')}").fetchone()[0] == 5
+    assert converted.dataset_id not in engine.attached
+    engine.close()
+
+    # Only SQLite datasets can be converted.
+    parquet_dataset = Dataset(dataset_id="csv-dataset", upload_type="csv", raw_byte_size=0, dataset_path="x.parquet", tables=["x"], schema={})
+    meta.save_metadata(parquet_dataset)
+    meta.create_job("job-csv", "csv-dataset")
+    run_convert_job("job-csv", "csv-dataset")
+    assert meta.get_job("job-csv").status == "failed"
+
+def test_parquet_layout(temp_metadata_db, tmp_path):
+    '''
+    test_parquet_layout writes the same CSV with a sorted zstd layout and a partitioned layout (two-pass and streaming),
+    and checks the files, the reads through the engine and that the layout is stored with the dataset.
+    '''
+    raw_path = tmp_path / "sales.csv"
+    lines = ["id,country,amount"] + [f"{i},{['FR', 'US', 'JP'][i % 3]},{(i * 7919) % 10000}" for i in range(10_000)]
+    raw_path.write_text("\n".join(lines) + "\n")
+
+    sorted_dir = tmp_path / "sorted"
+    sorted_layout = ParquetLayout(compression="zstd", compression_level=9, row_group_size=2048, sort_by=["amount"])
+    parquet_path = save_parquet_file(sorted_dir, raw_path, sorted_layout)
+    row_groups = duckdb.execute("""SELECT row_group_id, stats_min_value, stats_max_value, compression FROM parquet_metadata(?)
+                                   WHERE path_in_schema = 'amount' ORDER BY row_group_id""", [str(parquet_path)]).fetchall()
+    assert len(row_groups) > 1
+    assert {row[3] for row in row_groups} == {"ZSTD"}
+    # Sorted rows: every row group starts where the previous one ended.
+    assert all(int(previous[2]) <= int(current[1]) for previous, current in zip(row_groups, row_groups[1:]))
+
+    partitioned_layout = ParquetLayout(partition_by="country")
+    for stream in (False, True):
+        dataset_dir = tmp_path / f"partitioned_{stream}"
+        dataset_dir.mkdir()
+        if stream:
+            with open(raw_path, "rb") as source:
+                parquet_path, _, _ = stream_csv_to_parquet(dataset_dir, source, raw_path.name, keep_raw=False, layout=partitioned_layout)
+        else:
+            parquet_path = save_parquet_file(dataset_dir, raw_path, partitioned_layout)
+        assert parquet_path.is_dir()
+        assert sorted(path.name for path in parquet_path.iterdir()) == ["country=FR", "country=JP", "country=US"]
+        assert count_parquet_rows(parquet_path) == 10_000
+
+    dataset = build_csv_dataset("partitioned", parquet_path, raw_path.stat().st_size, partitioned_layout)
+    assert dataset.tables == ["sales"]
+    assert set(dataset.schema["sales"]) == {"id", "country", "amount"}
+    meta.save_metadata(dataset)
+    saved = meta.get_dataset_by_id("partitioned")
+    assert saved.layout == partitioned_layout
+
+    engine = DuckDBEngine(memory_limit="256MB", threads=2)
+    with engine.dataset(saved) as session:
+        assert session.cursor.execute(f"SELECT count(*) FROM {session.table('sales')} WHERE country = 'JP'").fetchone()[0] == 3333
+    engine.close()
+
+    # A compression level only exists for zstd, and the sort columns must be in the table.
+    with pytest.raises(ValueError):
+        save_parquet_file(tmp_path / "bad", raw_path, ParquetLayout(compression="gzip", compression_level=5))
+    with pytest.raises(ValueError):
+        save_parquet_file(tmp_path / "bad", raw_path, ParquetLayout(sort_by=["missing"]))
+    assert not list((tmp_path / "bad" / "tables").iterdir())
+
+def test_upload_dedup(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_upload_dedup uploads the same CSV twice and checks that the second dataset reuses the files and profile of the first,
+    that other conversion options are not deduplicated, and that the files are only deleted with the last dataset using them.
+    '''
+    monkeypatch.setattr(db_routes, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path / "datasets")
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    content = "name,age\nada,36\ngrace,45\n"
+
+    with TestClient(api) as client:
+        def upload(**params) -> dict:
+            response = client.post("/db/upload_db", params={"background": False, **params}, files={"file": ("people.csv", content)})
+            assert response.status_code == 200, response.text
+            return response.json()
+
+        first = upload()
+        second = upload()
+        assert "deduplicated" not in first and second["deduplicated"] is True
+        # The second upload left no directory of its own.
+        assert sorted(path.name for path in (tmp_path / "datasets").iterdir()) == [first["dataset_id"]]
+
+        first_dataset = meta.get_dataset_by_id(first["dataset_id"])
+        second_dataset = meta.get_dataset_by_id(second["dataset_id"])
+        assert second_dataset.dataset_path == first_dataset.dataset_path
+        assert second_dataset.artifact_key == first_dataset.artifact_key
+        assert meta.get_artifact_refcount(first_dataset.artifact_key) == 2
+        assert meta.get_profile(second["dataset_id"]).dataset_id == second["dataset_id"]
+
+        # The same bytes with another layout are other files.
+        third = upload(compression="zstd")
+        assert "deduplicated" not in third
+
+        assert client.delete(f"/db/datasets/{first['dataset_id']}").json()["files_deleted"] is False
+        assert Path(second_dataset.dataset_path).exists()
+        assert meta.get_artifact_refcount(first_dataset.artifact_key) == 1
+        assert client.delete(f"/db/datasets/{second['dataset_id']}").json()["files_deleted"] is True
+        assert not (tmp_path / "datasets" / first["dataset_id"]).exists()
+        assert meta.get_artifact_refcount(first_dataset.artifact_key) == 0
+        assert client.delete(f"/db/datasets/{second['dataset_id']}").status_code == 404
+
+        # Once every copy is gone the content is converted again.
+        assert "deduplicated" not in upload()
+
+def test_resumable_upload(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_resumable_upload sends a CSV in chunks out of order (one with a wrong checksum first), checks the received ranges,
+    completes the upload into a dataset and checks that an abandoned session is garbage collected with its file.
+    '''
+    monkeypatch.setattr(db_routes, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(db_uploads, "UPLOAD_ROOT", tmp_path / "uploads")
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    content = ("id,name\n" + "".join(f"{i},name_{i}\n" for i in range(1000))).encode()
+    chunk_bytes = 4096
+    chunks = [content[start:start + chunk_bytes] for start in range(0, len(content), chunk_bytes)]
+
+    with TestClient(api) as client:
+        session = client.post("/db/uploads", json={"filename": "people.csv", "total_bytes": len(content), "chunk_bytes": chunk_bytes}).json()
+        upload_id = session["upload_id"]
+        assert session["chunk_count"] == len(chunks) and session["status"] == "open"
+
+        def put(index: int, data: bytes, sha256: str = None):
+            headers = {"X-Chunk-SHA256": sha256} if sha256 else {}
+            return client.put(f"/db/uploads/{upload_id}/chunks/{index}", content=data, headers=headers)
+
+        assert put(1, chunks[1], sha256="0" * 64).status_code == 400
+        assert put(len(chunks), b"x").status_code == 400
+        assert put(0, chunks[0][:-1]).status_code == 400
+        for index in [2, 0, 1]:
+            assert put(index, chunks[index], hashlib.sha256(chunks[index]).hexdigest()).status_code == 200
+
+        state = client.get(f"/db/uploads/{upload_id}").json()
+        assert state["received_chunks"] == [0, 1, 2]
+        assert state["received_ranges"] == [[0, 3 * chunk_bytes]]
+        assert client.post(f"/db/uploads/{upload_id}/complete", params={"background": False}).status_code == 400
+
+        for index in range(3, len(chunks)):
+            assert put(index, chunks[index]).status_code == 200
+        result = client.post(f"/db/uploads/{upload_id}/complete", params={"background": False})
+        assert result.status_code == 200, result.text
+        dataset = meta.get_dataset_by_id(result.json()["dataset_id"])
+        assert count_parquet_rows(Path(dataset.dataset_path)) == 1000
+        assert client.get(f"/db/uploads/{upload_id}").json()["status"] == "completed"
+        assert put(0, chunks[0]).status_code == 409
+        assert not (tmp_path / "uploads" / upload_id).exists()
+
+        # The same file as a plain upload is deduplicated against the resumable one.
+        plain = client.post("/db/upload_db", params={"background": False}, files={"file": ("people.csv", content)}).json()
+        assert plain["deduplicated"] is True
+
+        abandoned = client.post("/db/uploads", json={"filename": "other.csv", "total_bytes": 10, "chunk_bytes": 4}).json()
+        assert (tmp_path / "uploads" / abandoned["upload_id"] / "other.csv").stat().st_size == 10
+        assert db_uploads.gc_upload_sessions(idle_seconds=-1) == 2
+        assert client.get(f"/db/uploads/{abandoned['upload_id']}").status_code == 404
+        assert not (tmp_path / "uploads" / abandoned["upload_id"]).exists()
+
+def test_directory_fingerprint(tmp_path):
+    '''
+    test_directory_fingerprint checks that a partitioned table's fingerprint changes when a file is published into
+    a nested partition directory or removed, and that it only stats the directories.
+    '''
+    table_dir = tmp_path / "table"
+    partition = table_dir / "year=2024" / "month=1"
+    partition.mkdir(parents=True)
+    (partition / "part-0.parquet").write_bytes(b"0")
+
+    def age(path: Path):
+        # Older than anything written next, so a change is seen whatever the file system's mtime resolution.
+        for directory in [path, *(p for p in path.rglob("*") if p.is_dir())]:
+            os.utime(directory, ns=(10**9, 10**9))
+
+    age(table_dir)
+    first = file_fingerprint(table_dir)
+    assert file_fingerprint(table_dir) == first
+
+    # Rewriting a file in place is not seen, files are only ever published by a rename.
+    os.utime(partition / "part-0.parquet", ns=(2 * 10**9, 2 * 10**9))
+    assert file_fingerprint(table_dir) == first
+
+    (tmp_path / "staged.parquet").write_bytes(b"1")
+    (tmp_path / "staged.parquet").rename(partition / "part-1.parquet")
+    published = file_fingerprint(table_dir)
+    assert published != first
+
+    age(table_dir)
+    (partition / "part-0.parquet").unlink()
+    assert file_fingerprint(table_dir) not in (first, published)
+
+    # Another directory with the same mtimes is another table.
+    other_dir = tmp_path / "other"
+    (other_dir / "year=2024" / "month=1").mkdir(parents=True)
+    age(other_dir)
+    assert file_fingerprint(other_dir) != first
+
+def test_append_dataset(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_append_dataset appends batches to a deduplicated CSV dataset and checks that the other dataset sharing its files is unchanged,
+    that the merged profile matches a full profile, that a batch with other columns is refused and that compaction keeps the rows.
+    '''
+    for module in (db_routes, meta, db_append):
+        monkeypatch.setattr(module, "DATA_ROOT", tmp_path / "datasets")
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    content = "id,amount,kind\n1,10.5,a\n2,20.0,b\n3,30.0,a\n"
+
+    with TestClient(api) as client:
+        first = client.post("/db/upload_db", params={"background": False}, files={"file": ("sales.csv", content)}).json()
+        second = client.post("/db/upload_db", params={"background": False}, files={"file": ("sales.csv", content)}).json()
+        assert second["deduplicated"] is True
+
+        response = client.post(f"/db/datasets/{first['dataset_id']}/append", files={"file": ("more.csv", "id,amount,kind\n4,-5.0,c\n5,100.0,a\n")})
+        assert response.status_code == 200, response.text
+        assert response.json()["ingest_stats"]["rows"] == 2
+        batch = [{"id": 6, "amount": 1.0}]
+        assert client.post(f"/db/datasets/{first['dataset_id']}/append", files={"file": ("more.jsonl", json.dumps(batch[0]) + "\n")}).status_code == 200
+        assert client.post(f"/db/datasets/{first['dataset_id']}/append", files={"file": ("bad.csv", "id,price\n7,1\n")}).status_code == 400
+        assert client.post(f"/db/datasets/{first['dataset_id']}/append", files={"file": ("bad.csv", "id,amount,kind\nx,1,a\n")}).status_code == 400
+        assert client.post(f"/db/datasets/{uuid.uuid4()}/append", files={"file": ("more.csv", content)}).status_code == 404
+
+        appended = meta.get_dataset_by_id(first["dataset_id"])
+        shared = meta.get_dataset_by_id(second["dataset_id"])
+        assert appended.artifact_key is None and appended.dataset_path.startswith(str(tmp_path / "datasets" / first["dataset_id"]))
+        assert count_parquet_rows(Path(appended.dataset_path)) == 6
+        assert count_parquet_rows(Path(shared.dataset_path)) == 3
+
+        merged = meta.get_profile(first["dataset_id"]).tables["sales"]
+        full = profile_dataset(appended).tables["sales"]
+        assert merged.row_count == full.row_count == 6
+        for merged_column, full_column in zip(merged.columns, full.columns):
+            assert merged_column.null_count == full_column.null_count
+            assert (merged_column.min, merged_column.max) == (full_column.min, full_column.max)
+            if merged_column.mean is not None:
+                assert merged_column.mean == pytest.approx(full_column.mean)
+                assert merged_column.stddev == pytest.approx(full_column.stddev)
+                assert sum(bin.count for bin in merged_column.histogram) == 6 - merged_column.null_count
+
+        compacted = db_append.compact_dataset(first["dataset_id"])
+        assert len(list(compacted.rglob("*.parquet"))) == 1
+        assert count_parquet_rows(compacted) == 6
+        assert meta.get_dataset_by_id(first["dataset_id"]).dataset_path == str(compacted)
+
+        assert client.delete(f"/db/datasets/{first['dataset_id']}").json()["files_deleted"] is True
+        assert count_parquet_rows(Path(meta.get_dataset_by_id(second["dataset_id"]).dataset_path)) == 3
+
+def test_search_index(temp_metadata_db, tmp_path):
+    '''
+    test_search_index checks that the search index follows save_metadata, clone_dataset and delete_dataset,
+    and that /db/search finds columns by name words, exact name, type and table.
+    '''
+    orders = Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=1, dataset_path=str(tmp_path / "shop.db"),
+                     tables=["orders", "customers"], schema={"orders": {"order_id": "INTEGER", "total": "DECIMAL(18,3)"},
+                                                              "customers": {"customer_id": "INTEGER", "full_name": "TEXT"}})
+    sales = Dataset(dataset_id=str(uuid.uuid4()), upload_type="csv", raw_byte_size=1, dataset_path=str(tmp_path / "sales.parquet"),
+                    tables=["sales"], schema={"sales": {"Customer_ID": "BIGINT", "amount": "DOUBLE"}}, artifact_key="sales-key")
+    meta.save_metadata(orders)
+    meta.save_metadata(sales, tmp_path)
+
+    def dataset_ids(hits) -> set[str]:
+        return {hit.dataset_id for hit in hits}
+
+    assert dataset_ids(meta.search_columns(column="customer_id")) == {orders.dataset_id, sales.dataset_id}
+    assert [(hit.table_name, hit.column_name) for hit in meta.search_columns(column_type="decimal")] == [("orders", "total")]
+    # LIKE wildcards in the type are not wildcards.
+    assert meta.search_columns(column_type="%") == [] and meta.search_columns(column_type="DECIMA_") == []
+    assert [hit.column_name for hit in meta.search_columns(query="cust id", table="customers")] == ["customer_id"]
+    assert [hit.file_name for hit in meta.search_columns(query="sales amount")] == ["sales.parquet"]
+    with pytest.raises(ValueError):
+        meta.search_columns()
+    with pytest.raises(ValueError):
+        meta.search_columns(query="*")
+
+    clone_id = str(uuid.uuid4())
+    meta.clone_dataset("sales-key", clone_id)
+    assert dataset_ids(meta.search_columns(query="amount")) == {sales.dataset_id, clone_id}
+
+    meta.delete_dataset(orders.dataset_id)
+    assert dataset_ids(meta.search_columns(column="customer_id")) == {sales.dataset_id, clone_id}
+
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    with TestClient(api) as client:
+        response = client.get("/db/search", params={"type": "DOUBLE", "limit": 1})
+        assert response.status_code == 200
+        assert len(response.json()) == 1 and response.json()[0]["column_name"] == "amount"
+        assert client.get("/db/search").status_code == 400
+
+def test_rows_viewer(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_rows_viewer pages through a Parquet table (one file, then partitioned) and a SQLite table with cursors,
+    and checks the projection, the filters and the Arrow format.
+    '''
+    monkeypatch.setattr(db_routes, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path / "datasets")
+    api = FastAPI()
+    api.include_router(db_routes.router)
+    content = "id,fare,city\n" + "".join(f"{i},{i * 1.5},{['austin', 'boston', 'chicago'][i % 3]}\n" for i in range(25))
+
+    def read_all(client: TestClient, dataset: dict, table: str, params: dict) -> list[dict]:
+        rows = []
+        cursor = None
+        while True:
+            response = client.get(f"/db/datasets/{dataset['dataset_id']}/tables/{table}/rows", params={**params, **({"cursor": cursor} if cursor else {})})
+            assert response.status_code == 200, response.text
+            page = response.json()
+            assert response.headers.get("X-Next-Cursor") == page["next_cursor"]
+            rows += [dict(zip(page["columns"], values)) for values in zip(*page["data"].values())]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return rows
+
+    with TestClient(api) as client:
+        single = client.post("/db/upload_db", params={"background": False}, files={"file": ("rides.csv", content)}).json()
+        partitioned = client.post("/db/upload_db", params={"background": False, "partition_by": "city"}, files={"file": ("rides.csv", content)}).json()
+
+        rows = read_all(client, single, "rides", {"limit": 10})
+        assert [row["id"] for row in rows] == list(range(25))
+        filtered = read_all(client, single, "rides", {"limit": 3, "columns": ["id"], "where": ["city:eq:boston", "fare:gte:10"]})
+        assert filtered == [{"id": i} for i in range(7, 25, 3)]
+        assert sorted(row["id"] for row in read_all(client, partitioned, "rides", {"limit": 4})) == list(range(25))
+
+        response = client.get(f"/db/datasets/{single['dataset_id']}/tables/rides/rows", params={"format": "arrow", "limit": 5, "cursor": "0:20"})
+        table = ipc.open_stream(response.content).read_all()
+        assert table.column("id").to_pylist() == [20, 21, 22, 23, 24] and "X-Next-Cursor" not in response.headers
+
+        for params in ({"where": "fare:between:1"}, {"columns": "missing"}, {"cursor": "x"}, {"limit": 0}):
+            assert client.get(f"/db/datasets/{single['dataset_id']}/tables/rides/rows", params=params).status_code == 400
+
+        sqlite_path = tmp_path / "shop.db"
+        conn = sqlite3.connect(sqlite_path)
+        conn.execute("CREATE TABLE items (name TEXT, price REAL)")
+        conn.executemany("INSERT INTO items VALUES (?, ?)", [(f"item_{i}", i if i % 5 else None) for i in range(30)])
+        conn.commit()
+        conn.close()
+        shop = Dataset(dataset_id=str(uuid.uuid4()), upload_type="db", raw_byte_size=1, dataset_path=str(sqlite_path),
+                       tables=get_sqlite_table_names(sqlite_path), schema=get_sqlite_schema(sqlite_path))
+        meta.save_metadata(shop)
+        rows = read_all(client, shop.model_dump(), "items", {"limit": 7, "where": ["price:is_null"]})
+        assert [row["name"] for row in rows] == [f"item_{i}" for i in range(0, 30, 5)]
+
+def test_metrics(temp_metadata_db, tmp_path, monkeypatch):
+    '''
+    test_metrics uploads a CSV through the metrics middleware and checks the Server-Timing header of the upload,
+    the Prometheus text of /metrics (stages, rows, bytes and the request by route template), and that nothing is recorded when metrics are off.
+    '''
+    monkeypatch.setattr(db_routes, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(meta, "DATA_ROOT", tmp_path / "datasets")
+    monkeypatch.setattr(db_metrics, "SERVER_TIMING_ENABLED", True)
+    api = FastAPI()
+    api.add_middleware(db_metrics.MetricsMiddleware)
+    api.include_router(db_routes.router)
+    api.include_router(db_metrics.router)
+    content = "name,age\n" + "".join(f"person_{i},{i % 90}\n" for i in range(500))
+
+    def stage_count(stage: str) -> int:
+        counts = db_metrics.STAGE_SECONDS.series.get((stage,))
+        return sum(counts[:-1]) if counts else 0
+
+    with TestClient(api) as client:
+        rows_before = db_metrics.STAGE_ROWS.values.get(("save_parquet",), 0)
+        response = client.post("/db/upload_db", params={"background": False}, files={"file": ("people.csv", content)})
+        assert response.status_code == 200, response.text
+        # The sync route runs on the threadpool, its stages still reach the header of its request.
+        timing = [part.split(";")[0] for part in response.headers["server-timing"].split(", ")]
+        assert timing == ["save_raw", "save_parquet", "schema", "profile", "save_metadata", "total"]
+        assert db_metrics.STAGE_ROWS.values[("save_parquet",)] == rows_before + 500
+
+        dataset_id = response.json()["dataset_id"]
+        assert client.get(f"/db/datasets/{dataset_id}/tables/people/rows", params={"limit": 10}).status_code == 200
+
+        metrics = client.get("/metrics")
+        assert metrics.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = metrics.text.splitlines()
+        assert "# TYPE dataspace_stage_seconds histogram" in lines
+        assert 'dataspace_stage_bytes_total{stage="save_raw"}' in metrics.text
+        # Buckets are cumulative, +Inf is every observation.
+        inf_line = next(line for line in lines if line.startswith('dataspace_stage_seconds_bucket{stage="read_rows",le="+Inf"}'))
+        count_line = next(line for line in lines if line.startswith('dataspace_stage_seconds_count{stage="read_rows"}'))
+        assert inf_line.split()[-1] == count_line.split()[-1]
+        # One series per route, not per dataset id.
+        assert 'dataspace_http_request_seconds_count{method="GET",route="/db/datasets/{dataset_id}/tables/{table_name}/rows",status="200"}' in metrics.text
+        assert dataset_id not in metrics.text
+
+        monkeypatch.setattr(db_metrics, "METRICS_ENABLED", False)
+        before = stage_count("read_rows")
+        assert client.get(f"/db/datasets/{dataset_id}/tables/people/rows", params={"limit": 10}).status_code == 200
+        assert stage_count("read_rows") == before
+
 if __name__ == "__main__":
     test_get_sample_rows_sql()
 
@@ -1,7 +1,19 @@
 import { type ChangeEvent, useState } from 'react'
 import axios from 'axios';
 
-type UploadStatus = "idle" | "uploading" | "success" | "error";
+type UploadStatus = "idle" | "uploading" | "processing" | "success" | "error";
+
+// The state of a background ingest job, returned by /db/jobs/{job_id}.
+type IngestJob = {
+  job_id: string;
+  dataset_id: string;
+  status: "queued" | "running" | "succeeded" | "failed";
+  percent: number;
+  error: string | null;
+};
+
+// How often to poll the ingest job while the file is converted.
+const JOB_POLL_MS = 1000;
 
 function Upload() {
 
@@ -9,6 +21,8 @@ function Upload() {
     const [file, setFile] = useState<File | null>(null);
     const [status, setStatus] = useState<UploadStatus>("idle")
     const [pct, setUploadProgress] = useState(0);
+    const [jobPct, setJobProgress] = useState(0);
+    const [error, setError] = useState<string | null>(null);
 
 
     function handleFileChange(e: ChangeEvent<HTMLInputElement>) {
@@ -18,11 +32,26 @@ function Upload() {
       }
     }
 
+    // The upload returns a job_id (202) while the file is converted in the background, poll it until it is done.
+    async function waitForJob(jobId: string) {
+      setStatus("processing");
+      while (true) {
+        const response = await axios.get<IngestJob>(`http://localhost:8000/db/jobs/${jobId}`);
+        const job = response.data;
+        setJobProgress(Math.round(job.percent));
+        if (job.status === "succeeded") return;
+        if (job.status === "failed") throw new Error(job.error ?? "Conversion failed");
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_MS));
+      }
+    }
+
     async function handleFileUpload() {
       // No file detected
       if (!file) return;
       // We are actually uploading the file now. 
       setStatus("uploading");
+      setJobProgress(0);
+      setError(null);
 
       // Now convert it to form data as we are going to be sending it to the backend server
       // Need to add authentification token here.
@@ -40,9 +69,19 @@ function Upload() {
         });
 
         console.log(response.data);
+        if (response.data.job_id) {
+          await waitForJob(response.data.job_id);
+        }
         setStatus("success");
       
       } catch(e) {
+        // Show the reason the server gave (HTTP error detail, or the error of the failed job).
+        if (axios.isAxiosError<{ detail?: unknown }>(e)) {
+          const detail = e.response?.data?.detail;
+          setError(typeof detail === "string" ? detail : e.message);
+        } else if (e instanceof Error) {
+          setError(e.message);
+        }
         setStatus("error");
       };
     }
@@ -59,10 +98,11 @@ function Upload() {
         </div>
       )}
       {/* Dont want to render button if we are already uploading. */}
-      {file && status !== "uploading" && <button className="bg-blue-500 text-white px-4 py-2 rounded-md" onClick={handleFileUpload}>Upload</button>}
+      {file && status !== "uploading" && status !== "processing" && <button className="bg-blue-500 text-white px-4 py-2 rounded-md" onClick={handleFileUpload}>Upload</button>}
       {status === "success" && <p className="text-green-500">File uploaded successfully</p>}
-      {status === "error" && <p className="text-red-500">File upload failed</p>}
+      {status === "error" && <p className="text-red-500">File upload failed{error && `: ${error}`}</p>}
       {status === "uploading" && <p className="text-yellow-500">Uploading... {pct}%</p>}
+      {status === "processing" && <p className="text-yellow-500">Converting... {jobPct}%</p>}
     </div>
     
   )